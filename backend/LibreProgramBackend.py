@@ -1,4 +1,4 @@
-from flask import Flask, request, make_response, jsonify
+from flask import Flask, Blueprint, Response, request, make_response, jsonify, g, current_app, send_file, stream_with_context
 from flask_cors import CORS
 import sqlite3
 import os
@@ -6,6 +6,7 @@ import json
 import jwt
 import datetime
 import hashlib
+import hmac
 from functools import wraps
 import time
 import logging
@@ -13,184 +14,1077 @@ from logging.handlers import RotatingFileHandler
 import re
 from collections import defaultdict, deque
 import threading
+import atexit
+import sys
+import itertools
+import gc
+
+from json_provider import FastJSONProvider
+from compression import ResponseCompressor
+from write_behind import WriteBehindBuffer
+from db_writer import DatabaseWriter
+from media_proxy import MediaProxy, ProxyError
+from hls_cache import SegmentCache, UncacheableResponse, cache_kind, KIND_MANIFEST, KIND_SEGMENT, SEGMENT_MIMETYPES
+from hls_playlist import PlaylistCache, SegmentPrefetcher
+from video_sources import SearchAggregator, DetailService, DEFAULT_API_SITES
+from douban import DoubanService, DoubanUnavailable
+from events import EventHub, EventLog, HubFull, init_event_log
+from user_index import UserIndex
+from ttl_cache import TTLCache
+from fast_path import FastPathMiddleware, parse_origin_max_age
+from bulk_transfer import EXPORT_KINDS, InvalidRecord, export_ndjson, import_ndjson
+from backup import BackupManager, BackupRunning
+from sharding import Shard, open_db, shard_index, shard_path
+from traffic_capture import TrafficRecorder
+from memory_diagnostics import AllocationTracer, SnapshotNotFound, gc_stats, process_memory, top_types
+from history_retention import (CompactionRunning, HistoryCompactor, RetentionPolicy, database_usage,
+                               storage_usage)
+from admission import (AdmissionController, Overloaded, PRIORITY_BULK, PRIORITY_LOGIN, PRIORITY_READ,
+                       PRIORITY_REFRESH, parse_bulkheads)
+from library_index import (KIND_FAVORITE, KIND_HISTORY, continue_watching_from_history, init_library_index,
+                           query_continue_watching, search_library)
+
+
+def load_config(app):
+    """从环境变量加载默认配置"""
+    # 设置 JSON 编码为 UTF-8（由 FastJSONProvider 读取）
+    app.config['JSON_AS_ASCII'] = False
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    app.config['JSONIFY_MIMETYPE'] = 'application/json; charset=utf-8'
+
+    # 配置
+    app.config['SECRET_KEY'] = os.environ.get(
+        'JWT_SECRET_KEY', '88366ca6e0a15c8d113028498a7f44b9cabed3ead55dcfeb68021da278c9fe3e')
+    app.config['REFRESH_SECRET_KEY'] = os.environ.get(
+        'JWT_REFRESH_SECRET_KEY', 'a1b2c3d4e5f6g7h8i9j0k1l2m3n4o5p6q7r8s9t0u1v2w3x4y5z6a7b8c9d0e1f')
+    app.config['JWT_ALGORITHM'] = 'HS256'
+    app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] = 5  # Access Token 5分钟过期
+    app.config['REFRESH_TOKEN_EXPIRATION_DAYS'] = 7  # Refresh Token 7天过期
+
+    # 新增：数据库与日志配置
+    app.config['DB_PATH'] = os.environ.get('DB_PATH', 'data/libretv.db')  # ':memory:' 表示进程内独立的内存数据库
+    app.config['LOG_DIR'] = os.environ.get('LOG_DIR', 'logs')  # 设为空字符串则不写日志文件
+
+    # 新增：Cookie配置
+    app.config['COOKIE_SECURE'] = os.environ.get('COOKIE_SECURE', 'false').lower() == 'true'  # 生产环境设为True
+    app.config['COOKIE_DOMAIN'] = os.environ.get('COOKIE_DOMAIN', None)  # 生产环境设置域名
+
+    # 新增：限流配置
+    app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    app.config['USER_RATE_LIMIT'] = int(os.environ.get('USER_RATE_LIMIT', 5))  # 用户每秒请求数限制
+    app.config['API_RATE_LIMIT'] = int(os.environ.get('API_RATE_LIMIT', 15))   # 接口每秒请求数限制
+    app.config['RATE_LIMIT_WINDOW'] = int(os.environ.get('RATE_LIMIT_WINDOW', 1))  # 限流窗口大小（秒）
+    app.config['RATE_LIMIT_PRUNE_INTERVAL'] = float(os.environ.get('RATE_LIMIT_PRUNE_INTERVAL', 60))  # 清理空闲限流key的间隔（秒）
+
+    # 新增：响应压缩配置
+    app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))  # 小于该字节数的响应不压缩
+    app.config['COMPRESSION_CACHE_MAX_BYTES'] = int(os.environ.get('COMPRESSION_CACHE_MAX_BYTES', 32 * 1024 * 1024))  # 压缩结果缓存上限
+
+    # 新增：观看历史写回缓冲配置
+    app.config['HISTORY_WRITE_BEHIND_ENABLED'] = os.environ.get('HISTORY_WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+    app.config['HISTORY_FLUSH_INTERVAL'] = float(os.environ.get('HISTORY_FLUSH_INTERVAL', 2))  # 落库间隔（秒）
+    app.config['HISTORY_MAX_PENDING'] = int(os.environ.get('HISTORY_MAX_PENDING', 500))  # 积压条数达到该值时立即落库
+
+    # 新增：单写线程配置
+    app.config['DB_WRITER_MAX_BATCH'] = int(os.environ.get('DB_WRITER_MAX_BATCH', 256))  # 每个事务最多合并的写操作数
+
+    # 新增：流式媒体代理配置
+    app.config['PROXY_MAX_CONNECTIONS_PER_HOST'] = int(os.environ.get('PROXY_MAX_CONNECTIONS_PER_HOST', 8))  # 每个上游主机的并发上限
+    app.config['PROXY_MAX_IDLE_PER_HOST'] = int(os.environ.get('PROXY_MAX_IDLE_PER_HOST', 4))  # 每个上游主机保留的空闲连接数
+    app.config['PROXY_TIMEOUT'] = float(os.environ.get('PROXY_TIMEOUT', 10))  # 上游连接/读取超时（秒）
+    app.config['PROXY_ACQUIRE_TIMEOUT'] = float(os.environ.get('PROXY_ACQUIRE_TIMEOUT', 5))  # 等待并发名额的超时（秒）
+    app.config['PROXY_CHUNK_SIZE'] = int(os.environ.get('PROXY_CHUNK_SIZE', 64 * 1024))  # 响应体转发块大小
+    app.config['PROXY_BLOCKED_HOSTS'] = os.environ.get('PROXY_BLOCKED_HOSTS', 'localhost,127.0.0.1')  # 禁止代理的主机，逗号分隔
+    # 默认只连接公网地址；允许代理的内网网段（CIDR），逗号分隔
+    app.config['PROXY_ALLOWED_NETWORKS'] = os.environ.get('PROXY_ALLOWED_NETWORKS', '')
+    app.config['PROXY_VERIFY_SSL'] = os.environ.get('PROXY_VERIFY_SSL', 'true').lower() == 'true'
+
+    # 新增：服务端HLS缓存配置
+    app.config['HLS_CACHE_ENABLED'] = os.environ.get('HLS_CACHE_ENABLED', 'true').lower() == 'true'
+    app.config['HLS_CACHE_DIR'] = os.environ.get('HLS_CACHE_DIR', 'data/hls-cache')
+    app.config['HLS_CACHE_MAX_BYTES'] = int(os.environ.get('HLS_CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # 磁盘缓存总上限
+    app.config['HLS_CACHE_MAX_ENTRIES'] = int(os.environ.get('HLS_CACHE_MAX_ENTRIES', 65536))  # 索引槽位数
+    app.config['HLS_CACHE_MAX_OBJECT_BYTES'] = int(os.environ.get('HLS_CACHE_MAX_OBJECT_BYTES', 32 * 1024 * 1024))  # 单文件上限
+    app.config['HLS_SEGMENT_TTL'] = int(os.environ.get('HLS_SEGMENT_TTL', 24 * 3600))  # 分片缓存时间（秒）
+    app.config['HLS_MANIFEST_TTL'] = int(os.environ.get('HLS_MANIFEST_TTL', 3600))  # 点播播放列表缓存时间（秒）
+    app.config['HLS_LIVE_MANIFEST_TTL'] = int(os.environ.get('HLS_LIVE_MANIFEST_TTL', 2))  # 直播播放列表缓存时间（秒）
+    app.config['HLS_REWRITE_ENABLED'] = os.environ.get('HLS_REWRITE_ENABLED', 'true').lower() == 'true'  # 播放列表URI改写为代理地址
+    # 改写后的URI前缀，须由反向代理转发到本服务的 /proxy/ 路由；为空时使用本服务的 /proxy/
+    app.config['HLS_PROXY_PREFIX'] = os.environ.get('HLS_PROXY_PREFIX', '')
+    app.config['HLS_PLAYLIST_CACHE_SIZE'] = int(os.environ.get('HLS_PLAYLIST_CACHE_SIZE', 256))  # 解析结果缓存条数
+    app.config['HLS_PREFETCH_SEGMENTS'] = int(os.environ.get('HLS_PREFETCH_SEGMENTS', 3))  # 预取后续分片数，0为关闭
+    app.config['HLS_PREFETCH_WORKERS'] = int(os.environ.get('HLS_PREFETCH_WORKERS', 2))  # 预取线程数
+    app.config['HLS_PREFETCH_MAX_PENDING'] = int(os.environ.get('HLS_PREFETCH_MAX_PENDING', 32))  # 预取队列上限
+
+    # 新增：聚合搜索配置（与 js/config.js 的 AGGREGATED_SEARCH_CONFIG 对应）
+    app.config['API_SITES'] = dict(DEFAULT_API_SITES)
+    app.config['SEARCH_SOURCE_TIMEOUT'] = float(os.environ.get('SEARCH_SOURCE_TIMEOUT', 8))  # 单个源超时（秒）
+    app.config['SEARCH_MAX_WORKERS'] = int(os.environ.get('SEARCH_MAX_WORKERS', 16))  # 并发请求源的线程数（不少于源的数量）
+    app.config['SEARCH_QUEUE_TIMEOUT'] = float(os.environ.get('SEARCH_QUEUE_TIMEOUT', 2))  # 源在线程池中排队的最长时间（秒），超过后不再请求
+    app.config['SEARCH_MAX_RESULTS'] = int(os.environ.get('SEARCH_MAX_RESULTS', 10000))  # 最大结果数量
+    app.config['SEARCH_CACHE_TTL'] = int(os.environ.get('SEARCH_CACHE_TTL', 600))  # 全部源成功时的缓存时间（秒）
+    app.config['SEARCH_PARTIAL_CACHE_TTL'] = int(os.environ.get('SEARCH_PARTIAL_CACHE_TTL', 60))  # 部分源失败时的缓存时间（秒）
+    app.config['SEARCH_CACHE_MAX_ENTRIES'] = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 1000))
+    app.config['SEARCH_BREAKER_THRESHOLD'] = int(os.environ.get('SEARCH_BREAKER_THRESHOLD', 3))  # 连续失败几次后熔断
+    app.config['SEARCH_BREAKER_RESET'] = int(os.environ.get('SEARCH_BREAKER_RESET', 60))  # 熔断冷却时间（秒）
+
+    # 新增：视频详情缓存配置
+    app.config['DETAIL_TIMEOUT'] = float(os.environ.get('DETAIL_TIMEOUT', 10))  # 详情请求超时（秒）
+    app.config['DETAIL_MAX_WORKERS'] = int(os.environ.get('DETAIL_MAX_WORKERS', 8))
+    app.config['DETAIL_MAX_BATCH'] = int(os.environ.get('DETAIL_MAX_BATCH', 20))  # 每次 ids=a,b,c 请求的ID数上限
+    app.config['DETAIL_MAX_ITEMS'] = int(os.environ.get('DETAIL_MAX_ITEMS', 50))  # 批量接口单次查询上限
+    app.config['DETAIL_CACHE_TTL'] = int(os.environ.get('DETAIL_CACHE_TTL', 1800))  # 详情新鲜时间（秒）
+    app.config['DETAIL_STALE_TTL'] = int(os.environ.get('DETAIL_STALE_TTL', 24 * 3600))  # 过期后仍可返回旧值的时间（秒）
+    app.config['DETAIL_CACHE_MAX_ENTRIES'] = int(os.environ.get('DETAIL_CACHE_MAX_ENTRIES', 5000))
+
+    # 新增：豆瓣数据缓存配置
+    app.config['DOUBAN_BASE_URL'] = os.environ.get('DOUBAN_BASE_URL', 'https://movie.douban.com')
+    app.config['DOUBAN_TAGS_TTL'] = int(os.environ.get('DOUBAN_TAGS_TTL', 6 * 3600))  # 标签列表缓存时间（秒）
+    app.config['DOUBAN_PAGE_TTL'] = int(os.environ.get('DOUBAN_PAGE_TTL', 1800))  # 推荐页缓存时间（秒）
+    app.config['DOUBAN_STALE_TTL'] = int(os.environ.get('DOUBAN_STALE_TTL', 24 * 3600))  # 过期后仍可返回旧值的时间（秒）
+    app.config['DOUBAN_CACHE_MAX_ENTRIES'] = int(os.environ.get('DOUBAN_CACHE_MAX_ENTRIES', 2000))
+    app.config['DOUBAN_POSTER_MAX_ENTRIES'] = int(os.environ.get('DOUBAN_POSTER_MAX_ENTRIES', 20000))
+    app.config['DOUBAN_BUDGET_PER_MINUTE'] = int(os.environ.get('DOUBAN_BUDGET_PER_MINUTE', 60))  # 每分钟最多请求豆瓣次数
+    app.config['DOUBAN_REFRESH_ENABLED'] = os.environ.get('DOUBAN_REFRESH_ENABLED', 'true').lower() == 'true'
+    app.config['DOUBAN_REFRESH_INTERVAL'] = int(os.environ.get('DOUBAN_REFRESH_INTERVAL', 300))  # 后台刷新周期（秒）
+    app.config['DOUBAN_REFRESH_TOP'] = int(os.environ.get('DOUBAN_REFRESH_TOP', 20))  # 每轮刷新的热门页面数
+
+    # 新增：多端同步事件流（SSE）配置
+    app.config['EVENTS_ENABLED'] = os.environ.get('EVENTS_ENABLED', 'true').lower() == 'true'
+    app.config['EVENTS_HEARTBEAT'] = float(os.environ.get('EVENTS_HEARTBEAT', 15))  # 心跳间隔（秒）
+    app.config['EVENTS_MAX_SUBSCRIBERS'] = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', 5000))  # 进程内连接数上限
+    app.config['EVENTS_MAX_PER_USER'] = int(os.environ.get('EVENTS_MAX_PER_USER', 5))  # 每个用户连接数上限
+    app.config['EVENTS_HISTORY_SIZE'] = int(os.environ.get('EVENTS_HISTORY_SIZE', 100))  # 每个用户保留的补发事件数
+    app.config['EVENTS_QUEUE_SIZE'] = int(os.environ.get('EVENTS_QUEUE_SIZE', 256))  # 单个连接积压上限
+    app.config['EVENTS_POLL_INTERVAL'] = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))  # 读取其它进程事件的间隔（秒）
+    app.config['EVENTS_RETENTION'] = int(os.environ.get('EVENTS_RETENTION', 3600))  # 事件表保留时间（秒），更早断开的客户端重连后全量同步
+
+    # 新增：页面加载聚合接口配置
+    app.config['BOOTSTRAP_MAX_KEYS'] = int(os.environ.get('BOOTSTRAP_MAX_KEYS', 200))  # 每类key数量上限
+
+    # 新增：片库搜索配置
+    app.config['LIBRARY_SEARCH_PAGE_SIZE'] = int(os.environ.get('LIBRARY_SEARCH_PAGE_SIZE', 20))  # 默认每页条数
+    app.config['LIBRARY_SEARCH_MAX_PAGE_SIZE'] = int(os.environ.get('LIBRARY_SEARCH_MAX_PAGE_SIZE', 100))  # 每页条数上限
+    app.config['LIBRARY_SEARCH_MAX_QUERY'] = int(os.environ.get('LIBRARY_SEARCH_MAX_QUERY', 50))  # 查询词长度上限
+    app.config['CONTINUE_WATCHING_LIMIT'] = int(os.environ.get('CONTINUE_WATCHING_LIMIT', 10))  # 继续观看默认条数
+    app.config['CONTINUE_WATCHING_MAX_LIMIT'] = int(os.environ.get('CONTINUE_WATCHING_MAX_LIMIT', 50))  # 继续观看条数上限
+
+    # 新增：用户名/邮箱存在性索引（布隆过滤器）配置
+    app.config['USER_INDEX_ENABLED'] = os.environ.get('USER_INDEX_ENABLED', 'true').lower() == 'true'
+    app.config['USER_INDEX_CAPACITY'] = int(os.environ.get('USER_INDEX_CAPACITY', 100000))  # 初始容量（用户名+邮箱个数）
+    app.config['USER_INDEX_ERROR_RATE'] = float(os.environ.get('USER_INDEX_ERROR_RATE', 0.01))  # 误判率
+    # 补充其它进程新注册用户的最短间隔（秒），期间判断不存在只查内存
+    app.config['USER_INDEX_SYNC_INTERVAL'] = float(os.environ.get('USER_INDEX_SYNC_INTERVAL', 1.0))
+    app.config['LOGIN_ATTEMPTS_CLEANUP_INTERVAL'] = float(os.environ.get('LOGIN_ATTEMPTS_CLEANUP_INTERVAL', 10))  # 清理过期登录尝试记录的间隔（秒）
+
+    # 新增：用户记录缓存配置（多进程部署时各进程独立缓存，TTL即其它进程写入后的最长可见延迟）
+    app.config['USER_CACHE_ENABLED'] = os.environ.get('USER_CACHE_ENABLED', 'true').lower() == 'true'
+    app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))  # 缓存有效期（秒）
+    app.config['USER_CACHE_MAX_ENTRIES'] = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 20000))  # 最多缓存的记录数
+
+    # 新增：管理接口令牌，未设置时所有 /api/admin/ 接口不可用
+    app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN', '')
+
+    # 新增：准入控制配置（优先级：refresh > login > read > bulk）
+    app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+    app.config['ADMISSION_BULKHEADS'] = os.environ.get('ADMISSION_BULKHEADS', 'refresh=32,login=16,read=64,bulk=16')  # 各类并发上限
+    app.config['ADMISSION_LATENCY_TARGET_MS'] = float(os.environ.get('ADMISSION_LATENCY_TARGET_MS', 200))  # 本地接口处理时间目标
+    app.config['ADMISSION_QUEUE_TARGET_MS'] = float(os.environ.get('ADMISSION_QUEUE_TARGET_MS', 50))  # 排队时间目标
+    app.config['ADMISSION_QUEUE_TIMEOUT'] = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1))  # 隔舱已满时最长排队时间（秒）
+    app.config['ADMISSION_INTERVAL'] = float(os.environ.get('ADMISSION_INTERVAL', 1))  # 卸载等级调整间隔（秒）
+    app.config['ADMISSION_MAX_INFLIGHT'] = int(os.environ.get('ADMISSION_MAX_INFLIGHT', 128))  # 进行中请求数目标
+
+    # 新增：CORS预检与健康检查快速路径配置
+    app.config['FAST_PATH_ENABLED'] = os.environ.get('FAST_PATH_ENABLED', 'true').lower() == 'true'
+    app.config['CORS_PREFLIGHT_MAX_AGE'] = int(os.environ.get('CORS_PREFLIGHT_MAX_AGE', 7200))  # 预检缓存时间（秒），0为不缓存；Chrome上限7200
+    app.config['CORS_PREFLIGHT_MAX_AGE_ORIGINS'] = os.environ.get('CORS_PREFLIGHT_MAX_AGE_ORIGINS', '')  # 按来源覆盖，如 https://a.example=86400
+
+    # 新增：批量导入配置
+    app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 50000))  # 每个事务写入的行数
+    app.config['IMPORT_MAX_BATCH_SIZE'] = int(os.environ.get('IMPORT_MAX_BATCH_SIZE', 200000))
+
+    # 新增：数据库在线备份配置
+    app.config['BACKUP_ENABLED'] = os.environ.get('BACKUP_ENABLED', 'false').lower() == 'true'  # 定期备份；关闭时仍可通过管理接口手动备份
+    app.config['BACKUP_DIR'] = os.environ.get('BACKUP_DIR', 'data/backups')
+    app.config['BACKUP_INTERVAL'] = float(os.environ.get('BACKUP_INTERVAL', 24 * 3600))  # 定期备份间隔（秒）
+    app.config['BACKUP_RETENTION'] = int(os.environ.get('BACKUP_RETENTION', 7))  # 保留的备份个数
+    app.config['BACKUP_PAGES_PER_STEP'] = int(os.environ.get('BACKUP_PAGES_PER_STEP', 1024))  # 每步复制的页数
+    app.config['BACKUP_STEP_SLEEP'] = float(os.environ.get('BACKUP_STEP_SLEEP', 0.005))  # 每步之间的休眠（秒）
+    app.config['BACKUP_COMPRESS'] = os.environ.get('BACKUP_COMPRESS', 'true').lower() == 'true'  # gzip压缩备份
+    app.config['BACKUP_SHIP_DIR'] = os.environ.get('BACKUP_SHIP_DIR', '')  # 备份完成后复制到该目录，空为不复制
+
+    # 新增：按用户分片存储配置
+    # 观看历史、收藏和刷新令牌按用户ID分散到多个数据库文件，每个文件一个写线程；1为不分片
+    # 修改分片数后需先停止服务，执行 python sharding.py rebalance <DB_PATH> --from 旧值 --to 新值
+    app.config['SHARD_COUNT'] = int(os.environ.get('SHARD_COUNT', 1))
+
+    # 新增：观看历史保留策略配置（0为不限制）
+    app.config['HISTORY_MAX_ITEMS'] = int(os.environ.get('HISTORY_MAX_ITEMS', 200))  # 每个key最多保留的条目数
+    app.config['HISTORY_MAX_AGE_DAYS'] = float(os.environ.get('HISTORY_MAX_AGE_DAYS', 0))  # 最长保留天数
+    app.config['HISTORY_MAX_BYTES'] = int(os.environ.get('HISTORY_MAX_BYTES', 2 * 1024 * 1024))  # 单个key序列化后的最大字节数
+    app.config['HISTORY_COMPACT_ENABLED'] = os.environ.get('HISTORY_COMPACT_ENABLED', 'true').lower() == 'true'  # 定期按策略裁剪已保存的历史
+    app.config['HISTORY_COMPACT_INTERVAL'] = float(os.environ.get('HISTORY_COMPACT_INTERVAL', 24 * 3600))  # 压缩间隔（秒）
+    app.config['HISTORY_COMPACT_BATCH_SIZE'] = int(os.environ.get('HISTORY_COMPACT_BATCH_SIZE', 500))  # 每次读取和提交的行数
+
+    # 新增：流量采集配置（默认关闭，采集结果用 traffic_replay.py 回放）
+    app.config['TRAFFIC_CAPTURE_ENABLED'] = os.environ.get('TRAFFIC_CAPTURE_ENABLED', 'false').lower() == 'true'
+    app.config['TRAFFIC_CAPTURE_PATH'] = os.environ.get('TRAFFIC_CAPTURE_PATH', 'data/traffic-{pid}.ndjson.gz')  # 每个进程一个文件
+    app.config['TRAFFIC_CAPTURE_SAMPLE_RATE'] = float(os.environ.get('TRAFFIC_CAPTURE_SAMPLE_RATE', 1.0))  # 采样比例
+    app.config['TRAFFIC_CAPTURE_USER_BUCKETS'] = int(os.environ.get('TRAFFIC_CAPTURE_USER_BUCKETS', 1024))  # 用户匿名分桶数
+    app.config['TRAFFIC_CAPTURE_MAX_BYTES'] = int(os.environ.get('TRAFFIC_CAPTURE_MAX_BYTES', 256 * 1024 * 1024))  # 文件上限，达到后停止采集
+
+    # 新增：内存诊断配置（管理接口按需拍 tracemalloc 快照）
+    app.config['MEMORY_TRACE_FRAMES'] = int(os.environ.get('MEMORY_TRACE_FRAMES', 1))  # 每次分配记录的调用栈深度
+    app.config['MEMORY_MAX_SNAPSHOTS'] = int(os.environ.get('MEMORY_MAX_SNAPSHOTS', 5))  # 保留的快照数
 
 
-app = Flask(__name__)
-CORS(app)
-
-# 配置日志
-if not os.path.exists('logs'):
-    os.makedirs('logs')
-
-# 创建日志记录器
-handler = RotatingFileHandler('logs/app.log', maxBytes=10240, backupCount=10)
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-))
-handler.setLevel(logging.INFO)
-app.logger.addHandler(handler)
-app.logger.setLevel(logging.INFO)
-
-app.logger.info('应用启动')
+# 初始化数据库
 
-# 设置 JSON 编码为 UTF-8
-app.config['JSON_AS_ASCII'] = False
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
-app.config['JSONIFY_MIMETYPE'] = 'application/json; charset=utf-8'
 
-# 配置
-app.config['SECRET_KEY'] = os.environ.get(
-    'JWT_SECRET_KEY', '88366ca6e0a15c8d113028498a7f44b9cabed3ead55dcfeb68021da278c9fe3e')
-app.config['REFRESH_SECRET_KEY'] = os.environ.get(
-    'JWT_REFRESH_SECRET_KEY', 'a1b2c3d4e5f6g7h8i9j0k1l2m3n4o5p6q7r8s9t0u1v2w3x4y5z6a7b8c9d0e1f')
-app.config['JWT_ALGORITHM'] = 'HS256'
-app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] = 5  # Access Token 5分钟过期
-app.config['REFRESH_TOKEN_EXPIRATION_DAYS'] = 7  # Refresh Token 7天过期
+def init_db(conn):
+    # 新建的库启用增量 vacuum，历史压缩后可以归还空闲页（已有表的库上不生效）
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    # 用户表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            email TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            login_attempts INTEGER DEFAULT 0,
+            locked_until TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1
+        )
+    ''')
+
+    # 登录尝试记录表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS login_attempts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ip_address TEXT NOT NULL,
+            username TEXT,
+            attempt_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            success BOOLEAN DEFAULT 0
+        )
+    ''')
 
-# 新增：Cookie配置
-app.config['COOKIE_SECURE'] = os.environ.get('COOKIE_SECURE', 'false').lower() == 'true'  # 生产环境设为True
-app.config['COOKIE_DOMAIN'] = os.environ.get('COOKIE_DOMAIN', None)  # 生产环境设置域名
+    # 按IP统计注册/登录频率
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_login_attempts_ip ON login_attempts (ip_address, attempt_time)')
 
-# 新增：限流配置
-app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
-app.config['USER_RATE_LIMIT'] = int(os.environ.get('USER_RATE_LIMIT', 5))  # 用户每秒请求数限制
-app.config['API_RATE_LIMIT'] = int(os.environ.get('API_RATE_LIMIT', 15))   # 接口每秒请求数限制
-app.config['RATE_LIMIT_WINDOW'] = int(os.environ.get('RATE_LIMIT_WINDOW', 1))  # 限流窗口大小（秒）
+    # 多端同步事件表，所有工作进程共享
+    init_event_log(conn)
 
-DB_PATH = 'data/libretv.db'
-os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    # 主库同时是0号分片
+    init_user_tables(conn)
 
-# 初始化数据库
+    conn.commit()
 
 
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        # 用户表
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                email TEXT UNIQUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP,
-                login_attempts INTEGER DEFAULT 0,
-                locked_until TIMESTAMP,
-                is_active BOOLEAN DEFAULT 1
-            )
-        ''')
-
-        # 刷新令牌表
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS refresh_tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                token_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP NOT NULL,
-                revoked BOOLEAN DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-
-        # 登录尝试记录表
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS login_attempts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ip_address TEXT NOT NULL,
-                username TEXT,
-                attempt_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                success BOOLEAN DEFAULT 0
-            )
-        ''')
-
-        # 观看历史表
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS viewing_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                key TEXT NOT NULL,
-                data TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(user_id, key)
-            )
-        ''')
-
-        # 用户收藏表
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_favorites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                key TEXT NOT NULL,
-                data TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(user_id, key)
-            )
-        ''')
+def init_user_tables(conn):
+    """按用户分片的表：刷新令牌、观看历史、收藏及片库索引（主库和每个分片文件都有）"""
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
 
-        conn.commit()
+    # 刷新令牌表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            revoked BOOLEAN DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # 观看历史表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS viewing_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, key)
+        )
+    ''')
+    # 旧库补上写入时间列（不同工作进程的写回缓冲按它决定覆盖顺序）
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(viewing_history)')}
+    if 'updated_at' not in columns:
+        conn.execute('ALTER TABLE viewing_history ADD COLUMN updated_at REAL NOT NULL DEFAULT 0')
+
+    # 用户收藏表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_favorites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, key)
+        )
+    ''')
 
+    # 收藏和观看历史标题的搜索索引，由触发器随写入同步
+    init_library_index(conn)
 
-init_db()
 
 # 限流器实现
 class RateLimiter:
-    def __init__(self, window_size=1):
+    def __init__(self, window_size=1, prune_interval=60):
         self.window_size = window_size
         self.user_requests = defaultdict(lambda: deque())
         self.api_requests = defaultdict(lambda: deque())
         self.lock = threading.Lock()
+        # 定期删除窗口内没有请求的key，否则每个出现过的用户都会永久占用一个deque
+        self.prune_interval = prune_interval
+        self.last_prune = time.time()
+        self.pruned_keys = 0
     
     def _cleanup_old_requests(self, requests_deque, current_time):
         """清理过期的请求记录"""
         while requests_deque and requests_deque[0] < current_time - self.window_size:
             requests_deque.popleft()
+
+    def _prune(self, current_time):
+        """删除窗口内已没有请求的key（调用方持有锁）"""
+        for requests in (self.user_requests, self.api_requests):
+            for key in list(requests):
+                self._cleanup_old_requests(requests[key], current_time)
+                if not requests[key]:
+                    del requests[key]
+                    self.pruned_keys += 1
+        self.last_prune = current_time
     
-    def is_allowed(self, key, requests_deque, limit):
-        """检查是否允许请求"""
+    def is_allowed(self, requests, key, limit, weight=1):
+        """检查是否允许请求，weight 为该请求占用的配额数"""
         current_time = time.time()
         
         with self.lock:
+            if current_time - self.last_prune >= self.prune_interval:
+                self._prune(current_time)
+            # 在锁内取deque，避免取到刚被删除的key
+            requests_deque = requests[key]
             self._cleanup_old_requests(requests_deque, current_time)
             
-            if len(requests_deque) >= limit:
+            if len(requests_deque) + weight > limit:
                 return False
             
-            requests_deque.append(current_time)
+            requests_deque.extend([current_time] * weight)
             return True
     
-    def check_user_rate_limit(self, user_id, limit):
+    def check_user_rate_limit(self, user_id, limit, weight=1):
         """检查用户限流"""
-        key = f"user_{user_id}"
-        return self.is_allowed(key, self.user_requests[key], limit)
+        return self.is_allowed(self.user_requests, f"user_{user_id}", limit, weight)
     
-    def check_api_rate_limit(self, endpoint, limit):
+    def check_api_rate_limit(self, endpoint, limit, weight=1):
         """检查接口限流"""
-        key = f"api_{endpoint}"
-        return self.is_allowed(key, self.api_requests[key], limit)
+        return self.is_allowed(self.api_requests, f"api_{endpoint}", limit, weight)
+
+    def _request_count(self, requests, key):
+        current_time = time.time()
+
+        with self.lock:
+            # 查询不创建key
+            requests_deque = requests.get(key)
+            if requests_deque is None:
+                return 0
+            self._cleanup_old_requests(requests_deque, current_time)
+            return len(requests_deque)
     
     def get_user_request_count(self, user_id):
         """获取用户当前窗口内的请求数"""
-        key = f"user_{user_id}"
-        current_time = time.time()
-        
-        with self.lock:
-            self._cleanup_old_requests(self.user_requests[key], current_time)
-            return len(self.user_requests[key])
+        return self._request_count(self.user_requests, f"user_{user_id}")
     
     def get_api_request_count(self, endpoint):
         """获取接口当前窗口内的请求数"""
-        key = f"api_{endpoint}"
-        current_time = time.time()
-        
+        return self._request_count(self.api_requests, f"api_{endpoint}")
+
+    def prune(self):
+        """立即删除空闲的key，返回剩余的key数"""
+        with self.lock:
+            self._prune(time.time())
+            return len(self.user_requests) + len(self.api_requests)
+
+    def stats(self):
+        with self.lock:
+            lengths = [len(requests_deque) for requests in (self.user_requests, self.api_requests)
+                       for requests_deque in requests.values()]
+            return {
+                'user_keys': len(self.user_requests),
+                'api_keys': len(self.api_requests),
+                'timestamps': sum(lengths),
+                'max_deque': max(lengths, default=0),
+                'pruned_keys': self.pruned_keys,
+                'last_prune': int(self.last_prune)
+            }
+
+# 内存数据库编号，保证同一进程内每个应用实例使用独立的内存数据库
+_memory_db_ids = itertools.count(1)
+
+
+class AppResources:
+    """
+    应用级资源，全部在首次使用时创建
+    导入模块和创建应用都不做磁盘I/O，也不启动线程，便于预加载后fork工作进程
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.RLock()
+        self.logging_ready = False
+        self.db_ready = False
+        self.memory_anchor = None
+        self._rate_limiter = None
+        self._compressor = None
+        self._db_writer = None
+        self._history_buffer = None
+        self._media_proxy = None
+        self._hls_cache = None
+        self.hls_cache_failed = False
+        self._playlist_cache = None
+        self._segment_prefetcher = None
+        self._search_aggregator = None
+        self._detail_service = None
+        self._douban = None
+        self._events = None
+        self._user_index = None
+        self._user_cache = None
+        self._admission = None
+        self.fast_path = None
+        self._backup = None
+        self._shards = None
+        self._history_compactor = None
+        self._traffic_recorder = None
+        self._memory_tracer = None
+        self.history_policy = RetentionPolicy(
+            max_items=app.config['HISTORY_MAX_ITEMS'],
+            max_age=app.config['HISTORY_MAX_AGE_DAYS'] * 86400,
+            max_bytes=app.config['HISTORY_MAX_BYTES']
+        )
+        self.background_started = False
+        self.attempts_cleaned_at = 0.0
+        self.exit_hook_registered = False
+
+        db_path = app.config['DB_PATH']
+        if db_path == ':memory:':
+            # 共享缓存的命名内存库：同一实例的多个连接看到同一份数据
+            self.db_uri = f'file:libretv-memdb-{os.getpid()}-{next(_memory_db_ids)}?mode=memory&cache=shared'
+            self.is_memory = True
+        else:
+            self.db_uri = db_path
+            self.is_memory = False
+
+    def setup_logging(self):
+        """首次请求时安装文件日志处理器"""
+        if self.logging_ready:
+            return
+        with self.lock:
+            if self.logging_ready:
+                return
+            log_dir = self.app.config['LOG_DIR']
+            if log_dir:
+                os.makedirs(log_dir, exist_ok=True)
+                # 创建日志记录器
+                handler = RotatingFileHandler(os.path.join(log_dir, 'app.log'), maxBytes=10240, backupCount=10)
+                handler.setFormatter(logging.Formatter(
+                    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+                ))
+                handler.setLevel(logging.INFO)
+                self.app.logger.addHandler(handler)
+            self.app.logger.setLevel(logging.INFO)
+            self.app.logger.info('应用启动')
+            self.logging_ready = True
+
+    def start_background_jobs(self):
+        """首次请求时启动已启用的定期任务（数据库备份、观看历史压缩）"""
+        if self.background_started:
+            return
+        with self.lock:
+            if self.background_started:
+                return
+            if self.app.config['BACKUP_ENABLED']:
+                self.backup
+            if self.app.config['HISTORY_COMPACT_ENABLED']:
+                self.history_compactor
+            self.background_started = True
+
+    def _open(self):
+        return open_db(self.db_uri, self.is_memory)
+
+    def ensure_db(self):
+        """首次使用数据库时创建目录和表结构"""
+        if self.db_ready:
+            return
         with self.lock:
-            self._cleanup_old_requests(self.api_requests[key], current_time)
-            return len(self.api_requests[key])
+            if self.db_ready:
+                return
+            if self.is_memory:
+                # 内存库在最后一个连接关闭时销毁，保留一个连接维持其生命周期
+                self.memory_anchor = self._open()
+                init_db(self.memory_anchor)
+            else:
+                db_dir = os.path.dirname(self.db_uri)
+                if db_dir:
+                    os.makedirs(db_dir, exist_ok=True)
+                with sqlite3.connect(self.db_uri) as conn:
+                    init_db(conn)
+            self.db_ready = True
+
+    def connect(self):
+        """获取一个读连接"""
+        self.ensure_db()
+        return self._open()
+
+    def _register_exit_hook(self):
+        if not self.exit_hook_registered:
+            atexit.register(self.close)
+            self.exit_hook_registered = True
+
+    @property
+    def rate_limiter(self):
+        if self._rate_limiter is None:
+            with self.lock:
+                if self._rate_limiter is None:
+                    self._rate_limiter = RateLimiter(window_size=self.app.config['RATE_LIMIT_WINDOW'],
+                                                     prune_interval=self.app.config['RATE_LIMIT_PRUNE_INTERVAL'])
+        return self._rate_limiter
+
+    @property
+    def compressor(self):
+        if self._compressor is None:
+            with self.lock:
+                if self._compressor is None:
+                    self._compressor = ResponseCompressor(
+                        min_size=self.app.config['COMPRESSION_MIN_SIZE'],
+                        cache_max_bytes=self.app.config['COMPRESSION_CACHE_MAX_BYTES']
+                    )
+        return self._compressor
+
+    @property
+    def db_writer(self):
+        """单写线程，所有写操作经由它合并提交"""
+        if self._db_writer is None:
+            with self.lock:
+                if self._db_writer is None:
+                    self.ensure_db()
+                    writer = DatabaseWriter(
+                        self.db_uri,
+                        max_batch=self.app.config['DB_WRITER_MAX_BATCH'],
+                        logger=self.app.logger,
+                        uri=self.is_memory
+                    )
+                    writer.start()
+                    self._db_writer = writer
+                    self._register_exit_hook()
+        return self._db_writer
+
+    @property
+    def shards(self):
+        """用户数据分片列表，0号分片是主库自身（与分片一样提供 connect() 和 db_writer）"""
+        if self._shards is None:
+            with self.lock:
+                if self._shards is None:
+                    shards = [self]
+                    for index in range(1, max(1, self.app.config['SHARD_COUNT'])):
+                        if self.is_memory:
+                            uri = self.db_uri.replace('?', f'-shard{index}?', 1)
+                        else:
+                            uri = shard_path(self.db_uri, index)
+                        shards.append(Shard(
+                            index, uri, init_user_tables,
+                            is_memory=self.is_memory,
+                            max_batch=self.app.config['DB_WRITER_MAX_BATCH'],
+                            logger=self.app.logger
+                        ))
+                    self._shards = shards
+                    self._register_exit_hook()
+        return self._shards
+
+    def shard_for(self, user_id):
+        """用户的历史、收藏和刷新令牌所在的分片"""
+        shards = self.shards
+        return shards[shard_index(user_id, len(shards))]
+
+    @property
+    def history_buffer(self):
+        """观看历史写回缓冲，进程退出时落库剩余数据"""
+        if self._history_buffer is None:
+            with self.lock:
+                if self._history_buffer is None:
+                    buffer = WriteBehindBuffer(
+                        self.write_viewing_history,
+                        flush_interval=self.app.config['HISTORY_FLUSH_INTERVAL'],
+                        max_pending=self.app.config['HISTORY_MAX_PENDING'],
+                        logger=self.app.logger
+                    )
+                    if self.app.config['HISTORY_WRITE_BEHIND_ENABLED']:
+                        buffer.start()
+                    self._history_buffer = buffer
+                    self._register_exit_hook()
+        return self._history_buffer
+
+    @property
+    def media_proxy(self):
+        """流式媒体代理，按上游主机复用连接"""
+        if self._media_proxy is None:
+            with self.lock:
+                if self._media_proxy is None:
+                    config = self.app.config
+                    self._media_proxy = MediaProxy(
+                        max_per_host=config['PROXY_MAX_CONNECTIONS_PER_HOST'],
+                        max_idle_per_host=config['PROXY_MAX_IDLE_PER_HOST'],
+                        timeout=config['PROXY_TIMEOUT'],
+                        acquire_timeout=config['PROXY_ACQUIRE_TIMEOUT'],
+                        chunk_size=config['PROXY_CHUNK_SIZE'],
+                        blocked_hosts=config['PROXY_BLOCKED_HOSTS'].split(','),
+                        allowed_networks=config['PROXY_ALLOWED_NETWORKS'].split(','),
+                        verify_ssl=config['PROXY_VERIFY_SSL'],
+                        logger=self.app.logger
+                    )
+        return self._media_proxy
+
+    @property
+    def hls_cache(self):
+        """服务端HLS磁盘缓存，未启用或初始化失败时为None"""
+        if self._hls_cache is None and not self.hls_cache_failed and self.app.config['HLS_CACHE_ENABLED']:
+            with self.lock:
+                if self._hls_cache is None and not self.hls_cache_failed:
+                    config = self.app.config
+                    try:
+                        self._hls_cache = SegmentCache(
+                            config['HLS_CACHE_DIR'],
+                            max_bytes=config['HLS_CACHE_MAX_BYTES'],
+                            max_entries=config['HLS_CACHE_MAX_ENTRIES'],
+                            max_object_bytes=config['HLS_CACHE_MAX_OBJECT_BYTES'],
+                            segment_ttl=config['HLS_SEGMENT_TTL'],
+                            manifest_ttl=config['HLS_MANIFEST_TTL'],
+                            live_manifest_ttl=config['HLS_LIVE_MANIFEST_TTL'],
+                            logger=self.app.logger
+                        )
+                    except (OSError, sqlite3.Error) as e:
+                        self.app.logger.warning(f"HLS缓存不可用，直接代理: {str(e)}")
+                        self.hls_cache_failed = True
+        return self._hls_cache
+
+    @property
+    def playlist_cache(self):
+        """M3U8解析结果缓存"""
+        if self._playlist_cache is None:
+            with self.lock:
+                if self._playlist_cache is None:
+                    self._playlist_cache = PlaylistCache(self.app.config['HLS_PLAYLIST_CACHE_SIZE'])
+        return self._playlist_cache
+
+    @property
+    def segment_prefetcher(self):
+        """分片预取线程池，未启用预取或没有HLS缓存时为None"""
+        if self._segment_prefetcher is None and self.app.config['HLS_PREFETCH_SEGMENTS'] > 0:
+            cache = self.hls_cache
+            if cache is None:
+                return None
+            with self.lock:
+                if self._segment_prefetcher is None:
+                    self._segment_prefetcher = SegmentPrefetcher(
+                        cache,
+                        self.fetch_for_cache,
+                        workers=self.app.config['HLS_PREFETCH_WORKERS'],
+                        max_pending=self.app.config['HLS_PREFETCH_MAX_PENDING'],
+                        logger=self.app.logger
+                    )
+        return self._segment_prefetcher
+
+    @property
+    def search_aggregator(self):
+        """视频源聚合搜索"""
+        if self._search_aggregator is None:
+            with self.lock:
+                if self._search_aggregator is None:
+                    config = self.app.config
+                    self._search_aggregator = SearchAggregator(
+                        self.media_proxy,
+                        sites=config['API_SITES'],
+                        timeout=config['SEARCH_SOURCE_TIMEOUT'],
+                        max_workers=config['SEARCH_MAX_WORKERS'],
+                        queue_timeout=config['SEARCH_QUEUE_TIMEOUT'],
+                        cache_ttl=config['SEARCH_CACHE_TTL'],
+                        partial_cache_ttl=config['SEARCH_PARTIAL_CACHE_TTL'],
+                        cache_max_entries=config['SEARCH_CACHE_MAX_ENTRIES'],
+                        max_results=config['SEARCH_MAX_RESULTS'],
+                        breaker_threshold=config['SEARCH_BREAKER_THRESHOLD'],
+                        breaker_reset=config['SEARCH_BREAKER_RESET'],
+                        logger=self.app.logger
+                    )
+        return self._search_aggregator
+
+    @property
+    def detail_service(self):
+        """视频详情查询与缓存"""
+        if self._detail_service is None:
+            with self.lock:
+                if self._detail_service is None:
+                    config = self.app.config
+                    self._detail_service = DetailService(
+                        self.media_proxy,
+                        sites=config['API_SITES'],
+                        timeout=config['DETAIL_TIMEOUT'],
+                        max_workers=config['DETAIL_MAX_WORKERS'],
+                        max_batch=config['DETAIL_MAX_BATCH'],
+                        cache_ttl=config['DETAIL_CACHE_TTL'],
+                        stale_ttl=config['DETAIL_STALE_TTL'],
+                        cache_max_entries=config['DETAIL_CACHE_MAX_ENTRIES'],
+                        logger=self.app.logger
+                    )
+        return self._detail_service
+
+    @property
+    def douban(self):
+        """豆瓣数据缓存，启用后台刷新时启动刷新线程"""
+        if self._douban is None:
+            with self.lock:
+                if self._douban is None:
+                    config = self.app.config
+                    service = DoubanService(
+                        self.media_proxy,
+                        base_url=config['DOUBAN_BASE_URL'],
+                        tags_ttl=config['DOUBAN_TAGS_TTL'],
+                        page_ttl=config['DOUBAN_PAGE_TTL'],
+                        stale_ttl=config['DOUBAN_STALE_TTL'],
+                        max_entries=config['DOUBAN_CACHE_MAX_ENTRIES'],
+                        poster_max_entries=config['DOUBAN_POSTER_MAX_ENTRIES'],
+                        budget_per_minute=config['DOUBAN_BUDGET_PER_MINUTE'],
+                        refresh_interval=config['DOUBAN_REFRESH_INTERVAL'],
+                        refresh_top=config['DOUBAN_REFRESH_TOP'],
+                        logger=self.app.logger
+                    )
+                    if config['DOUBAN_REFRESH_ENABLED']:
+                        service.start()
+                    self._douban = service
+        return self._douban
+
+    def fetch_for_cache(self, url, headers):
+        """向上游请求完整内容用于写入HLS缓存，非200时抛出 UncacheableResponse"""
+        upstream = self.media_proxy.open('GET', url, headers)
+        if upstream.status != 200:
+            raise UncacheableResponse(f'上游返回 {upstream.status}', upstream=upstream)
+        return upstream.iter_chunks()
+
+    @property
+    def events(self):
+        """用户事件分发中心"""
+        if self._events is None:
+            with self.lock:
+                if self._events is None:
+                    config = self.app.config
+                    self._events = EventHub(
+                        EventLog(self.connect, self.db_writer),
+                        max_queue=config['EVENTS_QUEUE_SIZE'],
+                        history_size=config['EVENTS_HISTORY_SIZE'],
+                        max_subscribers=config['EVENTS_MAX_SUBSCRIBERS'],
+                        max_per_user=config['EVENTS_MAX_PER_USER'],
+                        poll_interval=config['EVENTS_POLL_INTERVAL'],
+                        retention=config['EVENTS_RETENTION'],
+                        logger=self.app.logger
+                    )
+        return self._events
+
+    @property
+    def user_index(self):
+        """用户名/邮箱存在性索引，未启用时为None"""
+        if self._user_index is None and self.app.config['USER_INDEX_ENABLED']:
+            with self.lock:
+                if self._user_index is None:
+                    self._user_index = UserIndex(
+                        self.load_user_identities,
+                        count=self.count_user_identities,
+                        load_since=self.load_user_identities_since,
+                        min_capacity=self.app.config['USER_INDEX_CAPACITY'],
+                        error_rate=self.app.config['USER_INDEX_ERROR_RATE'],
+                        sync_interval=self.app.config['USER_INDEX_SYNC_INTERVAL'],
+                        logger=self.app.logger
+                    )
+        return self._user_index
+
+    def load_user_identities(self):
+        """逐行读取全部用户ID、用户名和邮箱，用于构建存在性索引"""
+        conn = self.connect()
+        try:
+            yield from conn.execute('SELECT id, username, email FROM users')
+        finally:
+            conn.close()
+
+    def load_user_identities_since(self, user_id):
+        """ID大于 user_id 的用户（主键范围查询），用于补充其它进程注册的用户；由索引按间隔调用"""
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT id, username, email FROM users WHERE id > ?', (user_id,)).fetchall()
+        finally:
+            conn.close()
+
+    @property
+    def user_cache(self):
+        """用户记录缓存，按 ('id', 用户ID) 和 ('name', 用户名) 两个键保存同一条记录；未启用时为None"""
+        if self._user_cache is None and self.app.config['USER_CACHE_ENABLED']:
+            with self.lock:
+                if self._user_cache is None:
+                    self._user_cache = TTLCache(
+                        max_entries=self.app.config['USER_CACHE_MAX_ENTRIES'] * 2,
+                        ttl=self.app.config['USER_CACHE_TTL']
+                    )
+        return self._user_cache
+
+    @property
+    def admission(self):
+        """准入控制，未启用时为None"""
+        if self._admission is None and self.app.config['ADMISSION_ENABLED']:
+            with self.lock:
+                if self._admission is None:
+                    config = self.app.config
+                    self._admission = AdmissionController(
+                        bulkheads=parse_bulkheads(config['ADMISSION_BULKHEADS']),
+                        latency_target=config['ADMISSION_LATENCY_TARGET_MS'] / 1000,
+                        queue_target=config['ADMISSION_QUEUE_TARGET_MS'] / 1000,
+                        queue_timeout=config['ADMISSION_QUEUE_TIMEOUT'],
+                        interval=config['ADMISSION_INTERVAL'],
+                        max_inflight=config['ADMISSION_MAX_INFLIGHT'],
+                        logger=self.app.logger
+                    )
+        return self._admission
+
+    @property
+    def backup(self):
+        """数据库在线备份，启用定期备份时首次访问即启动后台线程"""
+        if self._backup is None:
+            with self.lock:
+                if self._backup is None:
+                    config = self.app.config
+                    self.ensure_db()
+                    for shard in self.shards[1:]:
+                        shard.ensure_db()
+                    backup = BackupManager(
+                        self.db_uri,
+                        config['BACKUP_DIR'],
+                        uri=self.is_memory,
+                        pages_per_step=config['BACKUP_PAGES_PER_STEP'],
+                        step_sleep=config['BACKUP_STEP_SLEEP'],
+                        retention=config['BACKUP_RETENTION'],
+                        compress=config['BACKUP_COMPRESS'],
+                        interval=config['BACKUP_INTERVAL'],
+                        ship_dir=config['BACKUP_SHIP_DIR'],
+                        shard_paths=[shard.uri for shard in self.shards[1:]],
+                        logger=self.app.logger
+                    )
+                    if config['BACKUP_ENABLED']:
+                        backup.start()
+                        self._register_exit_hook()
+                    self._backup = backup
+        return self._backup
+
+    @property
+    def history_compactor(self):
+        """观看历史压缩，启用定期压缩时首次访问即启动后台线程"""
+        if self._history_compactor is None:
+            with self.lock:
+                if self._history_compactor is None:
+                    config = self.app.config
+                    compactor = HistoryCompactor(
+                        self.shards,
+                        self.history_policy,
+                        interval=config['HISTORY_COMPACT_INTERVAL'],
+                        batch_size=config['HISTORY_COMPACT_BATCH_SIZE'],
+                        logger=self.app.logger
+                    )
+                    if config['HISTORY_COMPACT_ENABLED']:
+                        compactor.start()
+                        self._register_exit_hook()
+                    self._history_compactor = compactor
+        return self._history_compactor
+
+    @property
+    def traffic_recorder(self):
+        """流量采集，未启用时为None"""
+        if self._traffic_recorder is None and self.app.config['TRAFFIC_CAPTURE_ENABLED']:
+            with self.lock:
+                if self._traffic_recorder is None:
+                    config = self.app.config
+                    self._traffic_recorder = TrafficRecorder(
+                        config['TRAFFIC_CAPTURE_PATH'],
+                        # 用密钥做分桶的 HMAC 密钥：各工作进程分桶一致，没有密钥无法反查用户
+                        salt=config['SECRET_KEY'],
+                        sample_rate=config['TRAFFIC_CAPTURE_SAMPLE_RATE'],
+                        user_buckets=config['TRAFFIC_CAPTURE_USER_BUCKETS'],
+                        max_bytes=config['TRAFFIC_CAPTURE_MAX_BYTES'],
+                        logger=self.app.logger
+                    )
+                    self._register_exit_hook()
+        return self._traffic_recorder
+
+    @property
+    def memory_tracer(self):
+        if self._memory_tracer is None:
+            with self.lock:
+                if self._memory_tracer is None:
+                    self._memory_tracer = AllocationTracer(frames=self.app.config['MEMORY_TRACE_FRAMES'],
+                                                           max_snapshots=self.app.config['MEMORY_MAX_SNAPSHOTS'])
+        return self._memory_tracer
+
+    def stats(self):
+        """已创建的各组件的运行统计"""
+        components = {
+            'rate_limiter': self._rate_limiter,
+            'db_writer': self._db_writer,
+            'history_buffer': self._history_buffer,
+            'media_proxy': self._media_proxy,
+            'hls_cache': self._hls_cache,
+            'playlist_cache': self._playlist_cache,
+            'segment_prefetcher': self._segment_prefetcher,
+            'search': self._search_aggregator,
+            'detail': self._detail_service,
+            'douban': self._douban,
+            'events': self._events,
+            'user_index': self._user_index,
+            'user_cache': self._user_cache,
+            'admission': self._admission,
+            'fast_path': self.fast_path,
+            'backup': self._backup,
+            'history_compactor': self._history_compactor,
+            'traffic_capture': self._traffic_recorder,
+            'compressor': self._compressor
+        }
+        stats = {name: component.stats() for name, component in components.items() if component is not None}
+        if self.hls_cache_failed:
+            # 缓存目录不可用时所有HLS请求直接代理
+            stats['hls_cache'] = {'available': False}
+        if self._shards is not None and len(self._shards) > 1:
+            # 0号分片即主库，写线程统计见 db_writer
+            stats['shards'] = [shard.stats() for shard in self._shards[1:]]
+        return stats
+
+    def count_user_identities(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COUNT(*) + COUNT(email) FROM users').fetchone()[0]
+        finally:
+            conn.close()
+
+    def publish_event(self, user_id, event_type, data):
+        """写入提交后通知该用户的其它设备"""
+        self.publish_events([(user_id, event_type, data)])
+
+    def publish_events(self, events):
+        """
+        把 [(user_id, type, data)] 写入共享事件表，各工作进程的分发中心轮询后推送给自己的连接
+        数据已经提交，事件写入失败只记录日志，客户端下次重连时按缺口全量同步
+        """
+        if not self.app.config['EVENTS_ENABLED'] or not events:
+            return
+        try:
+            self.events.publish_many(events)
+        except Exception as e:
+            self.app.logger.warning(f"写入同步事件失败: {str(e)}")
+
+    def write_viewing_history(self, items):
+        """
+        批量写入观看历史，items为[(user_id, key, data, written_at), ...]；每个分片一个事务，各分片并行提交
+        已有行的 updated_at 晚于 written_at 时不覆盖：其它工作进程的写回缓冲可能先落库了更新的保存
+        """
+        groups = defaultdict(list)
+        for item in items:
+            groups[self.shard_for(item[0])].append(item)
+        futures = [shard.db_writer.submit(lambda conn, rows=rows: conn.executemany(
+            'INSERT INTO viewing_history (user_id, key, data, updated_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(user_id, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at '
+            'WHERE excluded.updated_at >= viewing_history.updated_at',
+            rows
+        )) for shard, rows in groups.items()]
+        for future in futures:
+            future.result()
+        self.publish_events([(user_id, 'history', {'key': key}) for user_id, key, _, _ in items])
+
+    def close(self):
+        """落库缓冲数据并停止后台线程"""
+        # 写回缓冲的落库线程会发布同步事件（可能需要加锁创建分发中心），在持有锁之前停止它，避免互相等待
+        history_buffer, self._history_buffer = self._history_buffer, None
+        if history_buffer is not None:
+            history_buffer.stop()
+        with self.lock:
+            if self._backup is not None:
+                self._backup.close()
+                self._backup = None
+            if self._history_compactor is not None:
+                self._history_compactor.close()
+                self._history_compactor = None
+            if self._traffic_recorder is not None:
+                self._traffic_recorder.close()
+                self._traffic_recorder = None
+            if self._memory_tracer is not None:
+                self._memory_tracer.stop()
+                self._memory_tracer = None
+            if self._shards is not None:
+                for shard in self._shards[1:]:
+                    shard.close()
+                self._shards = None
+            # 分发中心的轮询线程会清理事件表，在写线程之前关闭
+            if self._events is not None:
+                self._events.close()
+                self._events = None
+            if self._db_writer is not None:
+                self._db_writer.stop()
+                self._db_writer = None
+            if self._media_proxy is not None:
+                self._media_proxy.close()
+                self._media_proxy = None
+            if self._douban is not None:
+                self._douban.close()
+                self._douban = None
+            if self._detail_service is not None:
+                self._detail_service.close()
+                self._detail_service = None
+            if self._search_aggregator is not None:
+                self._search_aggregator.close()
+                self._search_aggregator = None
+            if self._segment_prefetcher is not None:
+                self._segment_prefetcher.close()
+                self._segment_prefetcher = None
+            if self._hls_cache is not None:
+                self._hls_cache.close()
+                self._hls_cache = None
+            if self.memory_anchor is not None:
+                self.memory_anchor.close()
+                self.memory_anchor = None
+                self.db_ready = False
+
+
+def cooperative_server():
+    """是否已由 gevent 打补丁：此时每个请求是一个协程，长连接不占用线程"""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def get_resources():
+    """获取当前应用的资源"""
+    return current_app.extensions['libretv']
+
+
+def connect_db():
+    """获取当前应用的数据库读连接"""
+    return get_resources().connect()
+
+
+def user_shard(user_id):
+    """用户数据所在的分片：历史、收藏和刷新令牌的读连接用 connect()，写入用 db_writer"""
+    return get_resources().shard_for(user_id)
+
+
+api = Blueprint('api', __name__)
 
-# 创建全局限流器实例
-rate_limiter = RateLimiter(window_size=app.config['RATE_LIMIT_WINDOW'])
 
 # 防刷配置
 RATE_LIMIT = {
@@ -214,79 +1108,84 @@ def generate_access_token(user_id, username):
     payload = {
         'user_id': user_id,
         'username': username,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=app.config['ACCESS_TOKEN_EXPIRATION_MINUTES']),
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=current_app.config['ACCESS_TOKEN_EXPIRATION_MINUTES']),
         'iat': datetime.datetime.utcnow(),
         'type': 'access'
     }
-    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm=app.config['JWT_ALGORITHM'])
+    return jwt.encode(payload, current_app.config['SECRET_KEY'], algorithm=current_app.config['JWT_ALGORITHM'])
 
 
 def generate_refresh_token(user_id, username):
     payload = {
         'user_id': user_id,
         'username': username,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(days=app.config['REFRESH_TOKEN_EXPIRATION_DAYS']),
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(days=current_app.config['REFRESH_TOKEN_EXPIRATION_DAYS']),
         'iat': datetime.datetime.utcnow(),
         'type': 'refresh'
     }
-    return jwt.encode(payload, app.config['REFRESH_SECRET_KEY'], algorithm=app.config['JWT_ALGORITHM'])
+    return jwt.encode(payload, current_app.config['REFRESH_SECRET_KEY'], algorithm=current_app.config['JWT_ALGORITHM'])
 
 
 def verify_access_token(token):
     try:
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=[
-                             app.config['JWT_ALGORITHM']])
+        payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=[
+                             current_app.config['JWT_ALGORITHM']])
         if payload.get('type') != 'access':
             return None
         return payload
     except jwt.ExpiredSignatureError:
-        app.logger.warning(f"访问令牌已过期: {token}")
+        current_app.logger.warning(f"访问令牌已过期: {token}")
         return None
     except jwt.InvalidTokenError as e:
-        app.logger.warning(f"无效的访问令牌: {token}, 错误: {str(e)}")
+        current_app.logger.warning(f"无效的访问令牌: {token}, 错误: {str(e)}")
         return None
     except Exception as e:
-        app.logger.error(f"验证访问令牌时出错: {str(e)}")
+        current_app.logger.error(f"验证访问令牌时出错: {str(e)}")
         return None
 
 
 def verify_refresh_token(token):
     try:
-        payload = jwt.decode(token, app.config['REFRESH_SECRET_KEY'], algorithms=[
-                             app.config['JWT_ALGORITHM']])
+        payload = jwt.decode(token, current_app.config['REFRESH_SECRET_KEY'], algorithms=[
+                             current_app.config['JWT_ALGORITHM']])
         if payload.get('type') != 'refresh':
             return None
 
         # 检查令牌是否在数据库中且未撤销
         token_hash = hash_token(token)
-        with sqlite3.connect(DB_PATH) as conn:
+        with user_shard(payload['user_id']).connect() as conn:
             cursor = conn.execute(
                 'SELECT id FROM refresh_tokens WHERE token_hash = ? AND revoked = 0 AND expires_at > ?',
                 (token_hash, datetime.datetime.utcnow().isoformat())
             )
             if not cursor.fetchone():
-                app.logger.warning(f"刷新令牌无效或已撤销: {token_hash}")
+                current_app.logger.warning(f"刷新令牌无效或已撤销: {token_hash}")
                 return None
 
         return payload
     except jwt.ExpiredSignatureError:
-        app.logger.warning(f"刷新令牌已过期: {token}")
+        current_app.logger.warning(f"刷新令牌已过期: {token}")
         return None
     except jwt.InvalidTokenError as e:
-        app.logger.warning(f"无效的刷新令牌: {token}, 错误: {str(e)}")
+        current_app.logger.warning(f"无效的刷新令牌: {token}, 错误: {str(e)}")
         return None
     except Exception as e:
-        app.logger.error(f"验证刷新令牌时出错: {str(e)}")
+        current_app.logger.error(f"验证刷新令牌时出错: {str(e)}")
         return None
 
 
 def check_rate_limit(ip_address, action_type):
-    with sqlite3.connect(DB_PATH) as conn:
-        window_start = datetime.datetime.utcnow(
-        ) - datetime.timedelta(minutes=RATE_LIMIT['window_minutes'])
-        conn.execute(
-            'DELETE FROM login_attempts WHERE attempt_time < ?', (window_start,))
-
+    window_start = datetime.datetime.utcnow(
+    ) - datetime.timedelta(minutes=RATE_LIMIT['window_minutes'])
+    # 清理过期记录不影响计数结果，交给写线程异步执行；按间隔执行，避免每个请求都产生一次写入
+    resources = get_resources()
+    now = time.monotonic()
+    if now - resources.attempts_cleaned_at >= current_app.config['LOGIN_ATTEMPTS_CLEANUP_INTERVAL']:
+        resources.attempts_cleaned_at = now
+        resources.db_writer.submit(lambda conn: conn.execute(
+            'DELETE FROM login_attempts WHERE attempt_time < ?', (window_start,)))
+
+    with connect_db() as conn:
         limit = RATE_LIMIT['login_attempts_per_ip'] if action_type == 'login' else RATE_LIMIT['register_attempts_per_ip']
 
         cursor = conn.execute(
@@ -296,23 +1195,33 @@ def check_rate_limit(ip_address, action_type):
         count = cursor.fetchone()[0]
 
         if count >= limit:
-            app.logger.warning(f"IP {ip_address} 的 {action_type} 请求过于频繁，已限制")
+            current_app.logger.warning(f"IP {ip_address} 的 {action_type} 请求过于频繁，已限制")
 
         return count < limit
 
 
 def record_attempt(ip_address, username, success):
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            'INSERT INTO login_attempts (ip_address, username, success) VALUES (?, ?, ?)',
-            (ip_address, username, success)
-        )
-        conn.commit()
+    get_resources().db_writer.execute(
+        'INSERT INTO login_attempts (ip_address, username, success) VALUES (?, ?, ?)',
+        (ip_address, username, success)
+    )
 
     if success:
-        app.logger.info(f"成功尝试: IP {ip_address}, 用户名 {username}")
+        current_app.logger.info(f"成功尝试: IP {ip_address}, 用户名 {username}")
     else:
-        app.logger.warning(f"失败尝试: IP {ip_address}, 用户名 {username}")
+        current_app.logger.warning(f"失败尝试: IP {ip_address}, 用户名 {username}")
+
+
+def username_might_exist(username, email=None):
+    """用户名或邮箱是否可能已被使用；返回False时无需查询数据库"""
+    index = get_resources().user_index
+    return index is None or index.might_exist(username, email)
+
+
+def record_user_index_false_positive():
+    index = get_resources().user_index
+    if index is not None:
+        index.record_false_positive()
 
 
 def get_client_ip():
@@ -329,7 +1238,7 @@ def set_refresh_token_cookie(response, token):
         secure=False,  # 开发环境设为False，生产环境应设为True
         path='/proxy/api/auth/refresh',  # 确保路径与前端请求路径完全匹配
         samesite='Strict',  # 保持Strict以确保安全性
-        max_age=app.config['REFRESH_TOKEN_EXPIRATION_DAYS'] * 24 * 3600
+        max_age=current_app.config['REFRESH_TOKEN_EXPIRATION_DAYS'] * 24 * 3600
     )
     return response
 
@@ -339,32 +1248,30 @@ def set_access_token_cookie(response, token):
         'accessToken',
         token,
         httponly=True,
-        secure=app.config['COOKIE_SECURE'],
+        secure=current_app.config['COOKIE_SECURE'],
         path='/proxy/api',  # 路径设置为/proxy/api
         samesite='Strict',
-        max_age=app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 5分钟 = 300秒
+        max_age=current_app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 5分钟 = 300秒
     )
     return response
 
 
 def revoke_refresh_tokens(user_id):
     """撤销用户的所有刷新令牌"""
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            'UPDATE refresh_tokens SET revoked = 1 WHERE user_id = ?',
-            (user_id,)
-        )
-        conn.commit()
-    app.logger.info(f"已撤销用户 {user_id} 的所有刷新令牌")
+    user_shard(user_id).db_writer.execute(
+        'UPDATE refresh_tokens SET revoked = 1 WHERE user_id = ?',
+        (user_id,)
+    )
+    current_app.logger.info(f"已撤销用户 {user_id} 的所有刷新令牌")
 
 
 def store_refresh_token(user_id, token):
     """存储刷新令牌的哈希值到数据库"""
     token_hash = hash_token(token)
     expires_at = datetime.datetime.utcnow(
-    ) + datetime.timedelta(days=app.config['REFRESH_TOKEN_EXPIRATION_DAYS'])
+    ) + datetime.timedelta(days=current_app.config['REFRESH_TOKEN_EXPIRATION_DAYS'])
 
-    with sqlite3.connect(DB_PATH) as conn:
+    def rotate(conn):
         # 先撤销用户的所有旧令牌
         conn.execute(
             'UPDATE refresh_tokens SET revoked = 1 WHERE user_id = ?',
@@ -376,8 +1283,54 @@ def store_refresh_token(user_id, token):
             'INSERT INTO refresh_tokens (user_id, token_hash, expires_at) VALUES (?, ?, ?)',
             (user_id, token_hash, expires_at.isoformat())
         )
-        conn.commit()
-    app.logger.info(f"已为用户 {user_id} 存储新的刷新令牌")
+
+    user_shard(user_id).db_writer.run(rotate)
+    current_app.logger.info(f"已为用户 {user_id} 存储新的刷新令牌")
+
+
+def setup_request_logging():
+    """首次请求时初始化文件日志，并启动已启用的定期任务"""
+    resources = get_resources()
+    resources.setup_logging()
+    resources.start_background_jobs()
+
+
+def capture_traffic_start():
+    """启用流量采集时记录请求开始时间"""
+    if current_app.config['TRAFFIC_CAPTURE_ENABLED']:
+        g.capture_started = (time.time(), time.perf_counter())
+
+
+def capture_traffic(response):
+    """记录请求的匿名元数据；在压缩之后执行，响应字节数为实际发送的大小"""
+    started = g.pop('capture_started', None)
+    if started is None or request.path.startswith('/api/admin/'):
+        return response
+    recorder = get_resources().traffic_recorder
+    if recorder is not None:
+        user = getattr(request, 'user', None)
+        recorder.record(
+            started[0],
+            request.method,
+            request.url_rule.rule if request.url_rule is not None else None,
+            response.status_code,
+            time.perf_counter() - started[1],
+            request.content_length or 0,
+            None if response.is_streamed else response.content_length,
+            user['user_id'] if user else None
+        )
+    return response
+
+
+def compress_response(response):
+    """根据Accept-Encoding压缩响应，处理函数可通过g.compression_cache_key指定数据版本"""
+    if not current_app.config['COMPRESSION_ENABLED']:
+        return response
+    return get_resources().compressor.apply(
+        response,
+        request.headers.get('Accept-Encoding', ''),
+        g.get('compression_cache_key')
+    )
 
 # JWT认证装饰器
 def jwt_required(f):
@@ -390,7 +1343,7 @@ def jwt_required(f):
             token = request.headers.get('Authorization')
             # 如果Authorization header中还是没有，则返回401
             if not token:
-                app.logger.warning("请求缺少认证令牌")
+                current_app.logger.warning("请求缺少认证令牌")
                 return jsonify({'error': '缺少认证令牌'}), 401
             if token and token.startswith('Bearer '):
                 token = token[7:]
@@ -401,23 +1354,26 @@ def jwt_required(f):
             return jsonify({'error': '无效或过期的访问令牌'}), 401
 
         request.user = payload
-        app.logger.info(
+        current_app.logger.info(
             f"用户 {payload['username']} (ID: {payload['user_id']}) 认证成功")
         return f(*args, **kwargs)
     return decorated_function
 
 
 # 统一限流装饰器
-def rate_limit(user_limit=None, api_limit=None):
+def rate_limit(user_limit=None, api_limit=None, weight=1, priority=PRIORITY_READ):
     """
     统一限流装饰器
     :param user_limit: 用户限流数量，None表示不进行用户限流
     :param api_limit: 接口限流数量，None表示使用默认配置
+    :param weight: 每次请求占用的用户配额数，合并多个读取的接口按实际开销计费
+    :param priority: 准入控制优先级类别，过载时从最低优先级开始卸载
     """
     def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if not app.config['RATE_LIMIT_ENABLED']:
+        def limited(*args, **kwargs):
+            enabled = current_app.config['RATE_LIMIT_ENABLED']
+            # 关闭限流时仍需对需要用户身份的接口做JWT认证
+            if not enabled and user_limit is None:
                 return f(*args, **kwargs)
             
             endpoint = request.endpoint
@@ -426,13 +1382,13 @@ def rate_limit(user_limit=None, api_limit=None):
             if api_limit is not None:
                 limit = api_limit
             else:
-                limit = app.config['API_RATE_LIMIT']
+                limit = current_app.config['API_RATE_LIMIT']
             
-            if not rate_limiter.check_api_rate_limit(endpoint, limit):
-                app.logger.warning(f"接口 {endpoint} 限流触发，当前请求数: {rate_limiter.get_api_request_count(endpoint)}")
+            if enabled and not get_resources().rate_limiter.check_api_rate_limit(endpoint, limit):
+                current_app.logger.warning(f"接口 {endpoint} 限流触发，当前请求数: {get_resources().rate_limiter.get_api_request_count(endpoint)}")
                 return jsonify({
                     'error': '接口访问过于频繁，请稍后再试',
-                    'retry_after': app.config['RATE_LIMIT_WINDOW']
+                    'retry_after': current_app.config['RATE_LIMIT_WINDOW']
                 }), 429
             
             # 用户维度限流（如果指定了user_limit，则需要JWT认证）
@@ -442,7 +1398,7 @@ def rate_limit(user_limit=None, api_limit=None):
                 if not token:
                     token = request.headers.get('Authorization')
                     if not token:
-                        app.logger.warning("请求缺少认证令牌")
+                        current_app.logger.warning("请求缺少认证令牌")
                         return jsonify({'error': '缺少认证令牌'}), 401
                     if token and token.startswith('Bearer '):
                         token = token[7:]
@@ -457,21 +1413,179 @@ def rate_limit(user_limit=None, api_limit=None):
                 user_id = request.user['user_id']
                 username = request.user['username']
                 
-                if not rate_limiter.check_user_rate_limit(user_id, user_limit):
-                    app.logger.warning(f"用户 {username} (ID: {user_id}) 限流触发，当前请求数: {rate_limiter.get_user_request_count(user_id)}")
+                if enabled and not get_resources().rate_limiter.check_user_rate_limit(user_id, user_limit, weight):
+                    current_app.logger.warning(f"用户 {username} (ID: {user_id}) 限流触发，当前请求数: {get_resources().rate_limiter.get_user_request_count(user_id)}")
                     return jsonify({
                         'error': '用户访问过于频繁，请稍后再试',
-                        'retry_after': app.config['RATE_LIMIT_WINDOW']
+                        'retry_after': current_app.config['RATE_LIMIT_WINDOW']
                     }), 429
                 
-                app.logger.info(f"用户 {username} (ID: {user_id}) 认证成功")
+                current_app.logger.info(f"用户 {username} (ID: {user_id}) 认证成功")
             
             return f(*args, **kwargs)
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # 准入控制在限流和JWT认证之前，过载时被卸载的请求不再消耗任何处理
+            admission = get_resources().admission
+            if admission is None:
+                return limited(*args, **kwargs)
+            try:
+                ticket = admission.acquire(priority)
+            except Overloaded as e:
+                current_app.logger.warning(f"接口 {request.endpoint} 被准入控制拒绝（{priority}）")
+                response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+                response.status_code = 503
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
+            try:
+                return limited(*args, **kwargs)
+            finally:
+                admission.release(ticket)
         return decorated_function
     return decorator
 
 
-@app.route('/api/viewing-history/operation', methods=['GET', 'POST'])
+# 用户记录：登录、刷新令牌、用户信息共用，读取经过缓存，写入在提交后写回缓存
+
+USER_RECORD_FIELDS = ('id', 'username', 'password_hash', 'email', 'created_at', 'last_login',
+                      'login_attempts', 'locked_until', 'is_active')
+
+
+def fetch_user_record(conn, column, value):
+    row = conn.execute(
+        f"SELECT {', '.join(USER_RECORD_FIELDS)} FROM users WHERE {column} = ?", (value,)
+    ).fetchone()
+    return dict(zip(USER_RECORD_FIELDS, row)) if row else None
+
+
+def cache_user_record(record):
+    cache = get_resources().user_cache
+    if cache is not None:
+        cache.put(('id', record['id']), record)
+        cache.put(('name', record['username']), record)
+
+
+def get_user_record(user_id=None, username=None, conn=None):
+    """按用户ID或用户名读取用户记录，缓存未命中时才查询数据库（conn为None时按需打开连接）"""
+    column, value = ('id', user_id) if user_id is not None else ('username', username)
+    cache = get_resources().user_cache
+    if cache is not None:
+        record = cache.get(('id', value) if column == 'id' else ('name', value))
+        if record is not None:
+            return record
+    if conn is None:
+        with connect_db() as conn:
+            record = fetch_user_record(conn, column, value)
+    else:
+        record = fetch_user_record(conn, column, value)
+    if record is not None:
+        cache_user_record(record)
+    return record
+
+
+def write_user_record(user_id, sql, params):
+    """由写线程执行对用户行的写入，并在同一事务内读回该行，提交后写回缓存"""
+    def mutation(conn):
+        cursor = conn.execute(sql, params)
+        return fetch_user_record(conn, 'id', user_id if user_id is not None else cursor.lastrowid)
+
+    record = get_resources().db_writer.run(mutation)
+    if record is not None:
+        cache_user_record(record)
+    return record
+
+
+# 读取查询：单个接口和 /api/bootstrap 共用，调用方负责提供连接
+
+def query_user_info(conn, user_id):
+    """返回用户资料，用户不存在返回None；conn为None时只在缓存未命中时查询数据库"""
+    record = get_user_record(user_id=user_id, conn=conn)
+    if not record:
+        return None
+    return {
+        'id': user_id,
+        'username': record['username'],
+        'email': record['email'],
+        'created_at': record['created_at'],
+        'last_login': record['last_login']
+    }
+
+
+def query_favorites(conn, user_id):
+    """返回 (收藏列表, 版本)"""
+    rows = conn.execute(
+        'SELECT key, data, created_at, id FROM user_favorites WHERE user_id = ? ORDER BY created_at DESC',
+        (user_id,)
+    ).fetchall()
+    favorites = []
+    for row in rows:
+        try:
+            data = current_app.json.loads(row[1])  # 修复：row[1]是data，row[0]是key
+            favorites.append({
+                'key': row[0],
+                'data': data,
+                'created_at': row[2]
+            })
+        except json.JSONDecodeError:
+            continue
+    # 自增id不复用：新增/替换会增大最大id，删除会减少行数，二者组合即为收藏列表的版本
+    return favorites, (len(rows), max((row[3] for row in rows), default=0))
+
+
+def query_favorite_status(conn, user_id, keys):
+    """返回 key -> 是否已收藏"""
+    if not keys:
+        return {}
+    placeholders = ','.join(['?' for _ in keys])
+    cursor = conn.execute(
+        f'SELECT key FROM user_favorites WHERE user_id = ? AND key IN ({placeholders})',
+        [user_id] + keys
+    )
+    favorited_keys = {row[0] for row in cursor.fetchall()}
+    return {key: key in favorited_keys for key in keys}
+
+
+def query_viewing_history(conn, user_id, key):
+    """
+    返回 (data, 版本)，优先读取尚未落库的写入；key不存在返回None
+    conn 为None时只查写回缓冲（命中缓冲时调用方可以不打开连接）
+    """
+    pending = get_resources().history_buffer.get(user_id, key)
+    if pending:
+        data, seq = pending
+        return data, ('history-pending', seq)
+    if conn is None:
+        return None
+    row = conn.execute(
+        'SELECT id, data, updated_at FROM viewing_history WHERE user_id = ? AND key = ?',
+        (user_id, key)
+    ).fetchone()
+    if not row:
+        return None
+    # INSERT OR REPLACE 分配新的自增id，ON CONFLICT DO UPDATE 更新 updated_at，两者合起来作为行版本
+    return row[1], ('history', (row[0], row[2]))
+
+
+def admin_required(f):
+    """
+    管理接口认证：请求头 X-Admin-Token 必须与配置的 ADMIN_TOKEN 一致
+    未配置 ADMIN_TOKEN 时管理接口一律返回404，不暴露其存在
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        admin_token = current_app.config['ADMIN_TOKEN']
+        if not admin_token:
+            return jsonify({'error': '接口不存在'}), 404
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode(), admin_token.encode()):
+            current_app.logger.warning(f"管理接口认证失败: IP {get_client_ip()}")
+            return jsonify({'error': '无效的管理令牌'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@api.route('/api/viewing-history/operation', methods=['GET', 'POST'])
 @rate_limit(user_limit=10, api_limit=25)  # 用户每秒10次，接口每秒25次
 def user_viewing_history():
     try:
@@ -479,22 +1593,23 @@ def user_viewing_history():
         key = request.args.get('key', '').strip()
 
         if not key:
-            app.logger.warning("缺少URL参数key")
+            current_app.logger.warning("缺少URL参数key")
             return jsonify({'error': '缺少URL参数key'}), 400
 
         if request.method == 'GET':
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.execute(
-                    'SELECT data FROM viewing_history WHERE user_id = ? AND key = ?',
-                    (user_id, key)
-                )
-                row = cursor.fetchone()
+            # 优先读取尚未落库的写入
+            result = query_viewing_history(None, user_id, key)
+            if result is None:
+                with user_shard(user_id).connect() as conn:
+                    result = query_viewing_history(conn, user_id, key)
 
-                if not row:
-                    app.logger.warning("该key不存在")
-                    return jsonify({'error': '该key不存在'}), 404
+            if result is None:
+                current_app.logger.warning("该key不存在")
+                return jsonify({'error': '该key不存在'}), 404
 
-                return jsonify({'data': row[0]}), 200
+            data, (kind, version) = result
+            g.compression_cache_key = (kind, user_id, key, version)
+            return jsonify({'data': data}), 200
 
         elif request.method == 'POST':
             if not request.headers.get('Content-Type', '').startswith('application/json'):
@@ -504,12 +1619,19 @@ def user_viewing_history():
             if not data:
                 return jsonify({'error': '请求体不能为空'}), 400
 
-            with sqlite3.connect(DB_PATH) as conn:
-                conn.execute(
-                    'INSERT OR REPLACE INTO viewing_history (user_id, key, data) VALUES (?, ?, ?)',
-                    (user_id, key, json.dumps(data, separators=(',', ':')))
-                )
-                conn.commit()
+            # 按保留策略裁剪：条目数、时间和大小超出部分从最旧的记录开始删除
+            data, removed = get_resources().history_policy.apply(data)
+            if removed:
+                current_app.logger.info(f"用户 {user_id} 的观看历史 {key} 按保留策略删除 {removed} 条")
+            data = current_app.json.dumps(data, sort_keys=False)
+            max_bytes = current_app.config['HISTORY_MAX_BYTES']
+            if max_bytes and len(data.encode('utf-8')) > max_bytes:
+                return jsonify({'error': f'观看历史不能超过 {max_bytes} 字节'}), 413
+            if current_app.config['HISTORY_WRITE_BEHIND_ENABLED']:
+                # 播放过程中会反复保存同一个key，合并后批量落库
+                get_resources().history_buffer.put(user_id, key, data)
+            else:
+                get_resources().write_viewing_history([(user_id, key, data, time.time())])
 
             return jsonify({'message': '保存成功'}), 200
 
@@ -523,8 +1645,8 @@ def is_valid_email(email):
     return re.match(pattern, email) is not None
 
 # 检查用户名是否可用
-@app.route('/api/auth/check-username', methods=['POST'])
-@rate_limit(api_limit=10)  # 仅接口限流，每秒5次
+@api.route('/api/auth/check-username', methods=['POST'])
+@rate_limit(api_limit=10, priority=PRIORITY_LOGIN)  # 仅接口限流，每秒5次
 def check_username():
     try:
         data = request.get_json()
@@ -544,10 +1666,15 @@ def check_username():
         if not check_rate_limit(client_ip, 'register'):
             return jsonify({'error': '请求过于频繁，请稍后再试'}), 429
 
-        with sqlite3.connect(DB_PATH) as conn:
+        if not username_might_exist(username):
+            return jsonify({'username': username, 'available': True}), 200
+
+        with connect_db() as conn:
             cursor = conn.execute(
                 'SELECT id FROM users WHERE username = ?', (username,))
             exists = cursor.fetchone() is not None
+            if not exists:
+                record_user_index_false_positive()
 
             return jsonify({
                 'username': username,
@@ -558,8 +1685,8 @@ def check_username():
         return jsonify({'error': f'检查失败: {str(e)}'}), 500
 
 # 用户注册
-@app.route('/api/auth/register', methods=['POST'])
-@rate_limit(api_limit=5)  # 仅接口限流，每秒3次
+@api.route('/api/auth/register', methods=['POST'])
+@rate_limit(api_limit=5, priority=PRIORITY_LOGIN)  # 仅接口限流，每秒3次
 def register():
     try:
         data = request.get_json()
@@ -567,23 +1694,23 @@ def register():
         password = data.get('password', '')
         email = data.get('email', '').strip()
 
-        app.logger.info(f"注册请求: 用户名 {username}, 邮箱 {email}")
+        current_app.logger.info(f"注册请求: 用户名 {username}, 邮箱 {email}")
 
         if not username or not password:
-            app.logger.warning("注册请求缺少用户名或密码")
+            current_app.logger.warning("注册请求缺少用户名或密码")
             return jsonify({'error': '用户名和密码不能为空'}), 400
 
         # 验证用户名必须是邮箱格式
         if not is_valid_email(username):
-            app.logger.warning(f"用户名格式无效: {username}")
+            current_app.logger.warning(f"用户名格式无效: {username}")
             return jsonify({'error': '用户名必须是有效的邮箱格式'}), 400
 
         if len(username) < 5 or len(username) > 50:
-            app.logger.warning(f"用户名长度不符合要求: {username}")
+            current_app.logger.warning(f"用户名长度不符合要求: {username}")
             return jsonify({'error': '用户名长度必须在5-50个字符之间'}), 400
 
         if len(password) < 6:
-            app.logger.warning("密码长度不符合要求")
+            current_app.logger.warning("密码长度不符合要求")
             return jsonify({'error': '密码长度至少6个字符'}), 400
         # todo 由于客户端目前没设置email输入框 先使用邮箱格式的用户代理email
         if not email:
@@ -593,46 +1720,57 @@ def register():
         if not check_rate_limit(client_ip, 'register'):
             return jsonify({'error': '注册请求过于频繁，请稍后再试'}), 429
 
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.execute(
-                'SELECT id FROM users WHERE username = ?', (username,))
-            if cursor.fetchone():
-                record_attempt(client_ip, username, False)
-                app.logger.warning(f"用户名已存在: {username}")
-                return jsonify({'error': '用户名已存在'}), 409
+        # 验证邮箱格式（如果提供）
+        if email and not is_valid_email(email):
+            current_app.logger.warning(f"邮箱格式无效: {email}")
+            return jsonify({'error': '邮箱格式无效'}), 400
 
-            # 邮箱字段可选，如果提供则检查唯一性
-            if email:  # 只有当提供了email时才检查
-                # 验证邮箱格式（如果提供）
-                if not is_valid_email(email):
-                    app.logger.warning(f"邮箱格式无效: {email}")
-                    return jsonify({'error': '邮箱格式无效'}), 400
-                    
+        with connect_db() as conn:
+            # 索引判断用户名和邮箱都不存在时跳过查询，并发注册由唯一约束兜底
+            if username_might_exist(username, email):
                 cursor = conn.execute(
-                    'SELECT id FROM users WHERE email = ?', (email,))
+                    'SELECT id FROM users WHERE username = ?', (username,))
                 if cursor.fetchone():
                     record_attempt(client_ip, username, False)
-                    app.logger.warning(f"邮箱已被使用: {email}")
-                    return jsonify({'error': '邮箱已被使用'}), 409
+                    current_app.logger.warning(f"用户名已存在: {username}")
+                    return jsonify({'error': '用户名已存在'}), 409
+
+                # 邮箱字段可选，如果提供则检查唯一性
+                if email:  # 只有当提供了email时才检查
+                    cursor = conn.execute(
+                        'SELECT id FROM users WHERE email = ?', (email,))
+                    if cursor.fetchone():
+                        record_attempt(client_ip, username, False)
+                        current_app.logger.warning(f"邮箱已被使用: {email}")
+                        return jsonify({'error': '邮箱已被使用'}), 409
+                record_user_index_false_positive()
 
             password_hash = hash_password(password)
 
             # 根据是否提供email来构建不同的SQL语句
-            if email:
-                cursor = conn.execute(
-                    'INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)',
-                    (username, password_hash, email)
-                )
-            else:
-                cursor = conn.execute(
-                    'INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                    (username, password_hash)
-                )
-
-            user_id = cursor.lastrowid
-            conn.commit()
+            try:
+                if email:
+                    user = write_user_record(
+                        None,
+                        'INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)',
+                        (username, password_hash, email)
+                    )
+                else:
+                    user = write_user_record(
+                        None,
+                        'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                        (username, password_hash)
+                    )
+                user_id = user['id']
+            except sqlite3.IntegrityError:
+                # 并发注册同一用户名/邮箱时由唯一约束兜底
+                record_attempt(client_ip, username, False)
+                current_app.logger.warning(f"用户名或邮箱已存在: {username}")
+                return jsonify({'error': '用户名已存在'}), 409
 
             record_attempt(client_ip, username, True)
+            if get_resources().user_index is not None:
+                get_resources().user_index.add(username, email)
 
             # 生成访问令牌和刷新令牌
             access_token = generate_access_token(user_id, username)
@@ -644,7 +1782,7 @@ def register():
             # 创建响应，只返回过期时间，不返回敏感信息
             response_data = {
                 'message': '注册成功',
-                'expires_in': app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 返回秒数
+                'expires_in': current_app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 返回秒数
             }
 
             response = make_response(jsonify(response_data))
@@ -652,121 +1790,130 @@ def register():
             response = set_refresh_token_cookie(response, refresh_token)
             response = set_access_token_cookie(response, access_token)
 
-            app.logger.info(f"用户注册成功: {username} (ID: {user_id})")
+            current_app.logger.info(f"用户注册成功: {username} (ID: {user_id})")
             return response, 201
 
     except Exception as e:
-        app.logger.error(f"注册过程中出错: {str(e)}")
+        current_app.logger.error(f"注册过程中出错: {str(e)}")
         return jsonify({'error': f'注册失败: {str(e)}'}), 500
 
 
 # 用户登录
-@app.route('/api/auth/login', methods=['POST'])
-@rate_limit(api_limit=5)  # 仅接口限流，每秒5次
+@api.route('/api/auth/login', methods=['POST'])
+@rate_limit(api_limit=5, priority=PRIORITY_LOGIN)  # 仅接口限流，每秒5次
 def login():
     try:
         data = request.get_json()
         username = data.get('username', '').strip()
         password = data.get('password', '')
 
-        app.logger.info(f"登录请求: 用户名 {username}")
+        current_app.logger.info(f"登录请求: 用户名 {username}")
 
         if not username or not password:
-            app.logger.warning("登录请求缺少用户名或密码")
+            current_app.logger.warning("登录请求缺少用户名或密码")
             return jsonify({'error': '用户名和密码不能为空'}), 400
 
         client_ip = get_client_ip()
         if not check_rate_limit(client_ip, 'login'):
             return jsonify({'error': '登录请求过于频繁，请稍后再试'}), 429
 
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.execute(
-                'SELECT id, username, password_hash, login_attempts, locked_until, is_active FROM users WHERE username = ?',
-                (username,)
+        # 禁用和锁定状态以数据库为准：缓存是每个进程各自的，可能早于其它进程写入的锁定
+        with connect_db() as conn:
+            user = fetch_user_record(conn, 'username', username)
+
+        if not user:
+            record_attempt(client_ip, username, False)
+            current_app.logger.warning(f"登录失败: 用户名不存在 {username}")
+            return jsonify({'error': '用户名或密码错误'}), 401
+
+        cache_user_record(user)
+        user_id = user['id']
+        password_hash = user['password_hash']
+        locked_until = user['locked_until']
+        is_active = user['is_active']
+
+        if not is_active:
+            record_attempt(client_ip, username, False)
+            current_app.logger.warning(f"登录失败: 账户已被禁用 {username}")
+            return jsonify({'error': '账户已被禁用'}), 403
+
+        if locked_until and datetime.datetime.utcnow() < datetime.datetime.fromisoformat(locked_until):
+            current_app.logger.warning(f"登录失败: 账户已被锁定 {username}")
+            return jsonify({'error': '账户已被锁定，请稍后再试'}), 423
+
+        if hash_password(password) != password_hash:
+            # 在数据库中累加失败次数，缓存或其它进程中的旧计数不会导致少计
+            lock_until = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
+            updated = write_user_record(
+                user_id,
+                'UPDATE users SET login_attempts = login_attempts + 1, '
+                'locked_until = CASE WHEN login_attempts + 1 >= 5 THEN ? ELSE locked_until END WHERE id = ?',
+                (lock_until.isoformat(), user_id)
             )
-            user = cursor.fetchone()
+            if updated and updated['login_attempts'] >= 5:
+                current_app.logger.warning(f"用户 {username} 因多次失败尝试被锁定")
 
-            if not user:
-                record_attempt(client_ip, username, False)
-                app.logger.warning(f"登录失败: 用户名不存在 {username}")
-                return jsonify({'error': '用户名或密码错误'}), 401
-
-            user_id, db_username, password_hash, login_attempts, locked_until, is_active = user
-
-            if not is_active:
-                record_attempt(client_ip, username, False)
-                app.logger.warning(f"登录失败: 账户已被禁用 {username}")
-                return jsonify({'error': '账户已被禁用'}), 403
-
-            if locked_until and datetime.datetime.utcnow() < datetime.datetime.fromisoformat(locked_until):
-                app.logger.warning(f"登录失败: 账户已被锁定 {username}")
-                return jsonify({'error': '账户已被锁定，请稍后再试'}), 423
-
-            if hash_password(password) != password_hash:
-                new_attempts = login_attempts + 1
-                if new_attempts >= 5:
-                    lock_until = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
-                    conn.execute(
-                        'UPDATE users SET login_attempts = ?, locked_until = ? WHERE id = ?',
-                        (new_attempts, lock_until.isoformat(), user_id)
-                    )
-                    app.logger.warning(f"用户 {username} 因多次失败尝试被锁定")
-                else:
-                    conn.execute(
-                        'UPDATE users SET login_attempts = ? WHERE id = ?',
-                        (new_attempts, user_id)
-                    )
-                conn.commit()
+            record_attempt(client_ip, username, False)
+            current_app.logger.warning(f"登录失败: 密码错误 {username}")
+            return jsonify({'error': '用户名或密码错误'}), 401
 
-                record_attempt(client_ip, username, False)
-                app.logger.warning(f"登录失败: 密码错误 {username}")
-                return jsonify({'error': '用户名或密码错误'}), 401
+        # 在写线程的事务内再次确认未被禁用或锁定再清零计数，读取之后其它进程加上的锁定不会被清除
+        now = datetime.datetime.utcnow().isoformat()
 
-            conn.execute(
-                'UPDATE users SET login_attempts = 0, locked_until = NULL, last_login = ? WHERE id = ?',
-                (datetime.datetime.utcnow().isoformat(), user_id)
+        def reset_attempts(conn):
+            cursor = conn.execute(
+                'UPDATE users SET login_attempts = 0, locked_until = NULL, last_login = ? '
+                'WHERE id = ? AND is_active = 1 AND (locked_until IS NULL OR locked_until <= ?)',
+                (now, user_id, now)
             )
-            conn.commit()
+            return cursor.rowcount, fetch_user_record(conn, 'id', user_id)
 
-            record_attempt(client_ip, username, True)
+        updated, user = get_resources().db_writer.run(reset_attempts)
+        if user is not None:
+            cache_user_record(user)
+        if not updated:
+            current_app.logger.warning(f"登录失败: 账户已被禁用或锁定 {username}")
+            return jsonify({'error': '账户已被锁定，请稍后再试'}), 423
 
-            # 生成访问令牌和刷新令牌
-            access_token = generate_access_token(user_id, username)
-            refresh_token = generate_refresh_token(user_id, username)
+        record_attempt(client_ip, username, True)
 
-            # 存储刷新令牌
-            store_refresh_token(user_id, refresh_token)
+        # 生成访问令牌和刷新令牌
+        access_token = generate_access_token(user_id, username)
+        refresh_token = generate_refresh_token(user_id, username)
 
-            # 创建响应，只返回过期时间，不返回敏感信息
-            response_data = {
-                'message': '登录成功',
-                'expires_in': app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 返回秒数
-            }
+        # 存储刷新令牌
+        store_refresh_token(user_id, refresh_token)
 
-            response = make_response(jsonify(response_data))
-            response.headers['Content-Type'] = 'application/json; charset=utf-8'
-            response = set_refresh_token_cookie(response, refresh_token)
-            response = set_access_token_cookie(response, access_token)
+        # 创建响应，只返回过期时间，不返回敏感信息
+        response_data = {
+            'message': '登录成功',
+            'expires_in': current_app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 返回秒数
+        }
+
+        response = make_response(jsonify(response_data))
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        response = set_refresh_token_cookie(response, refresh_token)
+        response = set_access_token_cookie(response, access_token)
 
-            app.logger.info(f"用户登录成功: {username} (ID: {user_id})")
-            return response, 200
+        current_app.logger.info(f"用户登录成功: {username} (ID: {user_id})")
+        return response, 200
 
     except Exception as e:
-        app.logger.error(f"登录过程中出错: {str(e)}")
+        current_app.logger.error(f"登录过程中出错: {str(e)}")
         return jsonify({'error': f'登录失败: {str(e)}'}), 500
 
 # 刷新令牌
-@app.route('/api/auth/refresh', methods=['POST'])
-@rate_limit(api_limit=10)  # 仅接口限流，每秒10次
+@api.route('/api/auth/refresh', methods=['POST'])
+@rate_limit(api_limit=10, priority=PRIORITY_REFRESH)  # 仅接口限流，每秒10次
 def refresh_token():
     try:
         # 从Cookie中获取刷新令牌
         refresh_token = request.cookies.get('refreshToken')
         if not refresh_token:
-            app.logger.warning("刷新令牌请求缺少Cookie")
+            current_app.logger.warning("刷新令牌请求缺少Cookie")
             return jsonify({'error': '缺少刷新令牌'}), 401
 
-        app.logger.info("收到刷新令牌请求")
+        current_app.logger.info("收到刷新令牌请求")
 
         # 验证刷新令牌
         payload = verify_refresh_token(refresh_token)
@@ -776,16 +1923,11 @@ def refresh_token():
         user_id = payload['user_id']
         username = payload['username']
 
-        # 从数据库获取完整的用户信息
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.execute(
-                'SELECT username, email FROM users WHERE id = ?', (user_id,)
-            )
-            user_data = cursor.fetchone()
-            
-            if not user_data:
-                app.logger.error(f"用户 {user_id} 不存在")
-                return jsonify({'error': '用户不存在'}), 404
+        # 获取完整的用户信息（优先读缓存）
+        user_data = get_user_record(user_id=user_id)
+        if not user_data:
+            current_app.logger.error(f"用户 {user_id} 不存在")
+            return jsonify({'error': '用户不存在'}), 404
 
         # 生成新的访问令牌
         new_access_token = generate_access_token(user_id, username)
@@ -793,29 +1935,29 @@ def refresh_token():
         # 构建用户信息
         user_info = {
             'id': user_id,
-            'username': user_data[0],
-            'email': user_data[1]
+            'username': user_data['username'],
+            'email': user_data['email']
         }
 
         response_data = {
             'message': '令牌刷新成功',
-            'expires_in': app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 返回秒数
+            'expires_in': current_app.config['ACCESS_TOKEN_EXPIRATION_MINUTES'] * 60  # 返回秒数
         }
 
         response = make_response(jsonify(response_data))
         response.headers['Content-Type'] = 'application/json; charset=utf-8'
         response = set_access_token_cookie(response, new_access_token)
 
-        app.logger.info(f"令牌刷新成功: 用户 {username} (ID: {user_id})")
+        current_app.logger.info(f"令牌刷新成功: 用户 {username} (ID: {user_id})")
         return response, 200
 
     except Exception as e:
-        app.logger.error(f"刷新令牌过程中出错: {str(e)}")
+        current_app.logger.error(f"刷新令牌过程中出错: {str(e)}")
         return jsonify({'error': f'令牌刷新失败: {str(e)}'}), 500
 
 # 登出
-@app.route('/api/auth/logout', methods=['POST'])
-@rate_limit(user_limit=1, api_limit=8)  # 用户每秒2次，接口每秒5次
+@api.route('/api/auth/logout', methods=['POST'])
+@rate_limit(user_limit=1, api_limit=8, priority=PRIORITY_LOGIN)  # 用户每秒2次，接口每秒5次
 def logout():
     try:
         user_id = request.user['user_id']
@@ -842,75 +1984,231 @@ def logout():
             path='/proxy/api'
         )
 
-        app.logger.info(f"用户登出成功: {username} (ID: {user_id})")
+        current_app.logger.info(f"用户登出成功: {username} (ID: {user_id})")
         return response, 200
     except Exception as e:
-        app.logger.error(f"登出过程中出错: {str(e)}")
+        current_app.logger.error(f"登出过程中出错: {str(e)}")
         return jsonify({'error': f'登出失败: {str(e)}'}), 500
 
 # 用户详情查询接口
-@app.route('/api/auth/user-info', methods=['GET'])
+@api.route('/api/auth/user-info', methods=['GET'])
 @rate_limit(user_limit=15, api_limit=30)  # 用户每秒15次，接口每秒30次
 def get_user_info():
     try:
         user_id = request.user['user_id']
         
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.execute(
-                'SELECT username, email, created_at, last_login FROM users WHERE id = ?',
-                (user_id,)
-            )
-            user_data = cursor.fetchone()
-            
-            if not user_data:
-                return jsonify({'error': '用户不存在'}), 404
-            
-            username, email, created_at, last_login = user_data
-            
-            return jsonify({
-                'id': user_id,
-                'username': username,
-                'email': email,
-                'created_at': created_at,
-                'last_login': last_login
-            }), 200
+        user_info = query_user_info(None, user_id)
+        
+        if not user_info:
+            return jsonify({'error': '用户不存在'}), 404
+        
+        return jsonify(user_info), 200
             
     except Exception as e:
-        app.logger.error(f"获取用户信息时出错: {str(e)}")
+        current_app.logger.error(f"获取用户信息时出错: {str(e)}")
         return jsonify({'error': f'获取用户信息失败: {str(e)}'}), 500
 
-# 健康检查端点
-@app.route('/api/health', methods=['GET'])
+# 运行统计（管理接口）：各缓存命中率、写线程、代理连接池等
+@api.route('/api/admin/stats', methods=['GET'])
+@admin_required
+def admin_stats():
+    return jsonify(get_resources().stats()), 200
+
+
+# 批量导出（管理接口）：以 NDJSON 流式输出用户、收藏和观看历史，?kinds=users,favorites,history
+@api.route('/api/admin/export', methods=['GET'])
+@admin_required
+def admin_export():
+    kinds = [kind for kind in request.args.get('kinds', ','.join(EXPORT_KINDS)).split(',') if kind in EXPORT_KINDS]
+    if not kinds:
+        return jsonify({'error': f"kinds 可选: {', '.join(EXPORT_KINDS)}"}), 400
+    conn = connect_db()
+    shard_conns = [conn] + [shard.connect() for shard in get_resources().shards[1:]]
+    response = Response(export_ndjson(conn, kinds, shard_conns=shard_conns), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename="libretv-export.ndjson"'
+    # 客户端提前断开时生成器可能未启动，需要显式关闭连接
+    for each in shard_conns:
+        response.call_on_close(each.close)
+    current_app.logger.info(f"开始批量导出: {','.join(kinds)}")
+    return response
+
+
+# 批量导入（管理接口）：请求体为导出的 NDJSON，?import_id= 用于断点续传
+# 导入期间片库索引照常维护；先删除索引、导入后重建只能离线用命令行（bulk_transfer.py import），
+# 在线删除会让片库搜索和继续观看在导入期间报错
+@api.route('/api/admin/import', methods=['POST'])
+@admin_required
+def admin_import():
+    import_id = request.args.get('import_id', '').strip()
+    if not import_id:
+        return jsonify({'error': '缺少 import_id'}), 400
+    if request.args.get('defer_indexes'):
+        return jsonify({'error': 'defer_indexes 只能在停服后用 bulk_transfer.py import 使用'}), 400
+    try:
+        batch_size = int(request.args.get('batch_size', current_app.config['IMPORT_BATCH_SIZE']))
+    except ValueError:
+        return jsonify({'error': 'batch_size 必须是整数'}), 400
+    batch_size = max(1, min(batch_size, current_app.config['IMPORT_MAX_BATCH_SIZE']))
+
+    resources = get_resources()
+    # 先落库写回缓冲中的历史，避免导入后被缓冲里的旧数据覆盖
+    if current_app.config['HISTORY_WRITE_BEHIND_ENABLED']:
+        resources.history_buffer.flush()
+    index = resources.user_index
+
+    def on_users(users):
+        if index is not None:
+            for username, email in users:
+                index.add(username, email)
+
+    try:
+        stats = import_ndjson(request.stream, resources.db_writer.run, import_id, batch_size=batch_size,
+                              on_users=on_users,
+                              shard_runs=[shard.db_writer.run for shard in resources.shards])
+    except InvalidRecord as e:
+        current_app.logger.warning(f"批量导入 {import_id} 失败: {str(e)}")
+        return jsonify({'error': str(e), 'line': e.line}), 400
+    current_app.logger.info(f"批量导入 {import_id} 完成: {stats}")
+    return jsonify(stats), 200
+
+
+# 数据库备份（管理接口）：GET 查看状态和已有备份，POST 立即在后台执行一次备份
+@api.route('/api/admin/backup', methods=['GET', 'POST'])
+@admin_required
+def admin_backup():
+    backup = get_resources().backup
+    if request.method == 'POST':
+        try:
+            backup.trigger()
+        except BackupRunning as e:
+            return jsonify({'error': str(e), 'status': backup.stats()}), 409
+        current_app.logger.info(f"管理接口触发数据库备份: IP {get_client_ip()}")
+        return jsonify({'message': '备份已开始', 'status': backup.stats()}), 202
+    return jsonify(backup.stats()), 200
+
+# 存储用量（管理接口）：GET 按用户统计历史和收藏占用的空间（?limit=），POST 立即在后台执行一次历史压缩
+@api.route('/api/admin/storage', methods=['GET', 'POST'])
+@admin_required
+def admin_storage():
+    resources = get_resources()
+    compactor = resources.history_compactor
+    if request.method == 'POST':
+        try:
+            compactor.trigger()
+        except CompactionRunning as e:
+            return jsonify({'error': str(e), 'compaction': compactor.stats()}), 409
+        current_app.logger.info(f"管理接口触发观看历史压缩: IP {get_client_ip()}")
+        return jsonify({'message': '压缩已开始', 'compaction': compactor.stats()}), 202
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 1000))
+    except ValueError:
+        return jsonify({'error': 'limit必须是整数'}), 400
+    shards, users = [], []
+    for shard in resources.shards:
+        with shard.connect() as conn:
+            shards.append(database_usage(conn))
+            users.extend(storage_usage(conn, limit))
+    users = sorted(users, key=lambda user: user['bytes'], reverse=True)[:limit]
+    for user in users:
+        record = get_user_record(user_id=user['user_id'])
+        user['username'] = record['username'] if record else None
+    return jsonify({'shards': shards, 'users': users, 'compaction': compactor.stats()}), 200
+
+# 内存诊断（管理接口）：进程内存、GC、各组件的大小和快照概况；?types=N 按类型统计存活对象，?collect=1 先执行一次GC
+@api.route('/api/admin/memory', methods=['GET'])
+@admin_required
+def admin_memory():
+    resources = get_resources()
+    try:
+        types = max(0, min(int(request.args.get('types', 0)), 1000))
+    except ValueError:
+        return jsonify({'error': 'types必须是整数'}), 400
+    result = {}
+    if request.args.get('collect') == '1':
+        result['collected'] = gc.collect()
+    # 先清理空闲key，报告的是仍在使用的key数
+    resources.rate_limiter.prune()
+    result.update({
+        'process': process_memory(),
+        'gc': gc_stats(),
+        'threads': threading.active_count(),
+        'components': resources.stats(),
+        'tracemalloc': resources.memory_tracer.stats()
+    })
+    if types:
+        result['types'] = top_types(types)
+    return jsonify(result), 200
+
+
+# tracemalloc 快照（管理接口）：POST 拍快照（第一次同时开始跟踪），GET 列出快照，DELETE 停止跟踪并清除快照
+@api.route('/api/admin/memory/snapshots', methods=['GET', 'POST', 'DELETE'])
+@admin_required
+def admin_memory_snapshots():
+    tracer = get_resources().memory_tracer
+    if request.method == 'POST':
+        snapshot = tracer.take_snapshot()
+        current_app.logger.info(f"管理接口拍摄内存快照 {snapshot['id']}: IP {get_client_ip()}")
+        return jsonify(snapshot), 201
+    if request.method == 'DELETE':
+        tracer.stop()
+        current_app.logger.info(f"管理接口停止内存跟踪: IP {get_client_ip()}")
+    return jsonify(tracer.stats()), 200
+
+
+# 快照按分配位置统计（管理接口）：?base= 与较早的快照比较，?limit= 返回条数，?group_by=lineno|filename|traceback
+@api.route('/api/admin/memory/snapshots/<int:snapshot_id>', methods=['GET'])
+@admin_required
+def admin_memory_snapshot(snapshot_id):
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 500))
+        base_id = int(request.args['base']) if request.args.get('base') else None
+    except ValueError:
+        return jsonify({'error': 'limit和base必须是整数'}), 400
+    try:
+        top = get_resources().memory_tracer.top(snapshot_id, base_id, limit,
+                                                request.args.get('group_by', 'lineno'))
+    except SnapshotNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'snapshot': snapshot_id, 'base': base_id, 'top': top}), 200
+
+# 健康检查端点（启用快速路径时由 FastPathMiddleware 直接应答）
+HEALTH_STATUS = {'status': 'ok', 'message': '服务正常运行'}
+
+
+@api.route('/api/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'ok', 'message': '服务正常运行'})
+    return jsonify(HEALTH_STATUS)
 
 # 限流状态查询接口（仅用于调试）
-@app.route('/api/rate-limit/status', methods=['GET'])
-@rate_limit(user_limit=5, api_limit=10)  # 放宽限制以便调试
+@api.route('/api/rate-limit/status', methods=['GET'])
+@rate_limit(user_limit=5, api_limit=10, priority=PRIORITY_BULK)  # 放宽限制以便调试
 def rate_limit_status():
     try:
         user_id = request.user['user_id']
         endpoint = request.args.get('endpoint', '')
         
         result = {
-            'rate_limit_enabled': app.config['RATE_LIMIT_ENABLED'],
-            'user_rate_limit': app.config['USER_RATE_LIMIT'],
-            'api_rate_limit': app.config['API_RATE_LIMIT'],
-            'window_size': app.config['RATE_LIMIT_WINDOW'],
-            'current_user_requests': rate_limiter.get_user_request_count(user_id)
+            'rate_limit_enabled': current_app.config['RATE_LIMIT_ENABLED'],
+            'user_rate_limit': current_app.config['USER_RATE_LIMIT'],
+            'api_rate_limit': current_app.config['API_RATE_LIMIT'],
+            'window_size': current_app.config['RATE_LIMIT_WINDOW'],
+            'current_user_requests': get_resources().rate_limiter.get_user_request_count(user_id)
         }
         
         if endpoint:
-            result['current_api_requests'] = rate_limiter.get_api_request_count(endpoint)
+            result['current_api_requests'] = get_resources().rate_limiter.get_api_request_count(endpoint)
         
         return jsonify(result), 200
         
     except Exception as e:
-        app.logger.error(f"获取限流状态失败: {str(e)}")
+        current_app.logger.error(f"获取限流状态失败: {str(e)}")
         return jsonify({'error': f'获取限流状态失败: {str(e)}'}), 500
 
 # 用户收藏接口
-@app.route('/api/user-favorites', methods=['GET', 'POST'])
+@api.route('/api/user-favorites', methods=['GET', 'POST'])
 @rate_limit(user_limit=8, api_limit=15)  # 用户每秒8次，接口每秒15次
 def user_favorites():
     try:
@@ -918,23 +2216,10 @@ def user_favorites():
         
         if request.method == 'GET':
             # 获取用户所有收藏
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.execute(
-                    'SELECT key, data, created_at FROM user_favorites WHERE user_id = ? ORDER BY created_at DESC',
-                    (user_id,)
-                )
-                favorites = []
-                for row in cursor.fetchall():
-                    try:
-                        data = json.loads(row[1])  # 修复：row[1]是data，row[0]是key
-                        favorites.append({
-                            'key': row[0],
-                            'data': data,
-                            'created_at': row[2]
-                        })
-                    except json.JSONDecodeError:
-                        continue
-                
+            with user_shard(user_id).connect() as conn:
+                favorites, version = query_favorites(conn, user_id)
+
+                g.compression_cache_key = ('favorites', user_id) + version
                 return jsonify({'favorites': favorites}), 200
                 
         elif request.method == 'POST':
@@ -950,40 +2235,91 @@ def user_favorites():
             if not action or not key:
                 return jsonify({'error': '缺少必要参数'}), 400
                 
-            with sqlite3.connect(DB_PATH) as conn:
-                if action == 'add':
-                    if not video_data:
-                        return jsonify({'error': '添加收藏时视频数据不能为空'}), 400
-                    
-                    # 添加收藏
-                    conn.execute(
-                        'INSERT OR REPLACE INTO user_favorites (user_id, key, data) VALUES (?, ?, ?)',
-                        (user_id, key, json.dumps(video_data, separators=(',', ':')))
-                    )
-                    conn.commit()
-                    app.logger.info(f"用户 {user_id} 添加收藏: {key}")
-                    return jsonify({'message': '收藏成功'}), 200
-                    
-                elif action == 'remove':
-                    # 取消收藏
-                    conn.execute(
-                        'DELETE FROM user_favorites WHERE user_id = ? AND key = ?',
-                        (user_id, key)
-                    )
-                    conn.commit()
-                    app.logger.info(f"用户 {user_id} 取消收藏: {key}")
-                    return jsonify({'message': '取消收藏成功'}), 200
-                    
-                else:
-                    return jsonify({'error': '无效的操作类型'}), 400
+            if action == 'add':
+                if not video_data:
+                    return jsonify({'error': '添加收藏时视频数据不能为空'}), 400
+
+                # 添加收藏
+                user_shard(user_id).db_writer.execute(
+                    'INSERT OR REPLACE INTO user_favorites (user_id, key, data) VALUES (?, ?, ?)',
+                    (user_id, key, current_app.json.dumps(video_data, sort_keys=False))
+                )
+                get_resources().publish_event(user_id, 'favorite', {'action': 'add', 'key': key})
+                current_app.logger.info(f"用户 {user_id} 添加收藏: {key}")
+                return jsonify({'message': '收藏成功'}), 200
+
+            elif action == 'remove':
+                # 取消收藏
+                user_shard(user_id).db_writer.execute(
+                    'DELETE FROM user_favorites WHERE user_id = ? AND key = ?',
+                    (user_id, key)
+                )
+                get_resources().publish_event(user_id, 'favorite', {'action': 'remove', 'key': key})
+                current_app.logger.info(f"用户 {user_id} 取消收藏: {key}")
+                return jsonify({'message': '取消收藏成功'}), 200
+
+            else:
+                return jsonify({'error': '无效的操作类型'}), 400
                     
     except Exception as e:
-        app.logger.error(f"收藏操作失败: {str(e)}")
+        current_app.logger.error(f"收藏操作失败: {str(e)}")
         return jsonify({'error': f'操作失败: {str(e)}'}), 500
 
 
+# 多端同步事件流：观看历史和收藏写入提交后推送变更通知
+@api.route('/api/events', methods=['GET'])
+@rate_limit(user_limit=8, api_limit=50, priority=PRIORITY_BULK)  # 仅限制建立连接：用户每秒8次，接口每秒50次
+def user_events():
+    if not current_app.config['EVENTS_ENABLED']:
+        return jsonify({'error': '事件推送未启用'}), 404
+    # 每个事件流都会一直占住处理它的工作单元，gunicorn 的同步/线程工作进程几个连接就会被占满
+    if request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn') and not cooperative_server():
+        return jsonify({'error': '事件推送未启用：需要 gevent 工作进程（gunicorn -k gevent）'}), 404
+
+    user_id = request.user['user_id']
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    hub = get_resources().events
+    try:
+        subscriber = hub.subscribe(user_id, last_event_id)
+    except HubFull as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+    # 访问令牌过期时结束事件流，客户端刷新令牌后重连
+    expires_at = request.user['exp']
+    dumps = current_app.json.dumps
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while time.time() < expires_at:
+                events = hub.wait(subscriber, min(heartbeat, max(0.0, expires_at - time.time())))
+                if not events:
+                    yield ': ping\n\n'
+                    continue
+                yield ''.join(f'id: {event_id}\nevent: {event_type}\ndata: {dumps(dict(data, version=event_id))}\n\n'
+                              for event_id, event_type, data in events)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    # 生成器未开始迭代就断开时 finally 不会执行，这里再兜底退订一次
+    response.call_on_close(lambda: hub.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 关闭 nginx 缓冲
+    return response
+
+
 # 批量查询收藏状态接口
-@app.route('/api/user-favorites/batch-check', methods=['POST'])
+@api.route('/api/user-favorites/batch-check', methods=['POST'])
 @rate_limit(user_limit=10, api_limit=20)  # 用户每秒10次，接口每秒20次
 def batch_check_favorites():
     try:
@@ -997,25 +2333,398 @@ def batch_check_favorites():
         if not isinstance(keys, list):
             return jsonify({'error': 'keys必须是数组'}), 400
             
-        with sqlite3.connect(DB_PATH) as conn:
-            # 查询用户收藏的keys
-            placeholders = ','.join(['?' for _ in keys])
-            cursor = conn.execute(
-                f'SELECT key FROM user_favorites WHERE user_id = ? AND key IN ({placeholders})',
-                [user_id] + keys
-            )
-            favorited_keys = {row[0] for row in cursor.fetchall()}
-            
+        with user_shard(user_id).connect() as conn:
             # 构建结果：key -> 是否已收藏
-            result = {key: key in favorited_keys for key in keys}
+            result = query_favorite_status(conn, user_id, keys)
             
             return jsonify({'favorites': result}), 200
             
     except Exception as e:
-        app.logger.error(f"批量查询收藏状态失败: {str(e)}")
+        current_app.logger.error(f"批量查询收藏状态失败: {str(e)}")
         return jsonify({'error': f'查询失败: {str(e)}'}), 500
 
+# 页面加载聚合接口：一次请求返回用户信息、收藏列表、收藏状态和观看历史
+# 用户信息来自主库（通常命中缓存），其余部分在用户所在分片的同一个读事务里查询，来自同一快照
+@api.route('/api/bootstrap', methods=['POST'])
+@rate_limit(user_limit=10, api_limit=30, weight=2)  # 合并4个读取，按2次计入用户限流
+def bootstrap():
+    try:
+        user_id = request.user['user_id']
+        data = request.get_json(silent=True) or {}
+
+        include_favorites = data.get('favorites', True)
+        check_keys = data.get('check_keys') or []
+        history_keys = data.get('history_keys') or []
+        if not isinstance(check_keys, list) or not isinstance(history_keys, list):
+            return jsonify({'error': 'check_keys和history_keys必须是数组'}), 400
+        if len(check_keys) > current_app.config['BOOTSTRAP_MAX_KEYS'] or \
+                len(history_keys) > current_app.config['BOOTSTRAP_MAX_KEYS']:
+            return jsonify({'error': f"每类key最多{current_app.config['BOOTSTRAP_MAX_KEYS']}个"}), 400
+
+        user_info = query_user_info(None, user_id)
+        if not user_info:
+            return jsonify({'error': '用户不存在'}), 404
+        result = {'user': user_info}
+        with user_shard(user_id).connect() as conn:
+            conn.execute('BEGIN')
+            try:
+                if include_favorites:
+                    result['favorites'], _ = query_favorites(conn, user_id)
+                if check_keys:
+                    result['favorite_status'] = query_favorite_status(conn, user_id, check_keys)
+                if history_keys:
+                    history = {}
+                    for key in history_keys:
+                        found = query_viewing_history(conn, user_id, key)
+                        history[key] = found[0] if found else None
+                    result['history'] = history
+            finally:
+                conn.rollback()
+
+        return jsonify(result), 200
+
+    except Exception as e:
+        current_app.logger.error(f"页面初始化数据查询失败: {str(e)}")
+        return jsonify({'error': f'查询失败: {str(e)}'}), 500
+
+
+# 片库搜索接口：按标题搜索当前用户的收藏和观看历史，分页返回
+@api.route('/api/library/search', methods=['GET'])
+@rate_limit(user_limit=10, api_limit=30)  # 用户每秒10次，接口每秒30次
+def library_search():
+    try:
+        user_id = request.user['user_id']
+        query = request.args.get('q', '').strip()
+        kind = request.args.get('kind') or None
+        if not query:
+            return jsonify({'error': '缺少搜索关键词'}), 400
+        if len(query) > current_app.config['LIBRARY_SEARCH_MAX_QUERY']:
+            return jsonify({'error': '搜索关键词过长'}), 400
+        if kind not in (None, KIND_FAVORITE, KIND_HISTORY):
+            return jsonify({'error': 'kind只能是favorite或history'}), 400
+        try:
+            limit = int(request.args.get('limit', current_app.config['LIBRARY_SEARCH_PAGE_SIZE']))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return jsonify({'error': 'limit和offset必须是整数'}), 400
+        limit = max(1, min(limit, current_app.config['LIBRARY_SEARCH_MAX_PAGE_SIZE']))
+        offset = max(0, offset)
+
+        with user_shard(user_id).connect() as conn:
+            rows, has_more = search_library(conn, user_id, query, kind, limit, offset)
+
+        items = [{
+            'kind': row[0],
+            'key': row[1],
+            'title': row[2],
+            'data': current_app.json.loads(row[3])
+        } for row in rows]
+        return jsonify({
+            'items': items,
+            'offset': offset,
+            'limit': limit,
+            'next_offset': offset + len(items) if has_more else None
+        }), 200
+
+    except Exception as e:
+        current_app.logger.error(f"片库搜索失败: {str(e)}")
+        return jsonify({'error': f'搜索失败: {str(e)}'}), 500
+
+
+# 继续观看接口：返回最近观看的N条，首页无需下载完整观看历史
+@api.route('/api/continue-watching', methods=['GET'])
+@rate_limit(user_limit=10, api_limit=30)  # 用户每秒10次，接口每秒30次
+def continue_watching():
+    try:
+        user_id = request.user['user_id']
+        # 默认使用前端保存观看历史的key
+        key = request.args.get('key', '').strip() or f"{request.user['username']}_viewingHistory"
+        try:
+            limit = int(request.args.get('limit', current_app.config['CONTINUE_WATCHING_LIMIT']))
+        except ValueError:
+            return jsonify({'error': 'limit必须是整数'}), 400
+        limit = max(1, min(limit, current_app.config['CONTINUE_WATCHING_MAX_LIMIT']))
+
+        # 尚未落库的写入直接从缓冲计算，保证刚保存的进度立即可见
+        pending = get_resources().history_buffer.get(user_id, key)
+        if pending:
+            items = continue_watching_from_history(pending[0], limit)
+        else:
+            with user_shard(user_id).connect() as conn:
+                items = query_continue_watching(conn, user_id, key, limit)
+        return jsonify({'items': items}), 200
+
+    except Exception as e:
+        current_app.logger.error(f"获取继续观看列表失败: {str(e)}")
+        return jsonify({'error': f'查询失败: {str(e)}'}), 500
+
+
+# 聚合搜索接口：后端并发请求各个视频源，合并去重后缓存
+@api.route('/api/search', methods=['GET'])
+@rate_limit(api_limit=30, priority=PRIORITY_BULK)  # 仅接口限流，每秒30次
+def aggregated_search():
+    query = request.args.get('wd', '').strip()
+    if not query:
+        return jsonify({'code': 400, 'msg': '缺少搜索参数', 'list': []}), 400
+
+    aggregator = get_resources().search_aggregator
+    requested = [code.strip() for code in request.args.get('sources', '').split(',') if code.strip()]
+    codes = aggregator.resolve_sources(requested)
+    if not codes:
+        return jsonify({'code': 400, 'msg': '无效的API来源', 'list': []}), 400
+
+    cached = aggregator.lookup(query, codes)
+    results = cached if cached is not None else aggregator.stream(query, codes)
+    sites = current_app.config['API_SITES']
+
+    # 流式返回：每个源返回后输出一行 NDJSON，最后一行汇总
+    if request.args.get('stream') == '1' or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        def generate():
+            total = 0
+            for code, status, items in results:
+                items = items[:max(0, aggregator.max_results - total)]
+                total += len(items)
+                yield current_app.json.dumps({
+                    'source': code,
+                    'source_name': sites[code]['name'],
+                    'status': status,
+                    'list': items
+                }) + '\n'
+            yield current_app.json.dumps({'done': True, 'total': total, 'cached': cached is not None}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    results = list(results)
+    return jsonify({
+        'code': 200,
+        'list': aggregator.merge(results, codes),
+        'sources': {code: {'status': status, 'count': len(items)} for code, status, items in results},
+        'cached': cached is not None
+    }), 200
+
+
+# 视频详情接口，响应结构与前端 /api/detail 相同
+@api.route('/api/detail', methods=['GET'])
+@rate_limit(api_limit=30, priority=PRIORITY_BULK)  # 仅接口限流，每秒30次
+def video_detail():
+    vod_id = request.args.get('id', '')
+    source = request.args.get('source', '')
+    if not vod_id:
+        return jsonify({'code': 400, 'msg': '缺少视频ID参数', 'episodes': []}), 400
+
+    detail = get_resources().detail_service.get_details([(source, vod_id)])[(source, vod_id)]
+    if detail['code'] != 200:
+        return jsonify(dict(detail, episodes=[])), detail['code']
+    return jsonify(detail), 200
+
+
+# 批量视频详情接口：同一个源的ID合并请求
+@api.route('/api/detail/batch', methods=['POST'])
+@rate_limit(api_limit=20, priority=PRIORITY_BULK)  # 仅接口限流，每秒20次
+def video_detail_batch():
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items必须是非空数组'}), 400
+    if len(items) > current_app.config['DETAIL_MAX_ITEMS']:
+        return jsonify({'error': f"单次最多查询{current_app.config['DETAIL_MAX_ITEMS']}个"}), 400
+
+    pairs = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get('source') or not item.get('id'):
+            return jsonify({'error': '每一项必须包含source和id'}), 400
+        pairs.append((str(item['source']), str(item['id'])))
+
+    details = get_resources().detail_service.get_details(pairs)
+    return jsonify({'details': {f'{source}:{vod_id}': detail for (source, vod_id), detail in details.items()}}), 200
+
+
+def douban_response(loader):
+    """调用豆瓣缓存服务并返回原样的豆瓣JSON，X-Cache 标明命中情况"""
+    try:
+        data, cache_status = loader()
+    except DoubanUnavailable as e:
+        current_app.logger.warning(f"获取豆瓣数据失败: {str(e)}")
+        response = jsonify({'error': str(e)})
+        response.status_code = e.status
+        if e.retry_after:
+            response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    response = jsonify(data)
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+# 豆瓣标签列表，对应 js/douban.js 的 fetchDoubanTags
+@api.route('/api/douban/tags', methods=['GET'])
+@rate_limit(api_limit=50, priority=PRIORITY_BULK)  # 仅接口限流，每秒50次
+def douban_tags():
+    media_type = request.args.get('type', 'movie')
+    if media_type not in ('movie', 'tv'):
+        return jsonify({'error': 'type必须是movie或tv'}), 400
+    return douban_response(lambda: get_resources().douban.get_tags(media_type))
+
+
+# 豆瓣推荐页，对应 js/douban.js 的 renderRecommend
+@api.route('/api/douban/subjects', methods=['GET'])
+@rate_limit(api_limit=50, priority=PRIORITY_BULK)  # 仅接口限流，每秒50次
+def douban_subjects():
+    media_type = request.args.get('type', 'movie')
+    tag = request.args.get('tag', '热门').strip()
+    try:
+        page_limit = int(request.args.get('page_limit', 16))
+        page_start = int(request.args.get('page_start', 0))
+    except ValueError:
+        return jsonify({'error': '分页参数必须是整数'}), 400
+    if media_type not in ('movie', 'tv') or not tag or len(tag) > 32:
+        return jsonify({'error': '无效的类型或标签'}), 400
+    if not 0 < page_limit <= 50 or not 0 <= page_start <= 500:
+        return jsonify({'error': '分页参数超出范围'}), 400
+    return douban_response(lambda: get_resources().douban.get_subjects(media_type, tag, page_limit, page_start))
+
+
+# 豆瓣条目海报信息（来自已缓存的推荐页）
+@api.route('/api/douban/subject/<subject_id>', methods=['GET'])
+@rate_limit(api_limit=100, priority=PRIORITY_BULK)  # 仅接口限流，每秒100次
+def douban_subject(subject_id):
+    poster = get_resources().douban.get_poster(subject_id)
+    if poster is None:
+        return jsonify({'error': '未找到该条目'}), 404
+    return jsonify(poster), 200
+
+
+def serve_from_hls_cache(resources, target_url, kind, mimetype):
+    """
+    从服务端HLS缓存返回播放列表/分片，未命中时从上游完整获取后写入缓存
+    播放列表中的URI改写为代理地址；请求分片时预取其后的分片
+    返回None表示无法使用缓存，由调用方直接代理
+    """
+    cache = resources.hls_cache
+    # 缓存完整内容：不透传Range，也不接受上游压缩
+    headers = resources.media_proxy.filter_request_headers(
+        (name, value) for name, value in request.headers.items()
+        if name.lower() not in ('range', 'if-range', 'accept-encoding')
+    )
+
+    try:
+        entry, hit = cache.get_or_fetch(target_url, lambda: resources.fetch_for_cache(target_url, headers), kind)
+    except UncacheableResponse as e:
+        if e.upstream is None:
+            return None
+        response = Response(e.upstream.iter_chunks(), status=e.upstream.status,
+                            headers=e.upstream.headers, direct_passthrough=True)
+        response.call_on_close(e.upstream.close)
+        return response
+    if entry is None:
+        return None
+
+    try:
+        if kind == KIND_MANIFEST and current_app.config['HLS_REWRITE_ENABLED']:
+            with open(cache.path_for(entry), 'rb') as f:
+                data = f.read()
+            playlist = resources.playlist_cache.get(target_url, entry.content_hash, data)
+            prefix = current_app.config['HLS_PROXY_PREFIX'] or request.script_root + '/proxy/'
+            response = Response(playlist.render(prefix), mimetype=mimetype)
+        else:
+            response = send_file(cache.path_for(entry), mimetype=mimetype, conditional=True)
+    except FileNotFoundError:
+        # 刚好被淘汰
+        return None
+    response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+
+    if kind == KIND_SEGMENT:
+        prefetcher = resources.segment_prefetcher
+        if prefetcher is not None:
+            count = current_app.config['HLS_PREFETCH_SEGMENTS']
+            prefetcher.schedule(resources.playlist_cache.next_segments(target_url, count), headers)
+    return response
+
+
+# 流式媒体代理，与 server.mjs / nginx 的 /proxy/:encodedUrl 行为一致
+@api.route('/proxy/<path:target_url>', methods=['GET', 'HEAD', 'POST'], merge_slashes=False)
+@rate_limit(api_limit=200, priority=PRIORITY_BULK)  # 仅接口限流，每秒200次（播放时每个客户端每几秒一个分片）
+def media_proxy(target_url):
+    # 目标URL经过encodeURIComponent编码，WSGI已解码一次；未编码的查询串需要拼回去
+    if request.query_string:
+        target_url = f"{target_url}?{request.query_string.decode('latin-1')}"
+
+    resources = get_resources()
+    proxy = resources.media_proxy
+    cacheable = None
+    if request.method == 'GET':
+        cacheable = cache_kind(target_url)
+        if cacheable is None and resources.playlist_cache.is_segment(target_url):
+            # 播放列表里出现过的分片，即使扩展名不是 .ts 也按分片缓存
+            cacheable = (KIND_SEGMENT, SEGMENT_MIMETYPES['.ts'])
+    if cacheable is not None and resources.hls_cache is not None:
+        try:
+            response = serve_from_hls_cache(resources, target_url, *cacheable)
+        except ProxyError as e:
+            current_app.logger.warning(f"代理请求失败: {target_url}, 错误: {str(e)}")
+            response = make_response(str(e), e.status)
+            if e.retry_after:
+                response.headers['Retry-After'] = str(e.retry_after)
+        if response is not None:
+            return response
+
+    body = request.get_data() if request.method == 'POST' else None
+    try:
+        upstream = proxy.open(
+            request.method,
+            target_url,
+            proxy.filter_request_headers(request.headers.items()),
+            body
+        )
+    except ProxyError as e:
+        current_app.logger.warning(f"代理请求失败: {target_url}, 错误: {str(e)}")
+        response = make_response(str(e), e.status)
+        if e.retry_after:
+            response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    response = Response(upstream.iter_chunks(), status=upstream.status,
+                        headers=upstream.headers, direct_passthrough=True)
+    # 客户端提前断开时生成器可能未启动，需要显式归还连接
+    response.call_on_close(upstream.close)
+    return response
+
+
+def create_app(config=None):
+    """
+    创建应用实例
+    :param config: 覆盖默认配置的字典，例如 {'DB_PATH': ':memory:', 'LOG_DIR': ''}
+    数据库、日志、限流器和后台线程都在首次使用时才初始化
+    """
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+
+    load_config(app)
+    if config:
+        app.config.update(config)
+    CORS(app, max_age=app.config['CORS_PREFLIGHT_MAX_AGE'] or None)
+
+    resources = app.extensions['libretv'] = AppResources(app)
+    if app.config['FAST_PATH_ENABLED']:
+        app.wsgi_app = resources.fast_path = FastPathMiddleware(
+            app.wsgi_app,
+            max_age=app.config['CORS_PREFLIGHT_MAX_AGE'],
+            origin_max_age=parse_origin_max_age(app.config['CORS_PREFLIGHT_MAX_AGE_ORIGINS']),
+            health_body=app.json.dumps(HEALTH_STATUS).encode('utf-8') + b'\n',
+            health_mimetype=app.config['JSONIFY_MIMETYPE']
+        )
+    app.register_blueprint(api)
+    app.before_request(setup_request_logging)
+    app.before_request(capture_traffic_start)
+    # after_request 按注册的相反顺序执行：先压缩再采集
+    app.after_request(capture_traffic)
+    app.after_request(compress_response)
+    return app
+
+
+app = create_app()
+
 
 if __name__ == '__main__':
+    app.extensions['libretv'].setup_logging()
     app.logger.info('启动应用服务器...')
     app.run(host='0.0.0.0', port=5002, debug=False)
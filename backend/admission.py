@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端准入控制与过载卸载
+- 接口按优先级分为四类：刷新令牌 > 登录注册 > 历史/收藏等读写 > 批量、调试和上游聚合
+- 每类有独立的并发上限（隔舱），某一类被打满时只排队该类的请求，其它类不受影响
+- 统计进行中的请求数、排队等待时间和数据库相关接口的处理时间（EWMA），
+  超过目标时按固定间隔逐级提高卸载等级，从最低优先级开始直接返回 503 + Retry-After；
+  恢复到目标一半以下后逐级放开。刷新令牌类永远不会被卸载
+"""
+
+import logging
+import math
+import threading
+import time
+
+
+# 优先级从高到低
+PRIORITY_REFRESH = 'refresh'
+PRIORITY_LOGIN = 'login'
+PRIORITY_READ = 'read'
+PRIORITY_BULK = 'bulk'
+PRIORITIES = (PRIORITY_REFRESH, PRIORITY_LOGIN, PRIORITY_READ, PRIORITY_BULK)
+
+# 处理时间依赖上游（搜索、豆瓣等）的类别不参与过载判断，避免上游变慢时误卸载本地接口
+LATENCY_TRACKED = (PRIORITY_REFRESH, PRIORITY_LOGIN, PRIORITY_READ)
+
+
+class Overloaded(Exception):
+    """请求被卸载或排队超时"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_bulkheads(spec):
+    """解析 'refresh=32,login=16,read=64,bulk=16' 形式的并发上限配置"""
+    limits = {}
+    for item in spec.split(','):
+        name, _, value = item.strip().partition('=')
+        if name:
+            if name not in PRIORITIES:
+                raise ValueError(f'未知的优先级类别: {name}')
+            limits[name] = int(value)
+    return limits
+
+
+class PriorityClass:
+    """单个优先级类别的隔舱和统计"""
+
+    __slots__ = ('name', 'rank', 'limit', 'condition', 'inflight', 'waiting', 'admitted', 'shed',
+                 'timeouts', 'latency', 'queue_delay')
+
+    def __init__(self, name, rank, limit, lock):
+        self.name = name
+        self.rank = rank
+        self.limit = limit
+        self.condition = threading.Condition(lock)
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timeouts = 0
+        self.latency = 0.0
+        self.queue_delay = 0.0
+
+
+class AdmissionController:
+    """
+    按优先级准入请求
+    acquire() 返回的凭据必须在处理结束后交给 release()
+    """
+
+    def __init__(self, bulkheads=None, latency_target=0.2, queue_target=0.05, queue_timeout=1.0,
+                 interval=1.0, max_inflight=128, alpha=0.2, clock=time.monotonic, logger=None):
+        self.latency_target = latency_target
+        self.queue_target = queue_target
+        self.queue_timeout = queue_timeout
+        self.interval = interval
+        self.max_inflight = max_inflight
+        self.alpha = alpha
+        self.clock = clock
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        limits = bulkheads or {}
+        self.classes = {
+            name: PriorityClass(name, rank, limits.get(name, max_inflight), self.lock)
+            for rank, name in enumerate(PRIORITIES)
+        }
+        self.inflight = 0
+        # 参与过载判断的请求的处理时间和排队时间（EWMA，秒）
+        self.latency = 0.0
+        self.queue_delay = 0.0
+        self.samples = 0
+        # 卸载等级：等级为 n 时优先级最低的 n 类直接拒绝
+        self.level = 0
+        self.adjusted_at = clock()
+        self.level_changes = 0
+
+    def _ewma(self, current, sample):
+        return sample if current == 0.0 else current + self.alpha * (sample - current)
+
+    def _adjust(self, now):
+        """每个间隔根据最近的延迟调整一次卸载等级，调用方需持有锁"""
+        if now - self.adjusted_at < self.interval:
+            return
+        self.adjusted_at = now
+        if not self.samples:
+            # 这段时间没有完成的请求（可能都被卸载了），让旧的测量值衰减，避免永远停留在高等级
+            self.latency /= 2
+            self.queue_delay /= 2
+        self.samples = 0
+
+        overloaded = (self.latency > self.latency_target or self.queue_delay > self.queue_target
+                      or self.inflight > self.max_inflight)
+        healthy = (self.latency < self.latency_target / 2 and self.queue_delay < self.queue_target / 2
+                   and self.inflight <= self.max_inflight / 2)
+        if overloaded and self.level < len(PRIORITIES) - 1:
+            self.level += 1
+        elif healthy and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        self.level_changes += 1
+        self.logger.warning(
+            f"准入控制等级调整为 {self.level}: 处理时间 {self.latency * 1000:.1f}ms, "
+            f"排队时间 {self.queue_delay * 1000:.1f}ms, 进行中 {self.inflight}"
+        )
+
+    def retry_after(self):
+        """卸载等级越高，建议客户端等待越久"""
+        return max(1, math.ceil(self.interval * self.level))
+
+    def acquire(self, priority):
+        """准入一个请求，被卸载或排队超时抛出 Overloaded"""
+        now = self.clock()
+        with self.lock:
+            self._adjust(now)
+            cls = self.classes[priority]
+            if cls.rank >= len(PRIORITIES) - self.level:
+                cls.shed += 1
+                raise Overloaded('服务繁忙，请稍后再试', self.retry_after())
+
+            deadline = now + self.queue_timeout
+            while cls.inflight >= cls.limit:
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    cls.timeouts += 1
+                    if cls.name in LATENCY_TRACKED:
+                        self.queue_delay = self._ewma(self.queue_delay, self.queue_timeout)
+                    raise Overloaded('服务繁忙，请稍后再试', self.retry_after())
+                cls.waiting += 1
+                try:
+                    cls.condition.wait(remaining)
+                finally:
+                    cls.waiting -= 1
+
+            started = self.clock()
+            cls.inflight += 1
+            cls.admitted += 1
+            self.inflight += 1
+            delay = started - now
+            cls.queue_delay = self._ewma(cls.queue_delay, delay)
+            if cls.name in LATENCY_TRACKED:
+                self.queue_delay = self._ewma(self.queue_delay, delay)
+        return cls, started
+
+    def release(self, ticket):
+        cls, started = ticket
+        elapsed = self.clock() - started
+        with self.lock:
+            cls.inflight -= 1
+            self.inflight -= 1
+            cls.condition.notify()
+            cls.latency = self._ewma(cls.latency, elapsed)
+            if cls.name in LATENCY_TRACKED:
+                self.latency = self._ewma(self.latency, elapsed)
+                self.samples += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'level': self.level,
+                'shedding': list(PRIORITIES[len(PRIORITIES) - self.level:]),
+                'inflight': self.inflight,
+                'latency_ms': round(self.latency * 1000, 2),
+                'queue_delay_ms': round(self.queue_delay * 1000, 2),
+                'level_changes': self.level_changes,
+                'classes': {
+                    name: {
+                        'limit': cls.limit,
+                        'inflight': cls.inflight,
+                        'waiting': cls.waiting,
+                        'admitted': cls.admitted,
+                        'shed': cls.shed,
+                        'timeouts': cls.timeouts,
+                        'latency_ms': round(cls.latency * 1000, 2),
+                        'queue_delay_ms': round(cls.queue_delay * 1000, 2)
+                    }
+                    for name, cls in self.classes.items()
+                }
+            }
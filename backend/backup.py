@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端数据库在线备份
+- 使用 SQLite 在线备份API，每一步复制 pages_per_step 页后释放锁并短暂休眠，应用在备份期间照常读写
+- 备份期间其它连接写入会使备份从头开始；连续重来 max_restarts 次后把剩余部分一次复制完
+  （WAL 模式下一次复制只持有读事务，不阻塞写入）
+- 备份先写到临时文件，integrity_check 通过后压缩为 libretv-时间.db.gz，再原子改名，目录里不会出现半个备份
+- 按保留数量删除旧备份；配置了 ship_dir 时把新备份复制到该目录（例如挂载的远程存储），同样按数量保留
+- 按用户分片存储时，一次备份包含每个分片文件（libretv-时间.shard{i}.db.gz）；先复制分片再复制主库，
+  恢复后分片中的数据所属的用户在主库中都存在
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+BACKUP_PREFIX = 'libretv-'
+
+
+class BackupFailed(Exception):
+    """备份失败（完整性校验不通过、磁盘错误等）"""
+
+
+class BackupRunning(Exception):
+    """已有备份正在进行"""
+
+
+class _Restarted(Exception):
+    """备份被并发写入打断的次数过多"""
+
+
+class BackupManager:
+    """数据库备份：定期在后台线程执行，也可以手动触发"""
+
+    def __init__(self, db_path, backup_dir, uri=False, pages_per_step=1024, step_sleep=0.005, retention=7,
+                 compress=True, interval=24 * 3600, max_restarts=3, ship_dir='', shard_paths=(), logger=None):
+        self.db_path = db_path
+        # 1号分片起的分片文件，0号分片即主库
+        self.shard_paths = list(shard_paths)
+        self.backup_dir = backup_dir
+        self.uri = uri
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.retention = retention
+        self.compress = compress
+        self.interval = interval
+        self.max_restarts = max_restarts
+        self.ship_dir = ship_dir
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.running = False
+        self.stopped = threading.Event()
+        self.thread = None
+        self.progress = {'pages_total': 0, 'pages_done': 0, 'restarts': 0}
+        self.last = None
+        self.last_error = None
+        self.completed = 0
+        self.failed = 0
+
+    # ---- 备份 ----
+
+    def _copy(self, source_path, target):
+        """在线复制数据库到 target，返回总页数"""
+        source = sqlite3.connect(source_path, uri=self.uri, check_same_thread=False)
+        dest = sqlite3.connect(target)
+        state = {'remaining': None, 'restarts': 0}
+
+        def on_progress(status, remaining, total):
+            # 剩余页数变多说明源库被其它连接写入，备份从头开始了
+            if state['remaining'] is not None and remaining > state['remaining']:
+                state['restarts'] += 1
+            state['remaining'] = remaining
+            with self.lock:
+                self.progress = {'pages_total': total, 'pages_done': total - remaining,
+                                 'restarts': state['restarts']}
+            if state['restarts'] > self.max_restarts:
+                raise _Restarted()
+
+        try:
+            try:
+                source.backup(dest, pages=self.pages_per_step, progress=on_progress, sleep=self.step_sleep)
+            except _Restarted:
+                self.logger.info(f"备份被并发写入打断 {state['restarts']} 次，剩余部分一次复制")
+                source.backup(dest, pages=-1)
+            pages = dest.execute('PRAGMA page_count').fetchone()[0]
+            result = dest.execute('PRAGMA integrity_check').fetchone()[0]
+            if result != 'ok':
+                raise BackupFailed(f'备份完整性校验失败: {result}')
+            return pages
+        finally:
+            dest.close()
+            source.close()
+
+    def _finish(self, copy_path, name):
+        """压缩（可选）并原子地放入备份目录，返回最终路径"""
+        final_path = os.path.join(self.backup_dir, name)
+        if self.compress:
+            partial = final_path + '.partial'
+            with open(copy_path, 'rb') as source, gzip.open(partial, 'wb', compresslevel=6) as output:
+                shutil.copyfileobj(source, output, 1024 * 1024)
+            os.replace(partial, final_path)
+            os.remove(copy_path)
+        else:
+            os.replace(copy_path, final_path)
+        return final_path
+
+    def _ship(self, paths):
+        os.makedirs(self.ship_dir, exist_ok=True)
+        for path in paths:
+            target = os.path.join(self.ship_dir, os.path.basename(path))
+            shutil.copyfile(path, target + '.partial')
+            os.replace(target + '.partial', target)
+        self._prune(self.ship_dir)
+
+    def _prune(self, directory):
+        """只保留最新的 retention 个备份（一个备份包含主库和各分片文件），返回删除的文件数"""
+        backups = self.list_backups(directory)
+        keep = sorted({entry['snapshot'] for entry in backups}, reverse=True)[:self.retention]
+        removed = 0
+        for entry in backups:
+            if entry['snapshot'] in keep:
+                continue
+            try:
+                os.remove(os.path.join(directory, entry['name']))
+                removed += 1
+            except OSError as e:
+                self.logger.warning(f"删除旧备份失败: {entry['name']}: {str(e)}")
+        return removed
+
+    def run_backup(self):
+        """执行一次备份并返回结果；已有备份在进行时抛出 BackupRunning"""
+        with self.lock:
+            if self.running:
+                raise BackupRunning('已有备份正在进行')
+            self.running = True
+            self.progress = {'pages_total': 0, 'pages_done': 0, 'restarts': 0}
+
+        started = time.time()
+        snapshot = (BACKUP_PREFIX + time.strftime('%Y%m%d-%H%M%S', time.localtime(started))
+                    + f'-{int(started * 1000) % 1000:03d}')
+        extension = '.db.gz' if self.compress else '.db'
+        name = snapshot + extension
+        # 先复制分片再复制主库
+        sources = [(path, f'{snapshot}.shard{index}{extension}')
+                   for index, path in enumerate(self.shard_paths, 1)] + [(self.db_path, name)]
+        copy_path = None
+        paths = []
+        try:
+            os.makedirs(self.backup_dir, exist_ok=True)
+            pages = 0
+            for source_path, file_name in sources:
+                copy_path = os.path.join(self.backup_dir, f'.{file_name}.copy')
+                pages += self._copy(source_path, copy_path)
+                paths.append(self._finish(copy_path, file_name))
+            if self.ship_dir:
+                self._ship(paths)
+            pruned = self._prune(self.backup_dir)
+            result = {
+                'file': name,
+                'files': [os.path.basename(path) for path in paths],
+                'started_at': int(started),
+                'seconds': round(time.time() - started, 3),
+                'pages': pages,
+                'bytes': sum(os.path.getsize(path) for path in paths),
+                'restarts': self.progress['restarts'],
+                'pruned': pruned
+            }
+            self.logger.info(f"数据库备份完成: {result}")
+            with self.lock:
+                self.last = result
+                self.last_error = None
+                self.completed += 1
+            return result
+        except Exception as e:
+            self.logger.error(f"数据库备份失败: {str(e)}")
+            with self.lock:
+                self.last_error = {'at': int(time.time()), 'error': str(e)}
+                self.failed += 1
+            # 不保留不完整的备份
+            for path in paths + ([copy_path] if copy_path is not None else []):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        finally:
+            with self.lock:
+                self.running = False
+
+    def trigger(self):
+        """在后台线程立即执行一次备份；已有备份在进行时抛出 BackupRunning"""
+        with self.lock:
+            if self.running:
+                raise BackupRunning('已有备份正在进行')
+
+        def run():
+            try:
+                self.run_backup()
+            except Exception:
+                pass  # 已记录到日志和 last_error
+
+        threading.Thread(target=run, name='db-backup-manual', daemon=True).start()
+
+    # ---- 定期备份 ----
+
+    def start(self):
+        """启动定期备份线程"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='db-backup', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_backup()
+            except Exception:
+                pass  # 已记录到日志和 last_error
+
+    def close(self):
+        self.stopped.set()
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+
+    # ---- 状态 ----
+
+    def list_backups(self, directory=None):
+        """目录中的备份，最新的在前"""
+        directory = directory or self.backup_dir
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        backups = []
+        for name in names:
+            if name.startswith(BACKUP_PREFIX) and (name.endswith('.db') or name.endswith('.db.gz')):
+                stat = os.stat(os.path.join(directory, name))
+                backups.append({'name': name, 'snapshot': name.split('.', 1)[0], 'bytes': stat.st_size,
+                                'modified_at': int(stat.st_mtime)})
+        # 文件名以时间开头，按名称倒序即最新的在前
+        backups.sort(key=lambda entry: entry['name'], reverse=True)
+        return backups
+
+    def stats(self):
+        with self.lock:
+            status = {
+                'running': self.running,
+                'progress': dict(self.progress),
+                'last': self.last,
+                'last_error': self.last_error,
+                'completed': self.completed,
+                'failed': self.failed,
+                'scheduled': self.thread is not None,
+                'interval': self.interval,
+                'retention': self.retention
+            }
+        status['backups'] = self.list_backups()
+        return status
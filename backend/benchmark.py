@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端性能基准脚本
+
+用法:
+    python benchmark.py            # 运行全部基准
+    python benchmark.py json       # 只运行指定基准
+"""
+
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urljoin
+
+from flask import Flask
+
+import json_provider
+from db_writer import DatabaseWriter
+from json_provider import FastJSONProvider
+from library_index import search_library
+from LibreProgramBackend import create_app, init_db, init_user_tables
+from sharding import Shard, shard_index, shard_path
+
+
+SOURCE_NAMES = ['黑木耳', '天涯资源', '非凡影视', '量子资源', '360资源', '卧龙资源']
+TITLE_WORDS = ['庆余年', '繁花', '狂飙', '漫长的季节', '三体', '长相思', '莲花楼', '玫瑰的故事']
+
+
+def make_history_item(index, episodes=40):
+    """生成一条与前端 viewingHistory 结构一致的历史记录"""
+    source_code = f'source{index % len(SOURCE_NAMES)}'
+    vod_id = str(100000 + index)
+    return {
+        'title': f'{random.choice(TITLE_WORDS)} 第{index % 5 + 1}季',
+        'directVideoUrl': f'https://vip.example-cdn.com/20240{index % 9 + 1}/{vod_id}/index.m3u8',
+        'url': f'https://libretv.example.com/player.html?url=https%3A%2F%2Fvip.example-cdn.com%2F{vod_id}'
+               f'&title=%E5%BA%86%E4%BD%99%E5%B9%B4&index={index % episodes}&source={source_code}',
+        'episodeIndex': index % episodes,
+        'sourceName': SOURCE_NAMES[index % len(SOURCE_NAMES)],
+        'source_code': source_code,
+        'vod_id': vod_id,
+        'timestamp': 1700000000000 + index * 1000,
+        'playbackPosition': random.uniform(0, 2700),
+        'duration': 2700.0,
+        'episodes': [f'https://vip.example-cdn.com/20240{index % 9 + 1}/{vod_id}/{e}/index.m3u8'
+                     for e in range(episodes)],
+    }
+
+
+def make_history(count, episodes=40):
+    random.seed(count)
+    return [make_history_item(i, episodes) for i in range(count)]
+
+
+def percentile(samples, pct):
+    """计算百分位数"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_concurrently(worker, threads):
+    """启动多个线程同时执行 worker(i)，返回总耗时（秒）"""
+    barrier = threading.Barrier(threads + 1)
+
+    def target(i):
+        barrier.wait()
+        worker(i)
+
+    pool = [threading.Thread(target=target, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def create_favorites_table(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_favorites (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, key)
+            )
+        ''')
+
+
+def timeit(func, repeat=20):
+    """返回多次运行的耗时中位数（毫秒）"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def bench_json():
+    """对比标准库与 FastJSONProvider 在历史记录负载上的编解码耗时"""
+    print('🔍 JSON 编解码基准（观看历史负载）')
+    app = Flask(__name__)
+    app.config['JSON_AS_ASCII'] = False
+    app.json = FastJSONProvider(app)
+    print(f'   当前 JSON 后端: {app.json.backend_name}')
+
+    print(f"   {'条数':>6} {'大小(KB)':>9} {'json.dumps':>11} {'provider':>9} "
+          f"{'json.loads':>11} {'provider':>9} {'jsonify':>9} {'加速':>6}")
+    for count in (1000, 2000, 5000):
+        history = make_history(count)
+        text = json.dumps(history, ensure_ascii=False, separators=(',', ':'))
+        # 与 GET /api/viewing-history/operation 相同的响应包装
+        envelope = {'data': text}
+
+        std_dumps = timeit(lambda: json.dumps(history, ensure_ascii=False, separators=(',', ':')))
+        fast_dumps = timeit(lambda: app.json.dumps(history, sort_keys=False))
+        std_loads = timeit(lambda: json.loads(text))
+        fast_loads = timeit(lambda: app.json.loads(text))
+        with app.app_context():
+            fast_response = timeit(lambda: app.json.response(envelope).get_data())
+
+        speedup = (std_dumps + std_loads) / max(fast_dumps + fast_loads, 1e-9)
+        print(f'   {count:>6} {len(text.encode()) / 1024:>9.0f} {std_dumps:>9.2f}ms {fast_dumps:>7.2f}ms '
+              f'{std_loads:>9.2f}ms {fast_loads:>7.2f}ms {fast_response:>7.2f}ms {speedup:>5.1f}x')
+
+    if json_provider.orjson is None:
+        print('   ⚠️  未安装 orjson，provider 使用标准库回退路径')
+
+
+def bench_writer(writers=50, ops_per_writer=40):
+    """对比每请求独立连接提交与单写线程合并提交的写入吞吐和延迟"""
+    print(f'🔍 SQLite 写入基准（{writers} 个并发写线程，每个 {ops_per_writer} 次写入）')
+    payload = json.dumps(make_history_item(1), ensure_ascii=False)
+
+    def measure(name, write):
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def worker(i):
+            for n in range(ops_per_writer):
+                start = time.perf_counter()
+                try:
+                    write(i, f'fav_{n}')
+                except sqlite3.OperationalError as e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                with lock:
+                    latencies.append((time.perf_counter() - start) * 1000)
+
+        elapsed = run_concurrently(worker, writers)
+        print(f'   {name:<10} 吞吐 {len(latencies) / elapsed:>8.0f} 次/秒  '
+              f'p50 {percentile(latencies, 50):>7.2f}ms  p99 {percentile(latencies, 99):>8.2f}ms  '
+              f'失败 {len(errors)}（database is locked: {sum("locked" in e for e in errors)}）')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'direct.db')
+        create_favorites_table(db_path)
+
+        def direct_write(user_id, key):
+            with sqlite3.connect(db_path) as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO user_favorites (user_id, key, data) VALUES (?, ?, ?)',
+                    (user_id, key, payload)
+                )
+                conn.commit()
+
+        measure('独立连接', direct_write)
+
+        db_path = os.path.join(tmp, 'writer.db')
+        create_favorites_table(db_path)
+        writer = DatabaseWriter(db_path)
+        writer.start()
+
+        def writer_write(user_id, key):
+            writer.execute(
+                'INSERT OR REPLACE INTO user_favorites (user_id, key, data) VALUES (?, ?, ?)',
+                (user_id, key, payload)
+            )
+
+        measure('单写线程', writer_write)
+        writer.stop()
+        print(f"   单写线程平均每次提交合并 {writer.stats()['ops_per_commit']:.1f} 个写操作")
+
+
+class FakeHlsOrigin:
+    """
+    本地替身HLS源站：一个点播播放列表（相对分片路径）
+    每个请求按路径确定的随机延迟返回，模拟上游响应时间抖动
+    """
+
+    def __init__(self, segments=30, segment_bytes=200 * 1024, min_latency=0.1, max_latency=0.4):
+        self.segments = segments
+        self.requests = 0
+        body = os.urandom(segment_bytes)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+        for i in range(segments):
+            lines += ['#EXTINF:2.000,', f'seg{i:04d}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        routes = {'/vod/index.m3u8': ('\n'.join(lines) + '\n').encode()}
+        routes.update({f'/vod/seg{i:04d}.ts': body for i in range(segments)})
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                origin.requests += 1
+                time.sleep(random.Random(self.path).uniform(min_latency, max_latency))
+                data = routes.get(self.path)
+                self.send_response(200 if data is not None else 404)
+                self.send_header('Content-Length', str(len(data or b'')))
+                self.end_headers()
+                self.wfile.write(data or b'')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.manifest_url = f'http://127.0.0.1:{self.server.server_address[1]}/vod/index.m3u8'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def play_hls(client, manifest_url, segment_duration):
+    """
+    模拟播放器：获取播放列表后顺序下载分片，第一个分片到达即开始播放
+    每个分片可播放 segment_duration 秒，下一个分片晚于缓冲耗尽时记一次卡顿
+    返回 (首帧时间, 卡顿次数, 卡顿总时长)
+    """
+    start = time.perf_counter()
+    text = client.get('/proxy/' + quote(manifest_url, safe='')).get_data(as_text=True)
+    segments = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        # 改写后的播放列表直接给出代理地址；未改写时由播放器自己拼代理地址
+        segments.append(line if line.startswith('/proxy/') else '/proxy/' + quote(urljoin(manifest_url, line), safe=''))
+
+    ttff, play_start, buffered, stalls, stalled = None, 0.0, 0.0, 0, 0.0
+    for path in segments:
+        client.get(path).get_data()
+        now = time.perf_counter()
+        if ttff is None:
+            ttff, play_start = now - start, now
+        else:
+            played = now - play_start - stalled
+            if played > buffered:
+                stalls += 1
+                stalled += played - buffered
+        buffered += segment_duration
+    return ttff, stalls, stalled
+
+
+def bench_hls(segments=30, segment_duration=0.2):
+    """对比直接代理、服务端缓存、缓存+改写+预取三种方式的首帧时间和卡顿次数"""
+    print(f'🔍 HLS 播放基准（{segments} 个分片，每片播放 {segment_duration * 1000:.0f}ms，'
+          f'源站延迟 100-400ms）')
+    scenarios = [
+        ('直接代理', {'HLS_CACHE_ENABLED': False}),
+        ('服务端缓存', {'HLS_REWRITE_ENABLED': False, 'HLS_PREFETCH_SEGMENTS': 0}),
+        ('改写+预取', {'HLS_PREFETCH_SEGMENTS': 3}),
+    ]
+    print(f"   {'方式':<8} {'首帧(冷)':>9} {'卡顿':>5} {'卡顿时长':>8} {'首帧(热)':>9} {'卡顿':>5} {'源站请求':>8}")
+    for name, config in scenarios:
+        origin = FakeHlsOrigin(segments=segments)
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app(dict({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                                   'HLS_CACHE_DIR': os.path.join(tmp, 'hls-cache')}, **config))
+            client = app.test_client()
+            try:
+                cold = play_hls(client, origin.manifest_url, segment_duration)
+                warm = play_hls(client, origin.manifest_url, segment_duration)
+            finally:
+                app.extensions['libretv'].close()
+                origin.close()
+        print(f'   {name:<8} {cold[0] * 1000:>7.0f}ms {cold[1]:>5} {cold[2] * 1000:>6.0f}ms '
+              f'{warm[0] * 1000:>7.0f}ms {warm[1]:>5} {origin.requests:>8}')
+
+
+def bench_bootstrap(loads=200, threads=8, favorites=50, history_items=500):
+    """对比页面加载时分别请求4个接口与一次 /api/bootstrap 的耗时"""
+    print(f'🔍 页面加载接口基准（{favorites} 条收藏，{history_items} 条观看历史）')
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'DB_PATH': os.path.join(tmp, 'bootstrap.db'), 'LOG_DIR': '',
+                          'RATE_LIMIT_ENABLED': False, 'HISTORY_WRITE_BEHIND_ENABLED': False})
+        app.logger.disabled = True
+        client = app.test_client()
+        try:
+            response = client.post('/api/auth/register',
+                                   json={'username': 'bench@example.com', 'password': 'benchpass123'})
+            token = next(cookie for cookie in response.headers.getlist('Set-Cookie')
+                         if cookie.startswith('accessToken=')).split(';', 1)[0].split('=', 1)[1]
+            headers = {'Authorization': f'Bearer {token}'}
+            history_key = 'bench@example.com_viewingHistory'
+            client.post(f'/api/viewing-history/operation?key={history_key}',
+                        json=make_history(history_items, episodes=5), headers=headers)
+            for i in range(favorites):
+                client.post('/api/user-favorites', json={'action': 'add', 'key': f'fav_{i}',
+                                                         'data': make_history_item(i, episodes=5)}, headers=headers)
+            check_keys = [f'fav_{i * 2}' for i in range(24)]
+
+            def separate():
+                client.get('/api/auth/user-info', headers=headers)
+                client.get('/api/user-favorites', headers=headers)
+                client.post('/api/user-favorites/batch-check', json={'keys': check_keys}, headers=headers)
+                client.get(f'/api/viewing-history/operation?key={history_key}', headers=headers)
+
+            def combined():
+                client.post('/api/bootstrap', json={'check_keys': check_keys, 'history_keys': [history_key]},
+                            headers=headers)
+
+            print(f"   {'方式':<8} {'请求数':>6} {'单次p50':>9} {'单次p99':>9} {f'{threads}线程吞吐':>12}")
+            for name, load, requests in (('分别请求', separate, 4), ('bootstrap', combined, 1)):
+                latencies = []
+                for _ in range(loads):
+                    start = time.perf_counter()
+                    load()
+                    latencies.append((time.perf_counter() - start) * 1000)
+                elapsed = run_concurrently(lambda i: [load() for _ in range(loads // threads)], threads)
+                print(f'   {name:<10} {requests:>6} {percentile(latencies, 50):>7.2f}ms '
+                      f'{percentile(latencies, 99):>7.2f}ms {loads // threads * threads / elapsed:>9.0f} 次/秒')
+        finally:
+            app.extensions['libretv'].close()
+
+
+def bench_fast_path(hours=2, requests=2000):
+    """
+    模拟一个浏览器会话的请求量（带认证头的JSON请求都需要预检，负载均衡每5秒一次健康检查），
+    对比没有 Access-Control-Max-Age（浏览器默认只缓存5秒）与快速路径下到达 Flask 的请求数，以及各类请求的耗时
+    """
+    print(f'🔍 CORS预检与健康检查快速路径基准（{hours} 小时浏览器会话）')
+    # (接口, 间隔秒数)：播放时同步历史、翻页批量查收藏、定期拉取用户信息和收藏
+    schedule = [('/api/viewing-history/operation', 15), ('/api/user-favorites/batch-check', 60),
+                ('/api/auth/user-info', 240), ('/api/user-favorites', 300)]
+    duration = hours * 3600
+    calls = sorted((t, path) for path, interval in schedule for t in range(0, duration, interval))
+    health_checks = duration // 5
+
+    def count_preflights(max_age):
+        cached = {}
+        preflights = 0
+        for t, path in calls:
+            if cached.get(path, -1) < t:
+                preflights += 1
+                cached[path] = t + max_age
+        return preflights
+
+    baseline = len(calls) + count_preflights(5) + health_checks
+    fast = len(calls) + count_preflights(7200)
+    print(f"   {'方式':<12} {'预检':>6} {'到达Flask':>10} {'总请求':>8}")
+    print(f'   {"默认(5秒)":<10} {count_preflights(5):>8} {baseline:>10} {baseline:>8}')
+    print(f'   {"快速路径":<10} {count_preflights(7200):>8} {len(calls):>10} {fast + health_checks:>8}')
+    print(f'   到达 Flask 的请求减少 {(1 - len(calls) / baseline) * 100:.1f}%')
+
+    preflight = {'Origin': 'https://libretv.example.com', 'Access-Control-Request-Method': 'POST',
+                 'Access-Control-Request-Headers': 'authorization, content-type'}
+    print(f"   {'方式':<12} {'预检p50':>9} {'健康检查p50':>12} {'用户信息p50':>12}")
+    for name, enabled in (('Flask', False), ('快速路径', True)):
+        app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'RATE_LIMIT_ENABLED': False,
+                          'FAST_PATH_ENABLED': enabled})
+        app.logger.disabled = True
+        client = app.test_client()
+        try:
+            response = client.post('/api/auth/register',
+                                   json={'username': 'bench@example.com', 'password': 'benchpass123'})
+            token = next(cookie for cookie in response.headers.getlist('Set-Cookie')
+                         if cookie.startswith('accessToken=')).split(';', 1)[0].split('=', 1)[1]
+            headers = {'Authorization': f'Bearer {token}'}
+            results = []
+            for func in (lambda: client.options('/api/user-favorites', headers=preflight),
+                         lambda: client.get('/api/health'),
+                         lambda: client.get('/api/auth/user-info', headers=headers)):
+                latencies = []
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    func()
+                    latencies.append((time.perf_counter() - start) * 1000)
+                results.append(percentile(latencies, 50))
+            print(f'   {name:<10} {results[0]:>7.3f}ms {results[1]:>10.3f}ms {results[2]:>10.3f}ms')
+        finally:
+            app.extensions['libretv'].close()
+
+
+def bench_bulk(rows=10000000, favorites_per_user=50, batch_size=50000):
+    """批量导入/导出速度：生成 rows 行 NDJSON（用户、收藏、每个用户一条观看历史），导入空库后再导出"""
+    from bulk_transfer import connection_runner, export_ndjson, import_ndjson
+
+    users = rows // (favorites_per_user + 2)
+    print(f'🔍 NDJSON 批量导入/导出基准（{rows} 行，{users} 个用户，每批 {batch_size} 行）')
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'export.ndjson')
+        written = 0
+        with open(source, 'wb') as output:
+            output.write(b'{"type":"meta","version":1}\n')
+            for u in range(users):
+                username = f'user{u}@example.com'
+                lines = [json.dumps({'type': 'user', 'username': username, 'password_hash': 'x' * 64,
+                                     'email': None, 'created_at': '2024-01-01 00:00:00'})]
+                for f in range(favorites_per_user):
+                    data = json.dumps({'vod_id': f'{u}-{f}', 'vod_name': f'{TITLE_WORDS[f % len(TITLE_WORDS)]} {f}',
+                                       'source_code': SOURCE_NAMES[f % len(SOURCE_NAMES)]}, ensure_ascii=False)
+                    lines.append(json.dumps({'type': 'favorite', 'user': username, 'key': f'fav_{f}', 'data': data},
+                                            ensure_ascii=False))
+                history = json.dumps([{'title': TITLE_WORDS[u % len(TITLE_WORDS)], 'episodeIndex': 1,
+                                       'timestamp': 1700000000000 + u}], ensure_ascii=False)
+                lines.append(json.dumps({'type': 'history', 'user': username,
+                                         'key': f'{username}_viewingHistory', 'data': history}, ensure_ascii=False))
+                output.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                written += len(lines)
+        size = os.path.getsize(source)
+
+        db_path = os.path.join(tmp, 'bulk.db')
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        init_db(conn)
+        try:
+            with open(source, 'rb') as lines:
+                start = time.perf_counter()
+                stats = import_ndjson(lines, connection_runner(conn), 'bench', batch_size=batch_size,
+                                      defer_indexes=True)
+                imported = time.perf_counter() - start
+            start = time.perf_counter()
+            exported_bytes = sum(len(line) for line in export_ndjson(conn))
+            exported = time.perf_counter() - start
+        finally:
+            conn.close()
+        db_size = os.path.getsize(db_path)
+
+    print(f'   NDJSON {size / 1024 / 1024:.0f}MB，数据库 {db_size / 1024 / 1024:.0f}MB')
+    print(f"   导入 {written} 行: {imported:.1f}s，{written / imported:,.0f} 行/秒"
+          f"（用户 {stats['users']}，收藏 {stats['favorites']}，历史 {stats['history']}）")
+    print(f"   其中重建片库索引 {stats['index_seconds']:.1f}s，"
+          f"写入 {written / (imported - stats['index_seconds']):,.0f} 行/秒")
+    print(f'   导出 {written} 行: {exported:.1f}s，{written / exported:,.0f} 行/秒（{exported_bytes / 1024 / 1024:.0f}MB）')
+
+
+def bench_library(items=50000, users=3, history_items=50, queries=50):
+    """对比下载整个片库后客户端过滤与 FTS5 片库索引的搜索耗时"""
+    print(f'🔍 片库搜索基准（{users} 个用户，每人 {items} 条收藏+历史，历史按前端上限 {history_items} 条）')
+    random.seed(items)
+
+    def make_title(i):
+        return f'{TITLE_WORDS[i % len(TITLE_WORDS)]}{random.choice(TITLE_WORDS)} 第{i}部'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'library.db'))
+        conn.execute('PRAGMA journal_mode=WAL')
+        init_db(conn)
+        favorites = items - history_items
+        start = time.perf_counter()
+        for user_id in range(1, users + 1):
+            conn.executemany(
+                'INSERT INTO user_favorites (user_id, key, data) VALUES (?, ?, ?)',
+                ((user_id, f'fav_{i}', json.dumps({'vod_id': str(i), 'vod_name': make_title(i), 'source_code': 'heimuer'},
+                                                  ensure_ascii=False)) for i in range(favorites))
+            )
+            conn.commit()
+        elapsed = time.perf_counter() - start
+        print(f'   收藏写入并同步索引 {favorites * users / elapsed:.0f} 行/秒，'
+              f"索引行数 {conn.execute('SELECT COUNT(*) FROM library_items').fetchone()[0]}")
+
+        history = [dict(make_history_item(i), title=make_title(favorites + i)) for i in range(history_items)]
+        conn.execute('INSERT INTO viewing_history (user_id, key, data) VALUES (?, ?, ?)',
+                      (1, 'user1_viewingHistory', json.dumps(history, ensure_ascii=False)))
+        conn.commit()
+
+        def save_progress():
+            history[0]['playbackPosition'] += 10
+            conn.execute('INSERT OR REPLACE INTO viewing_history (user_id, key, data) VALUES (?, ?, ?)',
+                         (1, 'user1_viewingHistory', json.dumps(history, ensure_ascii=False)))
+            conn.commit()
+
+        print(f'   保存一次播放进度（{history_items} 条历史，含增量同步） {timeit(save_progress):.2f}ms')
+
+        terms = [make_title(random.randrange(items)).split(' ')[0][:n] for n in (4, 3) for _ in range(queries // 2)]
+        short_terms = [random.choice(TITLE_WORDS)[:2] for _ in range(queries)]
+
+        def client_side(term):
+            # 现状：客户端拉取全部收藏和历史后按标题过滤
+            rows = conn.execute('SELECT data FROM user_favorites WHERE user_id = ?', (1,)).fetchall()
+            titles = [json.loads(row[0])['vod_name'] for row in rows]
+            data = conn.execute('SELECT data FROM viewing_history WHERE user_id = ?', (1,)).fetchone()[0]
+            titles.extend(item['title'] for item in json.loads(data))
+            return [title for title in titles if term in title][:20]
+
+        print(f"   {'方式':<14} {'p50':>9} {'p99':>9}")
+        for name, search, words in (('下载全部+过滤', client_side, terms),
+                                    ('FTS5 trigram', lambda t: search_library(conn, 1, t, limit=20), terms),
+                                    ('2字 LIKE', lambda t: search_library(conn, 1, t, limit=20), short_terms)):
+            latencies = []
+            for term in words:
+                begin = time.perf_counter()
+                search(term)
+                latencies.append((time.perf_counter() - begin) * 1000)
+            print(f'   {name:<14} {percentile(latencies, 50):>7.2f}ms {percentile(latencies, 99):>7.2f}ms')
+        conn.close()
+
+
+def bench_usernames(users=1000000, probes=5000, threads=8):
+    """对比有无布隆过滤器时 check-username 的吞吐（探测不存在的用户名）"""
+    print(f'🔍 用户名检查基准（{users} 个已注册用户，{threads} 线程，探测新用户名）')
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'users.db')
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            init_db(conn)
+            conn.executemany('INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)',
+                             ((f'user{i}@example.com', 'x', f'user{i}@example.com') for i in range(users)))
+
+        print(f"   {'模式':<10} {'吞吐':>10} {'p50':>8} {'p99':>8}  索引")
+        for name, enabled in (('直接查库', False), ('布隆过滤器', True)):
+            app = create_app({'DB_PATH': db_path, 'LOG_DIR': '', 'RATE_LIMIT_ENABLED': False,
+                              'USER_INDEX_ENABLED': enabled})
+            app.logger.disabled = True
+            resources = app.extensions['libretv']
+            client = app.test_client()
+            index_info = ''
+            try:
+                if enabled:
+                    start = time.perf_counter()
+                    resources.user_index.wait_ready()
+                    stats = resources.user_index.stats()
+                    index_info = (f"构建 {time.perf_counter() - start:.1f}s，{stats['bytes'] / 1024 / 1024:.1f}MB，"
+                                  f"{stats['items']} 项")
+                latencies = []
+                lock = threading.Lock()
+
+                def worker(i):
+                    for n in range(probes // threads):
+                        begin = time.perf_counter()
+                        client.post('/api/auth/check-username', json={'username': f'probe{i}_{n}@example.com'},
+                                    headers={'X-Forwarded-For': f'10.{i}.0.1'})
+                        with lock:
+                            latencies.append((time.perf_counter() - begin) * 1000)
+
+                elapsed = run_concurrently(worker, threads)
+                print(f'   {name:<10} {len(latencies) / elapsed:>7.0f}/秒 {percentile(latencies, 50):>6.2f}ms '
+                      f'{percentile(latencies, 99):>6.2f}ms  {index_info}')
+                if enabled:
+                    stats = resources.user_index.stats()
+                    print(f"   过滤器拦截 {stats['negatives']} 次，误判 {stats['false_positives']} 次")
+            finally:
+                resources.close()
+
+
+def bench_shards(shard_counts=(1, 4, 16), threads=64, ops_per_thread=200, history_ops_per_thread=20):
+    """
+    按用户分片的并发写入扩展性：每个线程代表一个用户
+    - 收藏：单行小写入，主要开销在 Python 端
+    - 观看历史：保存50条的历史数组，触发器在 SQLite 中解析 JSON 并更新片库索引，该部分执行时释放 GIL
+    """
+    print(f'🔍 分片写入扩展性基准（{threads} 个并发用户，CPU {os.cpu_count()} 核）')
+    favorite = json.dumps(make_history_item(1), ensure_ascii=False)
+    history = json.dumps(make_history(50), ensure_ascii=False)
+    workloads = [
+        ('收藏', ops_per_thread, lambda user_id, n: (
+            'INSERT OR REPLACE INTO user_favorites (user_id, key, data) VALUES (?, ?, ?)',
+            (user_id, f'fav_{n}', favorite))),
+        ('观看历史', history_ops_per_thread, lambda user_id, n: (
+            'INSERT OR REPLACE INTO viewing_history (user_id, key, data) VALUES (?, ?, ?)',
+            (user_id, f'user{user_id}_viewingHistory', history))),
+    ]
+    for name, ops, statement in workloads:
+        print(f'   {name}（每个用户 {ops} 次写入）')
+        baseline = None
+        for count in shard_counts:
+            with tempfile.TemporaryDirectory() as tmp:
+                db_path = os.path.join(tmp, 'libretv.db')
+                shards = [Shard(index, shard_path(db_path, index), init_user_tables) for index in range(count)]
+                latencies = []
+                lock = threading.Lock()
+
+                def worker(i):
+                    user_id = i + 1
+                    writer = shards[shard_index(user_id, count)].db_writer
+                    samples = []
+                    for n in range(ops):
+                        start = time.perf_counter()
+                        writer.execute(*statement(user_id, n))
+                        samples.append((time.perf_counter() - start) * 1000)
+                    with lock:
+                        latencies.extend(samples)
+
+                for shard in shards:
+                    shard.db_writer  # 预先启动写线程，不计入耗时
+                elapsed = run_concurrently(worker, threads)
+                commits = sum(shard.db_writer.stats()['commits'] for shard in shards)
+                for shard in shards:
+                    shard.close()
+
+            throughput = len(latencies) / elapsed
+            baseline = baseline or throughput
+            print(f'     {count:>2} 个分片  吞吐 {throughput:>8.0f} 次/秒（{throughput / baseline:.2f}x）  '
+                  f'p50 {percentile(latencies, 50):>7.2f}ms  p99 {percentile(latencies, 99):>8.2f}ms  '
+                  f'每次提交合并 {len(latencies) / commits:.1f} 个写操作')
+
+
+BENCHMARKS = {
+    'json': bench_json,
+    'writer': bench_writer,
+    'hls': bench_hls,
+    'bootstrap': bench_bootstrap,
+    'library': bench_library,
+    'usernames': bench_usernames,
+    'fast_path': bench_fast_path,
+    'bulk': bench_bulk,
+    'shards': bench_shards,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"❌ 未知的基准: {name}，可选: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+
+    print('=' * 60)
+    print('LibreTV 后端性能基准')
+    print('=' * 60)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端用户数据批量导出/导入（NDJSON）
+- 每行一个JSON对象，type 为 meta / user / favorite / history；收藏和历史用用户名关联用户，
+  数据库自增ID不导出，可以在实例之间迁移
+- 导出逐行从游标读取，导入每 batch_size 行用 executemany 在一个事务中写入，内存占用与总行数无关
+- 导入进度（已提交的行数）与该批数据在同一事务中写入 bulk_import_checkpoints，
+  中断后用同一个 import_id 重新导入同一份文件，会跳过已提交的行继续
+- 导入期间可以先删除片库搜索和继续观看的派生索引，导入完成后一次性重建回填，避免逐行触发器；
+  删除期间这些表不存在，只能在服务停止时使用（命令行默认开启，管理接口不提供）
+- 已存在的用户名保留原账号不覆盖；收藏和历史按 (用户, key) 覆盖写入
+- 按用户分片存储时，用户和进度写入主库，收藏和历史按用户写入所在分片；一批数据分别在主库和各分片提交，
+  中断后重新执行会按进度重做未记录的整批，覆盖写入保证重做的结果相同
+
+命令行用法（直接读写数据库文件，建议在服务停止时执行）：
+    python bulk_transfer.py export data/libretv.db backup.ndjson.gz
+    python bulk_transfer.py import data/libretv.db backup.ndjson.gz --import-id restore-1
+    python bulk_transfer.py export data/libretv.db backup.ndjson.gz --shards 4   # 分片存储
+"""
+
+import argparse
+import gzip
+import json
+import sqlite3
+import sys
+import time
+
+from library_index import drop_library_index, init_library_index
+from sharding import shard_index, shard_path
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库（导入导出速度约为一半）
+    orjson = None
+
+
+FORMAT_VERSION = 1
+
+USER_FIELDS = ('username', 'password_hash', 'email', 'created_at', 'last_login', 'is_active')
+
+# 导出类型 -> (表名, 行类型)
+LIBRARY_TABLES = {'favorites': ('user_favorites', 'favorite'), 'history': ('viewing_history', 'history')}
+EXPORT_KINDS = ('users', 'favorites', 'history')
+
+CHECKPOINT_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS bulk_import_checkpoints (
+        import_id TEXT PRIMARY KEY,
+        lines INTEGER NOT NULL,
+        finished BOOLEAN DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+class InvalidRecord(ValueError):
+    """导入数据格式错误，line 为出错的行号（从1开始）"""
+
+    def __init__(self, message, line):
+        super().__init__(f'第 {line} 行: {message}')
+        self.line = line
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj) + b'\n'
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+def export_ndjson(conn, kinds=EXPORT_KINDS, fetch_size=1000, shard_conns=None):
+    """
+    按行生成 NDJSON（bytes）；每个连接的读事务覆盖整个导出过程，每个数据库文件导出的都是一致的快照
+    :param conn: 主库连接（用户表）
+    :param shard_conns: 各分片的连接（0号为主库，可以就是 conn），不分片时为None
+    """
+    shard_conns = shard_conns or [conn]
+    conns = [conn] + [shard_conn for shard_conn in shard_conns if shard_conn is not conn]
+    yield _dumps({'type': 'meta', 'version': FORMAT_VERSION, 'exported_at': int(time.time()), 'kinds': list(kinds)})
+    for each in conns:
+        each.execute('BEGIN')
+    try:
+        if 'users' in kinds:
+            cursor = conn.execute(f"SELECT {', '.join(USER_FIELDS)} FROM users ORDER BY id")
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield _dumps({'type': 'user', **dict(zip(USER_FIELDS, row))})
+
+        for kind in kinds:
+            if kind not in LIBRARY_TABLES:
+                continue
+            table, row_type = LIBRARY_TABLES[kind]
+            for shard_conn in shard_conns:
+                cursor = shard_conn.execute(f'SELECT user_id, key, data, created_at FROM {table} ORDER BY id')
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    # 分片中没有用户表，按本批涉及的用户ID到主库查询用户名；已不存在的用户的数据不导出
+                    user_ids = list({row[0] for row in rows})
+                    usernames = {}
+                    for start in range(0, len(user_ids), 500):
+                        chunk = user_ids[start:start + 500]
+                        usernames.update(conn.execute(
+                            f"SELECT id, username FROM users WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                        ).fetchall())
+                    for user_id, key, data, created_at in rows:
+                        username = usernames.get(user_id)
+                        if username is None:
+                            continue
+                        # data 原样作为字符串导出，不解析，导入时原样写回
+                        yield _dumps({'type': row_type, 'user': username, 'key': key, 'data': data,
+                                      'created_at': created_at})
+    finally:
+        for each in conns:
+            each.rollback()
+
+
+def _parse(line, number):
+    try:
+        record = _loads(line)
+    except ValueError:
+        raise InvalidRecord('不是有效的JSON', number)
+    if not isinstance(record, dict):
+        raise InvalidRecord('每行必须是JSON对象', number)
+    row_type = record.get('type')
+    if row_type == 'meta':
+        if record.get('version') != FORMAT_VERSION:
+            raise InvalidRecord(f"不支持的格式版本: {record.get('version')}", number)
+    elif row_type == 'user':
+        if not isinstance(record.get('username'), str) or not isinstance(record.get('password_hash'), str):
+            raise InvalidRecord('用户缺少 username 或 password_hash', number)
+    elif row_type in ('favorite', 'history'):
+        if not (isinstance(record.get('user'), str) and isinstance(record.get('key'), str)
+                and isinstance(record.get('data'), str)):
+            raise InvalidRecord(f'{row_type} 缺少 user、key 或 data', number)
+    else:
+        raise InvalidRecord(f'未知的行类型: {row_type}', number)
+    return record
+
+
+def _write_users(conn, users):
+    """写入用户（已存在的忽略），返回新增用户数"""
+    before = conn.total_changes
+    conn.executemany(
+        'INSERT OR IGNORE INTO users (username, password_hash, email, created_at, last_login, is_active) '
+        "VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, COALESCE(?, 1))",
+        [tuple(user.get(field) for field in USER_FIELDS) for user in users]
+    )
+    return conn.total_changes - before
+
+
+def _resolve_user_ids(conn, library):
+    """只查询本批涉及的用户名，不在内存中保存全部用户的映射"""
+    usernames = list({record['user'] for record in library})
+    user_ids = {}
+    for start in range(0, len(usernames), 500):
+        chunk = usernames[start:start + 500]
+        user_ids.update(conn.execute(
+            f"SELECT username, id FROM users WHERE username IN ({', '.join('?' * len(chunk))})", chunk
+        ).fetchall())
+    return user_ids
+
+
+def _library_rows(library, user_ids):
+    """返回 ({行类型: [(user_id, key, data, created_at), ...]}, 用户不存在而跳过的行数)"""
+    rows = {'favorite': [], 'history': []}
+    skipped = 0
+    for record in library:
+        user_id = user_ids.get(record['user'])
+        if user_id is None:
+            skipped += 1
+            continue
+        rows[record['type']].append((user_id, record['key'], record['data'], record.get('created_at')))
+    return rows, skipped
+
+
+def _write_library(conn, rows):
+    for row_type, table in (('favorite', 'user_favorites'), ('history', 'viewing_history')):
+        if rows[row_type]:
+            conn.executemany(
+                f'INSERT OR REPLACE INTO {table} (user_id, key, data, created_at) '
+                'VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))',
+                rows[row_type]
+            )
+
+
+def _save_checkpoint(conn, import_id, lines):
+    conn.execute(
+        'INSERT INTO bulk_import_checkpoints (import_id, lines) VALUES (?, ?) '
+        'ON CONFLICT(import_id) DO UPDATE SET lines = excluded.lines, updated_at = CURRENT_TIMESTAMP',
+        (import_id, lines)
+    )
+
+
+def _write_batch(conn, import_id, lines, users, library):
+    """在写事务中写入一批数据并记录进度，返回 (新增用户数, 写入收藏数, 写入历史数, 跳过行数)"""
+    created_users = _write_users(conn, users)
+    rows, skipped = _library_rows(library, _resolve_user_ids(conn, library))
+    _write_library(conn, rows)
+    _save_checkpoint(conn, import_id, lines)
+    return created_users, len(rows['favorite']), len(rows['history']), skipped
+
+
+def _write_sharded_batch(run, shard_runs, import_id, lines, users, library):
+    """分片存储：主库写入用户，各分片写入收藏和历史，最后在主库记录进度；返回值同 _write_batch"""
+    created_users, user_ids = run(lambda conn: (_write_users(conn, users), _resolve_user_ids(conn, library)))
+    rows, skipped = _library_rows(library, user_ids)
+    by_shard = {}
+    for row_type, typed_rows in rows.items():
+        for row in typed_rows:
+            index = shard_index(row[0], len(shard_runs))
+            by_shard.setdefault(index, {'favorite': [], 'history': []})[row_type].append(row)
+    for index, shard_rows in by_shard.items():
+        shard_runs[index](lambda conn, shard_rows=shard_rows: _write_library(conn, shard_rows))
+    run(lambda conn: _save_checkpoint(conn, import_id, lines))
+    return created_users, len(rows['favorite']), len(rows['history']), skipped
+
+
+def import_ndjson(lines, run, import_id, batch_size=50000, defer_indexes=False, on_users=None, shard_runs=None):
+    """
+    从可迭代的行（bytes 或 str）导入
+    :param run: run(func) 在写事务中执行 func(conn) 并提交，返回其返回值（DatabaseWriter.run 或 connection_runner）
+    :param shard_runs: 分片存储时各分片的 run（0号为主库），不分片时为None
+    :param import_id: 导入任务标识，用于断点续传
+    :param defer_indexes: 导入前删除派生索引，结束后重建回填
+    :param on_users: 每批用户提交后回调（包括已存在而被忽略的用户），参数为 [(username, email), ...]
+    :return: 统计字典
+    """
+    def setup(conn):
+        conn.execute(CHECKPOINT_SCHEMA)
+        row = conn.execute('SELECT lines, finished FROM bulk_import_checkpoints WHERE import_id = ?',
+                           (import_id,)).fetchone()
+        return row or (0, False)
+
+    resumed_from, finished = run(setup)
+    stats = {'import_id': import_id, 'resumed_from': resumed_from, 'lines': resumed_from, 'users': 0,
+             'favorites': 0, 'history': 0, 'skipped': 0, 'already_finished': bool(finished)}
+    if finished:
+        return stats
+
+    library_runs = shard_runs or [run]
+    sharded = len(library_runs) > 1
+    if defer_indexes:
+        for library_run in library_runs:
+            library_run(drop_library_index)
+    started = time.monotonic()
+    try:
+        number = 0
+        users, library = [], []
+
+        def flush():
+            batch_users, batch_library = users[:], library[:]
+            users.clear()
+            library.clear()
+            if sharded:
+                created, favorites, history, skipped = _write_sharded_batch(
+                    run, library_runs, import_id, number, batch_users, batch_library)
+            else:
+                created, favorites, history, skipped = run(
+                    lambda conn: _write_batch(conn, import_id, number, batch_users, batch_library))
+            stats['lines'] = number
+            stats['users'] += created
+            stats['favorites'] += favorites
+            stats['history'] += history
+            stats['skipped'] += skipped
+            if on_users is not None and created:
+                on_users([(user['username'], user.get('email')) for user in batch_users])
+
+        for number, line in enumerate(lines, 1):
+            if number <= resumed_from:
+                continue
+            if not line.strip():
+                continue
+            record = _parse(line, number)
+            if record['type'] == 'user':
+                users.append(record)
+            elif record['type'] != 'meta':
+                library.append(record)
+            if len(users) + len(library) >= batch_size:
+                flush()
+        flush()
+        run(lambda conn: conn.execute('UPDATE bulk_import_checkpoints SET finished = 1 WHERE import_id = ?',
+                                      (import_id,)))
+    finally:
+        if defer_indexes:
+            rebuild_started = time.monotonic()
+            for library_run in library_runs:
+                library_run(init_library_index)
+            stats['index_seconds'] = round(time.monotonic() - rebuild_started, 3)
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def connection_runner(conn):
+    """命令行使用：在给定连接上以独立事务执行写操作"""
+    def run(func):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(conn)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        return result
+    return run
+
+
+def _open_file(path, mode):
+    if path == '-':
+        return sys.stdout.buffer if 'w' in mode else sys.stdin.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LibreTV 用户数据批量导出/导入（NDJSON）')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='导出用户、收藏和观看历史')
+    export_parser.add_argument('db', help='数据库文件路径')
+    export_parser.add_argument('output', help="输出文件，.gz 结尾时压缩，'-' 为标准输出")
+    export_parser.add_argument('--kinds', default=','.join(EXPORT_KINDS), help='导出的类型，逗号分隔')
+    export_parser.add_argument('--shards', type=int, default=1, help='分片数（与服务的 SHARD_COUNT 一致）')
+
+    import_parser = commands.add_parser('import', help='导入 NDJSON 文件，可断点续传')
+    import_parser.add_argument('db', help='数据库文件路径')
+    import_parser.add_argument('input', help="输入文件，.gz 结尾时解压，'-' 为标准输入")
+    import_parser.add_argument('--import-id', required=True, help='导入任务标识，中断后使用相同标识继续')
+    import_parser.add_argument('--batch-size', type=int, default=50000, help='每个事务写入的行数')
+    import_parser.add_argument('--keep-indexes', action='store_true', help='导入期间保留派生索引（默认先删除再重建，服务运行时必须指定）')
+    import_parser.add_argument('--shards', type=int, default=1, help='分片数（与服务的 SHARD_COUNT 一致）')
+    args = parser.parse_args(argv)
+
+    conns = []
+    for index in range(max(1, args.shards)):
+        conn = sqlite3.connect(shard_path(args.db, index), isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conns.append(conn)
+    conn = conns[0]
+    try:
+        if args.command == 'export':
+            kinds = [kind for kind in args.kinds.split(',') if kind in EXPORT_KINDS]
+            with _open_file(args.output, 'wb') as output:
+                for line in export_ndjson(conn, kinds, shard_conns=conns):
+                    output.write(line)
+        else:
+            # 导入到新文件时先建表
+            from LibreProgramBackend import init_db, init_user_tables
+            init_db(conn)
+            for shard_conn in conns[1:]:
+                init_user_tables(shard_conn)
+            with _open_file(args.input, 'rb') as source:
+                stats = import_ndjson(source, connection_runner(conn), args.import_id,
+                                      batch_size=args.batch_size, defer_indexes=not args.keep_indexes,
+                                      shard_runs=[connection_runner(shard_conn) for shard_conn in conns])
+            print(json.dumps(stats, ensure_ascii=False))
+    except InvalidRecord as e:
+        print(f'导入失败: {str(e)}', file=sys.stderr)
+        return 1
+    finally:
+        for each in conns:
+            each.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端响应压缩
+根据 Accept-Encoding 协商 br/gzip，仅压缩超过阈值的响应，
+并按数据行版本缓存压缩结果，避免同一份数据在轮询时被重复压缩
+"""
+
+import gzip
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，未安装时只提供 gzip
+    brotli = None
+
+
+# 值得压缩的响应类型
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html', 'application/x-ndjson'}
+
+
+def parse_accept_encoding(header):
+    """解析 Accept-Encoding，返回 {编码: q值}"""
+    encodings = {}
+    for part in (header or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name.strip().lower()] = q
+    return encodings
+
+
+class ResponseCompressor:
+    def __init__(self, min_size=1024, cache_max_bytes=32 * 1024 * 1024,
+                 gzip_level=6, brotli_quality=5):
+        self.min_size = min_size
+        self.cache_max_bytes = cache_max_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        # (cache_key, encoding) -> 压缩后的字节，按最近使用排序
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def supported_encodings(self):
+        return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def choose_encoding(self, accept_encoding):
+        """选择客户端接受且服务端支持的编码，q 值相同时优先 br"""
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0.0
+        for encoding in self.supported_encodings:
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def _compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    def _cache_get(self, key):
+        with self.lock:
+            data = self.cache.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def _cache_put(self, key, data):
+        if len(data) > self.cache_max_bytes:
+            return
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.cache_bytes -= len(old)
+            self.cache[key] = data
+            self.cache_bytes += len(data)
+            while self.cache_bytes > self.cache_max_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= len(evicted)
+
+    def compress(self, body, encoding, cache_key=None):
+        """压缩响应体；提供 cache_key（包含数据版本）时复用已压缩的结果"""
+        if cache_key is None:
+            return self._compress(body, encoding)
+
+        key = (cache_key, encoding)
+        data = self._cache_get(key)
+        if data is None:
+            data = self._compress(body, encoding)
+            self._cache_put(key, data)
+        return data
+
+    def apply(self, response, accept_encoding, cache_key=None):
+        """按需压缩 Flask 响应，不满足条件时原样返回"""
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+
+        encoding = self.choose_encoding(accept_encoding)
+        if encoding is None:
+            return response
+
+        response.set_data(self.compress(body, encoding, cache_key))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def stats(self):
+        """压缩缓存统计"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.cache),
+                'bytes': self.cache_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端单写线程
+所有 SQLite 写操作提交到队列，由一个持有写连接的线程执行，
+队列中积压的写操作合并到同一个事务中提交（group commit）
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+
+_STOP = object()
+
+
+class DatabaseWriter:
+    """
+    单写线程
+    - submit(func) 提交写操作，返回 Future；func(conn) 在写线程中执行，返回值作为结果
+    - 每个写操作在独立的 SAVEPOINT 中执行，单个操作失败只回滚自己，不影响同批其它操作
+    - Future 在事务提交成功后才完成，调用方拿到结果时数据已落盘
+    """
+
+    def __init__(self, db_path, max_batch=256, busy_timeout=5.0, logger=None, uri=False):
+        self.db_path = db_path
+        self.uri = uri
+        self.max_batch = max_batch
+        self.busy_timeout = busy_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.operations = 0
+
+    def connect(self):
+        """创建写连接：手动管理事务，启用WAL使读连接不阻塞写入"""
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None, uri=self.uri)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self):
+        """启动写线程"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            ready = Future()
+            self.thread = threading.Thread(target=self._run, args=(ready,), name='sqlite-writer', daemon=True)
+            self.thread.start()
+        ready.result()
+
+    def stop(self):
+        """处理完队列中剩余的写操作后停止写线程"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return
+        self.queue.put(_STOP)
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def submit(self, func):
+        """提交写操作，返回Future"""
+        if self.thread is None:
+            self.start()
+        future = Future()
+        self.queue.put((func, future))
+        return future
+
+    def run(self, func, timeout=None):
+        """提交写操作并等待提交完成，返回func的返回值或抛出其异常"""
+        return self.submit(func).result(timeout)
+
+    def execute(self, sql, params=(), timeout=None):
+        """执行单条写语句，返回 (rowcount, lastrowid)"""
+        def mutation(conn):
+            cursor = conn.execute(sql, params)
+            return cursor.rowcount, cursor.lastrowid
+        return self.run(mutation, timeout)
+
+    def _run(self, ready):
+        try:
+            conn = self.connect()
+        except Exception as e:
+            self.logger.error(f"写线程打开数据库失败: {str(e)}")
+            with self.lock:
+                self.thread = None
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if _STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not _STOP]
+                # 停止前把队列里剩余的写操作一并处理
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _STOP:
+                        batch.append(item)
+
+            if batch:
+                self._commit_batch(conn, batch)
+
+        conn.close()
+
+    def _commit_batch(self, conn, batch):
+        """在一个事务中执行一批写操作"""
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for func, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute('SAVEPOINT mutation')
+                try:
+                    result = func(conn)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO mutation')
+                    conn.execute('RELEASE mutation')
+                    results.append((future, None, e))
+                else:
+                    conn.execute('RELEASE mutation')
+                    results.append((future, result, None))
+            conn.execute('COMMIT')
+        except Exception as e:
+            self.logger.error(f"批量写入事务失败: {str(e)}")
+            if conn.in_transaction:
+                conn.rollback()
+            for func, future in batch:
+                if not future.done():
+                    if not future.running():
+                        future.set_running_or_notify_cancel()
+                    future.set_exception(e)
+            return
+
+        self.commits += 1
+        self.operations += len(results)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        """写线程统计：平均每次提交合并的写操作数"""
+        return {
+            'queued': self.queue.qsize(),
+            'commits': self.commits,
+            'operations': self.operations,
+            'ops_per_commit': self.operations / self.commits if self.commits else 0.0
+        }
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端豆瓣数据缓存
+- 标签列表（/j/search_tags）和推荐页（/j/search_subjects）按TTL缓存，过期后先返回旧值再后台刷新
+- 同一页的并发未命中只请求一次豆瓣
+- 记录各标签/页的访问次数，后台线程定期刷新最热门、即将过期的页面
+- 推荐页中每个条目的海报信息按豆瓣ID单独缓存
+- 所有上游请求受每分钟请求额度限制，后台刷新只使用额度中超出预留部分的余量
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from media_proxy import ProxyError
+from ttl_cache import TTLCache
+
+
+# 与 js/douban.js 中 fetchDoubanData 的请求头一致
+DOUBAN_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
+    'Referer': 'https://movie.douban.com/',
+    'Accept': 'application/json, text/plain, */*'
+}
+
+# 海报信息中保留的字段
+POSTER_FIELDS = ('id', 'title', 'rate', 'cover', 'url', 'cover_x', 'cover_y', 'is_new', 'playable')
+
+
+class DoubanUnavailable(Exception):
+    """豆瓣请求失败或额度用完，且没有可用的缓存"""
+
+    def __init__(self, message, status=502, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RequestBudget:
+    """令牌桶：每分钟最多 per_minute 次上游请求"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.used = 0
+        self.rejected = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, reserve=0):
+        """取一个令牌；reserve 为需要保留给其它请求的令牌数"""
+        with self.lock:
+            self._refill()
+            if self.tokens - reserve < 1:
+                self.rejected += 1
+                return False
+            self.tokens -= 1
+            self.used += 1
+            return True
+
+    def retry_after(self):
+        """再等多少秒会有可用令牌"""
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1 or self.rate <= 0:
+                return 1
+            return max(1, int((1 - self.tokens) / self.rate) + 1)
+
+
+class DoubanService:
+    """豆瓣标签、推荐页和海报信息的缓存服务"""
+
+    def __init__(self, proxy, base_url='https://movie.douban.com', tags_ttl=6 * 3600, page_ttl=1800,
+                 stale_ttl=24 * 3600, max_entries=2000, poster_max_entries=20000, budget_per_minute=60,
+                 refresh_interval=300, refresh_top=20, wait_timeout=10.0, logger=None):
+        self.proxy = proxy
+        self.base_url = base_url.rstrip('/')
+        self.tags_ttl = tags_ttl
+        self.page_ttl = page_ttl
+        self.refresh_interval = refresh_interval
+        self.refresh_top = refresh_top
+        self.wait_timeout = wait_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.cache = TTLCache(max_entries=max_entries, ttl=page_ttl, stale_ttl=stale_ttl)
+        self.posters = TTLCache(max_entries=poster_max_entries, ttl=stale_ttl)
+        self.budget = RequestBudget(budget_per_minute)
+        # 后台刷新只在额度剩余超过一半时进行，保证用户请求优先
+        self.refresh_reserve = budget_per_minute / 2
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='douban-refresh')
+        self.lock = threading.Lock()
+        # 缓存键 -> threading.Event，正在从豆瓣获取的页面
+        self.inflight = {}
+        self.refreshing = set()
+        self.popularity = Counter()
+        self.max_tracked = max_entries
+        self.stopped = threading.Event()
+        self.thread = None
+        self.upstream_requests = 0
+        self.refreshes = 0
+
+    # ---- 上游请求 ----
+
+    def tags_url(self, media_type):
+        return f"{self.base_url}/j/search_tags?{urlencode({'type': media_type})}"
+
+    def subjects_url(self, media_type, tag, page_limit, page_start):
+        query = urlencode({'type': media_type, 'tag': tag, 'sort': 'recommend',
+                           'page_limit': page_limit, 'page_start': page_start})
+        return f'{self.base_url}/j/search_subjects?{query}'
+
+    def _fetch(self, key, background=False):
+        """按缓存键请求豆瓣并写入缓存；额度不足时抛出 DoubanUnavailable"""
+        if not self.budget.try_acquire(self.refresh_reserve if background else 0):
+            raise DoubanUnavailable('豆瓣请求过于频繁，请稍后再试', status=503,
+                                    retry_after=self.budget.retry_after())
+        url = self.tags_url(key[1]) if key[0] == 'tags' else self.subjects_url(*key[1:])
+        with self.lock:
+            self.upstream_requests += 1
+        try:
+            upstream = self.proxy.open('GET', url, DOUBAN_HEADERS)
+            if upstream.status != 200:
+                upstream.close()
+                raise DoubanUnavailable(f'豆瓣返回 {upstream.status}')
+            data = json.loads(upstream.read().decode('utf-8'))
+        except ProxyError as e:
+            raise DoubanUnavailable(str(e), status=e.status)
+        except ValueError:
+            raise DoubanUnavailable('豆瓣返回的不是有效JSON')
+
+        self.cache.put(key, data, ttl=self.tags_ttl if key[0] == 'tags' else self.page_ttl)
+        if key[0] == 'subjects' and isinstance(data, dict):
+            for subject in data.get('subjects') or []:
+                if isinstance(subject, dict) and subject.get('id'):
+                    self.posters.put(str(subject['id']), {field: subject.get(field) for field in POSTER_FIELDS})
+        return data
+
+    def _refresh_async(self, key):
+        """后台刷新一个缓存键，同一个键同时只刷新一次"""
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch(key, background=True)
+                with self.lock:
+                    self.refreshes += 1
+            except DoubanUnavailable as e:
+                self.logger.debug(f"豆瓣后台刷新跳过: {key}: {str(e)}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        self.executor.submit(refresh)
+
+    def _get(self, key):
+        """读取缓存，返回 (数据, 缓存状态 HIT/STALE/MISS)"""
+        with self.lock:
+            # 只统计有限数量的页面，避免任意标签把计数表撑大
+            if key in self.popularity or len(self.popularity) < self.max_tracked:
+                self.popularity[key] += 1
+        data, fresh = self.cache.lookup(key)
+        if data is not None:
+            if not fresh:
+                self._refresh_async(key)
+            return data, 'HIT' if fresh else 'STALE'
+
+        with self.lock:
+            event = self.inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self.inflight[key] = threading.Event()
+        if not leader:
+            event.wait(self.wait_timeout)
+            data = self.cache.get(key)
+            if data is None:
+                raise DoubanUnavailable('获取豆瓣数据失败')
+            return data, 'HIT'
+
+        try:
+            return self._fetch(key), 'MISS'
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            event.set()
+
+    # ---- 对外接口 ----
+
+    def get_tags(self, media_type):
+        return self._get(('tags', media_type))
+
+    def get_subjects(self, media_type, tag, page_limit, page_start):
+        return self._get(('subjects', media_type, tag, page_limit, page_start))
+
+    def get_poster(self, subject_id):
+        return self.posters.get(str(subject_id))
+
+    def refresh_popular(self):
+        """刷新访问次数最多且即将过期的页面，返回提交刷新的数量；访问次数每轮减半以反映近期热度"""
+        with self.lock:
+            popular = [key for key, _ in self.popularity.most_common(self.refresh_top)]
+            self.popularity = Counter({key: count // 2 for key, count in self.popularity.items() if count > 1})
+        submitted = 0
+        for key in popular:
+            remaining = self.cache.remaining_ttl(key)
+            if remaining is None or remaining < self.refresh_interval:
+                self._refresh_async(key)
+                submitted += 1
+        return submitted
+
+    def start(self):
+        """启动定期刷新热门页面的后台线程"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='douban-refresher', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.refresh_popular()
+            except Exception as e:
+                self.logger.error(f"刷新豆瓣热门页面失败: {str(e)}")
+
+    def close(self):
+        self.stopped.set()
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'cache': self.cache.stats(),
+                'posters': len(self.posters),
+                'upstream_requests': self.upstream_requests,
+                'background_refreshes': self.refreshes,
+                'budget_used': self.budget.used,
+                'budget_rejected': self.budget.rejected,
+                'tracked_pages': len(self.popularity)
+            }
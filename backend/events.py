@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端用户事件分发（Server-Sent Events）
+- 写入提交后调用 publish()，事件写入主库的 user_events 表，所有工作进程共享；
+  事件ID由 AUTOINCREMENT 分配，按提交顺序递增，同时作为版本号
+- 每个进程一个分发中心和一个轮询线程，按ID游标读取新事件，追加到本进程该用户所有订阅者的队列；
+  本进程发布后立即唤醒轮询线程，其它进程的事件最多延迟一个轮询间隔
+- 订阅者只是一个有界队列加一个 Event，由各自的响应生成器在请求协程里等待，
+  每个连接都会占住一个请求处理单元，需要 gevent 等协程服务器（见 start.py 和部署说明）
+- 断线重连时从事件表按 Last-Event-ID 补发；缺口太大或事件已过保留期时发送 resync 让客户端全量拉取
+"""
+
+import json
+import logging
+import threading
+import time
+
+
+EVENT_LOG_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS user_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_user_events_user ON user_events (user_id, id)',
+)
+
+# 每次轮询最多读取的事件数，积压更多时连续读取
+POLL_BATCH = 500
+
+
+def init_event_log(conn):
+    """创建事件表"""
+    for statement in EVENT_LOG_SCHEMA:
+        conn.execute(statement)
+
+
+class HubFull(Exception):
+    """订阅数达到上限"""
+
+
+class EventLog:
+    """user_events 表的读写：写入经由单写线程，读取每次使用新的读连接"""
+
+    def __init__(self, connect, writer):
+        self.connect = connect
+        self.writer = writer
+
+    def _query(self, sql, params=()):
+        conn = self.connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def append(self, events):
+        """写入 [(user_id, type, data)]，返回各事件的ID"""
+        now = time.time()
+        rows = [(user_id, event_type, json.dumps(data, ensure_ascii=False), now)
+                for user_id, event_type, data in events]
+        return self.writer.run(lambda conn: [
+            conn.execute('INSERT INTO user_events (user_id, type, data, created_at) VALUES (?, ?, ?, ?)',
+                         row).lastrowid
+            for row in rows
+        ])
+
+    def since(self, after, limit):
+        """ID大于 after 的事件 [(id, user_id, type, data)]"""
+        rows = self._query('SELECT id, user_id, type, data FROM user_events WHERE id > ? ORDER BY id LIMIT ?',
+                           (after, limit))
+        return [(event_id, user_id, event_type, json.loads(data)) for event_id, user_id, event_type, data in rows]
+
+    def for_user(self, user_id, after, upto, limit):
+        """某个用户ID在 (after, upto] 之间的事件 [(id, type, data)]"""
+        rows = self._query('SELECT id, type, data FROM user_events WHERE user_id = ? AND id > ? AND id <= ? '
+                           'ORDER BY id LIMIT ?', (user_id, after, upto, limit))
+        return [(event_id, event_type, json.loads(data)) for event_id, event_type, data in rows]
+
+    def bounds(self):
+        """返回 (已删除的最大ID, 已分配的最大ID)"""
+        oldest = self._query('SELECT MIN(id) FROM user_events')[0][0]
+        sequence = self._query("SELECT seq FROM sqlite_sequence WHERE name = 'user_events'")
+        last_id = sequence[0][0] if sequence else 0
+        return (oldest - 1 if oldest is not None else last_id), last_id
+
+    def prune(self, before):
+        """删除早于 before（时间戳）的事件"""
+        return self.writer.execute('DELETE FROM user_events WHERE created_at < ?', (before,))[0]
+
+
+class Subscriber:
+    """单个事件流连接"""
+
+    __slots__ = ('user_id', 'events', 'ready', 'max_queue')
+
+    def __init__(self, user_id, max_queue):
+        self.user_id = user_id
+        self.events = []
+        self.ready = threading.Event()
+        self.max_queue = max_queue
+
+    def push(self, event):
+        if len(self.events) >= self.max_queue:
+            # 客户端消费太慢，丢弃积压，通知客户端全量同步
+            self.events.clear()
+            event = (event[0], 'resync', {})
+        self.events.append(event)
+        self.ready.set()
+
+
+class EventHub:
+    """按用户分发事件，本进程的订阅者从共享事件表轮询得到所有进程发布的事件"""
+
+    def __init__(self, log, max_queue=256, history_size=100, max_subscribers=5000, max_per_user=5,
+                 poll_interval=0.5, retention=3600, prune_interval=60, logger=None):
+        self.log = log
+        self.max_queue = max_queue
+        self.history_size = history_size
+        self.max_subscribers = max_subscribers
+        self.max_per_user = max_per_user
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        # user_id -> set(Subscriber)
+        self.subscribers = {}
+        self.subscriber_count = 0
+        # 已分发的最大事件ID，只由持有 poll_lock 的轮询修改
+        self.poll_lock = threading.Lock()
+        self.cursor = log.bounds()[1]
+        self.pruned_at = time.monotonic()
+        self.published = 0
+        self.delivered = 0
+        self.polls = 0
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='event-poller', daemon=True)
+        self.thread.start()
+
+    def publish(self, user_id, event_type, data):
+        """发布单个事件，返回事件ID"""
+        return self.publish_many([(user_id, event_type, data)])[0]
+
+    def publish_many(self, events):
+        """在一个事务中写入多个 (user_id, type, data)，返回事件ID列表"""
+        ids = self.log.append(events)
+        with self.lock:
+            self.published += len(ids)
+        self.wakeup.set()
+        return ids
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            if self.stopped:
+                break
+            try:
+                self.poll()
+                if time.monotonic() - self.pruned_at >= self.prune_interval:
+                    self.pruned_at = time.monotonic()
+                    self.log.prune(time.time() - self.retention)
+            except Exception as e:
+                self.logger.warning(f"读取事件表失败: {str(e)}")
+
+    def poll(self):
+        """读取游标之后的新事件并分发给本进程的订阅者，返回读取的事件数"""
+        count = 0
+        with self.poll_lock:
+            while True:
+                events = self.log.since(self.cursor, POLL_BATCH)
+                with self.lock:
+                    for event_id, user_id, event_type, data in events:
+                        subscribers = self.subscribers.get(user_id, ())
+                        for subscriber in subscribers:
+                            subscriber.push((event_id, event_type, data))
+                        self.delivered += len(subscribers)
+                    if events:
+                        self.cursor = events[-1][0]
+                    self.polls += 1
+                count += len(events)
+                if len(events) < POLL_BATCH:
+                    return count
+
+    def _replay(self, user_id, last_event_id, upto):
+        """从事件表取 (last_event_id, upto] 之间的事件；无法补全时返回一个 resync"""
+        pruned_through, last_id = self.log.bounds()
+        # 客户端的ID来自已清空的库或旧版本，或者之后的事件已过保留期被删除
+        if last_event_id > last_id or last_event_id < pruned_through:
+            return [(upto, 'resync', {})]
+        if last_event_id >= upto:
+            return []
+        events = self.log.for_user(user_id, last_event_id, upto, self.history_size + 1)
+        if len(events) > self.history_size:
+            return [(upto, 'resync', {})]
+        return events
+
+    def subscribe(self, user_id, last_event_id=None):
+        """订阅用户事件；提供 last_event_id 时补发之后的事件"""
+        with self.lock:
+            user_subscribers = self.subscribers.get(user_id, set())
+            if self.subscriber_count >= self.max_subscribers or len(user_subscribers) >= self.max_per_user:
+                raise HubFull('事件连接数已达上限')
+            subscriber = Subscriber(user_id, self.max_queue)
+            user_subscribers.add(subscriber)
+            self.subscribers[user_id] = user_subscribers
+            self.subscriber_count += 1
+            # 注册之后分发的事件都大于 upto，补发的部分不会与之重复或遗漏
+            upto = self.cursor
+        if last_event_id is None:
+            return subscriber
+
+        try:
+            replay = self._replay(user_id, last_event_id, upto)
+        except Exception:
+            self.unsubscribe(subscriber)
+            raise
+        with self.lock:
+            live, subscriber.events = subscriber.events, []
+            for event in replay + live:
+                subscriber.push(event)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            user_subscribers = self.subscribers.get(subscriber.user_id)
+            if user_subscribers and subscriber in user_subscribers:
+                user_subscribers.discard(subscriber)
+                self.subscriber_count -= 1
+                if not user_subscribers:
+                    del self.subscribers[subscriber.user_id]
+        subscriber.ready.set()
+
+    def wait(self, subscriber, timeout):
+        """等待并取出该订阅者积压的事件，超时返回空列表"""
+        if not subscriber.events:
+            subscriber.ready.wait(timeout)
+        with self.lock:
+            events, subscriber.events = subscriber.events, []
+            subscriber.ready.clear()
+        return events
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': self.subscriber_count,
+                'users': len(self.subscribers),
+                'published': self.published,
+                'delivered': self.delivered,
+                'cursor': self.cursor,
+                'polls': self.polls
+            }
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端请求快速路径（WSGI 中间件）
+- 在 Flask 路由之前直接应答 CORS 预检（OPTIONS）和健康检查，不经过路由、请求钩子、限流和日志
+- 预检响应带 Access-Control-Max-Age，浏览器在有效期内不再为同一接口重复预检；有效期可按来源单独配置
+- 响应头按 (来源, 请求头) 缓存，重复的预检只做一次字典查找
+- 预检的允许方法与 flask-cors 默认配置一致，其它请求原样交给 Flask
+"""
+
+import threading
+
+
+# 与 flask-cors 默认的 methods 一致
+ALLOW_METHODS = 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+
+
+def parse_origin_max_age(spec):
+    """解析 'https://a.example=86400,https://b.example=600' 形式的按来源预检有效期配置"""
+    result = {}
+    for item in spec.split(','):
+        origin, _, seconds = item.strip().rpartition('=')
+        if origin:
+            result[origin.rstrip('/')] = int(seconds)
+    return result
+
+
+class FastPathMiddleware:
+    """
+    包装 Flask 的 wsgi_app
+    :param prefixes: 只对这些路径前缀应答预检，其它路径的 OPTIONS 交给 Flask（未知路径仍返回404）
+    :param health_body: 健康检查响应体（与 /api/health 接口的 JSON 一致）
+    """
+
+    def __init__(self, app, max_age=7200, origin_max_age=None, prefixes=('/api/', '/proxy/'),
+                 health_path='/api/health', health_body=b'', health_mimetype='application/json',
+                 max_cached=1024):
+        self.app = app
+        self.max_age = max_age
+        self.origin_max_age = origin_max_age or {}
+        self.prefixes = tuple(prefixes)
+        self.health_path = health_path
+        self.health_body = health_body
+        self.health_headers = [('Content-Type', health_mimetype), ('Content-Length', str(len(health_body)))]
+        self.max_cached = max_cached
+        self.lock = threading.Lock()
+        # (来源, 请求头) -> 预检响应头列表
+        self.preflight_headers = {}
+        # 计数不加锁，多线程下可能略少于实际值，只用于观察比例
+        self.preflights = 0
+        self.health_checks = 0
+        self.passed = 0
+
+    def _preflight_headers(self, origin, request_headers):
+        key = (origin, request_headers)
+        headers = self.preflight_headers.get(key)
+        if headers is not None:
+            return headers
+        max_age = self.origin_max_age.get(origin.rstrip('/'), self.max_age)
+        headers = [
+            ('Access-Control-Allow-Origin', origin),
+            ('Access-Control-Allow-Methods', ALLOW_METHODS),
+            ('Vary', 'Origin, Access-Control-Request-Headers'),
+            ('Content-Length', '0')
+        ]
+        if request_headers:
+            # 与 flask-cors 相同：按请求回显允许的请求头（小写、排序）
+            allowed = ', '.join(sorted({name.strip().lower() for name in request_headers.split(',') if name.strip()}))
+            headers.append(('Access-Control-Allow-Headers', allowed))
+        if max_age > 0:
+            headers.append(('Access-Control-Max-Age', str(max_age)))
+        with self.lock:
+            if len(self.preflight_headers) >= self.max_cached:
+                # 来源和请求头组合通常只有几个，超出说明有人在构造请求，直接清空
+                self.preflight_headers.clear()
+            self.preflight_headers[key] = headers
+        return headers
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '')
+
+        if method == 'OPTIONS' and path.startswith(self.prefixes):
+            origin = environ.get('HTTP_ORIGIN')
+            if origin and environ.get('HTTP_ACCESS_CONTROL_REQUEST_METHOD'):
+                headers = self._preflight_headers(origin, environ.get('HTTP_ACCESS_CONTROL_REQUEST_HEADERS', ''))
+                self.preflights += 1
+                start_response('204 No Content', list(headers))
+                return [b'']
+
+        elif path == self.health_path and method in ('GET', 'HEAD'):
+            headers = list(self.health_headers)
+            headers.append(('Access-Control-Allow-Origin', environ.get('HTTP_ORIGIN') or '*'))
+            self.health_checks += 1
+            start_response('200 OK', headers)
+            return [b''] if method == 'HEAD' else [self.health_body]
+
+        self.passed += 1
+        return self.app(environ, start_response)
+
+    def stats(self):
+        with self.lock:
+            cached = len(self.preflight_headers)
+        total = self.preflights + self.health_checks + self.passed
+        return {
+            'preflights': self.preflights,
+            'health_checks': self.health_checks,
+            'passed': self.passed,
+            'fast_path_share': (self.preflights + self.health_checks) / total if total else 0.0,
+            'cached_headers': cached
+        }
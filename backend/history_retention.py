@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端观看历史保留策略与压缩
+- 前端 syncConfig 每次合并远程和本地历史后整体回传，服务端不限制时历史数组只增不减
+- 保留策略：每个key最多保留 max_items 条最近的记录、丢弃早于 max_age 的记录、序列化后不超过 max_bytes；
+  写入接口保存前执行，后台压缩任务定期对已保存的历史执行同样的裁剪
+- 压缩任务逐个分片按ID分批扫描，只重写有变化的行；写入前确认该行在扫描后没有被用户重新保存，不会覆盖新数据
+- 裁剪释放的页在 auto_vacuum=INCREMENTAL 的库上由 incremental_vacuum 归还给文件系统；
+  新建的库默认启用，旧库需在服务停止时执行一次 vacuum 命令转换
+
+命令行用法（服务停止时执行）：
+    python history_retention.py vacuum data/libretv.db --shards 4
+    python history_retention.py usage data/libretv.db --limit 20
+"""
+
+import argparse
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+from sharding import shard_path
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库
+    orjson = None
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _timestamp(item):
+    """前端历史条目的毫秒时间戳，没有时返回None"""
+    if isinstance(item, dict):
+        value = item.get('timestamp')
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+    return None
+
+
+class RetentionPolicy:
+    """
+    观看历史保留策略，各项为0表示不限制
+    :param max_items: 每个key最多保留的条目数
+    :param max_age: 最长保留时间（秒）
+    :param max_bytes: 序列化后的最大字节数，超出时从最旧的条目开始删除
+    """
+
+    def __init__(self, max_items=0, max_age=0, max_bytes=0):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self):
+        return bool(self.max_items or self.max_age or self.max_bytes)
+
+    def apply(self, items, now=None):
+        """
+        裁剪历史数组，返回 (保留的条目, 删除的条目数)；保留的条目维持原有顺序
+        没有时间戳的条目不按时间删除，按条数和大小裁剪时视为最旧
+        """
+        if not isinstance(items, list) or not self.enabled:
+            return items, 0
+        cutoff = ((time.time() if now is None else now) - self.max_age) * 1000 if self.max_age else None
+        # 按时间从新到旧排列的下标
+        ranked = sorted(range(len(items)), key=lambda i: _timestamp(items[i]) or float('-inf'), reverse=True)
+        if cutoff is not None:
+            ranked = [i for i in ranked if (_timestamp(items[i]) is None or _timestamp(items[i]) >= cutoff)]
+        if self.max_items:
+            ranked = ranked[:self.max_items]
+        if self.max_bytes and len(ranked) and len(_dumps([items[i] for i in sorted(ranked)])) > self.max_bytes:
+            size = 2  # 数组的方括号
+            for count, i in enumerate(ranked):
+                size += len(_dumps(items[i])) + (1 if count else 0)
+                if size > self.max_bytes:
+                    ranked = ranked[:count]
+                    break
+        if len(ranked) == len(items):
+            return items, 0
+        return [items[i] for i in sorted(ranked)], len(items) - len(ranked)
+
+    def stats(self):
+        return {'max_items': self.max_items, 'max_age': self.max_age, 'max_bytes': self.max_bytes}
+
+
+class CompactionRunning(Exception):
+    """已有压缩任务正在进行"""
+
+
+class HistoryCompactor:
+    """
+    按保留策略裁剪已保存的观看历史并回收空间，定期在后台线程执行，也可以手动触发
+    :param shards: 分片列表，每个分片提供 connect() 和 db_writer
+    :param batch_size: 每次读取和提交的行数
+    :param batch_pause: 每批之间的休眠（秒），避免长时间占用写线程
+    :param vacuum_pages: 每个写操作回收的最大页数
+    """
+
+    def __init__(self, shards, policy, interval=24 * 3600, batch_size=500, batch_pause=0.01,
+                 vacuum_pages=2000, logger=None):
+        self.shards = shards
+        self.policy = policy
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.running = False
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last = None
+        self.last_error = None
+        self.completed = 0
+        self.failed = 0
+
+    # ---- 压缩 ----
+
+    def _rewrite(self, conn, updates):
+        """
+        写线程中执行：只重写扫描后没有被重新保存的行
+        INSERT OR REPLACE 会分配新ID，写回缓冲的 ON CONFLICT DO UPDATE 保留ID但更新 updated_at，两者都要比较
+        """
+        applied = 0
+        for row_id, user_id, key, data, created_at, updated_at in updates:
+            current = conn.execute('SELECT id, updated_at FROM viewing_history WHERE user_id = ? AND key = ?',
+                                   (user_id, key)).fetchone()
+            if current is None or tuple(current) != (row_id, updated_at):
+                continue
+            # 保留 updated_at，扫描前到达、尚未落库的旧写入仍然不能覆盖
+            conn.execute('INSERT OR REPLACE INTO viewing_history (user_id, key, data, created_at, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (user_id, key, data, created_at, updated_at))
+            applied += 1
+        return applied
+
+    def _vacuum(self, shard):
+        """归还空闲页，返回回收的页数；库未启用增量 vacuum 时返回0"""
+        def step(conn):
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                return 0
+            free = min(conn.execute('PRAGMA freelist_count').fetchone()[0], self.vacuum_pages)
+            # Python 执行该 PRAGMA 只单步一次，每次回收一页
+            for _ in range(free):
+                conn.execute('PRAGMA incremental_vacuum(1)')
+            return free
+
+        reclaimed = 0
+        while not self.stopped.is_set():
+            pages = shard.db_writer.run(step)
+            reclaimed += pages
+            if pages < self.vacuum_pages:
+                break
+            time.sleep(self.batch_pause)
+        return reclaimed
+
+    def _compact_shard(self, shard, stats, now):
+        conn = shard.connect()
+        try:
+            # 重写的行会分配更大的ID，只扫描开始时已存在的行
+            max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM viewing_history').fetchone()[0]
+            last_id = 0
+            while last_id < max_id and not self.stopped.is_set():
+                rows = conn.execute(
+                    'SELECT id, user_id, key, data, created_at, updated_at FROM viewing_history WHERE id > ? AND id <= ? '
+                    'ORDER BY id LIMIT ?',
+                    (last_id, max_id, self.batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                updates = []
+                for row_id, user_id, key, data, created_at, updated_at in rows:
+                    stats['scanned'] += 1
+                    try:
+                        items = _loads(data)
+                    except ValueError:
+                        continue
+                    kept, removed = self.policy.apply(items, now)
+                    if removed:
+                        encoded = _dumps(kept).decode('utf-8')
+                        stats['removed_items'] += removed
+                        stats['bytes_removed'] += len(data.encode('utf-8')) - len(encoded.encode('utf-8'))
+                        updates.append((row_id, user_id, key, encoded, created_at, updated_at))
+                if updates:
+                    stats['rewritten'] += shard.db_writer.run(lambda conn, updates=updates: self._rewrite(conn, updates))
+                    time.sleep(self.batch_pause)
+        finally:
+            conn.close()
+        stats['reclaimed_pages'] += self._vacuum(shard)
+
+    def run_once(self):
+        """执行一次压缩并返回结果；已有压缩在进行时抛出 CompactionRunning"""
+        with self.lock:
+            if self.running:
+                raise CompactionRunning('已有压缩任务正在进行')
+            self.running = True
+        started = time.time()
+        stats = {'started_at': int(started), 'scanned': 0, 'rewritten': 0, 'removed_items': 0,
+                 'bytes_removed': 0, 'reclaimed_pages': 0}
+        try:
+            for shard in self.shards:
+                self._compact_shard(shard, stats, started)
+            stats['seconds'] = round(time.time() - started, 3)
+            self.logger.info(f"观看历史压缩完成: {stats}")
+            with self.lock:
+                self.last = stats
+                self.last_error = None
+                self.completed += 1
+            return stats
+        except Exception as e:
+            self.logger.error(f"观看历史压缩失败: {str(e)}")
+            with self.lock:
+                self.last_error = {'at': int(time.time()), 'error': str(e)}
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.running = False
+
+    def trigger(self):
+        """在后台线程立即执行一次压缩；已有压缩在进行时抛出 CompactionRunning"""
+        with self.lock:
+            if self.running:
+                raise CompactionRunning('已有压缩任务正在进行')
+
+        def run():
+            try:
+                self.run_once()
+            except Exception:
+                pass  # 已记录到日志和 last_error
+
+        threading.Thread(target=run, name='history-compact-manual', daemon=True).start()
+
+    # ---- 定期压缩 ----
+
+    def start(self):
+        """启动定期压缩线程"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='history-compact', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                pass  # 已记录到日志和 last_error
+
+    def close(self):
+        self.stopped.set()
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'running': self.running,
+                'last': self.last,
+                'last_error': self.last_error,
+                'completed': self.completed,
+                'failed': self.failed,
+                'scheduled': self.thread is not None,
+                'interval': self.interval,
+                'policy': self.policy.stats()
+            }
+
+
+# ---- 存储用量 ----
+
+def storage_usage(conn, limit=20):
+    """按占用字节数从大到小返回前 limit 个用户的观看历史和收藏用量"""
+    rows = conn.execute('''
+        SELECT user_id, SUM(history_rows), SUM(history_bytes), MAX(history_largest),
+               SUM(favorite_rows), SUM(favorite_bytes)
+        FROM (
+            SELECT user_id, COUNT(*) AS history_rows, SUM(length(CAST(data AS BLOB))) AS history_bytes,
+                   MAX(length(CAST(data AS BLOB))) AS history_largest, 0 AS favorite_rows, 0 AS favorite_bytes
+            FROM viewing_history GROUP BY user_id
+            UNION ALL
+            SELECT user_id, 0, 0, 0, COUNT(*), SUM(length(CAST(data AS BLOB)))
+            FROM user_favorites GROUP BY user_id
+        )
+        GROUP BY user_id
+        ORDER BY SUM(history_bytes) + SUM(favorite_bytes) DESC
+        LIMIT ?
+    ''', (limit,)).fetchall()
+    users = []
+    for user_id, history_rows, history_bytes, history_largest, favorite_rows, favorite_bytes in rows:
+        # 只对排在前面的用户统计历史条目数，避免解析全部历史
+        history_items = conn.execute(
+            "SELECT COALESCE(SUM(json_array_length(data)), 0) FROM viewing_history "
+            "WHERE user_id = ? AND json_valid(data) AND json_type(data) = 'array'",
+            (user_id,)
+        ).fetchone()[0]
+        users.append({
+            'user_id': user_id,
+            'bytes': history_bytes + favorite_bytes,
+            'history_keys': history_rows,
+            'history_items': history_items,
+            'history_bytes': history_bytes,
+            'history_largest_bytes': history_largest,
+            'favorites': favorite_rows,
+            'favorite_bytes': favorite_bytes
+        })
+    return users
+
+
+def database_usage(conn):
+    """数据库文件大小、可回收的空闲页和用户数据总量"""
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    history_rows, history_bytes = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(length(CAST(data AS BLOB))), 0) FROM viewing_history').fetchone()
+    favorite_rows, favorite_bytes = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(length(CAST(data AS BLOB))), 0) FROM user_favorites').fetchone()
+    return {
+        'file_bytes': page_size * page_count,
+        'free_bytes': page_size * freelist,
+        'incremental_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2,
+        'history_keys': history_rows,
+        'history_bytes': history_bytes,
+        'favorites': favorite_rows,
+        'favorite_bytes': favorite_bytes
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LibreTV 观看历史存储维护')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    vacuum_parser = commands.add_parser('vacuum', help='启用增量 vacuum 并整理数据库文件（服务停止时执行）')
+    vacuum_parser.add_argument('db', help='主库文件路径（分片文件在同一目录）')
+    vacuum_parser.add_argument('--shards', type=int, default=1, help='分片数（与服务的 SHARD_COUNT 一致）')
+
+    usage_parser = commands.add_parser('usage', help='按用户统计存储用量')
+    usage_parser.add_argument('db', help='主库文件路径（分片文件在同一目录）')
+    usage_parser.add_argument('--shards', type=int, default=1, help='分片数（与服务的 SHARD_COUNT 一致）')
+    usage_parser.add_argument('--limit', type=int, default=20, help='列出的用户数')
+    args = parser.parse_args(argv)
+
+    result = {}
+    users = []
+    for index in range(max(1, args.shards)):
+        conn = sqlite3.connect(shard_path(args.db, index), isolation_level=None)
+        try:
+            if args.command == 'vacuum':
+                before = database_usage(conn)['file_bytes']
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+                result[index] = {'before_bytes': before, 'after_bytes': database_usage(conn)['file_bytes']}
+            else:
+                result[index] = database_usage(conn)
+                users.extend(storage_usage(conn, args.limit))
+        finally:
+            conn.close()
+    if args.command == 'usage':
+        result = {'shards': result, 'users': sorted(users, key=lambda user: user['bytes'], reverse=True)[:args.limit]}
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端 HLS 分片/播放列表磁盘缓存
+- 内容寻址：文件按内容 sha256 存放在 objects/ 下，相同内容只存一份
+- 索引：缓存目录下的 index.db（SQLite，WAL 模式），记录 URL -> 内容、大小、过期时间、最近访问时间，
+  以及每个内容文件的引用数；多个工作进程打开同一目录时共享一份缓存，重启后直接沿用
+- 内容文件的创建和删除都在索引的写事务内进行，不会删除其它进程刚写入的文件
+- 容量：总字节数或条目数超过上限时按最近访问时间（LRU）淘汰；条目数和总字节数记在单行的 totals 表中，
+  随增删同步更新，写入和淘汰不需要扫描全表；命中时的访问时间先记在内存，每秒批量写回索引
+- TTL：直播播放列表很短，点播播放列表和分片较长
+- 请求合并：同一 URL 的并发未命中只触发一次上游请求，其余请求等待结果；
+  不同进程之间通过锁文件上的字节范围锁合并（没有 fcntl 的平台只在进程内合并）
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只在进程内合并请求
+    fcntl = None
+
+
+KIND_SEGMENT = 0
+KIND_MANIFEST = 1
+
+# 可缓存的扩展名（整部影片的 .mp4 不缓存）
+SEGMENT_MIMETYPES = {
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.aac': 'audio/aac',
+    '.key': 'application/octet-stream'
+}
+MANIFEST_MIMETYPE = 'application/vnd.apple.mpegurl'
+
+_ENTRY_FIELDS = 'url_key, content_hash, size, expires_at, last_access, kind'
+# 跨进程获取锁：按 URL 摘要在锁文件上取一个字节加锁
+_LOCK_RANGE = 1 << 30
+
+
+class UncacheableResponse(Exception):
+    """上游响应不可缓存（非200、超出单文件上限等），由调用方直接代理"""
+
+    def __init__(self, message, upstream=None):
+        super().__init__(message)
+        self.upstream = upstream
+
+
+class CacheEntry:
+    __slots__ = ('url_key', 'content_hash', 'size', 'expires_at', 'last_access', 'kind')
+
+    def __init__(self, url_key, content_hash, size, expires_at, last_access, kind):
+        self.url_key = url_key
+        self.content_hash = content_hash
+        self.size = size
+        self.expires_at = expires_at
+        self.last_access = last_access
+        self.kind = kind
+
+
+def url_digest(url):
+    return hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+
+
+def cache_kind(url):
+    """根据URL路径判断是否可缓存，返回 (类型, MIME)，不可缓存返回 None"""
+    path = urlsplit(url).path.lower()
+    if path.endswith('.m3u8'):
+        return KIND_MANIFEST, MANIFEST_MIMETYPE
+    ext = os.path.splitext(path)[1]
+    if ext in SEGMENT_MIMETYPES:
+        return KIND_SEGMENT, SEGMENT_MIMETYPES[ext]
+    return None
+
+
+def is_live_manifest(data):
+    """没有 #EXT-X-ENDLIST 的媒体播放列表视为直播，会持续更新"""
+    return b'#EXT-X-ENDLIST' not in data and b'#EXT-X-STREAM-INF' not in data
+
+
+class _WriteTransaction:
+    """BEGIN IMMEDIATE ... COMMIT，异常时回滚"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
+
+
+class SegmentCache:
+    """HLS 磁盘缓存，同一目录可由多个进程同时使用"""
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, max_entries=65536,
+                 max_object_bytes=32 * 1024 * 1024, segment_ttl=24 * 3600,
+                 manifest_ttl=3600, live_manifest_ttl=2, access_flush_interval=1.0, logger=None):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_object_bytes = max_object_bytes
+        self.segment_ttl = segment_ttl
+        self.manifest_ttl = manifest_ttl
+        self.live_manifest_ttl = live_manifest_ttl
+        self.access_flush_interval = access_flush_interval
+        self.logger = logger or logging.getLogger(__name__)
+
+        # 保护本进程的索引连接和下列状态
+        self.lock = threading.Lock()
+        # url_key -> 最近访问时间，尚未写回索引
+        self.pending_access = {}
+        self.access_flushed_at = time.monotonic()
+        # url_key -> threading.Event，本进程正在从上游获取的 URL
+        self.inflight = {}
+
+        # 以下统计只包含本进程
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+        self.upstream_fetches = 0
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._open_index()
+
+    # ---- 索引 ----
+
+    def _open_index(self):
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), timeout=30,
+                                  isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self._write():
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    url_key BLOB PRIMARY KEY,
+                    content_hash BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    kind INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries (last_access)')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS objects (
+                    content_hash BLOB PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refs INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS totals (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    entries INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL
+                )
+            ''')
+            self._recover()
+
+        self.lock_file = None
+        if fcntl is not None:
+            self.lock_file = open(os.path.join(self.cache_dir, 'fetch.lock'), 'a+b')
+
+    def _write(self):
+        """索引写事务，调用方持有锁（初始化时除外）"""
+        return _WriteTransaction(self.db)
+
+    def _recover(self):
+        """丢弃内容文件已丢失的记录，删除未被引用的内容文件（在写事务内执行）"""
+        legacy = os.path.join(self.cache_dir, 'index.bin')
+        if os.path.exists(legacy):
+            # 旧版本的 mmap 索引，其中的内容文件按未引用处理
+            os.remove(legacy)
+        known = set()
+        for content_hash, in self.db.execute('SELECT content_hash FROM objects').fetchall():
+            if os.path.exists(self._object_path(content_hash)):
+                known.add(content_hash.hex())
+            else:
+                self.db.execute('DELETE FROM entries WHERE content_hash = ?', (content_hash,))
+                self.db.execute('DELETE FROM objects WHERE content_hash = ?', (content_hash,))
+        stale_before = time.time() - 3600
+        for root, _, files in os.walk(self.objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith('.tmp-'):
+                    # 其它进程可能正在写入，只清理很久以前中断留下的
+                    if os.path.getmtime(path) < stale_before:
+                        os.remove(path)
+                elif name not in known:
+                    os.remove(path)
+        # 启动时按实际内容重新统计一次，之后由增删同步维护
+        self.db.execute('''
+            INSERT OR REPLACE INTO totals (id, entries, bytes)
+            VALUES (0, (SELECT COUNT(*) FROM entries), (SELECT COALESCE(SUM(size), 0) FROM objects))
+        ''')
+
+    def _flush_access(self, force=False):
+        """把内存中的访问时间写回索引（需持有锁）"""
+        if not self.pending_access:
+            return
+        now = time.monotonic()
+        if not force and now - self.access_flushed_at < self.access_flush_interval:
+            return
+        pending, self.pending_access = self.pending_access, {}
+        self.access_flushed_at = now
+        with self._write():
+            self.db.executemany(
+                'UPDATE entries SET last_access = MAX(last_access, ?) WHERE url_key = ?',
+                [(last_access, url_key) for url_key, last_access in pending.items()]
+            )
+
+    # ---- 内容文件 ----
+
+    def _object_path(self, content_hash):
+        name = content_hash.hex()
+        return os.path.join(self.objects_dir, name[:2], name)
+
+    def _add_totals(self, entries, total_bytes):
+        """调整 totals 中的条目数和字节数（在写事务内执行）"""
+        self.db.execute('UPDATE totals SET entries = entries + ?, bytes = bytes + ? WHERE id = 0',
+                        (entries, total_bytes))
+
+    def _add_ref(self, content_hash, size):
+        """增加内容引用，返回内容文件是否已存在（在写事务内执行）"""
+        if self.db.execute('UPDATE objects SET refs = refs + 1 WHERE content_hash = ?', (content_hash,)).rowcount:
+            return True
+        self.db.execute('INSERT INTO objects (content_hash, size, refs) VALUES (?, ?, 1)', (content_hash, size))
+        self._add_totals(0, size)
+        return False
+
+    def _remove_entry(self, url_key, content_hash):
+        """
+        删除一条记录，内容不再被引用时删除文件（在写事务内执行）
+        返回 (删除的条目数, 释放的字节数)
+        """
+        if not self.db.execute('DELETE FROM entries WHERE url_key = ?', (url_key,)).rowcount:
+            return 0, 0
+        freed = 0
+        self.db.execute('UPDATE objects SET refs = refs - 1 WHERE content_hash = ?', (content_hash,))
+        row = self.db.execute('SELECT refs, size FROM objects WHERE content_hash = ?', (content_hash,)).fetchone()
+        if row is not None and row[0] <= 0:
+            freed = row[1]
+            self.db.execute('DELETE FROM objects WHERE content_hash = ?', (content_hash,))
+            try:
+                os.remove(self._object_path(content_hash))
+            except FileNotFoundError:
+                pass
+        self._add_totals(-1, -freed)
+        return 1, freed
+
+    def _totals(self):
+        """(条目数, 按内容去重后的总字节数)"""
+        return self.db.execute('SELECT entries, bytes FROM totals WHERE id = 0').fetchone()
+
+    def _evict(self):
+        """超出容量或条目数上限时按LRU淘汰（在写事务内执行）"""
+        entries, total_bytes = self._totals()
+        while entries > 0 and (total_bytes > self.max_bytes or entries > self.max_entries):
+            victims = self.db.execute(
+                'SELECT url_key, content_hash FROM entries ORDER BY last_access LIMIT 64').fetchall()
+            if not victims:
+                break
+            for url_key, content_hash in victims:
+                removed, freed = self._remove_entry(url_key, content_hash)
+                entries -= removed
+                total_bytes -= freed
+                self.evictions += removed
+                if total_bytes <= self.max_bytes and entries <= self.max_entries:
+                    break
+
+    # ---- 跨进程请求合并 ----
+
+    def _lock_fetch(self, url_key, timeout):
+        """获取该 URL 的跨进程获取锁，返回锁的偏移；超时返回 None，照常获取只是不再合并"""
+        if self.lock_file is None:
+            return None
+        offset = int.from_bytes(url_key[:8], 'big') % _LOCK_RANGE
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.lockf(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                return offset
+            except OSError:
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(0.02)
+
+    def _unlock_fetch(self, offset):
+        if offset is not None:
+            fcntl.lockf(self.lock_file.fileno(), fcntl.LOCK_UN, 1, offset)
+
+    # ---- 对外接口 ----
+
+    def path_for(self, entry):
+        return self._object_path(entry.content_hash)
+
+    def get(self, url):
+        """查询缓存，命中返回 CacheEntry，过期或不存在返回 None"""
+        url_key = url_digest(url)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(f'SELECT {_ENTRY_FIELDS} FROM entries WHERE url_key = ?', (url_key,)).fetchone()
+            if row is None:
+                return None
+            entry = CacheEntry(*row)
+            if entry.expires_at < now:
+                self.pending_access.pop(url_key, None)
+                with self._write():
+                    # 只删除仍过期的这份内容，其它进程可能刚写入了新内容
+                    if self.db.execute('SELECT 1 FROM entries WHERE url_key = ? AND content_hash = ? '
+                                       'AND expires_at < ?', (url_key, entry.content_hash, now)).fetchone():
+                        self._remove_entry(url_key, entry.content_hash)
+                return None
+            entry.last_access = now
+            self.pending_access[url_key] = now
+            self._flush_access()
+            return entry
+
+    def contains(self, url):
+        """是否有未过期的缓存，不更新访问时间"""
+        with self.lock:
+            row = self.db.execute('SELECT expires_at FROM entries WHERE url_key = ?', (url_digest(url),)).fetchone()
+            return row is not None and row[0] >= time.time()
+
+    def ttl_for(self, kind, data):
+        if kind == KIND_MANIFEST:
+            return self.live_manifest_ttl if is_live_manifest(data) else self.manifest_ttl
+        return self.segment_ttl
+
+    def put(self, url, chunks, kind=KIND_SEGMENT):
+        """把上游内容写入缓存，返回 CacheEntry；超过单文件上限或总容量时抛出 UncacheableResponse"""
+        hasher = hashlib.sha256()
+        size = 0
+        head = b''
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_object_bytes:
+                        raise UncacheableResponse(f'内容超过单文件缓存上限: {url}')
+                    hasher.update(chunk)
+                    if kind == KIND_MANIFEST:
+                        head += chunk
+                    f.write(chunk)
+            if size > self.max_bytes:
+                raise UncacheableResponse(f'内容超过缓存容量: {url}')
+
+            content_hash = hasher.digest()
+            object_path = self._object_path(content_hash)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            now = time.time()
+            url_key = url_digest(url)
+            entry = CacheEntry(url_key, content_hash, size, now + self.ttl_for(kind, head), now, kind)
+
+            with self.lock:
+                # 淘汰前写回访问时间，LRU 顺序包含最近的命中
+                self._flush_access(force=True)
+                with self._write():
+                    # 先占用新内容的引用再替换旧记录和淘汰：旧记录或被淘汰的记录可能持有同一内容的唯一引用
+                    if self._add_ref(content_hash, size):
+                        os.remove(tmp_path)
+                    else:
+                        os.replace(tmp_path, object_path)
+                    tmp_path = None
+                    old = self.db.execute('SELECT content_hash FROM entries WHERE url_key = ?',
+                                          (url_key,)).fetchone()
+                    if old is not None:
+                        self._remove_entry(url_key, old[0])
+                    self.db.execute(f'INSERT INTO entries ({_ENTRY_FIELDS}) VALUES (?, ?, ?, ?, ?, ?)',
+                                    (url_key, content_hash, size, entry.expires_at, now, kind))
+                    self._add_totals(1, 0)
+                    self._evict()
+                return entry
+        finally:
+            if tmp_path is not None:
+                # 中途失败时关闭上游迭代器，释放连接
+                close = getattr(chunks, 'close', None)
+                if close is not None:
+                    close()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def get_or_fetch(self, url, loader, kind=KIND_SEGMENT, wait_timeout=30.0):
+        """
+        查询缓存，未命中时调用 loader() 获取内容（返回字节块迭代器）并写入缓存
+        同一 URL 的并发未命中只有一个请求调用 loader，其余等待（包括其它进程中的请求）
+        返回 (CacheEntry, 是否命中)；等待后仍未命中时 CacheEntry 为 None
+        """
+        entry = self.get(url)
+        if entry is not None:
+            with self.lock:
+                self.hits += 1
+            return entry, True
+
+        url_key = url_digest(url)
+        with self.lock:
+            event = self.inflight.get(url_key)
+            leader = event is None
+            if leader:
+                event = self.inflight[url_key] = threading.Event()
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            event.wait(wait_timeout)
+            return self.get(url), True
+
+        lock_offset = None
+        try:
+            lock_offset = self._lock_fetch(url_key, wait_timeout)
+            # 等锁期间其它进程可能已经写入
+            entry = self.get(url)
+            if entry is not None:
+                with self.lock:
+                    self.collapsed += 1
+                return entry, True
+            with self.lock:
+                self.misses += 1
+                self.upstream_fetches += 1
+            return self.put(url, loader(), kind), False
+        finally:
+            self._unlock_fetch(lock_offset)
+            with self.lock:
+                self.inflight.pop(url_key, None)
+            event.set()
+
+    def close(self):
+        with self.lock:
+            try:
+                self._flush_access(force=True)
+            finally:
+                self.db.close()
+                if self.lock_file is not None:
+                    self.lock_file.close()
+
+    def stats(self):
+        """缓存统计：条目数和字节数是各进程共享的缓存，命中等计数只包含本进程"""
+        with self.lock:
+            entries, total_bytes = self._totals()
+            lookups = self.hits + self.misses + self.collapsed
+            return {
+                'entries': entries,
+                'bytes': total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'collapsed': self.collapsed,
+                'upstream_fetches': self.upstream_fetches,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.collapsed) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端 M3U8 播放列表改写与分片预取
+- 主播放列表/媒体播放列表只解析一次，解析结果按 (URL, 内容哈希) 缓存
+- 改写时把分片、子播放列表、密钥等URI替换为 /proxy/ 地址，相对路径先按播放列表地址解析
+- 请求某个分片时，按播放列表顺序把后续N个分片提交给有界线程池预取到服务端缓存
+"""
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin, urlsplit
+
+from hls_cache import KIND_SEGMENT, UncacheableResponse
+
+
+# EXT-X-KEY / EXT-X-MAP / EXT-X-MEDIA / EXT-X-I-FRAME-STREAM-INF 等标签中的URI属性
+URI_ATTRIBUTE_RE = re.compile(r'(URI=")([^"]*)(")')
+
+
+class Playlist:
+    """
+    解析后的播放列表
+    pieces 中偶数位置是原样输出的文本，奇数位置是需要改写的绝对URL
+    """
+
+    def __init__(self, url, text):
+        self.url = url
+        self.is_master = False
+        self.segments = []
+        self.variants = []
+        self.pieces = []
+        self.rendered = {}
+        self._parse(text)
+
+    def _add_uri(self, literal, uri):
+        absolute = urljoin(self.url, uri.strip())
+        if urlsplit(absolute).scheme not in ('http', 'https'):
+            # data: / skd:// 等不经过代理
+            self.pieces[-1] += literal + uri
+            return None
+        self.pieces[-1] += literal
+        self.pieces.append(absolute)
+        self.pieces.append('')
+        return absolute
+
+    def _parse(self, text):
+        self.pieces.append('')
+        expect_variant = False
+        for line in text.splitlines(keepends=True):
+            stripped = line.strip()
+            if not stripped:
+                self.pieces[-1] += line
+            elif stripped.startswith('#'):
+                if stripped.startswith('#EXT-X-STREAM-INF'):
+                    self.is_master = True
+                    expect_variant = True
+                position = 0
+                for match in URI_ATTRIBUTE_RE.finditer(line):
+                    self._add_uri(line[position:match.end(1)], match.group(2))
+                    position = match.start(3)
+                self.pieces[-1] += line[position:]
+            else:
+                leading = line[:len(line) - len(line.lstrip())]
+                absolute = self._add_uri(leading, stripped)
+                self.pieces[-1] += line[len(leading) + len(stripped):]
+                if absolute is None:
+                    continue
+                if expect_variant:
+                    self.variants.append(absolute)
+                    expect_variant = False
+                else:
+                    self.segments.append(absolute)
+
+    def render(self, proxy_prefix):
+        """返回把所有URI改写为 proxy_prefix + encodeURIComponent(url) 的播放列表文本"""
+        text = self.rendered.get(proxy_prefix)
+        if text is None:
+            text = ''.join(
+                piece if i % 2 == 0 else proxy_prefix + quote(piece, safe='')
+                for i, piece in enumerate(self.pieces)
+            )
+            self.rendered[proxy_prefix] = text
+        return text
+
+
+class PlaylistCache:
+    """解析结果的LRU缓存，同时记录分片URL在所属播放列表中的位置"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # (url, 内容哈希) -> Playlist
+        self.playlists = OrderedDict()
+        # 分片URL -> (Playlist, 序号)，指向最近一次解析到该分片的播放列表
+        self.positions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, content_hash, data):
+        """返回解析后的播放列表，相同内容只解析一次"""
+        key = (url, content_hash)
+        with self.lock:
+            playlist = self.playlists.get(key)
+            if playlist is not None:
+                self.playlists.move_to_end(key)
+                self.hits += 1
+                return playlist
+            self.misses += 1
+
+        playlist = Playlist(url, data.decode('utf-8', errors='replace'))
+        with self.lock:
+            self.playlists[key] = playlist
+            for index, segment in enumerate(playlist.segments):
+                self.positions[segment] = (playlist, index)
+            while len(self.playlists) > self.max_entries:
+                _, evicted = self.playlists.popitem(last=False)
+                for segment in evicted.segments:
+                    position = self.positions.get(segment)
+                    if position is not None and position[0] is evicted:
+                        del self.positions[segment]
+        return playlist
+
+    def is_segment(self, url):
+        with self.lock:
+            return url in self.positions
+
+    def next_segments(self, url, count):
+        """返回播放列表中排在该分片之后的 count 个分片URL"""
+        with self.lock:
+            position = self.positions.get(url)
+        if position is None:
+            return []
+        playlist, index = position
+        return playlist.segments[index + 1:index + 1 + count]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'playlists': len(self.playlists),
+                'segments': len(self.positions),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class SegmentPrefetcher:
+    """
+    分片预取：固定数量的工作线程，待处理数量有上限，超出时丢弃预取请求
+    fetch(url, headers) 返回上游内容的字节块迭代器，与 SegmentCache.get_or_fetch 的 loader 相同
+    """
+
+    def __init__(self, cache, fetch, workers=2, max_pending=32, logger=None):
+        self.cache = cache
+        self.fetch = fetch
+        self.max_pending = max_pending
+        self.logger = logger or logging.getLogger(__name__)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hls-prefetch')
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.closed = False
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def schedule(self, urls, headers=None):
+        """提交预取；已缓存或正在预取的URL会被跳过"""
+        for url in urls:
+            if self.cache.contains(url):
+                continue
+            with self.lock:
+                if self.closed or url in self.pending:
+                    continue
+                if len(self.pending) >= self.max_pending:
+                    self.dropped += 1
+                    continue
+                self.pending.add(url)
+                self.scheduled += 1
+            self.executor.submit(self._prefetch, url, headers or {})
+
+    def _prefetch(self, url, headers):
+        try:
+            self.cache.get_or_fetch(url, lambda: self.fetch(url, headers), KIND_SEGMENT)
+        except UncacheableResponse as e:
+            if e.upstream is not None:
+                e.upstream.close()
+            with self.lock:
+                self.failed += 1
+        except Exception as e:
+            self.logger.debug(f"分片预取失败: {url}, 错误: {str(e)}")
+            with self.lock:
+                self.failed += 1
+        else:
+            with self.lock:
+                self.completed += 1
+        finally:
+            with self.lock:
+                self.pending.discard(url)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'scheduled': self.scheduled,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped
+            }
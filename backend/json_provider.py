@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端 JSON 序列化提供者
+已安装 orjson 时使用 orjson 编解码，否则自动回退到标准库 json
+"""
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库
+    orjson = None
+
+
+# orjson 快速路径能够等价处理的 json.dumps 参数
+_ORJSON_DUMPS_KWARGS = {'default', 'ensure_ascii', 'sort_keys', 'separators', 'indent'}
+_COMPACT_SEPARATORS = (',', ':')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON 提供者
+    - request.get_json()、jsonify 以及 app.json.dumps/loads 都经过这里
+    - 保持 JSON_AS_ASCII=False（直接输出UTF-8）和紧凑分隔符的行为
+    - orjson 不支持的数据（非字符串键、超大整数等）自动回退到标准库
+    """
+
+    @property
+    def ensure_ascii(self):
+        return self._app.config.get('JSON_AS_ASCII', True)
+
+    @property
+    def sort_keys(self):
+        return self._app.config.get('JSON_SORT_KEYS', True)
+
+    @property
+    def compact(self):
+        if self._app.config.get('JSONIFY_PRETTYPRINT_REGULAR'):
+            return False
+        return None
+
+    @property
+    def mimetype(self):
+        return self._app.config.get('JSONIFY_MIMETYPE', 'application/json')
+
+    @property
+    def backend_name(self):
+        """当前实际使用的 JSON 库名称"""
+        return 'orjson' if orjson is not None else 'json'
+
+    def _orjson_dumps(self, obj, kwargs):
+        """使用 orjson 序列化，返回 bytes；参数无法等价处理时返回 None"""
+        if orjson is None or not set(kwargs) <= _ORJSON_DUMPS_KWARGS:
+            return None
+        # orjson 只能输出 UTF-8，需要 ASCII 转义时交给标准库
+        if kwargs.get('ensure_ascii', self.ensure_ascii):
+            return None
+        separators = kwargs.get('separators')
+        if separators is not None and tuple(separators) != _COMPACT_SEPARATORS:
+            return None
+        indent = kwargs.get('indent')
+        if indent not in (None, 2):
+            return None
+
+        # 日期交给 Flask 的 default 处理，保持 RFC 822 格式与标准库一致
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if indent == 2:
+            option |= orjson.OPT_INDENT_2
+
+        try:
+            return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option)
+        except TypeError:
+            return None
+
+    def dumps(self, obj, **kwargs):
+        """序列化为字符串，默认使用紧凑分隔符"""
+        data = self._orjson_dumps(obj, kwargs)
+        if data is not None:
+            return data.decode('utf-8')
+
+        if 'indent' not in kwargs:
+            kwargs.setdefault('separators', _COMPACT_SEPARATORS)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        """反序列化，orjson.JSONDecodeError 是 json.JSONDecodeError 的子类"""
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        """生成 JSON 响应，orjson 路径直接写入 bytes，省去一次编码"""
+        obj = self._prepare_response_obj(args, kwargs)
+        dump_args = {}
+
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            dump_args['indent'] = 2
+        else:
+            dump_args['separators'] = _COMPACT_SEPARATORS
+
+        body = self._orjson_dumps(obj, dump_args)
+        if body is None:
+            body = super().dumps(obj, **dump_args).encode('utf-8')
+
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
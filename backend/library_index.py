@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端片库搜索索引
+- 收藏和观看历史的标题只存在于 data JSON 中，这里把它们展开到 library_items 表，每个收藏/每条历史一行
+- 展开由 SQLite 触发器完成，任何写入 user_favorites / viewing_history 的路径（接口、批量导入）都会同步
+- 观看历史按标题增量同步：只插入新增标题、删除消失的标题、更新内容有变化的行，播放进度保存不会重建整个索引
+- library_fts 是基于 trigram 分词的 FTS5 无内容索引，支持中文子串搜索；
+  少于3个字符的查询无法使用 trigram，改为在该用户的行上做 LIKE 匹配
+- SQLite 未编译 FTS5 或版本低于 3.34 时只建 library_items，搜索全部走 LIKE
+- continue_watching 是观看历史的反范式副本，只保留首页"继续观看"需要的字段，
+  按 (user_id, key, timestamp DESC) 建索引，取最近N条只需一次索引范围扫描
+"""
+
+import json
+import sqlite3
+
+
+KIND_FAVORITE = 'favorite'
+KIND_HISTORY = 'history'
+
+# trigram 分词器至少需要3个字符才能匹配
+MIN_FTS_QUERY_LENGTH = 3
+
+LIBRARY_ITEMS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS library_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        title TEXT NOT NULL,
+        data TEXT NOT NULL,
+        UNIQUE(user_id, kind, key, title)
+    )
+'''
+
+# 无效JSON或不是数组时当作空数组；用嵌套 CASE 保证先校验再解析
+HISTORY_ARRAY = "COALESCE(CASE WHEN json_valid({data}) THEN CASE WHEN json_type({data}) = 'array' THEN {data} END END, '[]')"
+# 收藏数据中的标题（前端 toggleFavorite 保存 vod_name）
+FAVORITE_TITLE = "CASE WHEN json_valid({data}) THEN COALESCE(json_extract({data}, '$.vod_name'), json_extract({data}, '$.title')) END"
+# 只索引有文本标题的对象条目
+ITEM_HAS_TITLE = "CASE WHEN type = 'object' THEN json_type(value, '$.title') END = 'text'"
+
+# 观看历史写回时用 ON CONFLICT DO UPDATE 覆盖已有行，插入和更新 data 都要同步索引
+HISTORY_WRITE_EVENTS = (('insert', 'INSERT'), ('update', 'UPDATE OF data'))
+
+# 收藏：一行收藏对应一行索引；INSERT OR REPLACE 的隐式删除不触发删除触发器，由插入触发器先清理旧行
+# 历史：data 是前端 viewingHistory 数组，同一个key内按标题去重（与前端 addToViewingHistory 一致），
+# 数组倒序处理使排在前面（最近）的条目最后写入；episodes 列表很大且不参与搜索，不复制到索引
+SYNC_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS library_favorite_insert AFTER INSERT ON user_favorites
+    BEGIN
+        DELETE FROM library_items WHERE user_id = new.user_id AND kind = 'favorite' AND key = new.key;
+        INSERT INTO library_items (user_id, kind, key, title, data)
+        SELECT new.user_id, 'favorite', new.key, title, new.data
+        FROM (SELECT {FAVORITE_TITLE.format(data='new.data')} AS title)
+        WHERE title IS NOT NULL;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS library_favorite_delete AFTER DELETE ON user_favorites
+    BEGIN
+        DELETE FROM library_items WHERE user_id = old.user_id AND kind = 'favorite' AND key = old.key;
+    END
+    ''',
+    *(f'''
+    CREATE TRIGGER IF NOT EXISTS library_history_{name} AFTER {event} ON viewing_history
+    BEGIN
+        DELETE FROM library_items
+        WHERE user_id = new.user_id AND kind = 'history' AND key = new.key AND title NOT IN (
+            SELECT json_extract(value, '$.title') FROM json_each({HISTORY_ARRAY.format(data='new.data')})
+            WHERE {ITEM_HAS_TITLE});
+        INSERT INTO library_items (user_id, kind, key, title, data)
+        SELECT new.user_id, 'history', new.key, json_extract(value, '$.title'), json_remove(value, '$.episodes')
+        FROM json_each({HISTORY_ARRAY.format(data='new.data')})
+        WHERE {ITEM_HAS_TITLE}
+        ORDER BY key DESC
+        ON CONFLICT (user_id, kind, key, title) DO UPDATE SET data = excluded.data
+        WHERE data != excluded.data;
+    END
+    ''' for name, event in HISTORY_WRITE_EVENTS),
+    '''
+    CREATE TRIGGER IF NOT EXISTS library_history_delete AFTER DELETE ON viewing_history
+    BEGIN
+        DELETE FROM library_items WHERE user_id = old.user_id AND kind = 'history' AND key = old.key;
+    END
+    '''
+]
+
+# owner 列保存 "<用户ID>"，尖括号保证一个用户的 trigram 短语不会匹配到另一个用户
+FTS_SCHEMA = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS library_fts
+    USING fts5(owner, title, content='', tokenize='trigram')
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS library_fts_insert AFTER INSERT ON library_items
+    BEGIN
+        INSERT INTO library_fts (rowid, owner, title) VALUES (new.id, '<' || new.user_id || '>', new.title);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS library_fts_delete AFTER DELETE ON library_items
+    BEGIN
+        INSERT INTO library_fts (library_fts, rowid, owner, title)
+        VALUES ('delete', old.id, '<' || old.user_id || '>', old.title);
+    END
+    '''
+]
+
+# 继续观看：列名与前端 viewingHistory 条目字段的对应关系
+CONTINUE_WATCHING_FIELDS = (
+    ('title', 'title'),
+    ('source_name', 'sourceName'),
+    ('source_code', 'source_code'),
+    ('vod_id', 'vod_id'),
+    ('url', 'url'),
+    ('episode_index', 'episodeIndex'),
+    ('playback_position', 'playbackPosition'),
+    ('duration', 'duration'),
+    ('timestamp', 'timestamp')
+)
+
+CONTINUE_WATCHING_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS continue_watching (
+        user_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        title TEXT NOT NULL,
+        source_name TEXT,
+        source_code TEXT,
+        vod_id TEXT,
+        url TEXT,
+        episode_index INTEGER,
+        playback_position REAL,
+        duration REAL,
+        timestamp INTEGER NOT NULL,
+        PRIMARY KEY (user_id, key, title)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_continue_watching_recent
+    ON continue_watching (user_id, key, timestamp DESC)
+    '''
+]
+
+_CW_COLUMNS = ', '.join(column for column, _ in CONTINUE_WATCHING_FIELDS)
+_CW_VALUES = ', '.join(
+    f"COALESCE(json_extract(value, '$.{field}'), 0)" if column == 'timestamp'
+    else f"json_extract(value, '$.{field}')"
+    for column, field in CONTINUE_WATCHING_FIELDS
+)
+_CW_UPDATES = ', '.join(f'{column} = excluded.{column}' for column, _ in CONTINUE_WATCHING_FIELDS[1:])
+_CW_CHANGED = (
+    '(' + ', '.join(column for column, _ in CONTINUE_WATCHING_FIELDS[1:]) + ') IS NOT ('
+    + ', '.join(f'excluded.{column}' for column, _ in CONTINUE_WATCHING_FIELDS[1:]) + ')'
+)
+
+# 与 library_history_insert/update 相同的增量同步；只有字段变化的条目才会更新（通常只有正在播放的那一条）
+CONTINUE_WATCHING_TRIGGERS = [
+    *(f'''
+    CREATE TRIGGER IF NOT EXISTS continue_watching_{name} AFTER {event} ON viewing_history
+    BEGIN
+        DELETE FROM continue_watching
+        WHERE user_id = new.user_id AND key = new.key AND title NOT IN (
+            SELECT json_extract(value, '$.title') FROM json_each({HISTORY_ARRAY.format(data='new.data')})
+            WHERE {ITEM_HAS_TITLE});
+        INSERT INTO continue_watching (user_id, key, {_CW_COLUMNS})
+        SELECT new.user_id, new.key, {_CW_VALUES}
+        FROM json_each({HISTORY_ARRAY.format(data='new.data')})
+        WHERE {ITEM_HAS_TITLE}
+        ORDER BY key DESC
+        ON CONFLICT (user_id, key, title) DO UPDATE SET {_CW_UPDATES}
+        WHERE {_CW_CHANGED};
+    END
+    ''' for name, event in HISTORY_WRITE_EVENTS),
+    '''
+    CREATE TRIGGER IF NOT EXISTS continue_watching_delete AFTER DELETE ON viewing_history
+    BEGIN
+        DELETE FROM continue_watching WHERE user_id = old.user_id AND key = old.key;
+    END
+    '''
+]
+
+BACKFILL = [
+    f'''
+    INSERT OR IGNORE INTO library_items (user_id, kind, key, title, data)
+    SELECT user_id, 'favorite', key, title, data
+    FROM (SELECT user_id, key, data, {FAVORITE_TITLE.format(data='data')} AS title FROM user_favorites)
+    WHERE title IS NOT NULL
+    ''',
+    f'''
+    INSERT OR IGNORE INTO library_items (user_id, kind, key, title, data)
+    SELECT h.user_id, 'history', h.key, json_extract(value, '$.title'), json_remove(value, '$.episodes')
+    FROM viewing_history h, json_each({HISTORY_ARRAY.format(data='h.data')}) item
+    WHERE {ITEM_HAS_TITLE}
+    ORDER BY h.id, item.key
+    '''
+]
+
+CONTINUE_WATCHING_BACKFILL = f'''
+    INSERT OR IGNORE INTO continue_watching (user_id, key, {_CW_COLUMNS})
+    SELECT h.user_id, h.key, {_CW_VALUES}
+    FROM viewing_history h, json_each({HISTORY_ARRAY.format(data='h.data')}) item
+    WHERE {ITEM_HAS_TITLE}
+    ORDER BY h.id, item.key
+'''
+
+
+def _table_exists(conn, name):
+    return conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name,)).fetchone() is not None
+
+
+def init_library_index(conn, logger=None):
+    """创建索引表和同步触发器；首次创建时从已有收藏和历史回填。返回是否启用了全文索引"""
+    created = not _table_exists(conn, 'library_items')
+    conn.execute(LIBRARY_ITEMS_SCHEMA)
+
+    fts_enabled = True
+    try:
+        for statement in FTS_SCHEMA:
+            conn.execute(statement)
+    except sqlite3.OperationalError as e:
+        fts_enabled = False
+        if logger is not None:
+            logger.warning(f"SQLite 不支持 FTS5 trigram 分词，片库搜索使用 LIKE 匹配: {str(e)}")
+
+    for statement in SYNC_TRIGGERS:
+        conn.execute(statement)
+
+    if created:
+        for statement in BACKFILL:
+            conn.execute(statement)
+
+    created = not _table_exists(conn, 'continue_watching')
+    for statement in CONTINUE_WATCHING_SCHEMA + CONTINUE_WATCHING_TRIGGERS:
+        conn.execute(statement)
+    if created:
+        conn.execute(CONTINUE_WATCHING_BACKFILL)
+    return fts_enabled
+
+
+def drop_library_index(conn):
+    """删除索引表和同步触发器；批量导入前调用，导入后由 init_library_index 重建并一次性回填"""
+    for statement in SYNC_TRIGGERS + CONTINUE_WATCHING_TRIGGERS:
+        name = statement.split('IF NOT EXISTS', 1)[1].split()[0]
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    for table in ('library_fts', 'library_items', 'continue_watching'):
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+def fts_query(user_id, query):
+    """构造限定用户和标题的 FTS5 查询，查询词整体作为短语匹配"""
+    phrase = '"' + query.replace('"', '""') + '"'
+    return f'owner : "<{user_id}>" AND title : {phrase}'
+
+
+def search_library(conn, user_id, query, kind=None, limit=20, offset=0):
+    """
+    按标题子串搜索用户的收藏和观看历史
+    返回 (结果列表, 是否还有下一页)；结果为 (kind, key, title, data JSON文本)
+    """
+    kind_filter = ' AND i.kind = ?' if kind else ''
+    kind_params = [kind] if kind else []
+    if len(query) >= MIN_FTS_QUERY_LENGTH and _table_exists(conn, 'library_fts'):
+        sql = (
+            'SELECT i.kind, i.key, i.title, i.data FROM library_fts f '
+            'JOIN library_items i ON i.id = f.rowid '
+            f'WHERE library_fts MATCH ?{kind_filter} '
+            'ORDER BY f.rank, i.id DESC LIMIT ? OFFSET ?'
+        )
+        params = [fts_query(user_id, query)] + kind_params
+    else:
+        pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        sql = (
+            'SELECT i.kind, i.key, i.title, i.data FROM library_items i '
+            f"WHERE i.user_id = ?{kind_filter} AND i.title LIKE ? ESCAPE '\\' "
+            'ORDER BY i.id DESC LIMIT ? OFFSET ?'
+        )
+        params = [user_id] + kind_params + [pattern]
+
+    # 多取一条判断是否还有下一页，避免对全部匹配结果计数
+    rows = conn.execute(sql, params + [limit + 1, offset]).fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def query_continue_watching(conn, user_id, key, limit):
+    """按观看时间倒序返回最近 limit 条，字段名与前端 viewingHistory 条目一致"""
+    rows = conn.execute(
+        f'SELECT {_CW_COLUMNS} FROM continue_watching '
+        'WHERE user_id = ? AND key = ? ORDER BY timestamp DESC LIMIT ?',
+        (user_id, key, limit)
+    ).fetchall()
+    return [{field: row[i] for i, (_, field) in enumerate(CONTINUE_WATCHING_FIELDS)} for row in rows]
+
+
+def continue_watching_from_history(data, limit):
+    """从尚未落库的历史JSON计算与 query_continue_watching 相同的结果"""
+    try:
+        history = json.loads(data)
+    except ValueError:
+        return []
+    if not isinstance(history, list):
+        return []
+    items = {}
+    for item in history:
+        if isinstance(item, dict) and isinstance(item.get('title'), str) and item['title'] not in items:
+            entry = {field: item.get(field) for _, field in CONTINUE_WATCHING_FIELDS}
+            entry['timestamp'] = entry['timestamp'] or 0
+            items[item['title']] = entry
+    return sorted(items.values(), key=lambda entry: entry['timestamp'], reverse=True)[:limit]
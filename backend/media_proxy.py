@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端流式媒体代理
+- 按上游主机维护 keep-alive 连接池，复用 TCP/TLS 连接
+- 上游响应体按块通过生成器转发，不在内存中缓冲整个文件
+- 每个上游主机有并发上限，超出时排队等待，等待超时返回忙
+- 透传 Range 等条件请求头，支持 206 分段响应
+- 每次建立连接（包括重定向后的新主机）时解析主机名，只连接校验通过的公网地址：
+  本机、内网、链路本地、未指定和组播地址一律拒绝（allowed_networks 中的网段除外），
+  解析结果直接用于连接，避免校验后重新解析得到另一个地址
+"""
+
+import http.client
+import ipaddress
+import logging
+import socket
+import ssl
+import threading
+from collections import deque
+from urllib.parse import urlsplit, urljoin
+
+
+# 逐跳头，不能在代理两端之间转发
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'
+}
+
+# 转发给上游的客户端请求头（不转发Cookie、Authorization等本站凭据）
+FORWARDED_REQUEST_HEADERS = {
+    'accept', 'accept-language', 'accept-encoding', 'range', 'if-range',
+    'if-none-match', 'if-modified-since', 'user-agent', 'content-type'
+}
+
+# 不返回给客户端的上游响应头
+DROPPED_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | {'content-security-policy', 'set-cookie'}
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+# 复用的空闲连接可能已被上游关闭，出现这些错误时换新连接重试一次
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                           ConnectionResetError, BrokenPipeError)
+
+
+class ProxyError(Exception):
+    """代理请求失败，status 为返回给客户端的状态码"""
+
+    def __init__(self, message, status=502, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class UpstreamPool:
+    """单个上游主机的连接池，同时限制该主机的并发请求数"""
+
+    def __init__(self, scheme, host, port, max_connections=8, max_idle=4,
+                 timeout=10.0, ssl_context=None, create_connection=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        # 替代 socket.create_connection 建立TCP连接（校验地址），None 时使用默认实现
+        self.create_connection = create_connection
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.max_connections = max_connections
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.created = 0
+        self.reused = 0
+
+    def _new_connection(self):
+        self.created += 1
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        if self.create_connection is not None:
+            # Host 头和 TLS SNI 仍使用主机名，只替换TCP连接的目标地址
+            conn._create_connection = self.create_connection
+        return conn
+
+    def acquire(self, wait_timeout):
+        """占用一个并发名额并取出连接，返回 (conn, 是否复用)"""
+        if not self.slots.acquire(timeout=wait_timeout):
+            raise ProxyError(f'上游 {self.host} 并发请求过多，请稍后再试', status=503, retry_after=1)
+        with self.lock:
+            self.active += 1
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop(), True
+            return self._new_connection(), False
+
+    def new_connection(self):
+        """为已占用的名额替换一个新连接（复用连接失效时）"""
+        with self.lock:
+            return self._new_connection()
+
+    def release(self, conn, reusable):
+        """归还连接并释放并发名额"""
+        with self.lock:
+            self.active -= 1
+            if reusable and len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': self.active,
+                'idle': len(self.idle),
+                'max_connections': self.max_connections,
+                'created': self.created,
+                'reused': self.reused
+            }
+
+
+class UpstreamResponse:
+    """上游响应：状态码、过滤后的响应头和按块读取的响应体"""
+
+    def __init__(self, pool, conn, response, chunk_size, url):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.chunk_size = chunk_size
+        self.url = url
+        self.status = response.status
+        self.headers = [(name, value) for name, value in response.getheaders()
+                        if name.lower() not in DROPPED_RESPONSE_HEADERS]
+        self.released = False
+
+    def header(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def iter_chunks(self):
+        """逐块读取响应体；读完后连接放回连接池，中途关闭则丢弃连接"""
+        complete = False
+        try:
+            while True:
+                chunk = self.response.read(self.chunk_size)
+                if not chunk:
+                    complete = True
+                    break
+                yield chunk
+        finally:
+            self.release(reusable=complete)
+
+    def read(self):
+        """读取完整响应体（用于小文件，如m3u8）；读取中途超时或断开时抛出 ProxyError"""
+        try:
+            return b''.join(self.iter_chunks())
+        except socket.timeout:
+            raise ProxyError(f'上游 {urlsplit(self.url).hostname} 响应超时', status=504)
+        except (OSError, http.client.HTTPException) as e:
+            raise ProxyError(f'读取上游响应失败: {str(e)}', status=502)
+
+    def release(self, reusable=False):
+        if self.released:
+            return
+        self.released = True
+        reusable = reusable and not self.response.will_close
+        if not reusable:
+            self.response.close()
+        elif self.conn.timeout != self.pool.timeout:
+            # 恢复单次请求设置的超时后再放回连接池
+            self.conn.timeout = self.pool.timeout
+            if self.conn.sock is not None:
+                self.conn.sock.settimeout(self.pool.timeout)
+        self.pool.release(self.conn, reusable)
+
+    close = release
+
+
+class MediaProxy:
+    """按上游主机复用连接的流式代理"""
+
+    def __init__(self, max_per_host=8, max_idle_per_host=4, timeout=10.0,
+                 acquire_timeout=5.0, chunk_size=64 * 1024, max_redirects=5,
+                 blocked_hosts=('localhost', '127.0.0.1'), allowed_networks=(), verify_ssl=True, logger=None):
+        self.max_per_host = max_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.chunk_size = chunk_size
+        self.max_redirects = max_redirects
+        self.blocked_hosts = {host.lower() for host in blocked_hosts if host}
+        # 允许连接的非公网网段（例如内网CDN），默认为空
+        self.allowed_networks = [ipaddress.ip_network(network.strip(), strict=False)
+                                 for network in allowed_networks if network.strip()]
+        self.logger = logger or logging.getLogger(__name__)
+        self.ssl_context = ssl.create_default_context()
+        if not verify_ssl:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def validate_url(self, url):
+        """校验目标URL，返回 urlsplit 结果"""
+        try:
+            parts = urlsplit(url)
+            port = parts.port
+        except ValueError:
+            raise ProxyError('无效的目标URL', status=400)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ProxyError('无效的目标URL', status=400)
+        if parts.hostname.lower().rstrip('.') in self.blocked_hosts:
+            raise ProxyError('不允许代理该地址', status=400)
+        try:
+            literal = ipaddress.ip_address(parts.hostname)
+        except ValueError:
+            literal = None
+        if literal is not None:
+            # IP 字面量无需解析，直接拒绝；主机名在建立连接时解析后校验
+            self.check_address(str(literal))
+        return parts, port
+
+    def check_address(self, address):
+        """地址不是公网单播地址且不在 allowed_networks 中时抛出 ProxyError"""
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        if any(ip in network for network in self.allowed_networks):
+            return
+        if not ip.is_global or ip.is_multicast:
+            raise ProxyError('不允许代理该地址', status=400)
+
+    def _create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """解析主机名并校验全部地址，再连接校验过的地址（替代 socket.create_connection）"""
+        host, port = address
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        for *_, sockaddr in infos:
+            self.check_address(sockaddr[0])
+        error = None
+        for family, socktype, proto, _, sockaddr in infos:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                error = e
+                sock.close()
+        raise error or OSError(f'无法解析 {host}')
+
+    def get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        pool = self.pools.get(key)
+        if pool is None:
+            with self.lock:
+                pool = self.pools.get(key)
+                if pool is None:
+                    pool = UpstreamPool(scheme, host, port, max_connections=self.max_per_host,
+                                        max_idle=self.max_idle_per_host, timeout=self.timeout,
+                                        ssl_context=self.ssl_context, create_connection=self._create_connection)
+                    self.pools[key] = pool
+        return pool
+
+    @staticmethod
+    def filter_request_headers(headers):
+        """挑选需要转发给上游的请求头"""
+        return {name: value for name, value in headers
+                if name.lower() in FORWARDED_REQUEST_HEADERS}
+
+    @staticmethod
+    def _set_timeout(conn, timeout):
+        if timeout is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+    def _send(self, method, url, headers, body, timeout=None):
+        parts, port = self.validate_url(url)
+        scheme = parts.scheme
+        port = port or (443 if scheme == 'https' else 80)
+        pool = self.get_pool(scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+
+        acquire_timeout = self.acquire_timeout if timeout is None else min(self.acquire_timeout, timeout)
+        conn, reused = pool.acquire(acquire_timeout)
+        self._set_timeout(conn, timeout)
+        try:
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                if not reused or body is not None:
+                    raise
+                conn.close()
+                conn = pool.new_connection()
+                self._set_timeout(conn, timeout)
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+        except ProxyError:
+            # 解析出的地址未通过校验
+            pool.release(conn, False)
+            raise
+        except socket.timeout:
+            pool.release(conn, False)
+            raise ProxyError(f'上游 {parts.hostname} 响应超时', status=504)
+        except (OSError, http.client.HTTPException) as e:
+            pool.release(conn, False)
+            raise ProxyError(f'代理请求失败: {str(e)}', status=502)
+        return UpstreamResponse(pool, conn, response, self.chunk_size, url)
+
+    def open(self, method, url, headers=None, body=None, timeout=None):
+        """
+        发起上游请求并跟随重定向，返回 UpstreamResponse，调用方负责读完或关闭
+        timeout 覆盖这次请求的连接和读取超时（秒），默认使用连接池的超时
+        """
+        headers = dict(headers or {})
+        for _ in range(self.max_redirects + 1):
+            upstream = self._send(method, url, headers, body, timeout)
+            location = upstream.header('Location')
+            if upstream.status not in REDIRECT_STATUSES or not location:
+                return upstream
+            # 丢弃重定向响应体，连接可继续复用
+            upstream.read()
+            url = urljoin(url, location)
+            if upstream.status == 303:
+                method, body = 'GET', None
+        raise ProxyError('上游重定向次数过多', status=502)
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def stats(self):
+        """各上游主机的连接池统计"""
+        with self.lock:
+            pools = list(self.pools.items())
+        return {f'{scheme}://{host}:{port}': pool.stats() for (scheme, host, port), pool in pools}
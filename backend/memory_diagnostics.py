@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端内存诊断
+- 进程内存（RSS、峰值）、GC 各代计数和回收统计、线程数，以及按类型统计的存活对象数
+- tracemalloc 快照：第一次拍快照时开始跟踪，之后的快照只包含开始跟踪后分配且仍存活的内存；
+  两个快照按分配位置比较，增长最多的位置通常就是泄漏点。跟踪期间内存分配变慢、占用增加，诊断完应停止
+- 每个工作进程的内存各自独立，诊断结果只对应处理该请求的进程（结果中带 pid）
+"""
+
+import gc
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+
+try:
+    import resource
+except ImportError:  # Windows 下没有 resource，只在 /proc 可用时报告内存
+    resource = None
+
+
+# 快照中排除的分配位置：导入机制和 tracemalloc 自身
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+)
+
+GROUP_BY = ('lineno', 'filename', 'traceback')
+
+
+def process_memory():
+    """当前进程的内存占用（字节）"""
+    result = {'pid': os.getpid(), 'rss': None, 'peak_rss': None}
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                name, _, value = line.partition(':')
+                if name == 'VmRSS':
+                    result['rss'] = int(value.split()[0]) * 1024
+                elif name == 'VmHWM':
+                    result['peak_rss'] = int(value.split()[0]) * 1024
+    except OSError:
+        if resource is not None:
+            # 没有 /proc 时只能取得峰值；macOS 的单位是字节，Linux 是 KB
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result['peak_rss'] = peak if os.uname().sysname == 'Darwin' else peak * 1024
+    return result
+
+
+def gc_stats():
+    """GC 各代的待回收计数、阈值和累计回收统计"""
+    return {
+        'enabled': gc.isenabled(),
+        'counts': list(gc.get_count()),
+        'thresholds': list(gc.get_threshold()),
+        'generations': gc.get_stats(),
+        'frozen': gc.get_freeze_count(),
+        'garbage': len(gc.garbage)
+    }
+
+
+def top_types(limit=20):
+    """按类型统计 GC 跟踪的存活对象数（遍历全部对象，对象多时需要几百毫秒）"""
+    counts = Counter(f'{type(obj).__module__}.{type(obj).__qualname__}' for obj in gc.get_objects())
+    return [{'type': name, 'count': count} for name, count in counts.most_common(limit)]
+
+
+class SnapshotNotFound(Exception):
+    """快照不存在（已被淘汰或停止跟踪时清除）"""
+
+
+class AllocationTracer:
+    """
+    按需的 tracemalloc 快照与比较
+    :param frames: 每次分配记录的调用栈深度，按 traceback 分组时需要大于1
+    :param max_snapshots: 保留的快照数，超出时淘汰最早的
+    """
+
+    def __init__(self, frames=1, max_snapshots=5):
+        self.frames = frames
+        self.max_snapshots = max_snapshots
+        self.lock = threading.Lock()
+        self.snapshots = OrderedDict()
+        self.next_id = 1
+        self.started_at = None
+
+    def take_snapshot(self):
+        """拍一个快照（未跟踪时先开始跟踪），返回快照摘要"""
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self.started_at = time.time()
+            snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+            snapshot_id, self.next_id = self.next_id, self.next_id + 1
+            summary = {
+                'id': snapshot_id,
+                'taken_at': int(time.time()),
+                'blocks': len(snapshot.traces),
+                'bytes': sum(trace.size for trace in snapshot.traces)
+            }
+            self.snapshots[snapshot_id] = (summary, snapshot)
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+            return summary
+
+    def _get(self, snapshot_id):
+        entry = self.snapshots.get(snapshot_id)
+        if entry is None:
+            raise SnapshotNotFound(f'快照 {snapshot_id} 不存在')
+        return entry[1]
+
+    def top(self, snapshot_id, base_id=None, limit=20, group_by='lineno'):
+        """
+        按分配位置统计快照，占用最多的在前；指定 base_id 时与该快照比较，增长最多的在前
+        :param group_by: lineno（文件和行号）、filename 或 traceback（完整调用栈）
+        """
+        if group_by not in GROUP_BY:
+            raise ValueError(f"group_by 可选: {', '.join(GROUP_BY)}")
+        with self.lock:
+            snapshot = self._get(snapshot_id)
+            base = self._get(base_id) if base_id is not None else None
+        # 统计和比较不持锁，耗时与分配位置数成正比
+        if base is None:
+            stats = snapshot.statistics(group_by)
+        else:
+            stats = snapshot.compare_to(base, group_by)
+        entries = []
+        for stat in stats[:limit]:
+            entry = {
+                'site': [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback],
+                'bytes': stat.size,
+                'count': stat.count
+            }
+            if base is not None:
+                entry['bytes_diff'] = stat.size_diff
+                entry['count_diff'] = stat.count_diff
+            entries.append(entry)
+        return entries
+
+    def stop(self):
+        """停止跟踪并清除快照"""
+        with self.lock:
+            if self.started_at is not None and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self.started_at = None
+            self.snapshots.clear()
+
+    def stats(self):
+        with self.lock:
+            tracing = tracemalloc.is_tracing()
+            current, peak = tracemalloc.get_traced_memory()
+            return {
+                'tracing': tracing,
+                'started_at': int(self.started_at) if self.started_at else None,
+                'frames': tracemalloc.get_traceback_limit() if tracing else self.frames,
+                'traced_bytes': current,
+                'traced_peak': peak,
+                # tracemalloc 自身的内存开销
+                'overhead_bytes': tracemalloc.get_tracemalloc_memory(),
+                'snapshots': [summary for summary, _ in self.snapshots.values()]
+            }
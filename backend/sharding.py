@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端按用户分片存储
+- 观看历史、收藏和刷新令牌按 user_id 哈希分散到 N 个 SQLite 文件，每个文件有自己的单写线程，
+  写入吞吐随分片数增加；用户表和登录记录只在主库（用户目录）中
+- 0 号分片就是主库本身，分片数为1时与不分片完全相同；其它分片为 libretv-shard{i}.db
+- 分片函数使用 Jump Consistent Hash：分片数从 N 增加到 M 时只有 (M-N)/M 的用户需要迁移
+- 调整分片数后用 rebalance 迁移数据（服务停止时执行），可以中断后重新执行
+
+命令行用法：
+    python sharding.py rebalance data/libretv.db --from 1 --to 4
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from db_writer import DatabaseWriter
+
+
+# 分片的表 -> 迁移时复制的列（自增ID不复制，在目标分片重新分配）
+SHARDED_TABLES = {
+    'refresh_tokens': ('user_id', 'token_hash', 'created_at', 'expires_at', 'revoked'),
+    'viewing_history': ('user_id', 'key', 'data', 'created_at', 'updated_at'),
+    'user_favorites': ('user_id', 'key', 'data', 'created_at'),
+}
+
+_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def shard_index(user_id, count):
+    """用户所在的分片编号（0 ~ count-1）"""
+    if count <= 1:
+        return 0
+    # 用户ID是连续整数，先用 splitmix64 打散再做 Jump Consistent Hash
+    key = (user_id + 0x9E3779B97F4A7C15) & _MASK
+    key = ((key ^ (key >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    key = ((key ^ (key >> 27)) * 0x94D049BB133111EB) & _MASK
+    key ^= key >> 31
+    bucket, jump = -1, 0
+    while jump < count:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & _MASK
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_path(db_path, index):
+    """分片文件路径：data/libretv.db -> data/libretv-shard1.db；0 号分片即主库"""
+    if index == 0:
+        return db_path
+    base, ext = os.path.splitext(db_path)
+    return f'{base}-shard{index}{ext or ".db"}'
+
+
+def open_db(uri, is_memory):
+    """打开读连接"""
+    if is_memory:
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        # 共享缓存下读连接不加表级读锁，避免与写线程互相阻塞
+        conn.execute('PRAGMA read_uncommitted = 1')
+        return conn
+    return sqlite3.connect(uri)
+
+
+class Shard:
+    """
+    一个分片数据库：首次使用时建表，提供读连接和该文件的单写线程
+    与 AppResources 提供相同的 connect() 和 db_writer，调用方不区分主库和其它分片
+    """
+
+    def __init__(self, index, uri, init, is_memory=False, max_batch=256, logger=None):
+        self.index = index
+        self.uri = uri
+        self.init = init
+        self.is_memory = is_memory
+        self.max_batch = max_batch
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.RLock()
+        self.db_ready = False
+        self.memory_anchor = None
+        self._db_writer = None
+
+    def ensure_db(self):
+        if self.db_ready:
+            return
+        with self.lock:
+            if self.db_ready:
+                return
+            if self.is_memory:
+                # 内存库在最后一个连接关闭时销毁，保留一个连接维持其生命周期
+                self.memory_anchor = open_db(self.uri, True)
+                self.init(self.memory_anchor)
+                self.memory_anchor.commit()
+            else:
+                db_dir = os.path.dirname(self.uri)
+                if db_dir:
+                    os.makedirs(db_dir, exist_ok=True)
+                with sqlite3.connect(self.uri) as conn:
+                    self.init(conn)
+            self.db_ready = True
+
+    def connect(self):
+        """获取一个读连接"""
+        self.ensure_db()
+        return open_db(self.uri, self.is_memory)
+
+    @property
+    def db_writer(self):
+        if self._db_writer is None:
+            with self.lock:
+                if self._db_writer is None:
+                    self.ensure_db()
+                    writer = DatabaseWriter(self.uri, max_batch=self.max_batch, logger=self.logger,
+                                            uri=self.is_memory)
+                    writer.start()
+                    self._db_writer = writer
+        return self._db_writer
+
+    def stats(self):
+        writer = self._db_writer
+        return {'index': self.index, 'db_writer': writer.stats() if writer is not None else None}
+
+    def close(self):
+        with self.lock:
+            if self._db_writer is not None:
+                self._db_writer.stop()
+                self._db_writer = None
+            if self.memory_anchor is not None:
+                self.memory_anchor.close()
+                self.memory_anchor = None
+                self.db_ready = False
+
+
+# ---- 迁移 ----
+
+def _count_rows(conn):
+    return sum(conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in SHARDED_TABLES)
+
+
+def rebalance(db_path, old_count, new_count, init, batch_users=500, logger=None):
+    """
+    把数据从 old_count 个分片迁移到 new_count 个分片，应在服务停止时执行
+    - 逐个源分片找出不再属于它的用户，按批复制到目标分片：目标分片中先删除这批用户的行再插入，
+      提交后再从源分片删除。任何一步中断，重新执行都会得到相同的结果
+    :param init: 建表函数 init(conn)，新建的分片文件用它建表
+    :return: 统计字典
+    """
+    logger = logger or logging.getLogger(__name__)
+    started = time.monotonic()
+    conns = {}
+
+    def open_shard(index):
+        if index not in conns:
+            conn = sqlite3.connect(shard_path(db_path, index), isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            init(conn)
+            conns[index] = conn
+        return conns[index]
+
+    stats = {'from': old_count, 'to': new_count, 'moved_users': 0, 'moved_rows': 0}
+    try:
+        for source_index in range(old_count):
+            source = open_shard(source_index)
+            user_ids = [row[0] for row in source.execute(
+                ' UNION '.join(f'SELECT user_id FROM {table}' for table in SHARDED_TABLES))]
+            moving = [user_id for user_id in user_ids if shard_index(user_id, new_count) != source_index]
+            logger.info(f'分片 {source_index}: {len(user_ids)} 个用户，需要迁移 {len(moving)} 个')
+
+            for start in range(0, len(moving), batch_users):
+                targets = defaultdict(list)
+                for user_id in moving[start:start + batch_users]:
+                    targets[shard_index(user_id, new_count)].append(user_id)
+
+                for target_index, chunk in targets.items():
+                    target = open_shard(target_index)
+                    placeholders = ', '.join('?' * len(chunk))
+                    target.execute('BEGIN IMMEDIATE')
+                    try:
+                        for table, columns in SHARDED_TABLES.items():
+                            target.execute(f'DELETE FROM {table} WHERE user_id IN ({placeholders})', chunk)
+                            rows = source.execute(
+                                f"SELECT {', '.join(columns)} FROM {table} WHERE user_id IN ({placeholders})",
+                                chunk
+                            ).fetchall()
+                            target.executemany(
+                                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                                rows
+                            )
+                            stats['moved_rows'] += len(rows)
+                    except BaseException:
+                        target.rollback()
+                        raise
+                    target.commit()
+
+                    source.execute('BEGIN IMMEDIATE')
+                    try:
+                        for table in SHARDED_TABLES:
+                            source.execute(f'DELETE FROM {table} WHERE user_id IN ({placeholders})', chunk)
+                    except BaseException:
+                        source.rollback()
+                        raise
+                    source.commit()
+                    stats['moved_users'] += len(chunk)
+
+        stats['rows_per_shard'] = [_count_rows(open_shard(index)) for index in range(new_count)]
+        # 缩减分片数后多出的文件应已清空，确认后可以删除
+        stats['leftover_rows'] = {index: _count_rows(open_shard(index))
+                                  for index in range(new_count, old_count)}
+    finally:
+        for conn in conns.values():
+            conn.close()
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LibreTV 用户数据分片工具')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebalance_parser = commands.add_parser('rebalance', help='调整分片数后迁移用户数据（服务停止时执行）')
+    rebalance_parser.add_argument('db', help='主库文件路径（分片文件在同一目录）')
+    rebalance_parser.add_argument('--from', dest='old_count', type=int, required=True, help='原分片数')
+    rebalance_parser.add_argument('--to', dest='new_count', type=int, required=True, help='新分片数')
+    rebalance_parser.add_argument('--batch-users', type=int, default=500, help='每个事务迁移的用户数')
+    args = parser.parse_args(argv)
+
+    if args.old_count < 1 or args.new_count < 1:
+        print('分片数必须大于0', file=sys.stderr)
+        return 1
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    from LibreProgramBackend import init_user_tables
+    stats = rebalance(args.db, args.old_count, args.new_count, init_user_tables, batch_users=args.batch_users)
+    print(json.dumps(stats, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
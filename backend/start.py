@@ -23,6 +23,18 @@ def install_requirements():
 def start_server():
     """启动Flask服务器"""
     print("正在启动LibreTV后端服务...")
+
+    # 事件推送的每个连接都会一直占住一个请求处理单元，线程服务器上不启用，改用 gevent 协程服务器
+    events_enabled = os.environ.get('EVENTS_ENABLED', 'true').lower() == 'true'
+    if events_enabled:
+        try:
+            from gevent import monkey
+        except ImportError:
+            print("错误：启用事件推送（EVENTS_ENABLED）需要 gevent")
+            print("请安装 gevent，或设置 EVENTS_ENABLED=false 后再启动")
+            return False
+        # 必须在导入应用之前打补丁，线程、锁和套接字都换成协程版本
+        monkey.patch_all()
     
     try:
         # 启动Flask应用
@@ -32,7 +44,11 @@ def start_server():
         print(f"API文档: http://localhost:5002/api/health")
         print("按 Ctrl+C 停止服务器")
         
-        app.run(host='0.0.0.0', port=5002, debug=False)
+        if events_enabled:
+            from gevent.pywsgi import WSGIServer
+            WSGIServer(('0.0.0.0', 5002), app).serve_forever()
+        else:
+            app.run(host='0.0.0.0', port=5002, debug=False)
         
     except ImportError as e:
         print(f"导入模块失败: {e}")
@@ -0,0 +1,1701 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端单元测试（进程内运行，无需启动服务）
+
+运行: python -m pytest -q test_backend.py
+"""
+
+import gzip
+import ipaddress
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlencode
+
+import pytest
+from flask import Flask
+
+import json_provider
+from json_provider import FastJSONProvider
+from hls_cache import KIND_MANIFEST, SegmentCache
+from events import EventHub, EventLog
+from hls_playlist import Playlist
+from user_index import BloomFilter
+from admission import AdmissionController, Overloaded
+from LibreProgramBackend import create_app
+
+
+_ip_counter = itertools.count(1)
+
+
+class FakeUpstream:
+    """
+    本地替身上游HTTP服务器（HTTP/1.1 keep-alive）
+    routes: 路径 -> (状态码, 响应头, 响应体) 或 callable(handler) 返回该三元组
+    字节响应体支持 Range 请求
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = set()
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                upstream.requests.append((self.command, self.path, dict(self.headers)))
+                upstream.connections.add(self.client_address)
+                route = upstream.routes.get(self.path)
+                if route is None:
+                    status, headers, body = 404, {}, b'not found'
+                else:
+                    status, headers, body = route(self) if callable(route) else route
+                headers = dict(headers)
+                byte_range = self.headers.get('Range')
+                if status == 200 and byte_range and byte_range.startswith('bytes='):
+                    start, _, end = byte_range[6:].partition('-')
+                    start, end = int(start), int(end) if end else len(body) - 1
+                    headers['Content-Range'] = f'bytes {start}-{end}/{len(body)}'
+                    status, body = 206, body[start:end + 1]
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            do_HEAD = do_GET
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        # 代理中途断开连接是预期行为，不打印异常
+        self.server.handle_error = lambda request, client_address: None
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server.server_address[1]}{path}'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def upstream():
+    server = FakeUpstream()
+    yield server
+    server.close()
+
+
+def proxy_path(url):
+    """与前端 PROXY_URL + encodeURIComponent(url) 相同的代理路径"""
+    return '/proxy/' + quote(url, safe='')
+
+
+@pytest.fixture
+def app():
+    """每个测试使用独立的内存数据库实例"""
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_ENABLED': False})
+    yield app
+    app.extensions['libretv'].close()
+
+
+@pytest.fixture
+def resources(app):
+    return app.extensions['libretv']
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def register_user(client, username):
+    """注册用户并返回带访问令牌的请求头"""
+    ip = f'10.0.0.{next(_ip_counter)}'
+    response = client.post('/api/auth/register',
+                           json={'username': username, 'password': 'testpass123'},
+                           headers={'X-Forwarded-For': ip})
+    assert response.status_code == 201, response.get_json()
+    for cookie in response.headers.getlist('Set-Cookie'):
+        if cookie.startswith('accessToken='):
+            token = cookie.split(';', 1)[0].split('=', 1)[1]
+            return {'Authorization': f'Bearer {token}', 'X-Forwarded-For': ip}
+    raise AssertionError('注册响应缺少accessToken')
+
+
+@pytest.fixture
+def json_app():
+    app = Flask(__name__)
+    app.config['JSON_AS_ASCII'] = False
+    app.config['JSONIFY_MIMETYPE'] = 'application/json; charset=utf-8'
+    app.json = FastJSONProvider(app)
+    return app
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def json_backend(request, monkeypatch):
+    """分别在 orjson 与标准库回退路径下运行"""
+    if request.param == 'orjson':
+        if json_provider.orjson is None:
+            pytest.skip('未安装 orjson')
+    else:
+        monkeypatch.setattr(json_provider, 'orjson', None)
+    return request.param
+
+
+def test_json_provider_keeps_utf8_and_compact(json_app, json_backend):
+    """中文不转义，使用紧凑分隔符，键排序与标准库一致"""
+    data = {'title': '庆余年', 'episodes': [1, 2], 'a': None}
+    text = json_app.json.dumps(data)
+    assert text == '{"a":null,"episodes":[1,2],"title":"庆余年"}'
+    assert json_app.json.dumps(data, sort_keys=False) == json.dumps(
+        data, ensure_ascii=False, separators=(',', ':'))
+    assert json_app.json.loads(text.encode('utf-8')) == data
+
+
+def test_json_provider_response(json_app, json_backend):
+    """jsonify 响应体与 Content-Type 保持原有行为"""
+    with json_app.app_context():
+        response = json_app.json.response({'message': '保存成功'})
+    assert response.mimetype == 'application/json'
+    assert response.headers['Content-Type'] == 'application/json; charset=utf-8'
+    assert response.get_data(as_text=True) == '{"message":"保存成功"}\n'
+
+
+def test_json_provider_falls_back_for_unsupported_data(json_app):
+    """orjson 不支持的非字符串键回退到标准库"""
+    assert json_app.json.dumps({1: 'a'}, sort_keys=False) == '{"1":"a"}'
+    with pytest.raises(json.JSONDecodeError):
+        json_app.json.loads('{bad json')
+
+
+def test_history_response_compressed_and_cached(resources, client):
+    """超过阈值的历史记录按Accept-Encoding压缩，同一版本只压缩一次"""
+    headers = register_user(client, 'compress@example.com')
+    history = [{'title': f'庆余年 第{i}集', 'sourceName': '黑木耳', 'timestamp': i} for i in range(200)]
+    url = '/api/viewing-history/operation?key=compress_viewingHistory'
+    assert client.post(url, json=history, headers=headers).status_code == 200
+
+    plain = client.get(url, headers=headers)
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+    hits = resources.compressor.stats()['hits']
+    first = client.get(url, headers={**headers, 'Accept-Encoding': 'gzip, deflate'})
+    second = client.get(url, headers={**headers, 'Accept-Encoding': 'gzip'})
+    assert first.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(first.get_data()) == plain.get_data()
+    assert second.get_data() == first.get_data()
+    assert resources.compressor.stats()['hits'] == hits + 1
+
+    small = client.post(url, json=[{'title': 'a'}], headers={**headers, 'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+
+def test_history_writes_coalesced_with_read_your_writes(resources, client):
+    """同一key的多次保存合并为一次落库，落库前读取到最新值"""
+    headers = register_user(client, 'writebehind@example.com')
+    url = '/api/viewing-history/operation?key=wb_viewingHistory'
+    resources.history_buffer.flush()
+    stats = resources.history_buffer.stats()
+    for position in range(5):
+        assert client.post(url, json=[{'title': '繁花', 'playbackPosition': position}],
+                           headers=headers).status_code == 200
+
+    assert json.loads(client.get(url, headers=headers).get_json()['data'])[0]['playbackPosition'] == 4
+    resources.history_buffer.flush()
+    after = resources.history_buffer.stats()
+    assert after['writes'] - stats['writes'] == 5
+    assert after['flushed_rows'] - stats['flushed_rows'] == 1
+    assert json.loads(client.get(url, headers=headers).get_json()['data'])[0]['playbackPosition'] == 4
+
+
+def test_write_behind_requeues_failed_flush():
+    """落库失败的数据放回缓冲，且不覆盖期间产生的新值"""
+    from write_behind import WriteBehindBuffer
+
+    written = []
+
+    def flush(items):
+        if not written:
+            written.append(None)
+            buffer.put(1, 'k', 'newer')
+            raise RuntimeError('database is locked')
+        written.extend(items)
+
+    buffer = WriteBehindBuffer(flush)
+    buffer.put(1, 'k', 'old')
+    buffer.put(2, 'k', 'other')
+    assert buffer.flush() == 0
+    assert buffer.get(1, 'k')[0] == 'newer'
+    assert buffer.flush() == 2
+    assert sorted(item[:3] for item in written[1:]) == [(1, 'k', 'newer'), (2, 'k', 'other')]
+    assert buffer.get(1, 'k') is None
+
+
+def test_database_writer_group_commit(tmp_path):
+    """并发写入合并提交，单个失败的写操作只回滚自己"""
+    import sqlite3
+    import threading
+    from db_writer import DatabaseWriter
+
+    db_path = str(tmp_path / 'writer.db')
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+
+    writer = DatabaseWriter(db_path)
+    writer.start()
+    try:
+        def insert(i):
+            writer.execute('INSERT INTO items (name) VALUES (?)', (f'item{i}',))
+
+        threads = [threading.Thread(target=insert, args=(i,)) for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with pytest.raises(sqlite3.IntegrityError):
+            writer.execute('INSERT INTO items (name) VALUES (?)', ('item0',))
+        assert writer.execute('INSERT INTO items (name) VALUES (?)', ('last',))[0] == 1
+    finally:
+        writer.stop()
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 51
+    assert writer.stats()['operations'] == 52
+    assert writer.stats()['commits'] <= 52
+
+
+def test_create_app_is_lazy_and_isolated(tmp_path, monkeypatch):
+    """创建应用不做磁盘I/O，各实例的内存数据库互相隔离"""
+    monkeypatch.chdir(tmp_path)
+    first = create_app({'DB_PATH': ':memory:', 'LOG_DIR': ''})
+    second = create_app({'DB_PATH': ':memory:', 'LOG_DIR': ''})
+    assert list(tmp_path.iterdir()) == []
+    try:
+        register_user(first.test_client(), 'isolated@example.com')
+        response = second.test_client().post('/api/auth/check-username',
+                                              json={'username': 'isolated@example.com'})
+        assert response.get_json()['available'] is True
+    finally:
+        first.extensions['libretv'].close()
+        second.extensions['libretv'].close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_file_database_created_on_first_use(tmp_path):
+    """文件数据库和日志目录在首次请求时创建"""
+    app = create_app({'DB_PATH': str(tmp_path / 'data' / 'libretv.db'), 'LOG_DIR': str(tmp_path / 'logs')})
+    assert list(tmp_path.iterdir()) == []
+    try:
+        register_user(app.test_client(), 'file@example.com')
+    finally:
+        app.extensions['libretv'].close()
+    assert (tmp_path / 'data' / 'libretv.db').exists()
+    assert (tmp_path / 'logs' / 'app.log').exists()
+
+
+def test_media_proxy_streams_and_reuses_connections(resources, client, upstream):
+    """代理流式转发上游响应，支持Range，并复用到上游的keep-alive连接"""
+    body = bytes(range(256)) * 1024
+    upstream.routes['/video/seg1.ts?token=a%2Fb'] = (200, {'Content-Type': 'video/mp2t'}, body)
+    url = upstream.url('/video/seg1.ts?token=a%2Fb')
+
+    response = client.get(proxy_path(url), headers={'Cookie': 'accessToken=secret'})
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.get_data() == body
+    assert response.headers['Content-Type'] == 'video/mp2t'
+
+    partial = client.get(proxy_path(url), headers={'Range': 'bytes=100-199'})
+    assert partial.status_code == 206
+    assert partial.headers['Content-Range'] == f'bytes 100-199/{len(body)}'
+    assert partial.get_data() == body[100:200]
+
+    assert len(upstream.connections) == 1
+    assert all('Cookie' not in headers for _, _, headers in upstream.requests)
+    stats = resources.media_proxy.stats()
+    assert list(stats.values())[0]['reused'] == 1
+
+
+def test_media_proxy_enforces_per_host_cap(upstream):
+    """单个上游主机的并发达到上限时返回503"""
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_ENABLED': False,
+                      'PROXY_MAX_CONNECTIONS_PER_HOST': 1, 'PROXY_ACQUIRE_TIMEOUT': 0.1, 'PROXY_CHUNK_SIZE': 1024})
+    upstream.routes['/big.ts'] = (200, {}, b'x' * 64 * 1024)
+    client = app.test_client()
+    try:
+        streaming = client.get(proxy_path(upstream.url('/big.ts')), buffered=False)
+        next(streaming.response)
+        busy = client.get(proxy_path(upstream.url('/big.ts')))
+        assert busy.status_code == 503
+        assert busy.headers['Retry-After'] == '1'
+        streaming.close()
+        assert client.get(proxy_path(upstream.url('/big.ts'))).status_code == 200
+    finally:
+        app.extensions['libretv'].close()
+
+
+def test_media_proxy_rejects_blocked_hosts():
+    """默认禁止代理本机地址"""
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': ''})
+    response = app.test_client().get(proxy_path('http://localhost:5002/api/health'))
+    assert response.status_code == 400
+    assert app.test_client().get(proxy_path('ftp://example.com/a')).status_code == 400
+
+
+def test_media_proxy_only_connects_to_checked_public_addresses(upstream, monkeypatch):
+    """内网、本机、链路本地等地址在每一跳（包括重定向和主机名解析结果）都被拒绝，连接使用校验过的地址"""
+    import media_proxy
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'HLS_CACHE_ENABLED': False})
+    client = app.test_client()
+    try:
+        for url in ('http://169.254.169.254/latest/meta-data/', 'http://[::1]:5001/api/health',
+                    'http://0.0.0.0:5001/', 'http://127.0.0.2/', 'http://LOCALHOST./', 'http://10.0.0.1/',
+                    'http://[::ffff:127.0.0.1]/', 'http://224.0.0.1/'):
+            assert client.get(proxy_path(url)).status_code == 400, url
+
+        # 主机名解析到内网地址时拒绝；解析到允许的地址时连接该地址，Host 头仍是主机名
+        port = upstream.server.server_address[1]
+        resolved = {'internal.example': '10.1.2.3', 'cdn.example': '127.0.0.1'}
+        real_getaddrinfo = socket.getaddrinfo
+        monkeypatch.setattr(media_proxy.socket, 'getaddrinfo',
+                            lambda host, *args: real_getaddrinfo(resolved.get(host, host), *args))
+        assert client.get(proxy_path(f'http://internal.example:{port}/a.ts')).status_code == 400
+        assert upstream.requests == []
+
+        app.extensions['libretv'].media_proxy.allowed_networks = [ipaddress.ip_network('127.0.0.1/32')]
+        upstream.routes['/a.ts'] = (200, {}, b'segment')
+        response = client.get(proxy_path(f'http://cdn.example:{port}/a.ts'))
+        assert response.status_code == 200 and response.get_data() == b'segment'
+        assert upstream.requests[-1][2]['Host'] == f'cdn.example:{port}'
+
+        # 重定向到其它内网地址时在下一跳拒绝
+        upstream.routes['/jump'] = (302, {'Location': f'http://127.0.0.2:{port}/a.ts'}, b'')
+        assert client.get(proxy_path(f'http://cdn.example:{port}/jump')).status_code == 400
+        upstream.routes['/jump'] = (302, {'Location': f'http://internal.example:{port}/a.ts'}, b'')
+        assert client.get(proxy_path(f'http://cdn.example:{port}/jump')).status_code == 400
+        # 代理接口经过准入控制（bulk 隔舱）
+        assert app.extensions['libretv'].admission.stats()['classes']['bulk']['admitted'] == 12
+    finally:
+        app.extensions['libretv'].close()
+
+
+@pytest.fixture
+def hls_app(tmp_path):
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_DIR': str(tmp_path / 'hls-cache')})
+    yield app
+    app.extensions['libretv'].close()
+
+
+def test_hls_cache_serves_hits_without_upstream(hls_app, upstream):
+    """分片缓存命中后不再请求上游，命中内容支持Range"""
+    body = os.urandom(50000)
+    upstream.routes['/vod/seg1.ts'] = (200, {'Content-Type': 'video/mp2t'}, body)
+    client = hls_app.test_client()
+    url = proxy_path(upstream.url('/vod/seg1.ts'))
+
+    first = client.get(url, headers={'Range': 'bytes=0-99'})
+    assert first.status_code == 206
+    assert first.headers['X-Cache'] == 'MISS'
+    assert first.get_data() == body[:100]
+    # 缓存时向上游请求完整内容
+    assert 'Range' not in upstream.requests[0][2]
+
+    second = client.get(url)
+    assert second.status_code == 200
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.headers['Content-Type'] == 'video/mp2t'
+    assert second.get_data() == body
+    assert len(upstream.requests) == 1
+
+    upstream.routes['/vod/missing.ts'] = (404, {}, b'gone')
+    assert client.get(proxy_path(upstream.url('/vod/missing.ts'))).status_code == 404
+    assert hls_app.extensions['libretv'].hls_cache.stats()['entries'] == 1
+
+
+def test_hls_rewritten_playlist_points_at_backend_proxy(hls_app, upstream):
+    """改写后的分片URI由本服务的代理路由处理（经过缓存和预取），前缀可配置"""
+    upstream.routes['/vod/index.m3u8'] = (200, {}, b'#EXTM3U\n#EXTINF:4,\nseg1.ts\n#EXTINF:4,\nseg2.ts\n#EXT-X-ENDLIST\n')
+    upstream.routes['/vod/seg1.ts'] = (200, {}, b'one')
+    upstream.routes['/vod/seg2.ts'] = (200, {}, b'two')
+    client = hls_app.test_client()
+
+    text = client.get(proxy_path(upstream.url('/vod/index.m3u8'))).get_data(as_text=True)
+    uris = [line for line in text.splitlines() if line and not line.startswith('#')]
+    assert uris == [proxy_path(upstream.url('/vod/seg1.ts')), proxy_path(upstream.url('/vod/seg2.ts'))]
+    for uri, body in zip(uris, (b'one', b'two')):
+        adapter = hls_app.url_map.bind('localhost')
+        assert adapter.match(uri)[0] == 'api.media_proxy'
+        response = client.get(uri)
+        assert response.get_data() == body and 'X-Cache' in response.headers
+
+    hls_app.config['HLS_PROXY_PREFIX'] = 'https://media.example.com/proxy/'
+    upstream.routes['/vod/other.m3u8'] = (200, {}, b'#EXTM3U\n#EXTINF:4,\nseg1.ts\n#EXT-X-ENDLIST\n')
+    text = client.get(proxy_path(upstream.url('/vod/other.m3u8'))).get_data(as_text=True)
+    assert 'https://media.example.com' + proxy_path(upstream.url('/vod/seg1.ts')) in text.splitlines()
+
+
+def test_hls_cache_collapses_concurrent_misses(tmp_path):
+    """同一URL并发未命中只请求一次上游"""
+    cache = SegmentCache(str(tmp_path))
+    started = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return iter([b'segment-data'])
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch('http://cdn/a.ts', loader)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert all(entry is not None for entry, _ in results)
+    assert sum(not hit for _, hit in results) == 1
+    assert cache.stats()['collapsed'] == 7
+    cache.close()
+
+
+def test_hls_cache_lru_eviction_and_dedupe(tmp_path):
+    """超过容量按最近访问淘汰，相同内容只存一份"""
+    cache = SegmentCache(str(tmp_path), max_bytes=3000)
+    cache.put('http://cdn/1.ts', [b'a' * 1000])
+    cache.put('http://cdn/2.ts', [b'b' * 1000])
+    cache.put('http://cdn/3.ts', [b'c' * 1000])
+    assert cache.get('http://cdn/1.ts') is not None
+    cache.put('http://cdn/4.ts', [b'd' * 1000])
+
+    assert cache.get('http://cdn/2.ts') is None
+    assert cache.get('http://cdn/1.ts') is not None
+    assert cache.stats()['evictions'] == 1
+
+    same = cache.put('http://mirror/1.ts', [b'a' * 1000])
+    assert same.content_hash == cache.get('http://cdn/1.ts').content_hash
+    assert cache.stats()['bytes'] == 3000
+
+    # totals 表随增删维护，与全表统计一致
+    cache.put('http://cdn/3.ts', [b'e' * 500])
+    recount = (cache.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0],
+               cache.db.execute('SELECT SUM(size) FROM objects').fetchone()[0])
+    assert (cache.stats()['entries'], cache.stats()['bytes']) == recount == (4, 2500)
+    cache.close()
+
+
+def test_hls_cache_reput_same_content_keeps_object(tmp_path):
+    """同一URL重新写入相同内容、或被淘汰的记录持有唯一引用时，内容文件不被删除"""
+    cache = SegmentCache(str(tmp_path))
+    cache.put('http://cdn/1.ts', [b'a' * 1000])
+    cache.put('http://cdn/1.ts', [b'a' * 1000])
+    entry = cache.get('http://cdn/1.ts')
+    with open(cache.path_for(entry), 'rb') as f:
+        assert f.read() == b'a' * 1000
+    assert cache.stats()['bytes'] == 1000
+    cache.close()
+
+    full = SegmentCache(str(tmp_path / 'full'), max_entries=1)
+    full.put('http://cdn/1.ts', [b'a' * 1000])
+    full.put('http://mirror/1.ts', [b'a' * 1000])
+    assert full.get('http://cdn/1.ts') is None
+    assert os.path.exists(full.path_for(full.get('http://mirror/1.ts')))
+    full.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='需要 fork')
+def test_hls_cache_shared_between_processes(tmp_path):
+    """多个工作进程共享同一缓存目录：一个进程写入后其它进程命中，并发未命中只请求一次上游"""
+    first = SegmentCache(str(tmp_path))
+    second = SegmentCache(str(tmp_path))
+    first.put('http://cdn/shared.ts', [b's' * 1000])
+    entry = second.get('http://cdn/shared.ts')
+    assert entry is not None and os.path.exists(second.path_for(entry))
+    assert second.stats()['entries'] == 1
+    second.close()
+
+    fetches = tmp_path / 'fetches'
+    first.close()
+
+    def worker():
+        cache = SegmentCache(str(tmp_path))
+
+        def loader():
+            with open(fetches, 'a') as f:
+                f.write('x')
+            time.sleep(0.3)
+            return iter([b'collapsed-across-processes'])
+
+        entry, _ = cache.get_or_fetch('http://cdn/collapse.ts', loader)
+        cache.close()
+        os._exit(0 if entry is not None else 1)
+
+    pids = []
+    for _ in range(3):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                worker()
+            finally:
+                os._exit(1)
+        pids.append(pid)
+    assert all(os.waitpid(pid, 0)[1] == 0 for pid in pids)
+    assert fetches.read_text() == 'x'
+    reopened = SegmentCache(str(tmp_path))
+    assert reopened.stats()['entries'] == 2
+    reopened.close()
+
+    # 缓存目录不可用时直接代理，并在运行统计中标明
+    (tmp_path / 'not-a-dir').write_text('')
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'HLS_CACHE_DIR': str(tmp_path / 'not-a-dir')})
+    resources = app.extensions['libretv']
+    assert resources.hls_cache is None
+    assert resources.stats()['hls_cache'] == {'available': False}
+    resources.close()
+
+def test_hls_cache_manifest_ttl_and_reload(tmp_path):
+    """直播播放列表TTL很短，点播播放列表较长；重启后从索引恢复"""
+    cache = SegmentCache(str(tmp_path), manifest_ttl=3600, live_manifest_ttl=0.05)
+    live = b'#EXTM3U\n#EXT-X-MEDIA-SEQUENCE:10\n#EXTINF:4,\nseg10.ts\n'
+    vod = live + b'#EXT-X-ENDLIST\n'
+    cache.put('http://cdn/live.m3u8', [live], KIND_MANIFEST)
+    cache.put('http://cdn/vod.m3u8', [vod], KIND_MANIFEST)
+    time.sleep(0.1)
+    assert cache.get('http://cdn/live.m3u8') is None
+    assert cache.get('http://cdn/vod.m3u8') is not None
+    cache.close()
+
+    reopened = SegmentCache(str(tmp_path))
+    entry = reopened.get('http://cdn/vod.m3u8')
+    assert entry is not None
+    with open(reopened.path_for(entry), 'rb') as f:
+        assert f.read() == vod
+    assert reopened.stats()['entries'] == 1
+    reopened.close()
+
+
+def test_playlist_rewrites_uris_through_proxy():
+    """相对/绝对URI和标签中的URI属性都改写为代理地址，data: URI保持不变"""
+    master = Playlist('https://cdn.example.com/vod/index.m3u8', (
+        '#EXTM3U\n'
+        '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",URI="audio/zh.m3u8"\n'
+        '#EXT-X-STREAM-INF:BANDWIDTH=800000\n'
+        '720p/index.m3u8\n'
+    ))
+    assert master.is_master
+    assert master.variants == ['https://cdn.example.com/vod/720p/index.m3u8']
+    text = master.render('/proxy/')
+    assert 'URI="/proxy/https%3A%2F%2Fcdn.example.com%2Fvod%2Faudio%2Fzh.m3u8"' in text
+    assert '\n/proxy/https%3A%2F%2Fcdn.example.com%2Fvod%2F720p%2Findex.m3u8\n' in text
+
+    media = Playlist('https://cdn.example.com/vod/720p/index.m3u8', (
+        '#EXTM3U\r\n'
+        '#EXT-X-KEY:METHOD=AES-128,URI="data:text/plain;base64,AAAA",IV=0x1\r\n'
+        '#EXTINF:4.0,\r\n'
+        'seg0.ts?t=1\r\n'
+        '#EXTINF:4.0,\r\n'
+        'https://other.example.com/seg1.jpg\r\n'
+        '#EXT-X-ENDLIST\r\n'
+    ))
+    assert media.segments == ['https://cdn.example.com/vod/720p/seg0.ts?t=1', 'https://other.example.com/seg1.jpg']
+    lines = media.render('/proxy/').split('\r\n')
+    assert lines[1] == '#EXT-X-KEY:METHOD=AES-128,URI="data:text/plain;base64,AAAA",IV=0x1'
+    assert lines[3] == '/proxy/https%3A%2F%2Fcdn.example.com%2Fvod%2F720p%2Fseg0.ts%3Ft%3D1'
+    assert lines[5] == '/proxy/https%3A%2F%2Fother.example.com%2Fseg1.jpg'
+    assert lines[6] == '#EXT-X-ENDLIST'
+
+
+def test_hls_manifest_rewritten_and_segments_prefetched(hls_app, upstream):
+    """播放列表经过代理改写，请求分片时预取后续分片"""
+    hls_app.config['HLS_PREFETCH_SEGMENTS'] = 2
+    lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:4']
+    for i in range(5):
+        upstream.routes[f'/vod/seg{i}.jpg'] = (200, {'Content-Type': 'image/jpeg'}, f'segment-{i}'.encode() * 100)
+        lines += ['#EXTINF:4.0,', f'seg{i}.jpg']
+    upstream.routes['/vod/index.m3u8'] = (200, {}, ('\n'.join(lines + ['#EXT-X-ENDLIST']) + '\n').encode())
+    client = hls_app.test_client()
+    resources = hls_app.extensions['libretv']
+
+    manifest = client.get(proxy_path(upstream.url('/vod/index.m3u8')))
+    assert manifest.status_code == 200
+    assert manifest.mimetype == 'application/vnd.apple.mpegurl'
+    segment_paths = [line for line in manifest.get_data(as_text=True).splitlines() if line.startswith('/proxy/')]
+    assert segment_paths[0] == proxy_path(upstream.url('/vod/seg0.jpg'))
+
+    first = client.get(segment_paths[0])
+    assert first.get_data() == b'segment-0' * 100
+    assert first.headers['X-Cache'] == 'MISS'
+    deadline = time.time() + 5
+    while resources.segment_prefetcher.stats()['completed'] < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    fetched = [path for _, path, _ in upstream.requests]
+    assert fetched[:2] == ['/vod/index.m3u8', '/vod/seg0.jpg']
+    assert sorted(fetched[2:]) == ['/vod/seg1.jpg', '/vod/seg2.jpg']
+    second = client.get(segment_paths[1])
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.get_data() == b'segment-1' * 100
+    assert resources.playlist_cache.stats()['misses'] == 1
+
+
+@pytest.fixture
+def search_app(upstream):
+    sites = {
+        'fast': {'api': upstream.url('/fast/api.php/provide/vod'), 'name': '快速源'},
+        'slow': {'api': upstream.url('/slow/api.php/provide/vod'), 'name': '慢速源'},
+        'broken': {'api': upstream.url('/broken/api.php/provide/vod'), 'name': '故障源'},
+    }
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_ENABLED': False, 'API_SITES': sites,
+                      'SEARCH_SOURCE_TIMEOUT': 0.5, 'SEARCH_BREAKER_THRESHOLD': 2})
+    yield app
+    app.extensions['libretv'].close()
+
+
+def search_route(upstream, source, query, items, delay=0):
+    def respond(handler):
+        time.sleep(delay)
+        return 200, {'Content-Type': 'application/json'}, json.dumps({'code': 1, 'list': items}).encode()
+    upstream.routes[f'/{source}/api.php/provide/vod?ac=videolist&wd={query}'] = respond
+
+
+def test_search_fans_out_merges_and_caches(search_app, upstream):
+    """并发请求各源，超时的源不影响其它源，结果去重后缓存"""
+    search_route(upstream, 'fast', 'fanhua', [{'vod_id': 1, 'vod_name': '繁花'}, {'vod_id': 1, 'vod_name': '繁花'}])
+    search_route(upstream, 'slow', 'fanhua', [{'vod_id': 9, 'vod_name': '繁花'}], delay=1.0)
+    client = search_app.test_client()
+
+    start = time.monotonic()
+    data = client.get('/api/search?wd=fanhua&sources=fast,slow').get_json()
+    assert time.monotonic() - start < 0.9
+    assert data['sources'] == {'fast': {'status': 'ok', 'count': 1}, 'slow': {'status': 'timeout', 'count': 0}}
+    assert data['list'] == [{'vod_id': 1, 'vod_name': '繁花', 'source_name': '快速源', 'source_code': 'fast'}]
+    assert data['cached'] is False
+
+    requests_before = len(upstream.requests)
+    again = client.get('/api/search?wd=FanHua&sources=slow,fast').get_json()
+    assert again['cached'] is True
+    assert again['list'] == data['list']
+    assert len(upstream.requests) == requests_before
+    assert client.get('/api/search?wd=').status_code == 400
+
+
+def test_search_streams_results_as_sources_answer(search_app, upstream):
+    """流式返回时先返回的源先输出"""
+    search_route(upstream, 'fast', 'santi', [{'vod_id': 1, 'vod_name': '三体'}])
+    search_route(upstream, 'slow', 'santi', [{'vod_id': 2, 'vod_name': '三体'}], delay=0.2)
+    response = search_app.test_client().get('/api/search?wd=santi&sources=slow,fast&stream=1')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line.get('source') for line in lines] == ['fast', 'slow', None]
+    assert lines[0]['list'][0]['source_code'] == 'fast'
+    assert lines[-1] == {'done': True, 'total': 2, 'cached': False}
+
+
+def test_search_circuit_breaker_skips_failing_source(search_app, upstream):
+    """连续失败的源被熔断，之后的搜索不再请求它"""
+    client = search_app.test_client()
+    for query in ('q1', 'q2'):
+        data = client.get(f'/api/search?wd={query}&sources=broken').get_json()
+        assert data['sources']['broken']['status'] == 'error'
+    requests_before = len(upstream.requests)
+    data = client.get('/api/search?wd=q3&sources=broken').get_json()
+    assert data['sources']['broken']['status'] == 'open'
+    assert len(upstream.requests) == requests_before
+    assert search_app.extensions['libretv'].search_aggregator.stats()['breakers']['broken'] == 'open'
+
+
+def test_search_times_sources_from_start_and_merges_identical_queries(upstream):
+    """超时从源开始请求时计算，排队过久的源标记为 busy 且不缓存，相同的进行中搜索共享一次请求"""
+    sites = {'slow': {'api': upstream.url('/slow/api.php/provide/vod'), 'name': '慢速源'}}
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_ENABLED': False, 'API_SITES': sites,
+                      'SEARCH_SOURCE_TIMEOUT': 0.5, 'SEARCH_MAX_WORKERS': 1, 'SEARCH_QUEUE_TIMEOUT': 1.0})
+    aggregator = app.extensions['libretv'].search_aggregator
+    for query in ('q1', 'q2', 'q3', 'q4', 'q5'):
+        search_route(upstream, 'slow', query, [{'vod_id': 1, 'vod_name': query}], delay=0.35)
+
+    def search_concurrently(*queries):
+        results = {}
+        threads = [threading.Thread(target=lambda q=q: results.setdefault(q, []).append(
+            list(aggregator.stream(q, ['slow'])))) for q in queries]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        return {q: [[status for _, status, _ in result] for result in runs] for q, runs in results.items()}
+
+    try:
+        # 只有一个线程：q2 排队约 0.3 秒后才开始请求，总耗时超过 0.5 秒但请求本身没有超时
+        assert search_concurrently('q1', 'q2') == {'q1': [['ok']], 'q2': [['ok']]}
+
+        aggregator.queue_timeout = 0.2
+        assert search_concurrently('q3', 'q4') == {'q3': [['ok']], 'q4': [['busy']]}
+        assert aggregator.lookup('q3', ['slow']) is not None
+        assert aggregator.lookup('q4', ['slow']) is None
+
+        requests_before = len(upstream.requests)
+        assert search_concurrently('q5', 'q5') == {'q5': [['ok'], ['ok']]}
+        assert len(upstream.requests) == requests_before + 1
+        stats = aggregator.stats()
+        assert (stats['merged'], stats['queue_expired'], stats['inflight']) == (1, 1, 0)
+    finally:
+        app.extensions['libretv'].close()
+
+
+@pytest.fixture
+def detail_app(upstream):
+    sites = {
+        'json': {'api': upstream.url('/json/api.php/provide/vod'), 'name': '接口源'},
+        'html': {'api': upstream.url('/html'), 'name': '网页源', 'detail': upstream.url('/html')},
+    }
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_ENABLED': False, 'API_SITES': sites,
+                      'DETAIL_CACHE_TTL': 0.2, 'DETAIL_STALE_TTL': 60})
+    yield app
+    app.extensions['libretv'].close()
+
+
+def detail_item(vod_id, name):
+    return {'vod_id': vod_id, 'vod_name': name,
+            'vod_play_url': f'第1集$https://cdn.example.com/{vod_id}/1.m3u8#第2集$https://cdn.example.com/{vod_id}/2.m3u8'
+                            f'$$$第1集$https://cdn.example.com/{vod_id}/1.mp4'}
+
+
+def test_detail_batch_groups_ids_per_source(detail_app, upstream):
+    """同一个源的多个ID合并为一次上游请求，结果缓存"""
+    upstream.routes['/json/api.php/provide/vod?ac=videolist&ids=1,2,3'] = (200, {}, json.dumps(
+        {'list': [detail_item(1, '繁花'), detail_item(2, '狂飙')]}).encode())
+    upstream.routes['/html/index.php/vod/detail/id/77.html'] = (200, {}, (
+        '<h1>三体</h1><ul><li>$https://cdn.example.com/77/index.m3u8(高清)</li></ul>').encode())
+    client = detail_app.test_client()
+    items = [{'source': 'json', 'id': i} for i in ('1', '2', '3')] + [{'source': 'html', 'id': '77'}]
+
+    details = client.post('/api/detail/batch', json={'items': items}).get_json()['details']
+    assert details['json:1']['episodes'] == ['https://cdn.example.com/1/1.m3u8', 'https://cdn.example.com/1/2.m3u8']
+    assert details['json:2']['videoInfo']['title'] == '狂飙'
+    assert details['json:3']['code'] == 404
+    assert details['html:77']['episodes'] == ['https://cdn.example.com/77/index.m3u8']
+    assert details['html:77']['videoInfo']['title'] == '三体'
+    assert len(upstream.requests) == 2
+
+    single = client.get('/api/detail?id=1&source=json')
+    assert single.status_code == 200
+    assert single.get_json()['videoInfo']['source_code'] == 'json'
+    assert len(upstream.requests) == 2
+    assert client.get('/api/detail?id=1;drop&source=json').status_code == 400
+
+
+def test_detail_serves_stale_while_revalidating(detail_app, upstream):
+    """过期后先返回旧值，后台刷新后返回新值"""
+    route = '/json/api.php/provide/vod?ac=videolist&ids=5'
+    upstream.routes[route] = (200, {}, json.dumps({'list': [detail_item(5, '旧标题')]}).encode())
+    client = detail_app.test_client()
+    assert client.get('/api/detail?id=5&source=json').get_json()['videoInfo']['title'] == '旧标题'
+
+    upstream.routes[route] = (200, {}, json.dumps({'list': [detail_item(5, '新标题')]}).encode())
+    time.sleep(0.3)
+    assert client.get('/api/detail?id=5&source=json').get_json()['videoInfo']['title'] == '旧标题'
+    service = detail_app.extensions['libretv'].detail_service
+    deadline = time.time() + 5
+    while (len(upstream.requests) < 2 or service.stats()['refreshing']) and time.time() < deadline:
+        time.sleep(0.01)
+    assert client.get('/api/detail?id=5&source=json').get_json()['videoInfo']['title'] == '新标题'
+    assert service.stats()['cache']['stale_hits'] == 1
+
+
+def test_detail_upstream_body_cut_off_returns_502(detail_app, upstream):
+    """上游发完响应头后中途断开，详情接口返回502而不是500"""
+    def truncated(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Length', '1000')
+        handler.end_headers()
+        handler.wfile.write('<h1>三体</h1><ul><li>$https://cdn.example.com/'.encode())
+        handler.wfile.flush()
+        time.sleep(0.1)
+        # SO_LINGER=0 时关闭连接发送 RST，上游读取响应体时得到 ConnectionResetError
+        handler.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        handler.connection.close()
+        raise ConnectionAbortedError('中途断开')
+
+    upstream.routes['/html/index.php/vod/detail/id/9.html'] = truncated
+    client = detail_app.test_client()
+    response = client.get('/api/detail?id=9&source=html')
+    assert response.status_code == 502
+    assert response.get_json()['episodes'] == []
+
+    details = client.post('/api/detail/batch', json={'items': [{'source': 'html', 'id': '9'}]}).get_json()['details']
+    assert details['html:9']['code'] == 502
+
+
+@pytest.fixture
+def douban_app(upstream):
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_ENABLED': False,
+                      'DOUBAN_BASE_URL': upstream.url(''),
+                      'DOUBAN_REFRESH_ENABLED': False, 'DOUBAN_BUDGET_PER_MINUTE': 4})
+    yield app
+    app.extensions['libretv'].close()
+
+
+def douban_page_path(tag, page_start, media_type='movie', page_limit=16):
+    return '/j/search_subjects?' + urlencode({'type': media_type, 'tag': tag, 'sort': 'recommend',
+                                              'page_limit': page_limit, 'page_start': page_start})
+
+
+def douban_page(title):
+    return (200, {}, json.dumps({'subjects': [
+        {'id': '35267208', 'title': title, 'rate': '8.7', 'cover': 'https://img.example.com/p1.jpg',
+         'url': 'https://movie.douban.com/subject/35267208/'}
+    ]}).encode())
+
+
+def test_douban_pages_cached_with_posters(douban_app, upstream):
+    """标签和推荐页缓存后不再请求豆瓣，海报信息按条目缓存"""
+    upstream.routes['/j/search_tags?type=movie'] = (200, {}, json.dumps({'tags': ['热门', '最新']}).encode())
+    upstream.routes[douban_page_path('热门', 0)] = douban_page('繁花')
+    client = douban_app.test_client()
+
+    assert client.get('/api/douban/tags?type=movie').get_json() == {'tags': ['热门', '最新']}
+    first = client.get('/api/douban/subjects?type=movie&tag=热门&page_limit=16&page_start=0')
+    assert first.headers['X-Cache'] == 'MISS'
+    second = client.get('/api/douban/subjects?type=movie&tag=热门&page_limit=16&page_start=0')
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.get_json()['subjects'][0]['title'] == '繁花'
+    assert len(upstream.requests) == 2
+    assert upstream.requests[1][2]['Referer'] == 'https://movie.douban.com/'
+
+    poster = client.get('/api/douban/subject/35267208').get_json()
+    assert poster['cover'] == 'https://img.example.com/p1.jpg'
+    assert client.get('/api/douban/subject/1').status_code == 404
+    assert client.get('/api/douban/subjects?type=book').status_code == 400
+
+
+def test_douban_respects_request_budget(douban_app, upstream):
+    """超出请求额度时返回503，已缓存的页面仍可访问"""
+    client = douban_app.test_client()
+    for page_start in range(0, 64, 16):
+        upstream.routes[douban_page_path('热门', page_start)] = douban_page(f'第{page_start}页')
+        assert client.get(f'/api/douban/subjects?tag=热门&page_start={page_start}').status_code == 200
+
+    upstream.routes[douban_page_path('热门', 64)] = douban_page('第64页')
+    busy = client.get('/api/douban/subjects?tag=热门&page_start=64')
+    assert busy.status_code == 503
+    assert int(busy.headers['Retry-After']) >= 1
+    assert len(upstream.requests) == 4
+    assert client.get('/api/douban/subjects?tag=热门&page_start=0').status_code == 200
+
+
+def test_douban_refreshes_popular_pages(upstream):
+    """后台刷新访问最多且即将过期的页面"""
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'PROXY_BLOCKED_HOSTS': '',
+                      'PROXY_ALLOWED_NETWORKS': '127.0.0.1/32', 'HLS_CACHE_ENABLED': False,
+                      'DOUBAN_BASE_URL': upstream.url(''),
+                      'DOUBAN_REFRESH_ENABLED': False, 'DOUBAN_REFRESH_TOP': 1,
+                      'DOUBAN_PAGE_TTL': 60, 'DOUBAN_REFRESH_INTERVAL': 300})
+    try:
+        client = app.test_client()
+        service = app.extensions['libretv'].douban
+        upstream.routes[douban_page_path('热门', 0)] = douban_page('旧')
+        upstream.routes[douban_page_path('冷门', 0)] = douban_page('冷门')
+        for _ in range(3):
+            client.get('/api/douban/subjects?tag=热门')
+        client.get('/api/douban/subjects?tag=冷门')
+
+        upstream.routes[douban_page_path('热门', 0)] = douban_page('新')
+        assert service.refresh_popular() == 1
+        deadline = time.time() + 5
+        while service.stats()['background_refreshes'] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert client.get('/api/douban/subjects?tag=热门').get_json()['subjects'][0]['title'] == '新'
+        assert [path for _, path, _ in upstream.requests].count(douban_page_path('冷门', 0)) == 1
+    finally:
+        app.extensions['libretv'].close()
+
+
+def test_event_hub_replays_and_resyncs(resources):
+    """重连时从事件表补发 Last-Event-ID 之后的事件，缺口无法补全、事件已清理或积压过多时发送 resync"""
+    hub = EventHub(EventLog(resources.connect, resources.db_writer), max_queue=3, history_size=2, poll_interval=60)
+    try:
+        first = hub.publish(1, 'history', {'key': 'a'})
+        second = hub.publish(1, 'history', {'key': 'b'})
+        assert second > first
+        hub.poll()
+
+        subscriber = hub.subscribe(1, first)
+        assert [event[2] for event in hub.wait(subscriber, 0)] == [{'key': 'b'}]
+        hub.unsubscribe(subscriber)
+
+        hub.publish_many([(1, 'favorite', {'key': 'c'}), (2, 'favorite', {'key': 'x'})])
+        hub.poll()
+        stale = hub.subscribe(1, first - 1)
+        assert [event[1] for event in hub.wait(stale, 0)] == ['resync']
+        assert [event[1] for event in hub.wait(hub.subscribe(1, 10 ** 12), 0)] == ['resync']
+
+        for i in range(4):
+            hub.publish(1, 'history', {'key': str(i)})
+        hub.poll()
+        assert [event[1] for event in hub.wait(stale, 0)] == ['resync']
+
+        hub.log.prune(time.time() + 1)
+        assert [event[1] for event in hub.wait(hub.subscribe(1, second), 0)] == ['resync']
+        assert hub.stats()['subscribers'] == 3
+    finally:
+        hub.close()
+
+
+def test_events_stream_pushes_favorite_changes(client):
+    """收藏写入后，其它设备的事件流立即收到带版本号的通知"""
+    headers = register_user(client, 'events@example.com')
+    stream = client.get('/api/events', headers=headers, buffered=False)
+    assert stream.status_code == 200
+    assert stream.mimetype == 'text/event-stream'
+    chunks = iter(stream.response)
+    assert next(chunks).startswith(b'retry:')
+
+    response = client.post('/api/user-favorites',
+                           json={'action': 'add', 'key': 'fav_1', 'data': {'title': '漫长的季节'}},
+                           headers=headers)
+    assert response.status_code == 200
+    message = next(chunks).decode('utf-8')
+    fields = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+    assert fields['event'] == 'favorite'
+    data = json.loads(fields['data'])
+    assert data == {'action': 'add', 'key': 'fav_1', 'version': int(fields['id'])}
+    stream.close()
+
+    replay = client.get('/api/events', headers={**headers, 'Last-Event-ID': str(int(fields['id']) - 1)},
+                        buffered=False)
+    chunks = iter(replay.response)
+    next(chunks)
+    assert f"id: {fields['id']}" in next(chunks).decode('utf-8')
+    replay.close()
+
+
+def test_events_fan_out_across_processes(tmp_path):
+    """两个应用实例共享一个数据库（模拟两个工作进程）：一个进程的写入推送到另一个进程的连接，重连可以落到任意进程"""
+    config = {'DB_PATH': str(tmp_path / 'libretv.db'), 'LOG_DIR': '', 'EVENTS_POLL_INTERVAL': 0.05}
+    first, second = create_app(dict(config)), create_app(dict(config))
+    try:
+        headers = register_user(first.test_client(), 'fanout@example.com')
+        stream = first.test_client().get('/api/events', headers=headers, buffered=False)
+        chunks = iter(stream.response)
+        assert next(chunks).startswith(b'retry:')
+
+        response = second.test_client().post('/api/user-favorites',
+                                              json={'action': 'add', 'key': 'fav_1', 'data': {'title': '繁花'}},
+                                              headers=headers)
+        assert response.status_code == 200
+        start = time.monotonic()
+        message = next(chunks).decode('utf-8')
+        assert time.monotonic() - start < 1
+        fields = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+        assert fields['event'] == 'favorite'
+        assert json.loads(fields['data'])['key'] == 'fav_1'
+        stream.close()
+
+        replay = second.test_client().get('/api/events', headers={**headers, 'Last-Event-ID': str(int(fields['id']) - 1)},
+                                          buffered=False)
+        chunks = iter(replay.response)
+        next(chunks)
+        assert f"id: {fields['id']}" in next(chunks).decode('utf-8')
+        replay.close()
+        assert first.extensions['libretv'].events.stats()['published'] == 0
+        assert second.extensions['libretv'].events.stats()['published'] == 1
+
+        # gunicorn 同步工作进程下每个事件流会占住一个工作进程，拒绝建立
+        sync_worker = first.test_client().get('/api/events', headers=headers,
+                                              environ_base={'SERVER_SOFTWARE': 'gunicorn/21.2.0'})
+        assert sync_worker.status_code == 404
+    finally:
+        first.extensions['libretv'].close()
+        second.extensions['libretv'].close()
+
+
+def test_bootstrap_combines_page_load_reads(resources, client):
+    """一次请求返回与各单独接口一致的数据，并按权重计入用户限流"""
+    headers = register_user(client, 'bootstrap@example.com')
+    history_key = 'bootstrap@example.com_viewingHistory'
+    client.post(f'/api/viewing-history/operation?key={history_key}', json=[{'title': '繁花'}], headers=headers)
+    client.post('/api/user-favorites', json={'action': 'add', 'key': 'fav_1', 'data': {'title': '狂飙'}},
+                headers=headers)
+
+    response = client.post('/api/bootstrap', json={'check_keys': ['fav_1', 'fav_2'],
+                                                   'history_keys': [history_key, 'missing']}, headers=headers)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['user'] == client.get('/api/auth/user-info', headers=headers).get_json()
+    assert body['favorites'] == client.get('/api/user-favorites', headers=headers).get_json()['favorites']
+    assert body['favorite_status'] == {'fav_1': True, 'fav_2': False}
+    assert body['history'] == {history_key: json.dumps([{'title': '繁花'}], ensure_ascii=False,
+                                                       separators=(',', ':')), 'missing': None}
+
+    user_id = body['user']['id']
+    before = resources.rate_limiter.get_user_request_count(user_id)
+    assert client.post('/api/bootstrap', json={'favorites': False}, headers=headers).status_code == 200
+    assert resources.rate_limiter.get_user_request_count(user_id) == before + 2
+    assert client.post('/api/bootstrap', json={'history_keys': 'x'}, headers=headers).status_code == 400
+
+
+def test_library_search_follows_favorites_and_history(resources, client):
+    """收藏和观看历史写入后即可按标题子串搜索，结果只包含当前用户的数据"""
+    headers = register_user(client, 'library@example.com')
+    other = register_user(client, 'library-other@example.com')
+    history_url = '/api/viewing-history/operation?key=library@example.com_viewingHistory'
+    client.post(history_url, json=[{'title': '庆余年 第二季', 'episodeIndex': 3, 'episodes': ['a', 'b']},
+                                   {'title': '繁花'}], headers=headers)
+    resources.history_buffer.flush()
+    client.post('/api/user-favorites', json={'action': 'add', 'key': 'fav_1', 'data': {'vod_name': '庆余年'}},
+                headers=headers)
+    client.post('/api/user-favorites', json={'action': 'add', 'key': 'fav_2', 'data': {'vod_name': '庆余年'}},
+                headers=other)
+
+    body = client.get('/api/library/search?q=庆余年', headers=headers).get_json()
+    assert sorted((item['kind'], item['title']) for item in body['items']) == [
+        ('favorite', '庆余年'), ('history', '庆余年 第二季')]
+    history_item = next(item for item in body['items'] if item['kind'] == 'history')
+    assert history_item['data'] == {'title': '庆余年 第二季', 'episodeIndex': 3}
+    assert client.get('/api/library/search?q=繁花&kind=history', headers=headers).get_json()['items'][0]['title'] == '繁花'
+
+    page = client.get('/api/library/search?q=庆余年&limit=1', headers=headers).get_json()
+    assert len(page['items']) == 1 and page['next_offset'] == 1
+    rest = client.get('/api/library/search?q=庆余年&limit=1&offset=1', headers=headers).get_json()
+    assert rest['next_offset'] is None and rest['items'] != page['items']
+
+    client.post(history_url, json=[{'title': '繁花'}], headers=headers)
+    resources.history_buffer.flush()
+    client.post('/api/user-favorites', json={'action': 'remove', 'key': 'fav_1'}, headers=headers)
+    assert client.get('/api/library/search?q=庆余年', headers=headers).get_json()['items'] == []
+    assert client.get('/api/library/search?q=x&kind=bad', headers=headers).status_code == 400
+
+
+def test_continue_watching_tracks_history_writes(resources, client):
+    """继续观看列表随历史写入更新，按观看时间倒序，未落库的写入立即可见"""
+    headers = register_user(client, 'continue@example.com')
+    url = '/api/viewing-history/operation?key=continue@example.com_viewingHistory'
+    history = [{'title': f'剧集{i}', 'sourceName': '黑木耳', 'episodeIndex': i, 'playbackPosition': 60.0,
+                'timestamp': 1000 + i, 'episodes': ['a'] * 10} for i in range(5)]
+    client.post(url, json=history, headers=headers)
+    resources.history_buffer.flush()
+
+    items = client.get('/api/continue-watching?limit=3', headers=headers).get_json()['items']
+    assert [item['title'] for item in items] == ['剧集4', '剧集3', '剧集2']
+    assert items[0] == {'title': '剧集4', 'sourceName': '黑木耳', 'source_code': None, 'vod_id': None, 'url': None,
+                        'episodeIndex': 4, 'playbackPosition': 60.0, 'duration': None, 'timestamp': 1004}
+
+    history[0].update(timestamp=2000, playbackPosition=120.0)
+    client.post(url, json=history[:3], headers=headers)
+    pending = client.get('/api/continue-watching?limit=2', headers=headers).get_json()['items']
+    resources.history_buffer.flush()
+    stored = client.get('/api/continue-watching?limit=2', headers=headers).get_json()['items']
+    assert pending == stored
+    assert [(item['title'], item['playbackPosition']) for item in stored] == [('剧集0', 120.0), ('剧集2', 60.0)]
+    assert len(client.get('/api/continue-watching?limit=10', headers=headers).get_json()['items']) == 3
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(2000, error_rate=0.01)
+    for i in range(2000):
+        bloom.add(f'u:user{i}@example.com')
+    assert all(f'u:user{i}@example.com' in bloom for i in range(2000))
+    false_positives = sum(f'u:other{i}@example.com' in bloom for i in range(10000))
+    assert false_positives < 300
+    assert len(bloom.bits) < 2000 * 10 // 8 + 8
+
+
+def test_username_index_answers_negatives_without_database(resources, client):
+    """索引构建后新用户名直接判定可用，已注册的用户名（包括构建后注册的）由数据库确认"""
+    register_user(client, 'existing@example.com')
+    assert resources.user_index.wait_ready(5)
+
+    def check(username):
+        return client.post('/api/auth/check-username', json={'username': username},
+                           headers={'X-Forwarded-For': '10.1.0.1'}).get_json()['available']
+
+    assert check('existing@example.com') is False
+    negatives = resources.user_index.stats()['negatives']
+    assert check('fresh@example.com') is True
+    assert resources.user_index.stats()['negatives'] == negatives + 1
+
+    register_user(client, 'fresh@example.com')
+    assert check('fresh@example.com') is False
+    response = client.post('/api/auth/register', json={'username': 'fresh@example.com', 'password': 'testpass123'},
+                           headers={'X-Forwarded-For': '10.1.0.2'})
+    assert response.status_code == 409
+
+
+def test_username_index_sees_registrations_from_other_processes(tmp_path):
+    """其它进程注册的用户名在本进程的索引中也判定为已使用；补充查询按间隔限频"""
+    config = {'DB_PATH': str(tmp_path / 'libretv.db'), 'LOG_DIR': '', 'USER_INDEX_SYNC_INTERVAL': 0.3}
+    first, second = create_app(dict(config)), create_app(dict(config))
+    try:
+        register_user(first.test_client(), 'before@example.com')
+        index = second.extensions['libretv'].user_index
+        assert index.wait_ready(5)
+        register_user(first.test_client(), 'elsewhere@example.com')
+
+        def check(username):
+            return second.test_client().post('/api/auth/check-username', json={'username': username},
+                                             headers={'X-Forwarded-For': '10.1.1.1'}).get_json()['available']
+
+        assert check('elsewhere@example.com') is False
+        assert check('before@example.com') is False
+        assert check('nobody@example.com') is True
+        assert (index.stats()['synced'], index.stats()['sync_queries']) == (1, 1)
+
+        # 间隔内的判断只查内存：刚在其它进程注册的用户名暂时判定为可用，注册时由 UNIQUE 约束拒绝
+        register_user(first.test_client(), 'late@example.com')
+        assert check('late@example.com') is True
+        assert index.stats()['sync_queries'] == 1
+        response = second.test_client().post('/api/auth/register',
+                                             json={'username': 'late@example.com', 'password': 'testpass123'},
+                                             headers={'X-Forwarded-For': '10.1.1.2'})
+        assert response.status_code == 409
+        time.sleep(0.35)
+        assert check('late@example.com') is False
+        assert (index.stats()['synced'], index.stats()['sync_queries']) == (2, 2)
+    finally:
+        first.extensions['libretv'].close()
+        second.extensions['libretv'].close()
+
+
+def test_user_records_cached_and_written_through(app, resources, client):
+    """用户信息和刷新令牌读缓存，登录失败计数和锁定写回缓存"""
+    app.config['ADMIN_TOKEN'] = 'admin-secret'
+    app.config['RATE_LIMIT_ENABLED'] = False
+    headers = register_user(client, 'cached@example.com')
+    stats = resources.user_cache.stats()
+    for _ in range(3):
+        assert client.get('/api/auth/user-info', headers=headers).get_json()['username'] == 'cached@example.com'
+    assert resources.user_cache.stats()['hits'] == stats['hits'] + 3
+    assert resources.user_cache.stats()['misses'] == stats['misses']
+
+    def login(password):
+        return client.post('/api/auth/login', json={'username': 'cached@example.com', 'password': password},
+                           headers={'X-Forwarded-For': f'10.2.0.{next(_ip_counter)}'})
+
+    for _ in range(5):
+        assert login('wrong-password').status_code == 401
+    assert login('testpass123').status_code == 423
+    with resources.connect() as conn:
+        assert conn.execute("SELECT login_attempts FROM users WHERE username = 'cached@example.com'").fetchone()[0] == 5
+
+    assert client.get('/api/admin/stats').status_code == 403
+    body = client.get('/api/admin/stats', headers={'X-Admin-Token': 'admin-secret'}).get_json()
+    assert body['user_cache']['hit_rate'] > 0
+    app.config['ADMIN_TOKEN'] = ''
+    assert client.get('/api/admin/stats', headers={'X-Admin-Token': ''}).status_code == 404
+
+
+def test_login_lockout_applies_across_processes(tmp_path):
+    """锁定状态以数据库为准：另一个进程缓存的旧记录不能绕过锁定，也不会清除锁定"""
+    config = {'DB_PATH': str(tmp_path / 'libretv.db'), 'LOG_DIR': ''}
+    first, second = create_app(dict(config)), create_app(dict(config))
+    first.config['RATE_LIMIT_ENABLED'] = second.config['RATE_LIMIT_ENABLED'] = False
+    try:
+        client_a, client_b = first.test_client(), second.test_client()
+        headers = register_user(client_a, 'shared@example.com')
+
+        def login(client, password):
+            return client.post('/api/auth/login', json={'username': 'shared@example.com', 'password': password},
+                               headers={'X-Forwarded-For': f'10.3.0.{next(_ip_counter)}'})
+
+        # B 在锁定前缓存了该用户
+        assert client_b.get('/api/auth/user-info', headers=headers).status_code == 200
+        for _ in range(5):
+            assert login(client_a, 'wrong-password').status_code == 401
+        assert login(client_a, 'testpass123').status_code == 423
+        assert login(client_b, 'testpass123').status_code == 423
+        with first.extensions['libretv'].connect() as conn:
+            row = conn.execute("SELECT login_attempts, locked_until FROM users WHERE username = 'shared@example.com'"
+                               ).fetchone()
+        assert row[0] == 5 and row[1] is not None
+    finally:
+        first.extensions['libretv'].close()
+        second.extensions['libretv'].close()
+
+
+def test_history_flush_from_other_process_keeps_newer_save(tmp_path):
+    """两个进程的写回缓冲落库顺序与保存顺序相反时，较早的保存不会覆盖较新的"""
+    config = {'DB_PATH': str(tmp_path / 'libretv.db'), 'LOG_DIR': ''}
+    first, second = create_app(dict(config)), create_app(dict(config))
+    try:
+        client_a, client_b = first.test_client(), second.test_client()
+        headers = register_user(client_a, 'ordering@example.com')
+        url = '/api/viewing-history/operation?key=ordering_viewingHistory'
+        buffer_a, buffer_b = first.extensions['libretv'].history_buffer, second.extensions['libretv'].history_buffer
+
+        # B 先收到旧的保存，A 后收到新的保存；A 先落库
+        assert client_b.post(url, json=[{'title': '繁花', 'playbackPosition': 10, 'timestamp': 1}],
+                             headers=headers).status_code == 200
+        assert client_a.post(url, json=[{'title': '狂飙', 'playbackPosition': 20, 'timestamp': 2}],
+                             headers=headers).status_code == 200
+        buffer_a.flush()
+        buffer_b.flush()
+
+        for client in (client_a, client_b):
+            assert json.loads(client.get(url, headers=headers).get_json()['data'])[0]['title'] == '狂飙'
+        assert len(client_a.get('/api/library/search?q=狂飙', headers=headers).get_json()['items']) == 1
+        assert client_a.get('/api/library/search?q=繁花', headers=headers).get_json()['items'] == []
+        items = client_a.get('/api/continue-watching?key=ordering_viewingHistory', headers=headers).get_json()['items']
+        assert [item['title'] for item in items] == ['狂飙']
+
+        # 更新的保存照常覆盖，片库索引随 ON CONFLICT DO UPDATE 同步
+        assert client_b.post(url, json=[{'title': '三体', 'timestamp': 3}], headers=headers).status_code == 200
+        buffer_b.flush()
+        assert json.loads(client_a.get(url, headers=headers).get_json()['data'])[0]['title'] == '三体'
+        assert len(client_a.get('/api/library/search?q=三体', headers=headers).get_json()['items']) == 1
+        assert client_a.get('/api/library/search?q=狂飙', headers=headers).get_json()['items'] == []
+    finally:
+        first.extensions['libretv'].close()
+        second.extensions['libretv'].close()
+
+
+def test_admission_sheds_lowest_priority_first():
+    """处理时间超过目标后逐级卸载低优先级类别，刷新令牌始终放行，恢复后逐级放开"""
+    now = [0.0]
+    controller = AdmissionController(bulkheads={'bulk': 1}, latency_target=0.1, queue_timeout=0,
+                                     interval=1.0, clock=lambda: now[0])
+
+    ticket = controller.acquire('bulk')
+    with pytest.raises(Overloaded):
+        controller.acquire('bulk')  # 隔舱已满
+    controller.release(ticket)
+
+    for _ in range(3):
+        ticket = controller.acquire('read')
+        now[0] += 0.01
+        controller.release(ticket)
+        now[0] += 1.0
+    assert controller.stats()['level'] == 0
+
+    shed = []
+    for _ in range(5):
+        ticket = controller.acquire('refresh')
+        shed.append(controller.stats()['shedding'])
+        now[0] += 5.0
+        controller.release(ticket)
+    assert shed == [[], ['bulk'], ['read', 'bulk'], ['login', 'read', 'bulk'], ['login', 'read', 'bulk']]
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire('login')
+    assert excinfo.value.retry_after == 3
+
+    # 处理时间回落到目标一半以下后每个间隔放开一级
+    for _ in range(30):
+        now[0] += 1.0
+        controller.release(controller.acquire('refresh'))
+    assert controller.stats()['level'] == 0
+
+
+def test_admission_rejects_with_retry_after(app, client):
+    """被准入控制拒绝的请求返回503和Retry-After，其它类别不受影响"""
+    app.config['ADMISSION_BULKHEADS'] = 'bulk=0'
+    app.config['ADMISSION_QUEUE_TIMEOUT'] = 0
+    headers = register_user(client, 'shed@example.com')
+
+    response = client.get('/api/rate-limit/status', headers=headers)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert client.get('/api/auth/user-info', headers=headers).status_code == 200
+
+    stats = app.extensions['libretv'].stats()['admission']['classes']
+    assert stats['bulk']['timeouts'] == 1
+    assert stats['read']['admitted'] == 1 and stats['read']['inflight'] == 0
+
+
+def test_fast_path_answers_preflight_and_health():
+    """预检和健康检查在路由之前应答，预检有效期可按来源配置，其它请求照常交给 Flask"""
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'CORS_PREFLIGHT_MAX_AGE': 600,
+                      'CORS_PREFLIGHT_MAX_AGE_ORIGINS': 'https://tv.example.com=86400'})
+    client = app.test_client()
+    preflight = {'Access-Control-Request-Method': 'POST', 'Access-Control-Request-Headers': 'Content-Type, Authorization'}
+    try:
+        response = client.options('/api/user-favorites', headers={'Origin': 'https://tv.example.com', **preflight})
+        assert response.status_code == 204
+        assert response.headers['Access-Control-Allow-Origin'] == 'https://tv.example.com'
+        assert response.headers['Access-Control-Allow-Headers'] == 'authorization, content-type'
+        assert response.headers['Access-Control-Max-Age'] == '86400'
+        other = client.options('/api/viewing-history/operation', headers={'Origin': 'https://other.example', **preflight})
+        assert other.headers['Access-Control-Max-Age'] == '600'
+
+        health = client.get('/api/health')
+        assert health.status_code == 200
+        assert health.get_json() == {'status': 'ok', 'message': '服务正常运行'}
+        resources = app.extensions['libretv']
+        assert not resources.logging_ready  # 快速路径不经过请求钩子
+
+        # 不是预检的 OPTIONS 交给 Flask
+        assert client.options('/api/user-favorites').status_code == 200
+        stats = resources.stats()['fast_path']
+        assert (stats['preflights'], stats['health_checks'], stats['passed']) == (2, 1, 1)
+    finally:
+        app.extensions['libretv'].close()
+
+
+def test_bulk_export_import_resumes_from_checkpoint(app, client):
+    """导出的 NDJSON 可以导入另一个实例；中途出错后用同一个 import_id 从已提交的位置继续"""
+    app.config['ADMIN_TOKEN'] = 'admin-secret'
+    admin = {'X-Admin-Token': 'admin-secret'}
+    headers = register_user(client, 'export@example.com')
+    for i in range(3):
+        client.post('/api/user-favorites', json={'action': 'add', 'key': f'fav_{i}', 'data': {'vod_name': f'繁花{i}'}},
+                    headers=headers)
+    client.post('/api/viewing-history/operation?key=export@example.com_viewingHistory',
+                json=[{'title': '三体', 'timestamp': 1}], headers=headers)
+    app.extensions['libretv'].history_buffer.flush()
+
+    exported = client.get('/api/admin/export', headers=admin)
+    assert exported.status_code == 200
+    lines = exported.data.splitlines(keepends=True)
+    assert [json.loads(line)['type'] for line in lines] == ['meta', 'user', 'favorite', 'favorite', 'favorite', 'history']
+
+    target = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'ADMIN_TOKEN': 'admin-secret'})
+    try:
+        target_client = target.test_client()
+        broken = b''.join(lines[:4]) + b'{broken\n' + b''.join(lines[4:])
+        response = target_client.post('/api/admin/import?import_id=copy&batch_size=2', data=broken, headers=admin)
+        assert response.status_code == 400 and response.get_json()['line'] == 5
+
+        # 在线导入不允许删除片库索引
+        response = target_client.post('/api/admin/import?import_id=copy&defer_indexes=1',
+                                      data=b''.join(lines), headers=admin)
+        assert response.status_code == 400
+
+        response = target_client.post('/api/admin/import?import_id=copy&batch_size=2',
+                                      data=b''.join(lines[:4]) + b'\n' + b''.join(lines[4:]), headers=admin)
+        stats = response.get_json()
+        assert response.status_code == 200, stats
+        assert stats['resumed_from'] == 3  # 用户和第一条收藏已在第一批提交
+        assert (stats['users'], stats['favorites'], stats['history']) == (0, 2, 1)
+        assert target_client.post('/api/admin/import?import_id=copy', data=b''.join(lines),
+                                  headers=admin).get_json()['already_finished']
+
+        login = target_client.post('/api/auth/login', json={'username': 'export@example.com', 'password': 'testpass123'})
+        assert login.status_code == 200
+        token = next(cookie for cookie in login.headers.getlist('Set-Cookie')
+                     if cookie.startswith('accessToken=')).split(';', 1)[0].split('=', 1)[1]
+        copied = {'Authorization': f'Bearer {token}'}
+        assert len(target_client.get('/api/user-favorites', headers=copied).get_json()['favorites']) == 3
+        # 片库索引包含导入的收藏和历史
+        search = target_client.get('/api/library/search?q=繁花', headers=copied).get_json()
+        assert len(search['items']) == 3
+        assert target_client.get('/api/continue-watching', headers=copied).get_json()['items'][0]['title'] == '三体'
+    finally:
+        target.extensions['libretv'].close()
+
+
+def test_online_backup_under_concurrent_writes(tmp_path):
+    """备份期间持续写入：备份完成且通过完整性校验，按保留数量清理旧备份，可通过管理接口查看和触发"""
+    backup_dir = tmp_path / 'backups'
+    app = create_app({'DB_PATH': str(tmp_path / 'libretv.db'), 'LOG_DIR': '', 'ADMIN_TOKEN': 'admin-secret',
+                      'BACKUP_DIR': str(backup_dir), 'BACKUP_PAGES_PER_STEP': 4, 'BACKUP_STEP_SLEEP': 0.001,
+                      'BACKUP_RETENTION': 2})
+    resources = app.extensions['libretv']
+    client = app.test_client()
+    admin = {'X-Admin-Token': 'admin-secret'}
+    try:
+        register_user(client, 'backup@example.com')
+        writer = resources.db_writer
+        writer.run(lambda conn: conn.executemany(
+            'INSERT INTO user_favorites (user_id, key, data) VALUES (1, ?, ?)',
+            [(f'seed_{i}', json.dumps({'vod_name': f'种子{i}', 'pad': 'x' * 200})) for i in range(500)]))
+
+        stop = threading.Event()
+        written = itertools.count()
+
+        def write_load():
+            while not stop.is_set():
+                i = next(written)
+                writer.execute('INSERT INTO user_favorites (user_id, key, data) VALUES (1, ?, ?)',
+                               (f'live_{i}', json.dumps({'vod_name': f'直播{i}'})))
+
+        thread = threading.Thread(target=write_load)
+        thread.start()
+        try:
+            results = [resources.backup.run_backup() for _ in range(3)]
+        finally:
+            stop.set()
+            thread.join()
+        assert next(written) > 0
+
+        files = sorted(os.listdir(backup_dir))
+        assert files == sorted(result['file'] for result in results[1:])
+        restored = tmp_path / 'restored.db'
+        with gzip.open(backup_dir / results[-1]['file']) as source:
+            restored.write_bytes(source.read())
+        conn = sqlite3.connect(restored)
+        try:
+            assert conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+            assert conn.execute("SELECT COUNT(*) FROM user_favorites WHERE key LIKE 'seed_%'").fetchone()[0] == 500
+        finally:
+            conn.close()
+
+        status = client.get('/api/admin/backup', headers=admin).get_json()
+        assert status['completed'] == 3 and len(status['backups']) == 2
+        assert client.post('/api/admin/backup', headers=admin).status_code == 202
+        deadline = time.time() + 10
+        while resources.backup.stats()['completed'] < 4 and time.time() < deadline:
+            time.sleep(0.05)
+        assert resources.backup.stats()['completed'] == 4
+    finally:
+        resources.close()
+
+
+def test_sharded_storage_rebalances_and_routes_users(tmp_path):
+    """从1个分片迁移到4个：每个用户的数据只在所属分片，收藏、历史、刷新令牌和导出照常可用"""
+    from LibreProgramBackend import init_user_tables
+    from sharding import rebalance, shard_index, shard_path
+
+    db_path = str(tmp_path / 'libretv.db')
+    config = {'DB_PATH': db_path, 'LOG_DIR': '', 'ADMIN_TOKEN': 'admin-secret'}
+    app = create_app(config)
+    app.config['RATE_LIMIT_ENABLED'] = False
+    try:
+        client = app.test_client()
+        for i in range(12):
+            username = f'shard{i}@example.com'
+            headers = register_user(client, username)
+            client.post('/api/user-favorites', json={'action': 'add', 'key': 'fav', 'data': {'vod_name': f'繁花{i}'}},
+                        headers=headers)
+            client.post(f'/api/viewing-history/operation?key={username}_viewingHistory',
+                        json=[{'title': '三体', 'timestamp': i}], headers=headers)
+    finally:
+        app.extensions['libretv'].close()  # 落库写回缓冲
+
+    user_ids = range(1, 13)
+    stats = rebalance(db_path, 1, 4, init_user_tables)
+    assert stats['moved_users'] == sum(shard_index(user_id, 4) != 0 for user_id in user_ids)
+    for index in range(4):
+        conn = sqlite3.connect(shard_path(db_path, index))
+        try:
+            expected = {user_id for user_id in user_ids if shard_index(user_id, 4) == index}
+            for table in ('user_favorites', 'viewing_history', 'refresh_tokens'):
+                assert {row[0] for row in conn.execute(f'SELECT user_id FROM {table}')} == expected
+        finally:
+            conn.close()
+    # 重复执行不再迁移
+    assert rebalance(db_path, 1, 4, init_user_tables)['moved_users'] == 0
+
+    app = create_app(dict(config, SHARD_COUNT=4))
+    app.config['RATE_LIMIT_ENABLED'] = False
+    resources = app.extensions['libretv']
+    admin = {'X-Admin-Token': 'admin-secret'}
+    try:
+        client = app.test_client(use_cookies=False)
+        for i in range(12):
+            login = client.post('/api/auth/login', json={'username': f'shard{i}@example.com', 'password': 'testpass123'},
+                                headers={'X-Forwarded-For': f'10.1.0.{i}'})
+            assert login.status_code == 200
+            cookies = dict(cookie.split(';', 1)[0].split('=', 1) for cookie in login.headers.getlist('Set-Cookie'))
+            headers = {'Authorization': f"Bearer {cookies['accessToken']}"}
+            favorites = client.get('/api/user-favorites', headers=headers).get_json()['favorites']
+            assert [favorite['data']['vod_name'] for favorite in favorites] == [f'繁花{i}']
+            assert len(client.get('/api/library/search?q=繁花', headers=headers).get_json()['items']) == 1
+            assert client.get('/api/continue-watching', headers=headers).get_json()['items'][0]['title'] == '三体'
+            refreshed = client.post('/api/auth/refresh', headers={'Cookie': f"refreshToken={cookies['refreshToken']}"})
+            assert refreshed.status_code == 200
+
+        # 新用户的数据直接写入所属分片
+        headers = register_user(client, 'shard-new@example.com')
+        client.post('/api/user-favorites', json={'action': 'add', 'key': 'fav', 'data': {'vod_name': '狂飙'}},
+                    headers=headers)
+        with resources.shard_for(13).connect() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM user_favorites WHERE user_id = 13').fetchone()[0] == 1
+        assert len(resources.stats()['shards']) == 3
+
+        lines = client.get('/api/admin/export', headers=admin).data.splitlines()
+        types = [json.loads(line)['type'] for line in lines]
+        assert (types.count('user'), types.count('favorite'), types.count('history')) == (13, 13, 12)
+    finally:
+        resources.close()
+
+
+def test_history_retention_on_write_and_compaction(tmp_path):
+    """写入时按保留策略裁剪；收紧策略后后台压缩裁剪已保存的历史、同步片库索引并回收空间"""
+    app = create_app({'DB_PATH': str(tmp_path / 'libretv.db'), 'LOG_DIR': '', 'ADMIN_TOKEN': 'admin-secret',
+                      'HISTORY_MAX_ITEMS': 0, 'HISTORY_MAX_BYTES': 0})
+    app.config['RATE_LIMIT_ENABLED'] = False
+    resources = app.extensions['libretv']
+    client = app.test_client()
+    admin = {'X-Admin-Token': 'admin-secret'}
+    try:
+        heavy = register_user(client, 'heavy@example.com')
+        light = register_user(client, 'light@example.com')
+        # 前端历史最新的在前
+        history = [{'title': f'剧集{i:03d}', 'timestamp': 1700000000000 + i, 'episodes': ['x' * 200] * 20}
+                   for i in reversed(range(300))]
+        heavy_key = 'heavy@example.com_viewingHistory'
+        client.post(f'/api/viewing-history/operation?key={heavy_key}', json=history, headers=heavy)
+        client.post('/api/viewing-history/operation?key=light@example.com_viewingHistory',
+                    json=history[:3], headers=light)
+        resources.history_buffer.flush()
+
+        report = client.get('/api/admin/storage?limit=5', headers=admin).get_json()
+        assert [user['username'] for user in report['users']] == ['heavy@example.com', 'light@example.com']
+        assert report['users'][0]['history_items'] == 300
+
+        resources.history_policy.max_items = 50
+        # 写入时裁剪：只保留最新的50条
+        client.post('/api/viewing-history/operation?key=light@example.com_viewingHistory', json=history, headers=light)
+        saved = json.loads(client.get('/api/viewing-history/operation?key=light@example.com_viewingHistory',
+                                      headers=light).get_json()['data'])
+        assert [item['title'] for item in saved] == [f'剧集{i:03d}' for i in reversed(range(250, 300))]
+
+        # 压缩已保存的历史
+        assert client.post('/api/admin/storage', headers=admin).status_code == 202
+        deadline = time.time() + 10
+        while resources.history_compactor.stats()['completed'] < 1 and time.time() < deadline:
+            time.sleep(0.05)
+        result = resources.history_compactor.stats()['last']
+        assert result['rewritten'] == 1 and result['removed_items'] == 250
+        assert result['reclaimed_pages'] > 0
+        saved = json.loads(client.get(f'/api/viewing-history/operation?key={heavy_key}',
+                                      headers=heavy).get_json()['data'])
+        assert len(saved) == 50 and saved[0]['title'] == '剧集299'
+        assert client.get('/api/library/search?q=剧集000', headers=heavy).get_json()['items'] == []
+        assert len(client.get('/api/library/search?q=剧集299', headers=heavy).get_json()['items']) == 1
+        report = client.get('/api/admin/storage', headers=admin).get_json()
+        assert report['users'][0]['history_items'] == 50
+        assert report['shards'][0]['incremental_vacuum']
+
+        # 扫描后被用户重新保存的行不会被覆盖：REPLACE 换了ID，或者 ON CONFLICT DO UPDATE 改了 updated_at
+        compactor = resources.history_compactor
+        assert compactor._rewrite(resources.connect(), [(1, 1, heavy_key, '[]', None, 0)]) == 0
+        row_id, updated_at = resources.connect().execute(
+            'SELECT id, updated_at FROM viewing_history WHERE key = ?', (heavy_key,)).fetchone()
+        assert compactor._rewrite(resources.connect(), [(row_id, 1, heavy_key, '[]', None, updated_at - 1)]) == 0
+
+        # 大小上限：数组从最旧的条目删除，其它类型超出时拒绝
+        resources.history_policy.max_bytes = app.config['HISTORY_MAX_BYTES'] = 20000
+        client.post(f'/api/viewing-history/operation?key={heavy_key}', json=history, headers=heavy)
+        saved = client.get(f'/api/viewing-history/operation?key={heavy_key}', headers=heavy).get_json()['data']
+        assert len(saved.encode('utf-8')) <= 20000 and json.loads(saved)[0]['title'] == '剧集299'
+        response = client.post(f'/api/viewing-history/operation?key={heavy_key}', json={'blob': 'x' * 30000},
+                               headers=heavy)
+        assert response.status_code == 413
+    finally:
+        resources.close()
+
+
+def test_traffic_capture_is_anonymized_and_replays(tmp_path):
+    """流量采集只记录路由规则和用户分桶；回放按记录合成请求并报告各接口延迟"""
+    capture_path = str(tmp_path / 'traffic-{pid}.ndjson.gz')
+    app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'ADMIN_TOKEN': 'admin-secret',
+                      'TRAFFIC_CAPTURE_ENABLED': True, 'TRAFFIC_CAPTURE_PATH': capture_path})
+    app.config['RATE_LIMIT_ENABLED'] = False
+    resources = app.extensions['libretv']
+    client = app.test_client()
+    try:
+        alice = register_user(client, 'alice-capture@example.com')
+        bob = register_user(client, 'bob-capture@example.com')
+        history = [{'title': '采集剧集', 'episodeIndex': 1, 'timestamp': 1}]
+        for headers, key in ((alice, 'alice_viewingHistory'), (bob, 'bob_viewingHistory')):
+            client.post(f'/api/viewing-history/operation?key={key}', json=history, headers=headers)
+            client.get(f'/api/viewing-history/operation?key={key}', headers=headers)
+            client.post('/api/user-favorites', headers=headers,
+                        json={'action': 'add', 'key': 'fav_secret', 'data': {'vod_name': '采集收藏'}})
+        client.get('/api/admin/stats', headers={'X-Admin-Token': 'admin-secret'})
+        resources.traffic_recorder.flush()
+
+        path = resources.traffic_recorder.path
+        assert path == capture_path.format(pid=os.getpid())
+        with gzip.open(path, 'rt', encoding='utf-8') as source:
+            raw = source.read()
+        # 不含用户名、key、查询参数和请求内容，管理接口不采集
+        for secret in ('alice', 'bob', 'viewingHistory', 'fav_secret', '采集', '/api/admin'):
+            assert secret not in raw
+        records = [json.loads(line) for line in raw.splitlines()]
+        assert len(records) == 8
+        by_endpoint = {(record['m'], record['e']) for record in records}
+        assert ('POST', '/api/auth/register') in by_endpoint
+        assert ('GET', '/api/viewing-history/operation') in by_endpoint
+        history_posts = [record for record in records
+                         if record['m'] == 'POST' and record['e'] == '/api/viewing-history/operation']
+        assert len({record['u'] for record in history_posts}) == 2
+        assert all(record['q'] > 0 and record['s'] == 200 for record in history_posts)
+        assert all(record['u'] is None for record in records if record['e'] == '/api/auth/register')
+    finally:
+        resources.close()
+
+    # 回放到新的进程内实例
+    from traffic_replay import TestClientTarget, load_capture, replay
+    records = load_capture([path])
+    target_app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': ''})
+    target_app.config['RATE_LIMIT_ENABLED'] = False
+    try:
+        report = replay(records, TestClientTarget(target_app), speed=0, concurrency=1)
+    finally:
+        target_app.extensions['libretv'].close()
+    assert report['errors'] == {}
+    assert report['users'] == 2 and report['requests'] == 8
+    assert report['endpoints']['POST /api/viewing-history/operation']['statuses'] == {200: 2}
+    assert report['endpoints']['GET /api/viewing-history/operation']['statuses'] == {200: 2}
+    assert report['endpoints']['POST /api/user-favorites']['captured']['count'] == 2
+    assert report['endpoints']['POST /api/auth/register']['statuses'] == {201: 2}
+
+
+def test_memory_diagnostics_and_limiter_pruning(app, resources, client):
+    """内存诊断报告各组件大小；空闲的限流key被清理；tracemalloc 快照可按分配位置比较"""
+    app.config['ADMIN_TOKEN'] = 'admin-secret'
+    admin = {'X-Admin-Token': 'admin-secret'}
+    limiter = resources.rate_limiter
+    for user_id in range(100):
+        assert limiter.check_user_rate_limit(user_id, 5)
+    assert limiter.get_user_request_count(12345) == 0
+    assert limiter.stats()['user_keys'] == 100
+
+    # 窗口过后清理，查询不会重新创建key
+    limiter.window_size = 0
+    limiter.prune_interval = 0
+    assert limiter.check_user_rate_limit('active', 5)
+    assert limiter.stats()['user_keys'] == 1 and limiter.stats()['pruned_keys'] == 100
+
+    report = client.get('/api/admin/memory?types=5&collect=1', headers=admin).get_json()
+    assert report['process']['pid'] == os.getpid() and report['process']['rss'] > 0
+    assert len(report['gc']['generations']) == 3 and report['collected'] >= 0
+    assert report['components']['rate_limiter']['user_keys'] == 0
+    assert len(report['types']) == 5 and report['types'][0]['count'] > 0
+    assert report['tracemalloc']['tracing'] is False
+    assert client.get('/api/admin/memory').status_code == 403
+
+    # 两个快照之间保留的分配出现在比较结果的前面
+    first = client.post('/api/admin/memory/snapshots', headers=admin).get_json()
+    leak = [bytearray(1000) for _ in range(500)]
+    second = client.post('/api/admin/memory/snapshots', headers=admin).get_json()
+    assert second['id'] == first['id'] + 1
+    diff = client.get(f"/api/admin/memory/snapshots/{second['id']}?base={first['id']}&limit=5",
+                      headers=admin).get_json()['top']
+    assert any('test_backend.py' in entry['site'][0] and entry['bytes_diff'] >= 500 * 1000 for entry in diff)
+    top = client.get(f"/api/admin/memory/snapshots/{second['id']}?group_by=filename", headers=admin).get_json()
+    assert top['top'] and 'bytes_diff' not in top['top'][0]
+    assert client.get('/api/admin/memory/snapshots/999', headers=admin).status_code == 404
+    assert client.get(f"/api/admin/memory/snapshots/{second['id']}?group_by=x", headers=admin).status_code == 400
+    assert len(client.get('/api/admin/memory/snapshots', headers=admin).get_json()['snapshots']) == 2
+
+    stopped = client.delete('/api/admin/memory/snapshots', headers=admin).get_json()
+    assert stopped['tracing'] is False and stopped['snapshots'] == []
+    del leak
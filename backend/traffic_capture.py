@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端流量采集（默认关闭）
+- 每个请求记录一行匿名化的元数据：时间、方法、路由规则、状态码、处理耗时、请求/响应字节数、用户分桶
+- 只记录路由规则（如 /proxy/<path:target_url>），不记录实际路径、查询参数、IP、用户名和请求内容；
+  用户ID经 HMAC 映射到固定数量的分桶，同一用户在一次采集中落在同一个桶，但无法反查
+- 请求线程只把记录放入内存队列，后台线程每秒追加写入一次；文件超过上限后停止采集，队列满时丢弃
+- 每个进程写自己的文件（路径中的 {pid}），.gz 结尾时压缩；traffic_replay.py 读取后按原始节奏回放
+
+记录格式（NDJSON，短字段名）：
+    {"t":1700000000123.4,"m":"POST","e":"/api/viewing-history/operation","s":200,"d":3.21,"q":5120,"r":27,"u":17}
+    t 请求开始时间（毫秒时间戳） d 处理耗时（毫秒） q 请求体字节数 r 响应体字节数（流式响应为null） u 用户分桶（未登录为null）
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+from collections import deque
+
+
+class TrafficRecorder:
+    """
+    流量采集
+    :param path: 输出文件路径，可包含 {pid}
+    :param salt: 用户分桶的 HMAC 密钥
+    :param sample_rate: 采样比例（0~1）
+    :param user_buckets: 用户分桶数
+    :param max_bytes: 文件大小上限，达到后停止采集
+    """
+
+    def __init__(self, path, salt, sample_rate=1.0, user_buckets=1024, max_bytes=256 * 1024 * 1024,
+                 flush_interval=1.0, max_pending=100000, logger=None):
+        self.path = path.format(pid=os.getpid())
+        self.salt = salt.encode('utf-8') if isinstance(salt, str) else salt
+        self.sample_rate = sample_rate
+        self.user_buckets = user_buckets
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.full = False
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.bytes_written = 0
+
+    def user_bucket(self, user_id):
+        digest = hmac.new(self.salt, str(user_id).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') % self.user_buckets
+
+    def record(self, started_at, method, endpoint, status, duration, request_bytes, response_bytes, user_id=None):
+        """记录一个请求；started_at 为秒级时间戳，duration 为秒"""
+        if self.full or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return
+        entry = {
+            't': round(started_at * 1000, 1),
+            'm': method,
+            'e': endpoint,
+            's': status,
+            'd': round(duration * 1000, 3),
+            'q': request_bytes,
+            'r': response_bytes,
+            'u': self.user_bucket(user_id) if user_id is not None else None
+        }
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.pending.append(entry)
+            self.recorded += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='traffic-capture', daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        """把队列中的记录追加写入文件"""
+        with self.lock:
+            if not self.pending:
+                return
+            entries = list(self.pending)
+            self.pending.clear()
+        data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries).encode('utf-8')
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # gzip 追加写入会产生多个成员，读取时按一个流解压
+            opener = gzip.open if self.path.endswith('.gz') else open
+            with opener(self.path, 'ab') as output:
+                output.write(data)
+            size = os.path.getsize(self.path)
+        except OSError as e:
+            self.logger.error(f"写入流量采集文件失败: {str(e)}")
+            with self.lock:
+                self.dropped += len(entries)
+            return
+        with self.lock:
+            self.written += len(entries)
+            self.bytes_written = size
+            if size >= self.max_bytes and not self.full:
+                self.full = True
+                self.logger.warning(f"流量采集文件达到上限 {self.max_bytes} 字节，停止采集: {self.path}")
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'path': self.path,
+                'recorded': self.recorded,
+                'written': self.written,
+                'dropped': self.dropped,
+                'pending': len(self.pending),
+                'bytes': self.bytes_written,
+                'full': self.full,
+                'sample_rate': self.sample_rate
+            }
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 流量回放：按采集文件（traffic_capture.py）的节奏重放请求，报告各接口的延迟分布
+- 目标可以是进程内的 Flask 测试客户端（默认，使用内存数据库的新实例），也可以是 --url 指定的本地服务
+- 每个用户分桶对应一个回放用户，回放前注册；请求体按采集的字节数合成（历史数组、收藏、批量key等）
+- 按采集时间间隔发送，--speed 2 为两倍速，--speed 0 为不等待全速发送；同一随机种子的回放请求序列相同
+- 依赖上游的接口（搜索、详情、豆瓣、代理）和事件流默认跳过，避免回放时访问外网
+- 报告中同时列出采集时的服务端耗时，便于对比回放前后的变化
+
+命令行用法：
+    python traffic_replay.py data/traffic-*.ndjson.gz --speed 4
+    python traffic_replay.py data/traffic-1234.ndjson.gz --url http://127.0.0.1:5002 --concurrency 32
+"""
+
+import argparse
+import gzip
+import http.client
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+
+PASSWORD = 'replay-pass-123'
+
+# 回放时跳过：依赖上游或长连接
+SKIPPED_ENDPOINTS = ('/api/search', '/api/detail', '/api/detail/batch', '/api/douban/tags',
+                     '/api/douban/subjects', '/api/douban/subject/<subject_id>', '/proxy/<path:target_url>',
+                     '/api/events')
+
+# 不需要登录的接口，采集时没有用户分桶
+ANONYMOUS_ENDPOINTS = ('/api/auth/login', '/api/auth/refresh', '/api/auth/logout', '/api/auth/register',
+                       '/api/auth/check-username', '/api/health')
+
+_ip_ids = itertools.count(1)
+
+
+def load_capture(paths):
+    """读取采集文件（可以多个进程的文件），按请求开始时间排序"""
+    records = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as source:
+            for line in source:
+                if line.strip():
+                    records.append(json.loads(line))
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# ---- 回放目标 ----
+
+class TestClientTarget:
+    """进程内 Flask 应用；每个线程一个测试客户端，不保存 Cookie"""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, headers, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client(use_cookies=False)
+        response = client.open(path, method=method, headers=headers, data=body)
+        response.close()
+        return response.status_code, response.headers.getlist('Set-Cookie')
+
+
+class HttpTarget:
+    """本地HTTP服务；每个线程一个 keep-alive 连接"""
+
+    def __init__(self, url, timeout=30):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, method, path, headers, body):
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status, response.headers.get_all('Set-Cookie') or []
+            except (http.client.HTTPException, OSError):
+                # 服务端关闭了空闲连接，重连一次
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+
+# ---- 回放用户与请求合成 ----
+
+class ReplayUser:
+    """一个用户分桶对应的回放用户"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.username = f'replay-{bucket}@example.com'
+        ip_id = next(_ip_ids)
+        # 每个回放用户一个来源IP，登录和注册不受单IP限流影响
+        self.ip = f'10.{ip_id >> 16 & 255}.{ip_id >> 8 & 255}.{ip_id & 255}'
+        self.access_token = None
+        self.refresh_token = None
+        self.lock = threading.Lock()
+
+    def update_cookies(self, cookies):
+        for cookie in cookies:
+            name, _, value = cookie.split(';', 1)[0].partition('=')
+            if name == 'accessToken' and value:
+                self.access_token = value
+            elif name == 'refreshToken' and value:
+                self.refresh_token = value
+
+    def headers(self):
+        headers = {'X-Forwarded-For': self.ip}
+        if self.access_token:
+            headers['Authorization'] = f'Bearer {self.access_token}'
+        return headers
+
+
+def _json(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _history(size, rng):
+    """合成约 size 字节的观看历史数组（与前端条目结构相同）"""
+    items = []
+    count = max(1, size // 1500)
+    now = int(time.time() * 1000)
+    for i in range(count):
+        items.append({
+            'title': f'回放剧集{rng.randrange(1000)}',
+            'sourceName': '回放源',
+            'episodeIndex': rng.randrange(40),
+            'playbackPosition': rng.uniform(0, 2700),
+            'duration': 2700.0,
+            'timestamp': now - i * 1000,
+            'url': 'https://libretv.example.com/player.html',
+            'episodes': ['https://cdn.example.com/ep.m3u8'] * 35
+        })
+    return items
+
+
+def build_request(record, user, rng):
+    """按采集记录合成请求，返回 (method, path, headers, body)；无法回放时返回None"""
+    method, endpoint, size = record['m'], record['e'], record.get('q') or 0
+    headers = user.headers()
+    body = None
+    if endpoint == '/api/viewing-history/operation':
+        path = '/api/viewing-history/operation?' + urlencode({'key': f'{user.username}_viewingHistory'})
+        if method == 'POST':
+            body = _json(_history(size, rng))
+    elif endpoint == '/api/user-favorites' and method == 'POST':
+        path = endpoint
+        body = _json({'action': 'add' if rng.random() < 0.8 else 'remove', 'key': f'fav_{rng.randrange(50)}',
+                      'data': {'vod_name': f'回放收藏{rng.randrange(1000)}', 'pad': 'x' * max(0, size - 120)}})
+    elif endpoint == '/api/user-favorites/batch-check':
+        path = endpoint
+        body = _json({'keys': [f'fav_{i}' for i in range(max(1, size // 12))]})
+    elif endpoint == '/api/bootstrap':
+        path = endpoint
+        # 不超过默认的 BOOTSTRAP_MAX_KEYS
+        body = _json({'check_keys': [f'fav_{i}' for i in range(min(200, max(0, (size - 80) // 12)))],
+                      'history_keys': [f'{user.username}_viewingHistory']})
+    elif endpoint == '/api/library/search':
+        path = endpoint + '?' + urlencode({'q': f'回放{rng.randrange(10)}'})
+    elif endpoint == '/api/auth/login':
+        path = endpoint
+        body = _json({'username': user.username, 'password': PASSWORD})
+    elif endpoint == '/api/auth/refresh':
+        path = endpoint
+        headers = {'X-Forwarded-For': user.ip}
+        if user.refresh_token:
+            headers['Cookie'] = f'refreshToken={user.refresh_token}'
+    elif endpoint == '/api/auth/logout':
+        # 登出会撤销刷新令牌，使后续回放失效；只发送不带凭据的请求
+        path = endpoint
+        headers = {'X-Forwarded-For': user.ip}
+    elif endpoint == '/api/auth/register':
+        path = endpoint
+        headers = {'X-Forwarded-For': f'10.255.{rng.randrange(256)}.{rng.randrange(256)}'}
+        body = _json({'username': f'replay-new-{rng.getrandbits(48)}@example.com', 'password': PASSWORD})
+    elif endpoint == '/api/auth/check-username':
+        path = endpoint
+        body = _json({'username': f'replay-{rng.randrange(1000)}@example.com'})
+    elif '<' not in endpoint:
+        path = endpoint
+    else:
+        return None
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+    return method, path, headers, body
+
+
+def register_users(target, buckets):
+    """为每个分桶注册（或登录已存在的）回放用户"""
+    users = {}
+    for bucket in buckets:
+        user = ReplayUser(bucket)
+        body = _json({'username': user.username, 'password': PASSWORD})
+        headers = {'Content-Type': 'application/json', 'X-Forwarded-For': user.ip}
+        path = '/api/auth/register'
+        for _ in range(30):
+            status, cookies = target.request('POST', path, headers, body)
+            if status == 409:
+                path = '/api/auth/login'
+            elif status == 429:
+                # 注册接口有全局限流，稍后重试
+                time.sleep(1)
+            else:
+                break
+        if status not in (200, 201):
+            raise RuntimeError(f'回放用户 {user.username} 注册失败: HTTP {status}')
+        user.update_cookies(cookies)
+        users[bucket] = user
+    return users
+
+
+# ---- 回放 ----
+
+def replay(records, target, speed=1.0, concurrency=16, seed=0, include_upstream=False, relogin=True):
+    """
+    回放采集记录，返回报告字典
+    :param speed: 回放倍速，0 为不按时间间隔全速发送
+    """
+    rng = random.Random(seed)
+    skipped = defaultdict(int)
+    plan = []
+    buckets = sorted({record['u'] for record in records if record.get('u') is not None}) or [0]
+    for record in records:
+        endpoint = record.get('e')
+        if endpoint is None or (endpoint in SKIPPED_ENDPOINTS and not include_upstream):
+            skipped[endpoint or '<unmatched>'] += 1
+            continue
+        bucket = record.get('u')
+        if bucket is None:
+            # 登录、刷新等接口采集时没有用户，固定随机分配给一个回放用户
+            bucket = buckets[rng.randrange(len(buckets))]
+        plan.append((record, bucket, rng.getrandbits(32)))
+
+    users = register_users(target, buckets)
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    lateness = []
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def send(record, bucket, request_seed, due):
+        user = users[bucket]
+        request = build_request(record, user, random.Random(request_seed))
+        key = f"{record['m']} {record['e']}"
+        if request is None:
+            with lock:
+                skipped[record['e']] += 1
+            return
+        started = time.perf_counter()
+        try:
+            status, cookies = target.request(*request)
+            if status == 401 and relogin and record['e'] not in ANONYMOUS_ENDPOINTS:
+                # 访问令牌过期：重新登录后重试，重试的耗时一并计入
+                with user.lock:
+                    _, login_cookies = target.request('POST', '/api/auth/login',
+                                                      {'Content-Type': 'application/json', 'X-Forwarded-For': user.ip},
+                                                      _json({'username': user.username, 'password': PASSWORD}))
+                    user.update_cookies(login_cookies)
+                method, path, _, body = request
+                headers = user.headers()
+                if body is not None:
+                    headers['Content-Type'] = 'application/json'
+                status, cookies = target.request(method, path, headers, body)
+        except Exception as e:
+            with lock:
+                errors[f'{key}: {type(e).__name__}'] += 1
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        if record['e'] in ('/api/auth/login', '/api/auth/refresh'):
+            with user.lock:
+                user.update_cookies(cookies)
+        with lock:
+            latencies[key].append(elapsed)
+            statuses[key][status] += 1
+            if due is not None:
+                lateness.append(max(0.0, (started - due) * 1000))
+
+    started = time.perf_counter()
+    first = plan[0][0]['t'] if plan else 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record, bucket, request_seed in plan:
+            due = None
+            if speed > 0:
+                due = started + (record['t'] - first) / 1000 / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, record, bucket, request_seed, due)
+    elapsed = time.perf_counter() - started
+
+    captured = defaultdict(list)
+    for record, _, _ in plan:
+        captured[f"{record['m']} {record['e']}"].append(record['d'])
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'requests': len(all_latencies),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        'users': len(users),
+        'overall': _summary(all_latencies),
+        'lateness_ms': _summary(lateness),
+        'endpoints': {
+            key: dict(_summary(values), statuses=dict(statuses[key]), captured=_summary(captured[key]))
+            for key, values in sorted(latencies.items(), key=lambda item: -len(item[1]))
+        },
+        'skipped': dict(skipped),
+        'errors': dict(errors)
+    }
+
+
+def _summary(samples):
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'p50': round(percentile(samples, 50), 2),
+        'p90': round(percentile(samples, 90), 2),
+        'p99': round(percentile(samples, 99), 2),
+        'max': round(max(samples), 2)
+    }
+
+
+def print_report(report):
+    print(f"回放 {report['requests']} 个请求，{report['users']} 个用户，耗时 {report['seconds']}s，"
+          f"{report['throughput']} 次/秒")
+    overall = report['overall']
+    if overall['count']:
+        print(f"整体延迟 p50 {overall['p50']}ms  p90 {overall['p90']}ms  p99 {overall['p99']}ms  max {overall['max']}ms")
+    if report['lateness_ms']['count']:
+        print(f"发送滞后 p99 {report['lateness_ms']['p99']}ms（回放端来不及按节奏发送时偏大）")
+    print(f"{'接口':<48}{'次数':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'采集p50':>10}{'采集p99':>10}  状态码")
+    for key, summary in report['endpoints'].items():
+        captured = summary['captured']
+        print(f"{key:<48}{summary['count']:>7}{summary['p50']:>9}{summary['p90']:>9}{summary['p99']:>9}"
+              f"{captured.get('p50', '-'):>10}{captured.get('p99', '-'):>10}  "
+              f"{', '.join(f'{status}×{count}' for status, count in sorted(summary['statuses'].items()))}")
+    if report['skipped']:
+        print(f"跳过: {report['skipped']}")
+    if report['errors']:
+        print(f"错误: {report['errors']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LibreTV 流量回放')
+    parser.add_argument('captures', nargs='+', help='采集文件，多个进程的文件按时间合并')
+    parser.add_argument('--url', help='回放到本地服务，例如 http://127.0.0.1:5002；默认使用进程内测试客户端和内存数据库')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放倍速，0 为全速')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发发送线程数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子，相同种子生成相同的请求序列')
+    parser.add_argument('--include-upstream', action='store_true', help='同时回放依赖上游的接口')
+    parser.add_argument('--no-rate-limit', action='store_true', help='进程内回放时关闭限流，只测量处理耗时')
+    parser.add_argument('--json', action='store_true', help='以JSON输出报告')
+    args = parser.parse_args(argv)
+
+    records = load_capture(args.captures)
+    app = None
+    if args.url:
+        target = HttpTarget(args.url)
+    else:
+        from LibreProgramBackend import create_app
+        app = create_app({'DB_PATH': ':memory:', 'LOG_DIR': '', 'TRAFFIC_CAPTURE_ENABLED': False})
+        app.config['RATE_LIMIT_ENABLED'] = not args.no_rate_limit
+        target = TestClientTarget(app)
+    try:
+        report = replay(records, target, speed=args.speed, concurrency=args.concurrency, seed=args.seed,
+                        include_upstream=args.include_upstream)
+    finally:
+        if app is not None:
+            app.extensions['libretv'].close()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
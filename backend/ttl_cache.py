@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端内存 TTL 缓存
+按条数限制大小，超出时淘汰最久未使用的条目；每个条目可以单独指定过期时间
+过期后还可以在 stale_ttl 秒内取到旧值（stale-while-revalidate），由调用方在后台刷新
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """线程安全的 LRU + TTL 缓存"""
+
+    def __init__(self, max_entries=1000, ttl=600, stale_ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.lock = threading.Lock()
+        # key -> (过期时间, 旧值可用截止时间, value)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """命中且未过期返回缓存值，否则返回 default"""
+        value, fresh = self.lookup(key)
+        return value if fresh else default
+
+    def lookup(self, key):
+        """
+        返回 (value, 是否新鲜)
+        已过期但仍在旧值可用期内返回 (旧值, False)，不存在返回 (None, False)
+        """
+        now = time.monotonic()
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or item[1] < now:
+                if item is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None, False
+            self.entries.move_to_end(key)
+            if item[0] < now:
+                self.stale_hits += 1
+                return item[2], False
+            self.hits += 1
+            return item[2], True
+
+    def put(self, key, value, ttl=None):
+        """写入缓存，ttl 为 None 时使用默认过期时间"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, expires_at + self.stale_ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def remaining_ttl(self, key):
+        """距离过期的秒数（已过期为负数），不存在返回 None；不影响LRU顺序和命中统计"""
+        with self.lock:
+            item = self.entries.get(key)
+        return None if item is None else item[0] - time.monotonic()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.entries.pop(key, None)
+        return default if item is None else item[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端用户名/邮箱存在性索引
+- 布隆过滤器判断"一定不存在"，用户名检查和注册的大部分请求（新用户名、探测用户名）不再查询数据库
+- 过滤器判断"可能存在"时由调用方查询数据库确认，因此不保存精确集合，100万用户（用户名+邮箱200万项，1%误判率）约占 3MB
+- 首次使用时在后台线程从 users 表构建，构建完成前所有查询都回落到数据库
+- 注册成功后写入；数量超过容量时按两倍容量在后台重建，保证误判率不随用户增长而上升
+- 多个工作进程各有一份过滤器，只有本进程的注册会直接写入；判断"不存在"之前先按用户ID增量读取
+  比已索引的最大ID更大的用户（其它进程注册或导入的），走主键范围查询，没有新用户时只读一个索引页，
+  因此"一定不存在"的结论包含所有已提交的注册
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+
+class BloomFilter:
+    """固定大小的布隆过滤器，使用 blake2b 双重哈希生成 k 个位置"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        # 已存在的项（例如本进程注册后又被增量读取到）不重复计数
+        if added:
+            self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class UserIndex:
+    """
+    用户名和邮箱的存在性索引
+    might_exist() 返回 False 时一定不存在；返回 True 时需要查询数据库确认
+    load() 返回 (user_id, username, email) 的可迭代对象，用于构建和重建；count() 返回当前用户名+邮箱的个数，用于预估容量；
+    load_since(user_id) 返回ID大于 user_id 的用户，用于补充其它进程注册的用户；
+    每 sync_interval 秒最多查询一次，期间的判断直接用内存中的过滤器回答，
+    其它进程刚注册的用户名最多晚 sync_interval 秒才判定为已使用，注册时由数据库 UNIQUE 约束兜底
+    """
+
+    def __init__(self, load, count=None, load_since=None, min_capacity=100000, error_rate=0.01,
+                 sync_interval=1.0, logger=None):
+        self.load = load
+        self.count = count
+        self.load_since = load_since
+        self.sync_interval = sync_interval
+        self.min_capacity = min_capacity
+        self.error_rate = error_rate
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.filter = None
+        self.building = False
+        self.built = threading.Event()
+        # 构建期间注册的用户，构建完成后补充写入
+        self.pending = []
+        self.negatives = 0
+        self.positives = 0
+        self.false_positives = 0
+        self.unavailable = 0
+        self.builds = 0
+        # 已写入过滤器的最大用户ID
+        self.last_id = 0
+        self.synced = 0
+        # 补充查询：同一时间只有一个线程查询，其余线程不等待
+        self.sync_lock = threading.Lock()
+        self.synced_at = None
+        self.sync_queries = 0
+
+    @staticmethod
+    def _keys(username=None, email=None):
+        keys = []
+        if username:
+            keys.append('u:' + username)
+        if email:
+            keys.append('e:' + email)
+        return keys
+
+    def _build(self, capacity):
+        try:
+            if self.count is not None:
+                # 预留25%余量，避免刚构建完就因注册增长而重建
+                capacity = max(capacity, int(self.count() * 1.25))
+            bloom = None
+            while bloom is None or bloom.count > bloom.capacity:
+                # 已有用户数超过预估容量时按实际数量的两倍重新构建
+                capacity = capacity if bloom is None else bloom.count * 2
+                bloom = BloomFilter(capacity, self.error_rate)
+                last_id = 0
+                for user_id, username, email in self.load():
+                    for key in self._keys(username, email):
+                        bloom.add(key)
+                    last_id = max(last_id, user_id)
+            with self.lock:
+                for key in self.pending:
+                    bloom.add(key)
+                self.pending = []
+                self.filter = bloom
+                self.last_id = max(self.last_id, last_id)
+                self.builds += 1
+            self.logger.info(f"用户名索引构建完成: {bloom.count} 项, 容量 {bloom.capacity}, {len(bloom.bits)} 字节")
+        except Exception as e:
+            self.logger.error(f"用户名索引构建失败: {str(e)}")
+        finally:
+            with self.lock:
+                self.building = False
+                if self.filter is None:
+                    self.pending = []
+            self.built.set()
+
+    def _start_build(self, capacity):
+        """在后台线程构建过滤器，调用方需持有锁"""
+        if self.building:
+            return
+        self.building = True
+        threading.Thread(target=self._build, args=(capacity,), name='user-index-build', daemon=True).start()
+
+    def start(self):
+        """开始在后台构建索引（已构建或正在构建时不做任何事）"""
+        with self.lock:
+            if self.filter is None:
+                self._start_build(self.min_capacity)
+
+    def wait_ready(self, timeout=None):
+        """等待首次构建结束，返回是否可用；主要用于测试和基准"""
+        self.start()
+        self.built.wait(timeout)
+        with self.lock:
+            return self.filter is not None
+
+    def _catch_up(self):
+        """
+        写入ID大于已索引最大ID的用户（其它进程注册或导入的），返回新增的用户数
+        距上次查询不足 sync_interval 秒、或另一个线程正在查询时直接返回0
+        """
+        if self.load_since is None or not self.sync_lock.acquire(blocking=False):
+            return 0
+        try:
+            now = time.monotonic()
+            with self.lock:
+                if self.synced_at is not None and now - self.synced_at < self.sync_interval:
+                    return 0
+                self.synced_at = now
+                self.sync_queries += 1
+                last_id = self.last_id
+            # 查询期间不持有 self.lock，其它线程的判断照常用内存中的过滤器
+            rows = list(self.load_since(last_id))
+        finally:
+            self.sync_lock.release()
+        if not rows:
+            return 0
+        with self.lock:
+            for user_id, username, email in rows:
+                keys = self._keys(username, email)
+                if self.building:
+                    # 重建读取的快照可能不包含这些用户
+                    self.pending.extend(keys)
+                for key in keys:
+                    self.filter.add(key)
+                self.last_id = max(self.last_id, user_id)
+            self.synced += len(rows)
+        return len(rows)
+
+    def might_exist(self, username=None, email=None):
+        """用户名或邮箱是否可能已被使用"""
+        keys = self._keys(username, email)
+        with self.lock:
+            bloom = self.filter
+            if bloom is None:
+                self.unavailable += 1
+                self._start_build(self.min_capacity)
+                return True
+            found = any(key in bloom for key in keys)
+        # 判断不存在之前补充其它进程注册的用户（按间隔限频）
+        if not found and self._catch_up():
+            with self.lock:
+                found = any(key in self.filter for key in keys)
+        with self.lock:
+            if found:
+                self.positives += 1
+            else:
+                self.negatives += 1
+        return found
+
+    def record_false_positive(self):
+        """过滤器判断可能存在但数据库确认不存在（过滤器尚未构建时不计入）"""
+        with self.lock:
+            if self.filter is not None:
+                self.false_positives += 1
+
+    def add(self, username, email=None):
+        """注册成功后写入"""
+        keys = self._keys(username, email)
+        with self.lock:
+            if self.building:
+                self.pending.extend(keys)
+            bloom = self.filter
+            if bloom is None:
+                return
+            for key in keys:
+                bloom.add(key)
+            if bloom.count > bloom.capacity:
+                # 超出容量后误判率上升，按两倍容量重建；重建期间继续使用旧过滤器
+                self._start_build(bloom.capacity * 2)
+
+    def stats(self):
+        with self.lock:
+            bloom = self.filter
+            return {
+                'ready': bloom is not None,
+                'building': self.building,
+                'items': bloom.count if bloom else 0,
+                'capacity': bloom.capacity if bloom else 0,
+                'bytes': len(bloom.bits) if bloom else 0,
+                'negatives': self.negatives,
+                'positives': self.positives,
+                'false_positives': self.false_positives,
+                'unavailable': self.unavailable,
+                'builds': self.builds,
+                'last_id': self.last_id,
+                'synced': self.synced,
+                'sync_queries': self.sync_queries
+            }
@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端视频源聚合搜索
+- 并发请求所有选中的源，单个源超时不影响其它源；超时从该源真正开始请求时计算，
+  在线程池中排队过久的源标记为 busy，这样的结果不缓存
+- 每个源一个熔断器，连续失败后暂停请求该源，冷却后放行一次试探请求
+- 结果按源合并去重，按 (关键词, 源集合) 缓存；相同的搜索正在进行时共享同一次并发请求
+- 可按源返回先后逐个产出结果，用于流式响应
+- 详情查询：同一个源的多个ID合并为一次 ids=a,b,c 请求，解析后的剧集列表带TTL缓存，
+  过期后先返回旧值再在后台刷新（stale-while-revalidate）
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import quote, urlsplit
+
+from media_proxy import ProxyError
+from ttl_cache import TTLCache
+
+
+# 与 js/config.js 中的 API_SITES 保持一致
+DEFAULT_API_SITES = {
+    'mozhua': {'api': 'https://mozhuazy.com', 'name': '魔爪资源'},
+    'mdzy': {'api': 'https://www.mdzyapi.com', 'name': '魔都资源'},
+    'xinlang': {'api': 'https://api.xinlangapi.com/xinlangapi.php/provide/vod', 'name': '新浪资源'},
+    'wolong': {'api': 'https://wolongzyw.com', 'name': '卧龙资源'},
+    'dyttzy': {'api': 'https://caiji.dyttzyapi.com', 'name': '电影天堂资源', 'detail': 'https://caiji.dyttzyapi.com'},
+    'ruyi': {'api': 'https://cj.rycjapi.com', 'name': '如意资源'},
+    'bfzy': {'api': 'https://bfzyapi.com', 'name': '暴风资源'},
+    'tyyszy': {'api': 'https://tyyszy.com', 'name': '天涯资源'},
+    'ffzy': {'api': 'http://ffzy5.tv', 'name': '非凡影视', 'detail': 'http://ffzy5.tv'},
+    'zy360': {'api': 'https://360zy.com', 'name': '360资源'},
+    'hwba': {'api': 'https://cjhwba.com', 'name': '华为吧资源'},
+    'jisu': {'api': 'https://jszyapi.com', 'name': '极速资源', 'detail': 'https://jszyapi.com'},
+    'lzi': {'api': 'https://cj.lziapi.com', 'name': '量子资源'},
+    'p2100': {'api': 'https://p2100.net', 'name': '飘零影院'},
+    'ckzy': {'api': 'https://www.ckzy1.com', 'name': 'CK资源', 'adult': True},
+    'jkun': {'api': 'https://jkunzyapi.com', 'name': 'jkun资源', 'adult': True},
+    'bwzy': {'api': 'https://api.bwzym3u8.com', 'name': '百万资源', 'adult': True},
+    'souav': {'api': 'https://api.souavzy.vip', 'name': 'souav资源', 'adult': True},
+    'r155': {'api': 'https://155api.com', 'name': '155资源', 'adult': True},
+    'lsb': {'api': 'https://apilsbzy1.com', 'name': 'lsb资源', 'adult': True},
+    'huangcang': {'api': 'https://hsckzy.vip', 'name': '黄色仓库', 'adult': True, 'detail': 'https://hsckzy.vip'},
+    'yutu': {'api': 'https://yutuzy10.com', 'name': '玉兔资源', 'adult': True},
+    'naixx': {'api': 'https://naixxzy.com', 'name': '奶昔资源', 'adult': True},
+}
+
+# 与 js/config.js 中的 API_CONFIG 保持一致
+SEARCH_PATH = '/api.php/provide/vod/?ac=videolist&wd='
+DETAIL_PATH = '/api.php/provide/vod/?ac=videolist&ids='
+API_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': 'application/json'
+}
+
+
+# 与 js/api.js 中的 VIDEO_URL_RE 保持一致
+VIDEO_URL_RE = re.compile(r"""https?://[^\s'"$#<>]+?\.(m3u8|mp4|flv|avi|mkv|mov|wmv)(\?[^'"\s#<>]*)?""", re.IGNORECASE)
+VIDEO_EXT_RE = re.compile(r'\.(m3u8|mp4|flv|avi|mkv|mov|wmv)(?=$|\?|#)', re.IGNORECASE)
+# 详情页HTML中的m3u8链接（handleSpecialSourceDetail）
+FFZY_M3U8_RE = re.compile(r"""\$(https?://[^"'\s]+?/\d{8}/\d+_[a-f0-9]+/index\.m3u8)""")
+GENERAL_M3U8_RE = re.compile(r"""\$(https?://[^"'\s]+?\.m3u8)""")
+VOD_ID_RE = re.compile(r'^[\w-]+$')
+
+
+class SourceError(Exception):
+    """视频源返回错误或数据格式无效"""
+
+
+def build_api_url(base_api, path_with_query, value):
+    """与前端 buildApiUrl 相同：纯域名拼接完整路径，已带路径的只拼查询参数"""
+    base = (base_api or '').rstrip('/')
+    query_template = path_with_query.split('?', 1)[1] if '?' in path_with_query else ''
+    if urlsplit(base_api).path in ('', '/'):
+        return f'{base}{path_with_query}{value}'
+    if '?' in base:
+        separator = '' if base.endswith(('?', '&')) else '&'
+    else:
+        separator = '?'
+    return f'{base}{separator}{query_template}{value}'
+
+
+def unique(items):
+    """去重并保持顺序"""
+    return list(dict.fromkeys(items))
+
+
+def extract_video_episodes_from_block(block):
+    """从单个播放源块中提取视频直链"""
+    if not block:
+        return []
+    urls = []
+    for episode in block.replace('&amp;', '&').split('#'):
+        last_part = episode.split('$')[-1].strip()
+        urls.extend(match.group(0) for match in VIDEO_URL_RE.finditer(last_part))
+    return [url for url in unique(url.strip() for url in urls) if re.match(r'^https?://', url, re.IGNORECASE)]
+
+
+def filter_by_dominant_extension(urls):
+    """只保留数量最多的那种后缀的链接"""
+    counter = {}
+    for url in urls:
+        match = VIDEO_EXT_RE.search(url)
+        if match:
+            ext = match.group(1).lower()
+            counter[ext] = counter.get(ext, 0) + 1
+    if not counter:
+        return []
+    dominant = max(counter, key=counter.get)
+    return [url for url in urls if f'.{dominant}' in url.lower()]
+
+
+def pick_primary_video_episodes(play_url):
+    """与前端 pickPrimaryVideoEpisodes 相同：选剧集最多的播放源"""
+    best = []
+    for block in filter(None, play_url.split('$$$')):
+        episodes = extract_video_episodes_from_block(block)
+        if len(episodes) > len(best):
+            best = episodes
+    if not best:
+        best = unique(match.group(0) for match in VIDEO_URL_RE.finditer(play_url.replace('&amp;', '&')))
+    return filter_by_dominant_extension(best)
+
+
+def parse_detail_item(item, code, source_name, detail_url):
+    """把 videolist 接口返回的单个条目解析成前端 /api/detail 的响应结构"""
+    episodes = pick_primary_video_episodes(item.get('vod_play_url') or '')
+    if not episodes and item.get('vod_content'):
+        content = item['vod_content'].replace('&amp;', '&')
+        episodes = filter_by_dominant_extension(unique(match.group(0) for match in VIDEO_URL_RE.finditer(content)))
+    return {
+        'code': 200,
+        'episodes': episodes,
+        'detailUrl': detail_url,
+        'videoInfo': {
+            'title': item.get('vod_name'),
+            'cover': item.get('vod_pic'),
+            'desc': item.get('vod_content'),
+            'type': item.get('type_name'),
+            'year': item.get('vod_year'),
+            'area': item.get('vod_area'),
+            'director': item.get('vod_director'),
+            'actor': item.get('vod_actor'),
+            'remarks': item.get('vod_remarks'),
+            'source_name': source_name,
+            'source_code': code
+        }
+    }
+
+
+def _html_text(pattern, html, flags=0):
+    match = re.search(pattern, html, flags)
+    return match.group(1) if match else ''
+
+
+def parse_detail_html(html, code, source_name, detail_url):
+    """解析带 detail 地址的源的详情页HTML，与前端 handleSpecialSourceDetail 相同"""
+    matches = []
+    if code == 'ffzy':
+        matches = FFZY_M3U8_RE.findall(html)
+    if not matches:
+        matches = GENERAL_M3U8_RE.findall(html)
+    episodes = unique(link.split('(', 1)[0] if link.find('(') > 0 else link for link in unique(matches))
+
+    desc = ''
+    desc_block = _html_text(r"""<div[^>]*class=["']max-h-\[290px\][^>]*>([\s\S]*?)</div>""", html)
+    if desc_block:
+        desc = _html_text(r'<p>([\s\S]*?)</p>', desc_block).strip()
+    video_type = _html_text(r'<td[^>]*>\s*类型[^<]*</td>\s*<td[^>]*>([\s\S]*?)</td>', html)
+    video_type = re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', '', video_type)).replace('&nbsp;', '').strip()
+    return {
+        'code': 200,
+        'episodes': episodes,
+        'detailUrl': detail_url,
+        'videoInfo': {
+            'title': _html_text(r'<h1[^>]*>([^<]+)</h1>', html).strip(),
+            'desc': desc,
+            'source_name': source_name,
+            'source_code': code,
+            'cover': _html_text(r"""<main[\s\S]*?<img[^>]*src=["']([^"']+)["'][^>]*>""", html, re.IGNORECASE),
+            'type': video_type,
+            'year': _html_text(r'<td[^>]*>\s*年代[^<]*</td>\s*<td[^>]*>([^<]+)</td>', html).strip()
+        }
+    }
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败 failure_threshold 次后打开，reset_timeout 秒内拒绝请求，
+    之后放行一次试探请求，成功则关闭，失败则重新计时
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.probing else 'open'
+
+
+class SearchFanout:
+    """一次 (关键词, 源集合) 的并发搜索，结果按完成先后追加，等待者通过 condition 逐个取出"""
+
+    def __init__(self, key, codes):
+        self.key = key
+        self.codes = codes
+        self.condition = threading.Condition()
+        self.results = []
+        # 源 -> 提交到线程池的时间 / 开始请求的时间
+        self.submitted = {}
+        self.started = {}
+        self.futures = {}
+        self.finished = set()
+        self.done = False
+
+
+class SearchAggregator:
+    """聚合搜索：共享媒体代理的上游连接池，线程池并发请求各个源"""
+
+    def __init__(self, proxy, sites=None, timeout=8.0, max_workers=16, queue_timeout=2.0, cache_ttl=600,
+                 partial_cache_ttl=60, cache_max_entries=1000, max_results=10000,
+                 breaker_threshold=3, breaker_reset=60, logger=None):
+        self.proxy = proxy
+        self.sites = sites if sites is not None else DEFAULT_API_SITES
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.partial_cache_ttl = partial_cache_ttl
+        self.max_results = max_results
+        self.logger = logger or logging.getLogger(__name__)
+        # 线程数不少于源的数量，一次全源搜索自身不会排队
+        self.executor = ThreadPoolExecutor(max_workers=max(max_workers, len(self.sites)),
+                                           thread_name_prefix='source-search')
+        self.cache = TTLCache(max_entries=cache_max_entries, ttl=cache_ttl)
+        self.breakers = {code: CircuitBreaker(breaker_threshold, breaker_reset) for code in self.sites}
+        self.lock = threading.Lock()
+        # 进行中的搜索：缓存键 -> SearchFanout
+        self.inflight = {}
+        self.fanouts = 0
+        self.merged = 0
+        self.queue_expired = 0
+
+    def resolve_sources(self, codes):
+        """过滤未知的源；未指定时使用全部非成人源"""
+        if not codes:
+            return [code for code, site in self.sites.items() if not site.get('adult')]
+        resolved = []
+        for code in codes:
+            if code in self.sites and code not in resolved:
+                resolved.append(code)
+        return resolved
+
+    def fetch_json(self, url, timeout=None):
+        """通过媒体代理请求视频源接口并解析JSON"""
+        upstream = self.proxy.open('GET', url, API_HEADERS, timeout=timeout)
+        if upstream.status != 200:
+            upstream.close()
+            raise SourceError(f'接口返回 {upstream.status}')
+        try:
+            return json.loads(upstream.read().decode('utf-8-sig'))
+        except ValueError:
+            raise SourceError('接口返回的不是有效JSON')
+
+    def _search_source(self, code, query):
+        """请求单个源，成功与否都记入该源的熔断器；超时后才返回的结果也算失败"""
+        site = self.sites[code]
+        breaker = self.breakers[code]
+        start = time.monotonic()
+        try:
+            # 上游超时与聚合超时一致，超时的源尽快让出线程
+            data = self.fetch_json(build_api_url(site['api'], SEARCH_PATH, quote(query, safe='')),
+                                   timeout=self.timeout)
+            if not isinstance(data, dict) or not isinstance(data.get('list'), list):
+                raise SourceError('返回的数据格式无效')
+        except (ProxyError, SourceError) as e:
+            breaker.record_failure()
+            self.logger.debug(f"视频源 {code} 搜索失败: {str(e)}")
+            raise
+
+        if time.monotonic() - start > self.timeout:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        items, seen = [], set()
+        for item in data['list']:
+            if not isinstance(item, dict):
+                continue
+            vod_id = str(item.get('vod_id', ''))
+            if vod_id and vod_id in seen:
+                continue
+            seen.add(vod_id)
+            items.append(dict(item, source_name=site['name'], source_code=code))
+        return items
+
+    @staticmethod
+    def cache_key(query, codes):
+        return query.strip().lower(), tuple(sorted(codes))
+
+    def lookup(self, query, codes):
+        """返回缓存的 [(源, 状态, 结果列表)]，未命中返回 None"""
+        return self.cache.get(self.cache_key(query, codes))
+
+    def stream(self, query, codes):
+        """
+        并发搜索各个源，按返回先后产出 (源, 状态, 结果列表)
+        状态: ok / error / timeout / open（熔断中，未请求）/ busy（排队超过 queue_timeout，未请求）
+        相同的搜索正在进行时加入已有的请求；全部产出后写入缓存，有源失败时只短暂缓存，有源排队超时不缓存
+        """
+        key = self.cache_key(query, codes)
+        with self.lock:
+            fanout = self.inflight.get(key)
+            if fanout is None:
+                fanout = self.inflight[key] = SearchFanout(key, list(codes))
+                self.fanouts += 1
+                leader = True
+            else:
+                self.merged += 1
+                leader = False
+        if leader:
+            self._start(fanout, query)
+
+        index = 0
+        while True:
+            with fanout.condition:
+                while index == len(fanout.results) and not fanout.done:
+                    deadline = self._expire(fanout, time.monotonic())
+                    if index < len(fanout.results) or fanout.done:
+                        break
+                    fanout.condition.wait(max(0.0, deadline - time.monotonic()))
+                batch = fanout.results[index:]
+                done = fanout.done
+            index += len(batch)
+            yield from batch
+            if done and index == len(fanout.results):
+                return
+
+    def _start(self, fanout, query):
+        with fanout.condition:
+            for code in fanout.codes:
+                if self.breakers[code].allow():
+                    fanout.submitted[code] = time.monotonic()
+                    fanout.futures[code] = self.executor.submit(self._run, fanout, code, query)
+                else:
+                    self._finish(fanout, code, 'open', [])
+            if not fanout.futures:
+                self._complete(fanout)
+
+    def _run(self, fanout, code, query):
+        """线程池中执行：从这里开始计算该源的超时"""
+        with fanout.condition:
+            if code in fanout.finished:
+                return
+            fanout.started[code] = time.monotonic()
+        try:
+            status, items = 'ok', self._search_source(code, query)
+        except Exception:
+            status, items = 'error', []
+        with fanout.condition:
+            if code not in fanout.finished:
+                self._finish(fanout, code, status, items)
+                if len(fanout.finished) == len(fanout.codes):
+                    self._complete(fanout)
+
+    def _expire(self, fanout, now):
+        """
+        把开始请求后超过 timeout 的源标记为 timeout，排队超过 queue_timeout 的源取消并标记为 busy，
+        返回下一个到期时间；调用方需持有 fanout.condition
+        """
+        deadline = now + self.timeout
+        for code, submitted in fanout.submitted.items():
+            if code in fanout.finished:
+                continue
+            started = fanout.started.get(code)
+            if started is not None:
+                if now >= started + self.timeout:
+                    self._finish(fanout, code, 'timeout', [])
+                else:
+                    deadline = min(deadline, started + self.timeout)
+            elif now >= submitted + self.queue_timeout:
+                fanout.futures[code].cancel()
+                with self.lock:
+                    self.queue_expired += 1
+                self._finish(fanout, code, 'busy', [])
+            else:
+                deadline = min(deadline, submitted + self.queue_timeout)
+        if not fanout.done and len(fanout.finished) == len(fanout.codes):
+            self._complete(fanout)
+        return deadline
+
+    @staticmethod
+    def _finish(fanout, code, status, items):
+        fanout.finished.add(code)
+        fanout.results.append((code, status, items))
+        fanout.condition.notify_all()
+
+    def _complete(self, fanout):
+        """所有源都有结果后写入缓存并移出进行中列表，调用方需持有 fanout.condition"""
+        fanout.done = True
+        fanout.condition.notify_all()
+        results = fanout.results
+        statuses = [status for _, status, _ in results]
+        # 因排队而没有请求的源不代表该源没有结果，不缓存
+        if 'ok' in statuses and 'busy' not in statuses:
+            complete = all(status == 'ok' for status in statuses)
+            self.cache.put(fanout.key, list(results), ttl=None if complete else self.partial_cache_ttl)
+        with self.lock:
+            if self.inflight.get(fanout.key) is fanout:
+                del self.inflight[fanout.key]
+
+    def merge(self, results, codes):
+        """按请求的源顺序合并结果，截断到 max_results"""
+        by_source = {code: items for code, _, items in results}
+        merged = []
+        for code in codes:
+            merged.extend(by_source.get(code, []))
+        return merged[:self.max_results]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            inflight = len(self.inflight)
+            fanouts = self.fanouts
+            merged = self.merged
+            queue_expired = self.queue_expired
+        return {
+            'cache': self.cache.stats(),
+            'breakers': {code: breaker.state for code, breaker in self.breakers.items()},
+            'inflight': inflight,
+            'fanouts': fanouts,
+            'merged': merged,
+            'queue_expired': queue_expired
+        }
+
+
+class DetailService:
+    """
+    视频详情查询
+    - 同一个源的多个ID合并为一次 ids=a,b,c 请求（每批最多 max_batch 个）
+    - 配置了 detail 地址的源按前端的方式逐个请求详情页HTML
+    - 解析结果按 (源, ID) 缓存；过期后在 stale_ttl 内先返回旧值，同时在后台刷新
+    """
+
+    def __init__(self, proxy, sites=None, timeout=10.0, max_workers=8, max_batch=20,
+                 cache_ttl=1800, stale_ttl=24 * 3600, cache_max_entries=5000, logger=None):
+        self.proxy = proxy
+        self.sites = sites if sites is not None else DEFAULT_API_SITES
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.logger = logger or logging.getLogger(__name__)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='source-detail')
+        self.cache = TTLCache(max_entries=cache_max_entries, ttl=cache_ttl, stale_ttl=stale_ttl)
+        self.lock = threading.Lock()
+        # 正在后台刷新的 (源, ID)
+        self.refreshing = set()
+        self.upstream_requests = 0
+
+    def fetch_text(self, url, headers):
+        upstream = self.proxy.open('GET', url, headers)
+        with self.lock:
+            self.upstream_requests += 1
+        if upstream.status != 200:
+            upstream.close()
+            raise SourceError(f'详情请求失败: {upstream.status}')
+        return upstream.read().decode('utf-8-sig', errors='replace')
+
+    def _fetch_batch(self, code, ids):
+        """一次请求一个源的多个ID，返回 {ID: 详情}，并写入缓存"""
+        site = self.sites[code]
+        if site.get('detail'):
+            detail_url = f"{site['detail']}/index.php/vod/detail/id/{ids[0]}.html"
+            html = self.fetch_text(detail_url, {'User-Agent': API_HEADERS['User-Agent']})
+            details = {ids[0]: parse_detail_html(html, code, site['name'], detail_url)}
+        else:
+            detail_url = build_api_url(site['api'], DETAIL_PATH, quote(','.join(ids), safe=','))
+            try:
+                data = json.loads(self.fetch_text(detail_url, API_HEADERS))
+            except ValueError:
+                raise SourceError('详情接口返回的不是有效JSON')
+            if not isinstance(data, dict) or not isinstance(data.get('list'), list):
+                raise SourceError('获取到的详情内容无效')
+            details = {}
+            for item in data['list']:
+                if not isinstance(item, dict):
+                    continue
+                vod_id = str(item.get('vod_id', ''))
+                if vod_id in ids and vod_id not in details:
+                    single_url = build_api_url(site['api'], DETAIL_PATH, quote(vod_id, safe=''))
+                    details[vod_id] = parse_detail_item(item, code, site['name'], single_url)
+        for vod_id, detail in details.items():
+            self.cache.put((code, vod_id), detail)
+        return details
+
+    def _submit(self, code, ids):
+        """按批提交上游请求，返回 [(Future, ids)]"""
+        size = 1 if self.sites[code].get('detail') else self.max_batch
+        return [(self.executor.submit(self._fetch_batch, code, ids[i:i + size]), ids[i:i + size])
+                for i in range(0, len(ids), size)]
+
+    def _refresh(self, code, ids):
+        """后台刷新过期条目，同一条目同时只刷新一次"""
+        with self.lock:
+            ids = [vod_id for vod_id in ids if (code, vod_id) not in self.refreshing]
+            self.refreshing.update((code, vod_id) for vod_id in ids)
+        if not ids:
+            return
+
+        def done(future, batch):
+            with self.lock:
+                self.refreshing.difference_update((code, vod_id) for vod_id in batch)
+            if future.exception() is not None:
+                self.logger.debug(f"后台刷新详情失败: {code} {batch}: {str(future.exception())}")
+
+        for future, batch in self._submit(code, ids):
+            future.add_done_callback(lambda f, batch=batch: done(f, batch))
+
+    def get_details(self, items):
+        """
+        查询多个 (源, ID) 的详情，返回 {(源, ID): 详情}
+        失败或找不到的条目返回 {'code': 4xx/5xx, 'msg': ...}
+        """
+        results, missing, stale = {}, {}, {}
+        for code, vod_id in items:
+            if code not in self.sites:
+                results[(code, vod_id)] = {'code': 400, 'msg': '无效的API来源'}
+                continue
+            if not VOD_ID_RE.match(vod_id):
+                results[(code, vod_id)] = {'code': 400, 'msg': '无效的视频ID格式'}
+                continue
+            detail, fresh = self.cache.lookup((code, vod_id))
+            if detail is not None:
+                results[(code, vod_id)] = detail
+                if not fresh:
+                    stale.setdefault(code, []).append(vod_id)
+            elif vod_id not in missing.setdefault(code, []):
+                missing[code].append(vod_id)
+
+        for code, ids in stale.items():
+            self._refresh(code, unique(ids))
+
+        pending = [(code, future, batch) for code, ids in missing.items() if ids
+                   for future, batch in self._submit(code, ids)]
+        deadline = time.monotonic() + self.timeout
+        for code, future, batch in pending:
+            try:
+                details = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                error = None
+            except FutureTimeout:
+                # Python 3.11 之前 concurrent.futures.TimeoutError 不是内置 TimeoutError
+                details, error = {}, {'code': 504, 'msg': '详情请求超时'}
+            except (ProxyError, SourceError) as e:
+                details, error = {}, {'code': 502, 'msg': str(e)}
+            except OSError as e:
+                details, error = {}, {'code': 502, 'msg': f'详情请求失败: {str(e)}'}
+            for vod_id in batch:
+                results[(code, vod_id)] = details.get(vod_id) or error or {'code': 404, 'msg': '获取到的详情内容无效'}
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            refreshing = len(self.refreshing)
+            upstream_requests = self.upstream_requests
+        return {'cache': self.cache.stats(), 'refreshing': refreshing, 'upstream_requests': upstream_requests}
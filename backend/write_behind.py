@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LibreTV 后端写回缓冲（write-behind）
+按 (user_id, key) 合并写入，只保留最新值，定时或在积压过多时批量落库
+- 读己之写只在同一个工作进程内成立：保存后由另一个进程处理的读取，在本进程落库前（最多 flush_interval 秒）
+  读到的是数据库中的旧值
+- 每个进程的缓冲各自落库，同一个 key 先后由不同进程处理的两次保存落库顺序不确定；
+  每条写入记录到达时间，落库时只覆盖时间不晚于它的行，旧值不会覆盖新值
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+
+class WriteBehindBuffer:
+    """
+    写回缓冲
+    - put() 只写内存，同一个 (user_id, key) 的多次写入合并为一次
+    - get() 优先读取尚未落库的值，保证读己之写（仅限同一进程）
+    - 后台线程每 flush_interval 秒或积压达到 max_pending 时调用 flush_func 批量写入
+    - flush_func 接收 [(user_id, key, data, written_at), ...]，written_at 为 put() 时的时间戳，
+      应在一个事务中完成写入，并且不覆盖 written_at 更晚的行
+    """
+
+    def __init__(self, flush_func, flush_interval=2.0, max_pending=500, logger=None):
+        self.flush_func = flush_func
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.logger = logger or logging.getLogger(__name__)
+        # (user_id, key) -> (data, seq, written_at)，seq 单调递增，可作为未落库数据的版本号
+        self.pending = {}
+        # 正在落库的数据，落库完成前仍需对读可见
+        self.flushing = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.seq = itertools.count(1)
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.writes = 0
+        self.flushed_rows = 0
+        self.flush_count = 0
+
+    def start(self):
+        """启动后台落库线程"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name='history-write-behind', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """停止后台线程并落库所有剩余数据"""
+        self.stopped.set()
+        self.wakeup.set()
+        thread, self.thread = self.thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def put(self, user_id, key, data, written_at=None):
+        """写入缓冲，返回该值的版本号；written_at 默认为当前时间"""
+        if written_at is None:
+            written_at = time.time()
+        with self.lock:
+            seq = next(self.seq)
+            self.pending[(user_id, key)] = (data, seq, written_at)
+            self.writes += 1
+            over_limit = len(self.pending) >= self.max_pending
+        if over_limit:
+            self.wakeup.set()
+        return seq
+
+    def get(self, user_id, key):
+        """读取尚未落库的值，返回 (data, seq)，不存在时返回 None"""
+        with self.lock:
+            value = self.pending.get((user_id, key)) or self.flushing.get((user_id, key))
+        return value[:2] if value else None
+
+    def flush(self):
+        """把当前积压的数据批量落库，返回写入的行数"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                batch, self.pending = self.pending, {}
+                self.flushing = batch
+
+            try:
+                self.flush_func([(user_id, key, data, written_at)
+                                 for (user_id, key), (data, _, written_at) in batch.items()])
+            except Exception as e:
+                self.logger.error(f"观看历史批量落库失败，稍后重试: {str(e)}")
+                with self.lock:
+                    # 失败的数据放回缓冲，但不覆盖期间产生的更新值
+                    for item_key, value in batch.items():
+                        self.pending.setdefault(item_key, value)
+                    self.flushing = {}
+                return 0
+
+            with self.lock:
+                self.flushing = {}
+                self.flushed_rows += len(batch)
+                self.flush_count += 1
+            return len(batch)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def stats(self):
+        """缓冲统计：合并写入次数与实际落库行数"""
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'writes': self.writes,
+                'flushed_rows': self.flushed_rows,
+                'flush_count': self.flush_count
+            }